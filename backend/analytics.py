@@ -0,0 +1,188 @@
+"""Marketplace analytics rolled up into daily stats collections.
+
+``stats_daily_tasks`` holds, per day and category, tasks posted, accepted
+and completed that day, the median budget of tasks posted and the median
+time-to-accept of tasks accepted. ``stats_daily_payments`` holds GMV per day.
+The analytics endpoints read only these rollups.
+
+Each run finds the days touched by writes since the last watermark (the
+global ``sync_seq``), recomputes just those days with ``$merge``
+aggregations and advances the watermark. A recomputed day's rows are
+deleted first, so a day or category left with nothing to count (its tasks
+deleted, moved or no longer accepted) loses its row instead of keeping the
+old numbers. The first run rebuilds everything.
+In the app, runs come every ``ANALYTICS_ROLLUP_INTERVAL_SECONDS`` from
+whichever worker holds the ``analytics`` lease. ``$median`` needs MongoDB
+7.0 or newer.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+INTERVAL_SECONDS = float(os.environ.get("ANALYTICS_ROLLUP_INTERVAL_SECONDS", "300"))
+# Writes draw their sync_seq before they land; only settled ones move the watermark
+SETTLE_SECONDS = float(os.environ.get("ANALYTICS_SETTLE_SECONDS", "5"))
+SCAN_BATCH = 1000
+LEASE_NAME = "analytics"
+
+DAY_FORMAT = "%Y-%m-%d"
+TASKS_WATERMARK = "analytics:tasks"
+PAYMENTS_WATERMARK = "analytics:payments"
+
+Window = Tuple[Optional[datetime], Optional[datetime]]
+
+
+def _day(field: str) -> dict:
+    return {"$dateToString": {"format": DAY_FORMAT, "date": f"${field}"}}
+
+
+def _match(field: str, window: Window) -> dict:
+    start, end = window
+    if start is None:
+        return {"$match": {field: {"$ne": None}}}
+    return {"$match": {field: {"$gte": start, "$lt": end}}}
+
+
+def _by_day_and_category(field: str, window: Window, accumulators: dict, into: str) -> List[dict]:
+    return [
+        _match(field, window),
+        {"$group": {"_id": {"day": _day(field), "category": "$category"}, **accumulators}},
+        {"$set": {
+            "_id": {"$concat": ["$_id.day", ":", "$_id.category"]},
+            "day": "$_id.day",
+            "category": "$_id.category",
+        }},
+        # Each pipeline owns some fields of the day's document
+        {"$merge": {"into": into, "on": "_id", "whenMatched": "merge", "whenNotMatched": "insert"}},
+    ]
+
+
+def task_pipelines(window: Window, into: str) -> List[List[dict]]:
+    return [
+        _by_day_and_category("created_at", window, {
+            "posted": {"$sum": 1},
+            "median_budget": {"$median": {
+                "input": {"$divide": [{"$add": ["$budget_min", "$budget_max"]}, 2]},
+                "method": "approximate",
+            }},
+        }, into),
+        _by_day_and_category("accepted_at", window, {
+            "accepted": {"$sum": 1},
+            "median_time_to_accept_seconds": {"$median": {
+                "input": {"$divide": [{"$subtract": ["$accepted_at", "$created_at"]}, 1000]},
+                "method": "approximate",
+            }},
+        }, into),
+        _by_day_and_category("completed_at", window, {"completed": {"$sum": 1}}, into),
+    ]
+
+
+def payment_pipelines(window: Window, into: str) -> List[List[dict]]:
+    completed = {"$eq": ["$status", "completed"]}
+    return [[
+        _match("created_at", window),
+        # Every payment of the day is grouped so a refund can bring GMV back down
+        {"$group": {
+            "_id": _day("created_at"),
+            "payments": {"$sum": 1},
+            "completed_payments": {"$sum": {"$cond": [completed, 1, 0]}},
+            "gmv": {"$sum": {"$cond": [completed, "$amount", 0]}},
+        }},
+        {"$set": {"day": "$_id"}},
+        {"$merge": {"into": into, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]]
+
+
+def _day_range(window: Window) -> dict:
+    start, end = window
+    if start is None:
+        return {}
+    return {"day": {"$gte": start.strftime(DAY_FORMAT), "$lt": end.strftime(DAY_FORMAT)}}
+
+
+def _spans(days: Iterable[date]) -> List[Window]:
+    """Coalesce days into half-open ``[start, end)`` datetime windows."""
+    spans: List[List[date]] = []
+    for day in sorted(days):
+        if spans and spans[-1][1] == day:
+            spans[-1][1] = day + timedelta(days=1)
+        else:
+            spans.append([day, day + timedelta(days=1)])
+    return [(datetime.combine(start, time.min), datetime.combine(end, time.min)) for start, end in spans]
+
+
+async def _changed_days(repo, watermark: int, fields: List[str]) -> Tuple[Set[date], int]:
+    settled_before = datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)
+    projection = {"_id": 0, "sync_seq": 1, "updated_at": 1, **{field: 1 for field in fields}}
+    days: Set[date] = set()
+    while True:
+        batch = await repo.find(
+            {"sync_seq": {"$gt": watermark}}, projection, sort=[("sync_seq", 1)], limit=SCAN_BATCH
+        )
+        for document in batch:
+            if document.get("updated_at") and document["updated_at"] >= settled_before:
+                return days, watermark
+            days.update(document[field].date() for field in fields if document.get(field))
+            watermark = document["sync_seq"]
+        if len(batch) < SCAN_BATCH:
+            return days, watermark
+
+
+async def _recompute(source, rollups, pipelines, window: Window):
+    # $merge only writes the rows the window still produces
+    await rollups.delete_many(_day_range(window))
+    for pipeline in pipelines(window, rollups.collection_name):
+        await source.aggregate(pipeline)
+
+
+async def _roll_up(storage, source, watermark_name: str, fields: List[str], pipelines, rollups) -> int:
+    counters = storage.counters
+    watermark = await counters.current(watermark_name)
+    if watermark == 0:
+        upper = await storage.changes.current_seq()
+        # Let writes that drew a sequence up to ``upper`` land before the scan
+        await asyncio.sleep(SETTLE_SECONDS)
+        await _recompute(source, rollups, pipelines, (None, None))
+        if upper:
+            await counters.advance(watermark_name, upper)
+        return -1
+    days, last_seq = await _changed_days(source, watermark, fields)
+    for window in _spans(days):
+        await _recompute(source, rollups, pipelines, window)
+    if last_seq > watermark:
+        await counters.advance(watermark_name, last_seq)
+    return len(days)
+
+
+async def run_rollups(storage) -> Dict[str, int]:
+    """Refresh the rollups; returns the days recomputed (-1 for a rebuild)."""
+    totals = {
+        "task_days": await _roll_up(
+            storage, storage.tasks, TASKS_WATERMARK, ["created_at", "accepted_at", "completed_at"],
+            task_pipelines, storage.task_stats,
+        ),
+        "payment_days": await _roll_up(
+            storage, storage.payments, PAYMENTS_WATERMARK, ["created_at"],
+            payment_pipelines, storage.payment_stats,
+        ),
+    }
+    if any(totals.values()):
+        logger.info("analytics rollup %s", totals)
+    return totals
+
+
+async def run_periodically(storage, interval: float = INTERVAL_SECONDS, owner: Optional[str] = None):
+    owner = owner or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    while True:
+        try:
+            # Outlasts the interval, so the holder keeps running the rollups
+            if await storage.leases.acquire(LEASE_NAME, owner, 2 * interval):
+                await run_rollups(storage)
+        except Exception:
+            logger.exception("analytics rollup failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,246 @@
+"""Skill and title autocomplete from an in-memory prefix index.
+
+Suggestions come from the skills on user profiles and tasks
+(``User.skills``, ``Task.required_skills``) and from task titles. They are
+ranked by how many users and tasks use them. Matching ignores case and
+whitespace runs, and works from the start of any word, so ``q=sink``
+suggests "Fix leaking sink".
+
+Each kind keeps the word starts of its terms in one sorted list, so the
+terms under a prefix are one contiguous slice found by bisection. The top
+``AUTOCOMPLETE_MAX_RESULTS`` of each prefix asked for is kept and updated
+in place as counts grow, so repeated queries cost a dict lookup. The top
+lists of the shortest prefixes, which span the most terms, are computed
+with the index.
+
+The index is built at startup, with titles and task skills from tasks of
+the last ``AUTOCOMPLETE_TITLE_DAYS``. ``create_user``, ``update_user`` and
+``create_task`` update this worker's index as they write; updates made
+while a build runs are also replayed onto the index it produces, so the
+swap doesn't lose them. A rebuild every ``AUTOCOMPLETE_REBUILD_SECONDS``
+picks up the other workers' writes. Until the first build completes,
+queries return nothing.
+"""
+import asyncio
+import bisect
+import heapq
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = int(os.environ.get("AUTOCOMPLETE_MAX_RESULTS", "20"))
+TITLE_DAYS = float(os.environ.get("AUTOCOMPLETE_TITLE_DAYS", "90"))
+REBUILD_SECONDS = float(os.environ.get("AUTOCOMPLETE_REBUILD_SECONDS", "600"))
+# Prefixes this short cover the most terms; their top lists are built with the index
+WARM_DEPTH = int(os.environ.get("AUTOCOMPLETE_WARM_DEPTH", "2"))
+# Memoized prefixes per kind; the memo starts over when it outgrows this
+MEMO_SIZE = int(os.environ.get("AUTOCOMPLETE_MEMO_SIZE", "50000"))
+
+KINDS = ("skill", "title")
+_END = "\U0010ffff"
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _word_starts(key: str) -> List[str]:
+    words = key.split(" ")
+    return [" ".join(words[n:]) for n in range(len(words))]
+
+
+class PrefixIndex:
+    def __init__(self, max_results: int = MAX_RESULTS):
+        self.max_results = max_results
+        self._starts: List[Tuple[str, str]] = []  # (word start, term key), sorted
+        self._counts: Dict[str, int] = {}
+        self._display: Dict[str, str] = {}
+        self._top: Dict[str, List[str]] = {}
+
+    @classmethod
+    def build(cls, terms: Iterable[Tuple[str, int]], max_results: int = MAX_RESULTS) -> "PrefixIndex":
+        index = cls(max_results)
+        shown: Dict[str, int] = {}
+        for text, count in terms:
+            key = normalize(text)
+            if key and count > 0:
+                # Suggest the most used spelling
+                if count > shown.get(key, 0):
+                    index._display[key], shown[key] = " ".join(text.split()), count
+                index._counts[key] = index._counts.get(key, 0) + count
+        index._starts = sorted((start, key) for key in index._counts for start in _word_starts(key))
+        buckets: Dict[str, Set[str]] = defaultdict(set)
+        for start, key in index._starts:
+            for n in range(1, min(WARM_DEPTH, len(start)) + 1):
+                buckets[start[:n]].add(key)
+        for prefix, keys in buckets.items():
+            index._top[prefix] = heapq.nsmallest(max_results, keys, key=index._rank)
+        return index
+
+    def __len__(self):
+        return len(self._counts)
+
+    def _rank(self, key: str) -> Tuple[int, str]:
+        return -self._counts[key], key
+
+    def _prefixes(self, key: str) -> Set[str]:
+        return {start[:n] for start in _word_starts(key) for n in range(1, len(start) + 1)}
+
+    def add(self, text: str, count: int = 1):
+        """Count ``text`` ``count`` more times; a negative count takes uses away."""
+        key = normalize(text)
+        if not key or not count:
+            return
+        if key not in self._counts:
+            if count < 0:
+                return
+            self._counts[key] = 0
+            self._display[key] = " ".join(text.split())
+            for start in _word_starts(key):
+                bisect.insort(self._starts, (start, key))
+        self._counts[key] += count
+        if count > 0:
+            self._promote(key)
+            return
+        # A term losing uses can drop out of a top list; recompute those lazily
+        for prefix in self._prefixes(key):
+            top = self._top.get(prefix)
+            if top is not None and key in top:
+                del self._top[prefix]
+        if self._counts[key] <= 0:
+            del self._counts[key], self._display[key]
+            for start in _word_starts(key):
+                del self._starts[bisect.bisect_left(self._starts, (start, key))]
+
+    def _promote(self, key: str):
+        rank = self._rank
+        for prefix in self._prefixes(key):
+            top = self._top.get(prefix)
+            if top is None:
+                continue
+            if key not in top:
+                # A short list already holds every term under the prefix
+                if len(top) < self.max_results:
+                    top.append(key)
+                elif rank(key) < rank(top[-1]):
+                    top[-1] = key
+                else:
+                    continue
+            top.sort(key=rank)
+
+    def search(self, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        top = self._top.get(prefix)
+        if top is None:
+            start = bisect.bisect_left(self._starts, (prefix,))
+            end = bisect.bisect_left(self._starts, (prefix + _END,), start)
+            keys = {key for _, key in self._starts[start:end]}
+            top = heapq.nsmallest(self.max_results, keys, key=self._rank)
+            if len(self._top) >= MEMO_SIZE:
+                self._top.clear()
+            self._top[prefix] = top
+        return [(self._display[key], self._counts[key]) for key in top[:limit]]
+
+
+class Autocomplete:
+    def __init__(self, storage):
+        self.storage = storage
+        self.indexes: Dict[str, PrefixIndex] = {kind: PrefixIndex() for kind in KINDS}
+        self.built_at: Optional[datetime] = None
+        self.build_ms: Optional[float] = None
+        self.queries = 0
+        # Live updates made while a build runs, as (kind, text, count)
+        self._pending: Optional[List[Tuple[str, str, int]]] = None
+
+    def search(self, kind: str, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        self.queries += 1
+        return self.indexes[kind].search(prefix, limit)
+
+    def _add(self, kind: str, text: str, count: int = 1):
+        self.indexes[kind].add(text, count)
+        if self._pending is not None:
+            self._pending.append((kind, text, count))
+
+    def user_skills(self, before: Iterable[str], after: Iterable[str]):
+        before = {normalize(skill): skill for skill in before}
+        after = {normalize(skill): skill for skill in after}
+        for key in after.keys() - before.keys():
+            self._add("skill", after[key], 1)
+        for key in before.keys() - after.keys():
+            self._add("skill", before[key], -1)
+
+    def task_posted(self, task: dict):
+        self._add("title", task["title"])
+        for skill in {normalize(skill): skill for skill in task.get("required_skills") or []}.values():
+            self._add("skill", skill)
+
+    async def build(self):
+        started = time.monotonic()
+        self._pending = []
+        try:
+            indexes = await self._build_indexes()
+            # Writes that landed before the aggregates read them are counted
+            # twice until the next build; dropping them would hide new terms
+            for kind, text, count in self._pending:
+                indexes[kind].add(text, count)
+            self.indexes = indexes
+        finally:
+            self._pending = None
+        self.built_at = datetime.utcnow()
+        self.build_ms = round((time.monotonic() - started) * 1000, 1)
+        logger.info(
+            "autocomplete built with %d skills and %d titles in %.0f ms",
+            len(self.indexes["skill"]), len(self.indexes["title"]), self.build_ms,
+        )
+
+    async def _build_indexes(self) -> Dict[str, PrefixIndex]:
+        recent = {"$match": {"created_at": {"$gte": datetime.utcnow() - timedelta(days=TITLE_DAYS)}}}
+
+        def counted(field: str):
+            return {"$group": {"_id": f"${field}", "count": {"$sum": 1}}}
+
+        user_skills = await self.storage.users.aggregate([{"$unwind": "$skills"}, counted("skills")])
+        task_skills = await self.storage.tasks.aggregate([recent, {"$unwind": "$required_skills"}, counted("required_skills")])
+        titles = await self.storage.tasks.aggregate([recent, counted("title")])
+
+        def terms(groups: List[dict]):
+            return ((group["_id"], group["count"]) for group in groups if isinstance(group["_id"], str))
+
+        # Off the event loop: a large index takes a while to sort
+        return {
+            "skill": await asyncio.to_thread(PrefixIndex.build, [*terms(user_skills), *terms(task_skills)]),
+            "title": await asyncio.to_thread(PrefixIndex.build, list(terms(titles))),
+        }
+
+    async def run(self):
+        while True:
+            try:
+                await self.build()
+            except Exception:
+                logger.exception("autocomplete build failed")
+            if REBUILD_SECONDS <= 0 and self.built_at is not None:
+                return
+            await asyncio.sleep(REBUILD_SECONDS if REBUILD_SECONDS > 0 else 30)
+
+    def stats(self) -> dict:
+        return {
+            "terms": {kind: len(index) for kind, index in self.indexes.items()},
+            "queries": self.queries,
+            "build_ms": self.build_ms,
+            "built_at": self.built_at.isoformat() if self.built_at else None,
+        }
+
+
+def install(storage) -> Autocomplete:
+    service = Autocomplete(storage)
+    metrics.register("autocomplete", service.stats)
+    return service
@@ -0,0 +1,104 @@
+"""Bring documents written before delta sync into it.
+
+Delta sync (``GET /api/sync``) only returns documents that carry a
+``sync_seq``, and finds bids on a user's tasks through the ``client_id``
+copied onto each bid. Documents written before either existed have neither,
+so a client syncing from scratch never receives them. This script:
+
+- copies each task's ``client_id`` onto its bids;
+- gives every tracked document without a ``sync_seq`` one from the global
+  change sequence, plus ``updated_at`` (its ``created_at``) and ``version``
+  0 (what its ETag has been served with so far) where those are missing.
+
+The new sequence numbers come after every existing sync token, so clients
+that synced before also receive these documents once. ``updated_at`` keeps
+its old value, so the settle window doesn't hold them back. Running the
+script again only touches what is still missing, so an interrupted run can
+simply be restarted::
+
+    python backfill_sync.py
+    python backfill_sync.py --dry-run   # counts only
+"""
+import argparse
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from typing import Dict
+
+from dotenv import load_dotenv
+
+from storage import create_storage
+
+ROOT_DIR = Path(__file__).parent
+
+
+async def backfill_bid_clients(storage, batch: int = 1000, dry_run: bool = False) -> int:
+    missing = {"client_id": None}
+    if dry_run:
+        return await storage.task_bids.count(missing)
+    filled = 0
+    while True:
+        bids = await storage.task_bids.find(missing, {"id": 1, "task_id": 1}, limit=batch)
+        if not bids:
+            return filled
+        tasks = await storage.tasks.get_many(list({bid["task_id"] for bid in bids}), {"id": 1, "client_id": 1})
+        clients = {task["id"]: task["client_id"] for task in tasks}
+        # Bids of deleted tasks get "" so the next batch moves past them
+        await storage.task_bids.untracked.bulk_update([
+            ({"id": bid["id"]}, {"$set": {"client_id": clients.get(bid["task_id"], "")}})
+            for bid in bids
+        ])
+        filled += len(bids)
+
+
+async def backfill_sequence(repo, changes, batch: int = 1000, dry_run: bool = False) -> int:
+    missing = {"sync_seq": None}
+    if dry_run:
+        return await repo.count(missing)
+    stamped = 0
+    now = datetime.utcnow()
+    while True:
+        documents = await repo.find(missing, {"id": 1, "created_at": 1, "updated_at": 1, "version": 1}, limit=batch)
+        if not documents:
+            return stamped
+        last_seq = await changes.next_seq(len(documents))
+        first_seq = last_seq - len(documents) + 1
+        await repo.untracked.bulk_update([
+            (
+                {"id": document["id"]},
+                {"$set": {
+                    "sync_seq": first_seq + offset,
+                    "updated_at": document.get("updated_at") or document.get("created_at") or now,
+                    "version": document.get("version") or 0,
+                }},
+            )
+            for offset, document in enumerate(documents)
+        ])
+        stamped += len(documents)
+
+
+async def backfill(storage, batch: int = 1000, dry_run: bool = False) -> Dict[str, int]:
+    # Bids first, so they are stamped with their client_id already in place
+    totals = {"task_bids.client_id": await backfill_bid_clients(storage, batch, dry_run)}
+    for repo in storage.repositories().values():
+        if repo.tracks_changes:
+            totals[repo.collection_name] = await backfill_sequence(repo, storage.changes, batch, dry_run)
+    return totals
+
+
+async def main(args):
+    load_dotenv(ROOT_DIR / ".env")
+    storage = create_storage()
+    try:
+        totals = await backfill(storage, args.batch, args.dry_run)
+        for name, count in totals.items():
+            print(f"{name}: {count} {'to backfill' if args.dry_run else 'backfilled'}")
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill delta-sync fields on documents written before it.")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="count documents to backfill without writing")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,164 @@
+"""Cold-start profile: import time per module and time to first request.
+
+    python coldstart.py                       # phases and the slowest imports
+    python coldstart.py --top 40 --json cold.json
+    python coldstart.py --budget-ms 1500      # exit 1 when over budget
+
+A fresh interpreter is started with ``-X importtime``. It imports the app,
+runs the startup hooks and serves one request in-process. The report
+splits the wall time from spawn to first response into these phases:
+
+* ``interpreter_ms`` - interpreter start-up and ``site``.
+* ``import_ms`` - ``import server`` and everything it pulls in.
+* ``startup_ms`` - the startup hooks: storage client, indexes, jobs.
+* ``first_request_ms`` - the first request, which pays any lazy imports.
+
+Import times are broken down by module (self and cumulative, as in
+``-X importtime``) and by top-level package. ``heavy_loaded`` lists any
+``HEAVY_MODULES`` loaded by then; those should only appear once a feature
+that needs them is used. The environment is inherited, so run it with the
+``STORAGE_BACKEND`` and feature flags of the deployment being measured.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent
+
+# Packages that must not load on the way to the first request
+HEAVY_MODULES = ("pandas", "numpy", "boto3", "botocore", "brotli", "zstandard", "cProfile", "pstats")
+
+IMPORTS_DONE = "coldstart:imports-done"
+RESULT = "coldstart:result "
+
+_PROBE = """
+import time
+spawned = time.time()
+import sys
+import server
+imported = time.time()
+print({done!r}, file=sys.stderr, flush=True)
+
+import asyncio
+import json
+import httpx
+
+async def first_request():
+    started = time.time()
+    await server.app.router.startup()
+    ready = time.time()
+    try:
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://coldstart") as client:
+            response = await client.get({path!r})
+        served = time.time()
+    finally:
+        await server.app.router.shutdown()
+    return started, ready, served, response.status_code
+
+started, ready, served, status = asyncio.run(first_request())
+print({result!r} + json.dumps({{
+    "spawned": spawned, "imported": imported, "startup_started": started,
+    "ready": ready, "served": served, "status": status,
+    "heavy_loaded": sorted(name for name in {heavy!r} if name in sys.modules),
+}}), flush=True)
+"""
+
+
+def parse_importtime(lines: List[str]) -> List[dict]:
+    modules = []
+    for line in lines:
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # the header line
+        modules.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+        })
+    return modules
+
+
+def by_package(modules: List[dict]) -> Dict[str, float]:
+    totals: Dict[str, float] = defaultdict(float)
+    for module in modules:
+        totals[module["module"].split(".")[0]] += module["self_ms"]
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+def profile(path: str = "/api/", env: Optional[dict] = None) -> dict:
+    """Start a fresh interpreter and measure its way to the first response."""
+    probe = _PROBE.format(done=IMPORTS_DONE, result=RESULT, path=path, heavy=HEAVY_MODULES)
+    spawned = time.time()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", probe],
+        cwd=BACKEND_DIR, env={**os.environ, **(env or {})}, capture_output=True, text=True,
+    )
+    result_lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT)]
+    if process.returncode != 0 or not result_lines:
+        raise RuntimeError(f"cold-start probe failed ({process.returncode}):\n{process.stderr[-4000:]}")
+    timings = json.loads(result_lines[-1][len(RESULT):])
+
+    stderr = process.stderr.splitlines()
+    # Modules imported after the app (httpx for the probe itself) don't count
+    cutoff = stderr.index(IMPORTS_DONE) if IMPORTS_DONE in stderr else len(stderr)
+    modules = parse_importtime(stderr[:cutoff])
+
+    def ms(start: float, end: float) -> float:
+        return round((end - start) * 1000, 1)
+
+    return {
+        "path": path,
+        "status": timings["status"],
+        "phases": {
+            "interpreter_ms": ms(spawned, timings["spawned"]),
+            "import_ms": ms(timings["spawned"], timings["imported"]),
+            "startup_ms": ms(timings["startup_started"], timings["ready"]),
+            "first_request_ms": ms(timings["ready"], timings["served"]),
+        },
+        "time_to_first_response_ms": ms(spawned, timings["served"]),
+        "heavy_loaded": timings["heavy_loaded"],
+        "packages": by_package(modules),
+        "modules": modules,
+    }
+
+
+def print_report(report: dict, top: int):
+    print(f"cold start to first response for GET {report['path']} ({report['status']}): "
+          f"{report['time_to_first_response_ms']:.1f} ms")
+    for phase, value in report["phases"].items():
+        print(f"  {phase:<20}{value:>10.1f}")
+    print(f"\n{'package':<40}{'self ms':>10}")
+    for package, total in list(report["packages"].items())[:top]:
+        print(f"  {package:<38}{total:>10.1f}")
+    print(f"\n{'module':<60}{'self ms':>10}{'cumulative ms':>15}")
+    slowest = sorted(report["modules"], key=lambda module: -module["cumulative_ms"])[:top]
+    for module in slowest:
+        print(f"  {'  ' * module['depth'] + module['module']:<58}{module['self_ms']:>10.1f}{module['cumulative_ms']:>15.1f}")
+    if report["heavy_loaded"]:
+        print(f"\nheavy modules loaded before the first response: {', '.join(report['heavy_loaded'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default="/api/", help="route of the first request")
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--json", help="write the full report to this path")
+    parser.add_argument("--budget-ms", type=float, help="fail when time to first response exceeds this")
+    args = parser.parse_args()
+    report = profile(args.path)
+    print_report(report, args.top)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+    if args.budget_ms and report["time_to_first_response_ms"] > args.budget_ms:
+        print(f"\nover budget: {report['time_to_first_response_ms']:.1f} ms > {args.budget_ms:.1f} ms")
+        sys.exit(1)
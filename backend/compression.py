@@ -0,0 +1,263 @@
+"""Content-negotiated response compression.
+
+Responses are compressed with the best encoding the client accepts out of
+zstd, brotli and gzip. zstd and brotli are only offered when the
+``zstandard`` / ``brotli`` packages are installed, and are imported by the
+first response using them. Configuration:
+
+* ``COMPRESSION_ENABLED`` - set to 0 to skip installing the middleware.
+* ``COMPRESSION_MIN_SIZE`` - complete bodies smaller than this many bytes
+  are sent as they are (default 1024).
+* ``COMPRESSION_GZIP_LEVEL`` / ``COMPRESSION_BROTLI_QUALITY`` /
+  ``COMPRESSION_ZSTD_LEVEL`` - compression levels (6 / 4 / 3).
+
+Streaming responses (more than one body message) are always compressed
+because their size is not known up front. Each chunk is flushed as it is
+compressed, so a client reading an export sees data while it is still
+being produced. Media types that are already compressed, event streams and
+responses that already carry a ``Content-Encoding`` pass through untouched.
+A strong ``ETag`` gets the encoding appended on compressed responses
+(``"3"`` becomes ``"3-gzip"``), because the bytes differ from the identity
+representation; ``etags`` reads such tags as the version they carry.
+"""
+import importlib
+import importlib.util
+import os
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+from etags import encoded_etag
+
+ENABLED = os.environ.get("COMPRESSION_ENABLED", "1") == "1"
+MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "4"))
+ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", "3"))
+
+# Media types not worth compressing again
+INCOMPRESSIBLE_PREFIXES = ("image/", "video/", "audio/", "font/woff")
+INCOMPRESSIBLE_TYPES = {
+    "application/gzip", "application/zip", "application/zstd", "application/x-brotli",
+    "application/x-7z-compressed", "application/x-rar-compressed", "application/pdf",
+    "application/octet-stream", "text/event-stream",
+}
+
+
+def _optional(name: str) -> bool:
+    # Only look the package up; it is imported when first used
+    return importlib.util.find_spec(name) is not None
+
+
+class GzipCompressor:
+    def __init__(self, level: int = GZIP_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, quality: int = BROTLI_QUALITY):
+        brotli = importlib.import_module("brotli")
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level: int = ZSTD_LEVEL):
+        zstandard = importlib.import_module("zstandard")
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        self._flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(self._flush_block)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+# Server preference when the client weighs encodings equally
+COMPRESSORS = {"gzip": GzipCompressor}
+if _optional("brotli"):
+    COMPRESSORS["br"] = BrotliCompressor
+if _optional("zstandard"):
+    COMPRESSORS["zstd"] = ZstdCompressor
+PREFERENCE = [name for name in ("zstd", "br", "gzip") if name in COMPRESSORS]
+
+
+def negotiate(accept_encoding: str, available: List[str] = PREFERENCE) -> Optional[str]:
+    """Pick an encoding from an ``Accept-Encoding`` header, or None for identity."""
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+    best, best_weight = None, 0.0
+    for name in available:
+        weight = weights.get(name, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = name, weight
+    return best
+
+
+def _compressible(headers: List[Tuple[bytes, bytes]]) -> bool:
+    for name, value in headers:
+        if name == b"content-encoding":
+            return False
+        if name == b"content-type":
+            media_type = value.decode("latin-1").split(";")[0].strip().lower()
+            if media_type.startswith(INCOMPRESSIBLE_PREFIXES) or media_type in INCOMPRESSIBLE_TYPES:
+                return False
+    return True
+
+
+def _vary(headers: List[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    for index, (name, value) in enumerate(headers):
+        if name == b"vary":
+            if b"accept-encoding" not in value.lower():
+                headers[index] = (name, value + b", Accept-Encoding")
+            return headers
+    return headers + [(b"vary", b"Accept-Encoding")]
+
+
+def _encoded_headers(headers: List[Tuple[bytes, bytes]], encoding: str) -> List[Tuple[bytes, bytes]]:
+    encoded = []
+    for name, value in headers:
+        if name == b"content-length":
+            continue
+        if name == b"etag":
+            value = encoded_etag(value, encoding)
+        encoded.append((name, value))
+    encoded.append((b"content-encoding", encoding.encode()))
+    return encoded
+
+
+class CompressionStats:
+    def __init__(self):
+        self.responses: Dict[str, int] = {}
+        self.bytes_in: Dict[str, int] = {}
+        self.bytes_out: Dict[str, int] = {}
+        self.skipped_small = 0
+
+    def record(self, encoding: str, bytes_in: int, bytes_out: int):
+        self.responses[encoding] = self.responses.get(encoding, 0) + 1
+        self.bytes_in[encoding] = self.bytes_in.get(encoding, 0) + bytes_in
+        self.bytes_out[encoding] = self.bytes_out.get(encoding, 0) + bytes_out
+
+    def snapshot(self) -> dict:
+        return {
+            "available": list(PREFERENCE),
+            "min_size": MIN_SIZE,
+            "skipped_small": self.skipped_small,
+            "encodings": {
+                encoding: {
+                    "responses": count,
+                    "bytes_in": self.bytes_in[encoding],
+                    "bytes_out": self.bytes_out[encoding],
+                    "ratio": round(self.bytes_out[encoding] / self.bytes_in[encoding], 3) if self.bytes_in[encoding] else None,
+                }
+                for encoding, count in sorted(self.responses.items())
+            },
+        }
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing eligible responses.
+
+    The start message is held back until the first body message shows
+    whether the response is complete and how large it is.
+    """
+
+    def __init__(self, app, min_size: int = MIN_SIZE, stats: Optional[CompressionStats] = None):
+        self.app = app
+        self.min_size = min_size
+        self.stats = stats or CompressionStats()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for name, value in scope.get("headers", ()):
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        encoding = negotiate(accept) if accept else None
+        if encoding is None or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+        passthrough = False
+        bytes_in = bytes_out = 0
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough, bytes_in, bytes_out
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", ()))
+                if message["status"] in (204, 304) or message["status"] < 200 or not _compressible(headers):
+                    passthrough = True
+                    await send(message)
+                    return
+                start = {**message, "headers": _vary(headers)}
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                if not more_body and len(body) < self.min_size:
+                    passthrough = True
+                    self.stats.skipped_small += 1
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = COMPRESSORS[encoding]()
+                await send({**start, "headers": _encoded_headers(start["headers"], encoding)})
+
+            bytes_in += len(body)
+            if more_body:
+                chunk = compressor.compress(body) if body else b""
+                if chunk:
+                    bytes_out += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                return
+            chunk = compressor.finish(body)
+            bytes_out += len(chunk)
+            self.stats.record(encoding, bytes_in, bytes_out)
+            await send({"type": "http.response.body", "body": chunk, "more_body": False})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def install(app):
+    if not ENABLED:
+        return
+    stats = CompressionStats()
+    app.add_middleware(CompressionMiddleware, stats=stats)
+    metrics.register("compression", stats.snapshot)
@@ -0,0 +1,142 @@
+"""Write-behind engagement counters and popularity ranking for tasks.
+
+Views (task detail and bundle reads), bids and messages are counted in
+process and flushed every ``COUNTER_FLUSH_SECONDS`` as one unordered bulk
+write of ``$inc`` upserts into ``task_counters``. A hot task costs one
+write per worker per flush instead of one per event, and the task document
+itself (its version, ETag and sync sequence) is left alone.
+
+At most ``COUNTER_MAX_PENDING`` tasks buffer at once. Reaching that limit
+flushes early, and increments for further tasks are dropped (and counted)
+until the flush takes the buffer. A failed flush puts its increments back
+for the next one. Shutdown flushes whatever is left.
+
+``GET /api/tasks?sort=popular`` ranks the newest ``POPULAR_CANDIDATES``
+matching tasks by their flushed counters, weighted per event type, with
+the score halving every ``POPULAR_HALF_LIFE_HOURS`` of task age.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SECONDS = float(os.environ.get("COUNTER_FLUSH_SECONDS", "5"))
+MAX_PENDING = int(os.environ.get("COUNTER_MAX_PENDING", "10000"))
+POPULAR_CANDIDATES = int(os.environ.get("POPULAR_CANDIDATES", "500"))
+HALF_LIFE_HOURS = float(os.environ.get("POPULAR_HALF_LIFE_HOURS", "24"))
+WEIGHTS = {
+    "views": float(os.environ.get("POPULAR_VIEW_WEIGHT", "1")),
+    "bids": float(os.environ.get("POPULAR_BID_WEIGHT", "5")),
+    "messages": float(os.environ.get("POPULAR_MESSAGE_WEIGHT", "2")),
+}
+
+
+def popularity(counts: Optional[dict], created_at: datetime, now: datetime) -> float:
+    """Weighted engagement, plus one so fresh tasks rank by age, decayed by task age."""
+    engagement = 1 + sum(weight * (counts or {}).get(field, 0) for field, weight in WEIGHTS.items())
+    age_hours = max(0.0, (now - created_at).total_seconds() / 3600)
+    return engagement * 0.5 ** (age_hours / HALF_LIFE_HOURS)
+
+
+class CounterBuffer:
+    def __init__(self, storage, flush_seconds: float = FLUSH_SECONDS, max_pending: int = MAX_PENDING):
+        self.storage = storage
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._pending: Dict[str, Dict[str, int]] = {}
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"increments": 0, "dropped": 0, "flushes": 0, "written": 0, "failures": 0}
+        self.flush_ms: Optional[float] = None
+
+    def add(self, task_id: str, field: str, count: int = 1):
+        counts = self._pending.get(task_id)
+        if counts is None:
+            if len(self._pending) >= self.max_pending:
+                self._stats["dropped"] += count
+                self._wake.set()
+                return
+            counts = self._pending[task_id] = {}
+            if len(self._pending) >= self.max_pending:
+                self._wake.set()
+        counts[field] = counts.get(field, 0) + count
+        self._stats["increments"] += count
+
+    def _restore(self, batch: Dict[str, Dict[str, int]]):
+        for task_id, counts in batch.items():
+            for field, count in counts.items():
+                self.add(task_id, field, count)
+                self._stats["increments"] -= count
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            started = time.monotonic()
+            now = datetime.utcnow()
+            try:
+                await self.storage.task_counters.bulk_update(
+                    [
+                        ({"id": task_id}, {"$inc": counts, "$set": {"updated_at": now}})
+                        for task_id, counts in batch.items()
+                    ],
+                    upsert=True,
+                )
+            except Exception:
+                self._stats["failures"] += 1
+                self._restore(batch)
+                raise
+            self._stats["flushes"] += 1
+            self._stats["written"] += len(batch)
+            self.flush_ms = round((time.monotonic() - started) * 1000, 1)
+
+    async def run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("counter flush failed")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the flush loop and flush what is left."""
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("final counter flush failed; %d tasks' counts lost", len(self._pending))
+
+    async def rank(self, tasks: List[dict], now: Optional[datetime] = None) -> List[dict]:
+        """``tasks`` (with ``id`` and ``created_at``) ordered by popularity, most popular first."""
+        now = now or datetime.utcnow()
+        found = await self.storage.task_counters.get_many([task["id"] for task in tasks], {"_id": 0})
+        counts = {document["id"]: document for document in found}
+        return sorted(tasks, key=lambda task: -popularity(counts.get(task["id"]), task["created_at"], now))
+
+    def stats(self) -> dict:
+        return {**self._stats, "pending": len(self._pending), "flush_ms": self.flush_ms}
+
+
+def install(storage) -> CounterBuffer:
+    buffer = CounterBuffer(storage)
+    metrics.register("counters", buffer.stats)
+    return buffer
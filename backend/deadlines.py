@@ -0,0 +1,256 @@
+"""Per-request deadlines.
+
+Every HTTP request gets a time budget: the ``X-Request-Timeout`` header in
+milliseconds when the client sends one (capped at ``DEADLINE_MAX_MS``), else
+the first matching ``DEADLINE_ROUTES`` entry, else ``DEADLINE_DEFAULT_MS``.
+``DEADLINE_ROUTES`` lists ``METHOD path milliseconds`` entries separated by
+``;``; a ``*`` in the path matches one path segment.
+
+The deadline is carried in a context variable. Every storage call runs
+within it: Mongo commands get the time left as ``maxTimeMS``, and a call
+that starts with no time left fails at once. ``gather`` runs sub-queries
+concurrently and cancels the ones still running when one fails or time
+runs out. Outbound HTTP calls take their timeout from ``outbound_timeout``
+and pass the deadline on with ``forward_headers``.
+
+A request that runs out of time gets ``504`` with a breakdown of where the
+budget went: milliseconds per stage (``<collection>.<operation>``) and the
+stages still running when it expired. The budget only covers the time to
+the first response byte, so streams run on once their headers are sent.
+"""
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+import metrics
+from ratelimit import path_pattern
+from storage import DeadlineExceeded, current_deadline, current_routing
+
+ENABLED = os.environ.get("DEADLINE_ENABLED", "1") == "1"
+DEFAULT_MS = float(os.environ.get("DEADLINE_DEFAULT_MS", "5000"))
+MAX_MS = float(os.environ.get("DEADLINE_MAX_MS", "30000"))
+ROUTES = os.environ.get(
+    "DEADLINE_ROUTES",
+    "GET /api/tasks 2000; GET /api/tasks/*/bundle 2000; GET /api/dashboard/* 2000; GET /api/analytics/* 10000",
+)
+
+HEADER = b"x-request-timeout"
+FORWARD_HEADER = "X-Request-Timeout"
+
+
+class Deadline:
+    def __init__(self, budget_ms: float, source: str):
+        self.budget_ms = budget_ms
+        self.source = source
+        self.started = time.monotonic()
+        self.expires: Optional[float] = self.started + budget_ms / 1000
+        self.stages: Dict[str, float] = {}  # stage -> seconds spent
+        self.active: Dict[str, int] = {}  # stage -> calls in progress
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, or None once the response has started."""
+        return None if self.expires is None else self.expires - time.monotonic()
+
+    def disarm(self):
+        self.expires = None
+
+    @contextmanager
+    def stage(self, name: str):
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(name)
+        started = time.monotonic()
+        self.active[name] = self.active.get(name, 0) + 1
+        try:
+            yield remaining
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - started
+            self.active[name] -= 1
+            if not self.active[name]:
+                del self.active[name]
+
+    def in_progress(self) -> List[str]:
+        return sorted(self.active)
+
+    def breakdown(self, in_progress: Optional[List[str]] = None) -> dict:
+        return {
+            "budget_ms": self.budget_ms,
+            "source": self.source,
+            "elapsed_ms": round((time.monotonic() - self.started) * 1000, 1),
+            "stages": {
+                name: round(seconds * 1000, 1)
+                for name, seconds in sorted(self.stages.items(), key=lambda item: -item[1])
+            },
+            "in_progress": self.in_progress() if in_progress is None else in_progress,
+        }
+
+
+def remaining() -> Optional[float]:
+    deadline = current_deadline.get()
+    return deadline.remaining() if deadline is not None else None
+
+
+def outbound_timeout(default: float) -> float:
+    """Timeout in seconds for an outbound call, bounded by the time left."""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("outbound")
+    return min(default, left)
+
+
+def forward_headers() -> Dict[str, str]:
+    left = remaining()
+    return {FORWARD_HEADER: str(max(1, int(left * 1000)))} if left is not None else {}
+
+
+async def gather(*aws: Awaitable[Any]) -> List[Any]:
+    """Like ``asyncio.gather``, but the first failure or the deadline cancels the rest."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    deadline = current_deadline.get()
+    try:
+        done, pending = await asyncio.wait(
+            tasks, timeout=deadline.remaining() if deadline else None, return_when=asyncio.FIRST_EXCEPTION
+        )
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+        if pending:
+            raise DeadlineExceeded(", ".join(deadline.in_progress()) or None)
+        return [task.result() for task in tasks]
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def detached(coroutine: Awaitable[Any]) -> Any:
+    """Await ``coroutine`` outside the current request, for jobs that outlive it."""
+    current_deadline.set(None)
+    current_routing.set(None)
+    return await coroutine
+
+
+def parse_routes(spec: str) -> List[Tuple[str, Any, float]]:
+    routes = []
+    for entry in spec.split(";"):
+        if not entry.strip():
+            continue
+        method, path, budget_ms = entry.split()
+        routes.append((method.upper(), path_pattern(path), float(budget_ms)))
+    return routes
+
+
+class DeadlineStats:
+    def __init__(self):
+        self.exceeded = 0
+        self.by_stage: Dict[str, int] = {}
+
+    def record(self, stages: List[str]):
+        self.exceeded += 1
+        for stage in stages or ["handler"]:
+            self.by_stage[stage] = self.by_stage.get(stage, 0) + 1
+
+    def snapshot(self) -> dict:
+        return {
+            "default_ms": DEFAULT_MS,
+            "max_ms": MAX_MS,
+            "exceeded": self.exceeded,
+            "by_stage": dict(sorted(self.by_stage.items(), key=lambda item: -item[1])),
+        }
+
+
+def _exceeded_body(deadline: Deadline, stage: Optional[str], in_progress: Optional[List[str]] = None) -> dict:
+    return {"detail": "Deadline exceeded", "stage": stage, **deadline.breakdown(in_progress)}
+
+
+class DeadlineMiddleware:
+    def __init__(self, app, routes: List[Tuple[str, Any, float]], stats: DeadlineStats):
+        self.app = app
+        self.routes = routes
+        self.stats = stats
+
+    def budget(self, scope) -> Tuple[float, str]:
+        for name, value in scope.get("headers", ()):
+            if name == HEADER:
+                try:
+                    requested = float(value)
+                except ValueError:
+                    break
+                if requested > 0:
+                    return min(requested, MAX_MS), "header"
+                break
+        for method, path, budget_ms in self.routes:
+            if method == scope["method"] and path.match(scope["path"]):
+                return budget_ms, "route"
+        return DEFAULT_MS, "default"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        deadline = Deadline(*self.budget(scope))
+        response_started = asyncio.Event()
+
+        async def send_and_disarm(message):
+            if message["type"] == "http.response.start":
+                deadline.disarm()
+                response_started.set()
+            await send(message)
+
+        # The handler task copies the context, deadline included
+        token = current_deadline.set(deadline)
+        try:
+            handler = asyncio.ensure_future(self.app(scope, receive, send_and_disarm))
+        finally:
+            current_deadline.reset(token)
+        started = asyncio.ensure_future(response_started.wait())
+        try:
+            await asyncio.wait({handler, started}, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+            if handler.done() or response_started.is_set():
+                await handler
+                return
+            in_progress = deadline.in_progress()
+            handler.cancel()
+            await asyncio.wait({handler})
+            if not handler.cancelled():
+                handler.exception()
+            if response_started.is_set():
+                return
+            self.stats.record(in_progress)
+            body = json.dumps(_exceeded_body(deadline, None, in_progress)).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 504,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            })
+            await send({"type": "http.response.body", "body": body})
+        finally:
+            started.cancel()
+            if not handler.done():
+                handler.cancel()
+
+
+def install(app) -> Optional[DeadlineStats]:
+    if not ENABLED:
+        return None
+    stats = DeadlineStats()
+
+    async def deadline_exceeded(request: Request, exc: DeadlineExceeded):
+        deadline = current_deadline.get()
+        stats.record([exc.stage] if exc.stage else [])
+        if deadline is None:
+            return JSONResponse({"detail": "Deadline exceeded", "stage": exc.stage}, status_code=504)
+        return JSONResponse(_exceeded_body(deadline, exc.stage), status_code=504)
+
+    app.add_middleware(DeadlineMiddleware, routes=parse_routes(ROUTES), stats=stats)
+    app.add_exception_handler(DeadlineExceeded, deadline_exceeded)
+    metrics.register("deadlines", stats.snapshot)
+    return stats
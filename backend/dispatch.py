@@ -0,0 +1,448 @@
+"""Dispatch of urgent tasks to the nearest available taskers.
+
+Urgent tasks in ``DISPATCH_CATEGORIES`` are offered in waves: each wave
+offers the task to the ``DISPATCH_WAVE_SIZE`` nearest available taskers not
+offered it yet, then waits ``DISPATCH_WAVE_TIMEOUT_SECONDS`` for one of them
+to accept. Dispatch stops once the task is accepted or no longer posted, or
+after ``DISPATCH_MAX_WAVES``.
+
+A tasker is available when they reported a location in the last
+``DISPATCH_LOCATION_MAX_AGE_MINUTES`` and have no accepted or in-progress
+task. Nearest means by great-circle distance from ``users.location``. The
+search uses bounding boxes of growing radius over the location index. A box
+holding more than ``SEARCH_SCAN_LIMIT`` candidates is narrowed until it
+holds them all, so the ranking never works from an arbitrary sample.
+
+Every running dispatch is checkpointed in ``dispatch_checkpoints`` at the
+start of each wave, before its offers go out over ``OfferHub`` to the SSE
+and WebSocket streams of this worker. Streams on other workers get them
+from the relay: every ``DISPATCH_RELAY_SECONDS`` each worker reads the open
+waves offered to its connected taskers from the checkpoints, and pushes the
+offers they haven't seen and withdrawals for the ones that closed. A stream
+replays the offers still open for its tasker when it connects. Checkpoints
+whose owner stopped renewing them are claimed and resumed by the sweep,
+which also runs at startup. A graceful shutdown hands its checkpoints over
+immediately.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+import deadlines
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("DISPATCH_ENABLED", "1") == "1"
+CATEGORIES = set(os.environ.get("DISPATCH_CATEGORIES", "delivery,transportation").split(","))
+WAVE_SIZE = int(os.environ.get("DISPATCH_WAVE_SIZE", "5"))
+WAVE_TIMEOUT = float(os.environ.get("DISPATCH_WAVE_TIMEOUT_SECONDS", "30"))
+MAX_WAVES = int(os.environ.get("DISPATCH_MAX_WAVES", "4"))
+LOCATION_MAX_AGE = timedelta(minutes=float(os.environ.get("DISPATCH_LOCATION_MAX_AGE_MINUTES", "30")))
+SEARCH_RADII_KM = (2, 5, 10, 25, 50)
+# Candidates read per bounding box before ranking by distance
+SEARCH_SCAN_LIMIT = 200
+# Narrowing steps for a box over the scan limit
+SEARCH_MAX_SPLITS = 8
+RELAY_SECONDS = float(os.environ.get("DISPATCH_RELAY_SECONDS", "1"))
+# Connected taskers looked up per relay query
+RELAY_BATCH = 500
+QUEUE_SIZE = 100
+
+EARTH_RADIUS_KM = 6371.0
+# A checkpoint is renewed every wave; one missing two waves is orphaned
+STALE_AFTER = timedelta(seconds=2 * WAVE_TIMEOUT + 5)
+
+
+def distance_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi, d_lambda = phi2 - phi1, math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def bounding_box(lat: float, lng: float, radius_km: float) -> dict:
+    d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    d_lng = math.degrees(radius_km / (EARTH_RADIUS_KM * max(math.cos(math.radians(lat)), 1e-6)))
+    return {
+        "location.latitude": {"$gte": lat - d_lat, "$lte": lat + d_lat},
+        "location.longitude": {"$gte": lng - d_lng, "$lte": lng + d_lng},
+    }
+
+
+def should_dispatch(task: dict) -> bool:
+    category = getattr(task.get("category"), "value", task.get("category"))
+    return ENABLED and task.get("priority") == "urgent" and category in CATEGORIES
+
+
+class OfferHub:
+    """Per-worker fan-out of offer events to connected tasker streams.
+
+    Remembers which offers each connected tasker has open, so the relay
+    only sends what changed.
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self._open: Dict[str, Dict[str, Tuple[int, float]]] = {}  # tasker -> task id -> (wave, sent at)
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        self._subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+                self._open.pop(user_id, None)
+
+    def users(self) -> List[str]:
+        return list(self._subscribers)
+
+    def opened(self, user_id: str, event: dict):
+        """Record ``event`` as seen by ``user_id``'s streams."""
+        if user_id not in self._subscribers:
+            return
+        if event["type"] == "offer":
+            self._open.setdefault(user_id, {})[event["task_id"]] = (event["wave"], time.monotonic())
+        else:
+            self._open.get(user_id, {}).pop(event["task_id"], None)
+
+    def publish(self, user_id: str, event: dict) -> int:
+        self.opened(user_id, event)
+        queues = self._subscribers.get(user_id, ())
+        for queue in queues:
+            if queue.full():
+                # A stalled client loses its oldest event, not the newest
+                queue.get_nowait()
+            queue.put_nowait(event)
+        return len(queues)
+
+    def reconcile(self, user_id: str, offers: Dict[str, dict], read_at: float) -> int:
+        """Bring ``user_id``'s streams in line with the open ``offers`` read at ``read_at``.
+
+        Offers sent here after the read are newer than it and left alone.
+        """
+        known = dict(self._open.get(user_id, {}))
+        sent = 0
+        for task_id, event in offers.items():
+            if event["wave"] > known.get(task_id, (0, 0.0))[0]:
+                sent += 1
+                self.publish(user_id, event)
+        for task_id, (_, sent_at) in known.items():
+            if task_id not in offers and sent_at < read_at:
+                sent += 1
+                self.publish(user_id, {"type": "withdrawn", "task_id": task_id})
+        return sent
+
+    def connections(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+
+def _offer_summary(task: dict) -> dict:
+    location = task["location"]
+    return {
+        "task_id": task["id"],
+        "title": task["title"],
+        "category": getattr(task["category"], "value", task["category"]),
+        "budget_min": task["budget_min"],
+        "budget_max": task["budget_max"],
+        "client_id": task["client_id"],
+        "latitude": location["latitude"],
+        "longitude": location["longitude"],
+        "address": location.get("address"),
+    }
+
+
+class Dispatcher:
+    def __init__(self, storage, hub: OfferHub, owner: Optional[str] = None):
+        self.storage = storage
+        self.hub = hub
+        self.owner = owner or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._jobs: Dict[str, asyncio.Task] = {}
+        self._accepted: Dict[str, asyncio.Event] = {}
+        self._stats = {
+            "dispatched": 0, "resumed": 0, "waves": 0, "offers": 0, "accepted": 0, "exhausted": 0, "relayed": 0,
+        }
+
+    # Entry points
+
+    def enqueue(self, task: dict):
+        if should_dispatch(task):
+            self._stats["dispatched"] += 1
+            self._start(task["id"], self._begin(task))
+
+    def accepted(self, task_id: str):
+        event = self._accepted.get(task_id)
+        if event is not None:
+            self._stats["accepted"] += 1
+            event.set()
+
+    async def pending_offers(self, user_id: str) -> List[dict]:
+        now = datetime.utcnow()
+        checkpoints = await self.storage.dispatch_checkpoints.find(
+            {"current": user_id, "wave_ends_at": {"$gt": now}}, {"_id": 0}, limit=50
+        )
+        events = [self._offer_event(checkpoint) for checkpoint in checkpoints]
+        for event in events:
+            # The stream replays these itself, so the relay needn't send them
+            self.hub.opened(user_id, event)
+        return events
+
+    # Jobs
+
+    def _start(self, task_id: str, coroutine):
+        self._accepted[task_id] = asyncio.Event()
+        # Jobs started by a request outlive it, its deadline and read routing
+        job = asyncio.create_task(deadlines.detached(coroutine))
+        self._jobs[task_id] = job
+        job.add_done_callback(lambda _: self._forget(task_id))
+
+    def _forget(self, task_id: str):
+        self._jobs.pop(task_id, None)
+        self._accepted.pop(task_id, None)
+
+    async def _begin(self, task: dict):
+        state = {
+            "id": task["id"],
+            "owner": self.owner,
+            "wave": 0,
+            "offered": [],
+            "current": [],
+            "wave_ends_at": None,
+            "offer": _offer_summary(task),
+            "heartbeat_at": datetime.utcnow(),
+        }
+        try:
+            await self.storage.dispatch_checkpoints.insert(state)
+        except DuplicateKeyError:
+            return
+        await self._run(state)
+
+    async def _run(self, state: dict):
+        task_id = state["id"]
+        try:
+            while True:
+                if state["wave_ends_at"] is None:
+                    if state["wave"] >= MAX_WAVES or not await self._still_posted(task_id):
+                        break
+                    if not await self._next_wave(state):
+                        break
+                remaining = (state["wave_ends_at"] - datetime.utcnow()).total_seconds()
+                try:
+                    await asyncio.wait_for(self._accepted[task_id].wait(), max(remaining, 0))
+                    break
+                except asyncio.TimeoutError:
+                    state["wave_ends_at"] = None
+        except asyncio.CancelledError:
+            # Shutdown: the checkpoint stays behind for another worker
+            raise
+        except Exception:
+            logger.exception("dispatch of task %s failed", task_id)
+        if not self._accepted[task_id].is_set() and state["wave"] >= MAX_WAVES:
+            self._stats["exhausted"] += 1
+        await self._finish(state)
+
+    async def _still_posted(self, task_id: str) -> bool:
+        task = await self.storage.tasks.get(task_id, {"status": 1})
+        return task is not None and task["status"] == "posted"
+
+    async def _next_wave(self, state: dict) -> bool:
+        offer = state["offer"]
+        exclude = set(state["offered"]) | {offer["client_id"]}
+        nearest = await self.nearest_taskers(offer["latitude"], offer["longitude"], WAVE_SIZE, exclude)
+        if not nearest:
+            return False
+        now = datetime.utcnow()
+        state["wave"] += 1
+        state["current"] = [tasker["id"] for tasker in nearest]
+        state["offered"] += state["current"]
+        state["wave_ends_at"] = now + timedelta(seconds=WAVE_TIMEOUT)
+        state["heartbeat_at"] = now
+        renewed = await self.storage.dispatch_checkpoints.update_one(
+            {"id": state["id"], "owner": self.owner},
+            {"$set": {key: state[key] for key in ("wave", "current", "offered", "wave_ends_at", "heartbeat_at")}},
+        )
+        if not renewed:
+            # Another worker took this dispatch over
+            return False
+        self._stats["waves"] += 1
+        event = self._offer_event(state)
+        for tasker in nearest:
+            self._stats["offers"] += 1
+            self.hub.publish(tasker["id"], {**event, "distance_km": round(tasker["distance_km"], 2)})
+        return True
+
+    async def _finish(self, state: dict):
+        withdrawn = {"type": "withdrawn", "task_id": state["id"]}
+        for tasker_id in state["current"]:
+            self.hub.publish(tasker_id, withdrawn)
+        await self.storage.dispatch_checkpoints.delete_one({"id": state["id"], "owner": self.owner})
+
+    @staticmethod
+    def _offer_event(state: dict) -> dict:
+        return {"type": "offer", **state["offer"], "wave": state["wave"], "expires_at": state["wave_ends_at"]}
+
+    # Candidate search
+
+    async def nearest_taskers(self, lat: float, lng: float, count: int, exclude: Set[str]) -> List[dict]:
+        fresh_since = datetime.utcnow() - LOCATION_MAX_AGE
+        ranked: List[dict] = []
+        fits = 0.0
+        for radius in SEARCH_RADII_KM:
+            candidates = await self._candidates(lat, lng, radius, exclude, fresh_since)
+            dense = candidates is None
+            if dense:
+                # Too many to rank whole: narrow down to the widest box that fits
+                low, high = fits, float(radius)
+                for _ in range(SEARCH_MAX_SPLITS):
+                    middle = (low + high) / 2
+                    found = await self._candidates(lat, lng, middle, exclude, fresh_since)
+                    if found is None:
+                        high = middle
+                    else:
+                        low, candidates = middle, found
+                if candidates is None:
+                    break
+                radius = low
+            fits = radius
+            ranked = []
+            for candidate in candidates:
+                location = candidate["location"]
+                distance = distance_km(lat, lng, location["latitude"], location["longitude"])
+                if distance <= radius:
+                    ranked.append({"id": candidate["id"], "distance_km": distance})
+            ranked = await self._drop_busy(ranked)
+            # Wider boxes than a dense one could only be sampled, not ranked
+            if len(ranked) >= count or dense:
+                break
+        ranked.sort(key=lambda candidate: candidate["distance_km"])
+        return ranked[:count]
+
+    async def _candidates(
+        self, lat: float, lng: float, radius: float, exclude: Set[str], fresh_since: datetime
+    ) -> Optional[List[dict]]:
+        """Every available tasker in the box around ``radius``, or None when there
+        are more than ``SEARCH_SCAN_LIMIT``."""
+        found = await self.storage.users.find(
+            {
+                **bounding_box(lat, lng, radius),
+                "role": {"$in": ["tasker", "both"]},
+                "location_updated_at": {"$gte": fresh_since},
+                "id": {"$nin": list(exclude)},
+            },
+            {"_id": 0, "id": 1, "location": 1},
+            limit=SEARCH_SCAN_LIMIT + 1,
+        )
+        return None if len(found) > SEARCH_SCAN_LIMIT else found
+
+    async def _drop_busy(self, candidates: List[dict]) -> List[dict]:
+        if not candidates:
+            return candidates
+        busy = await self.storage.tasks.find(
+            {"tasker_id": {"$in": [c["id"] for c in candidates]}, "status": {"$in": ["accepted", "in_progress"]}},
+            {"_id": 0, "tasker_id": 1},
+            limit=0,
+        )
+        busy_ids = {task["tasker_id"] for task in busy}
+        return [candidate for candidate in candidates if candidate["id"] not in busy_ids]
+
+    # Recovery
+
+    async def sweep(self) -> int:
+        """Claim and resume checkpoints abandoned by their owner."""
+        now = datetime.utcnow()
+        orphans = await self.storage.dispatch_checkpoints.find(
+            {"heartbeat_at": {"$lt": now - STALE_AFTER}}, {"_id": 0, "id": 1}, limit=100
+        )
+        resumed = 0
+        for orphan in orphans:
+            if orphan["id"] in self._jobs:
+                continue
+            state = await self.storage.dispatch_checkpoints.find_one_and_update(
+                {"id": orphan["id"], "heartbeat_at": {"$lt": now - STALE_AFTER}},
+                {"$set": {"owner": self.owner, "heartbeat_at": now}},
+                {"_id": 0},
+            )
+            if state is None:
+                continue
+            resumed += 1
+            self._stats["resumed"] += 1
+            if state["wave_ends_at"] is not None and state["wave_ends_at"] > now:
+                # Taskers connected here get the open wave's offer again
+                event = self._offer_event(state)
+                for tasker_id in state["current"]:
+                    self.hub.publish(tasker_id, event)
+            self._start(state["id"], self._run(state))
+        return resumed
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("dispatch sweep failed")
+            await asyncio.sleep(WAVE_TIMEOUT)
+
+    # Relay
+
+    async def relay_once(self) -> int:
+        """Send the connected taskers the waves other workers offered them."""
+        connected = self.hub.users()
+        if not connected:
+            return 0
+        read_at = time.monotonic()
+        now = datetime.utcnow()
+        offers: Dict[str, Dict[str, dict]] = defaultdict(dict)
+        for start in range(0, len(connected), RELAY_BATCH):
+            batch = connected[start:start + RELAY_BATCH]
+            checkpoints = await self.storage.dispatch_checkpoints.find(
+                {"current": {"$in": batch}, "wave_ends_at": {"$gt": now}},
+                {"_id": 0, "id": 1, "current": 1, "wave": 1, "wave_ends_at": 1, "offer": 1},
+                limit=0,
+            )
+            for checkpoint in checkpoints:
+                event = self._offer_event(checkpoint)
+                for tasker_id in set(batch).intersection(checkpoint["current"]):
+                    offers[tasker_id][checkpoint["id"]] = event
+        sent = sum(self.hub.reconcile(tasker_id, offers.get(tasker_id, {}), read_at) for tasker_id in connected)
+        self._stats["relayed"] += sent
+        return sent
+
+    async def relay(self):
+        while True:
+            try:
+                await self.relay_once()
+            except Exception:
+                logger.exception("offer relay failed")
+            await asyncio.sleep(RELAY_SECONDS)
+
+    async def stop(self):
+        jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+        # Hand open dispatches over without waiting for them to go stale
+        await self.storage.dispatch_checkpoints.update_many(
+            {"owner": self.owner}, {"$set": {"heartbeat_at": datetime(1970, 1, 1)}}
+        )
+
+    def stats(self) -> dict:
+        return {**self._stats, "active": len(self._jobs), "connections": self.hub.connections()}
+
+
+def install(storage) -> Dispatcher:
+    dispatcher = Dispatcher(storage, OfferHub())
+    metrics.register("dispatch", dispatcher.stats)
+    return dispatcher
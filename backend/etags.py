@@ -0,0 +1,69 @@
+"""Version-based strong ETags and conditional request helpers."""
+from typing import Optional
+
+from fastapi import HTTPException, Response
+
+
+def format_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def encoded_etag(etag: bytes, encoding: str) -> bytes:
+    """The strong tag of a content-coded representation, e.g. ``"3-gzip"``.
+
+    Its bytes differ from the identity response, so it needs its own tag,
+    but it stays strong so clients can echo it in If-Match.
+    """
+    if etag.startswith(b"W/") or len(etag) < 2 or not etag.endswith(b'"'):
+        return etag
+    return etag[:-1] + b"-" + encoding.encode("latin-1") + b'"'
+
+
+def _version(tag: str) -> str:
+    # Drops the content-coding suffix added by ``encoded_etag``
+    return tag.strip('"').split("-", 1)[0]
+
+
+def _tags(header: str):
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        yield tag
+
+
+def etag_matches(header: Optional[str], version: int) -> bool:
+    """Weak comparison as used by If-None-Match, ignoring the content coding."""
+    if not header:
+        return False
+    return any(tag == "*" or _version(tag) == str(version) for tag in _tags(header))
+
+
+def parse_if_match(header: Optional[str]) -> Optional[int]:
+    """Version required by an If-Match header, or None when absent or ``*``.
+
+    Only a single strong tag is meaningful for optimistic concurrency; the
+    tag of any content coding of a version stands for that version.
+    """
+    if not header or header.strip() == "*":
+        return None
+    tag = header.strip()
+    if tag.startswith("W/") or "," in tag:
+        raise HTTPException(status_code=412, detail="If-Match requires a single strong ETag")
+    try:
+        return int(_version(tag))
+    except ValueError:
+        raise HTTPException(status_code=412, detail="Precondition failed")
+
+
+def version_filter(expected: int):
+    # Documents written before versioning have no version field
+    return {"$in": [0, None]} if expected == 0 else expected
+
+
+def not_modified(version: int) -> Response:
+    return Response(status_code=304, headers={"ETag": format_etag(version)})
+
+
+def precondition_failed() -> HTTPException:
+    return HTTPException(status_code=412, detail="Resource version does not match If-Match")
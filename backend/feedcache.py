@@ -0,0 +1,432 @@
+"""Feed cache: the newest POSTED tasks per region and category, in memory.
+
+The public feed (``GET /api/tasks?status=posted``, optionally narrowed by
+``category`` and ``lat``/``lng``) is the same for everybody in a region,
+so each worker keeps it precomputed. A window holds the newest
+``FEED_WINDOW`` feed tasks of one key: a geohash cell at
+``FEED_GEOHASH_PRECISION`` (4 gives cells of about 39 x 20 km) or
+anywhere, and one category or all of them. Every task sits in the four
+windows covering it.
+
+Pages inside a window are served without a query. A window that may be
+missing older tasks (it overflowed, or tasks left it) misses once a page
+runs past its end, and the miss refills it from the database. Pages
+beyond ``FEED_WINDOW`` always read from the database.
+
+Windows are kept current three ways:
+
+* ``create_task`` and the accept and cancel transitions update this
+  worker's windows as they write;
+* every ``FEED_SYNC_SECONDS`` each worker pulls the tasks changed since its
+  last pull through the ``sync_seq`` change sequence. That covers the other
+  workers' writes and the scheduler surfacing and expiring tasks;
+* on startup, one scan of the newest ``FEED_REBUILD_LIMIT`` feed tasks on
+  the ``(status, created_at)`` index fills every window at once. Until it
+  completes, feed pages read from the database.
+
+Entries hold the list-page summary of a task (the fields passed to
+``install``, without images), and fills, rebuilds and pulls read only those
+fields, so the cache's size follows ``FEED_MAX_TASKS`` rather than what
+clients attach to tasks.
+
+``/api/metrics`` reports the hit ratio and the staleness under
+``feed_cache``: how long other workers' changes took to reach this
+worker's windows, and how long ago the last pull ran.
+"""
+import asyncio
+import bisect
+import heapq
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import metrics
+from presence import cell_bounds, geohash
+from singleflight import reads
+from storage import current_routing
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("FEED_CACHE_ENABLED", "1") == "1"
+PRECISION = int(os.environ.get("FEED_GEOHASH_PRECISION", "4"))
+WINDOW = int(os.environ.get("FEED_WINDOW", "200"))
+MAX_TASKS = int(os.environ.get("FEED_MAX_TASKS", "50000"))
+REBUILD_LIMIT = int(os.environ.get("FEED_REBUILD_LIMIT", "20000"))
+SYNC_SECONDS = float(os.environ.get("FEED_SYNC_SECONDS", "2"))
+SETTLE_SECONDS = float(os.environ.get("FEED_SETTLE_SECONDS", "5"))
+SYNC_BATCH = int(os.environ.get("FEED_SYNC_BATCH", "1000"))
+
+POSTED = "posted"
+ANY = "*"
+# Local removals are remembered this long, so a fill or pull that read the
+# task before it was removed cannot put it back
+REMOVED_MEMORY_SECONDS = 60.0
+
+Key = Tuple[str, str]  # (cell or ANY, category or ANY)
+SortKey = Tuple[float, str]  # newest first
+
+
+def cell(latitude: float, longitude: float) -> str:
+    return geohash(latitude, longitude, PRECISION)
+
+
+def region_filter(region: str) -> dict:
+    south, west, north, east = cell_bounds(region)
+    return {
+        "location.latitude": {"$gte": south, "$lt": north},
+        "location.longitude": {"$gte": west, "$lt": east},
+    }
+
+
+def feed_filter(key: Key) -> dict:
+    region, category = key
+    query = {"status": POSTED, "surface_at": {"$exists": False}}
+    if category != ANY:
+        query["category"] = category
+    if region != ANY:
+        query.update(region_filter(region))
+    return query
+
+
+def in_feed(task: dict) -> bool:
+    return _value(task.get("status")) == POSTED and "surface_at" not in task
+
+
+def _value(value):
+    return getattr(value, "value", value)
+
+
+def _sort_key(task: dict) -> SortKey:
+    return -task["created_at"].timestamp(), task["id"]
+
+
+class Entry:
+    __slots__ = ("task", "sort_key", "keys")
+
+    def __init__(self, task: dict, sort_key: SortKey, keys: List[Key]):
+        self.task = task
+        self.sort_key = sort_key
+        self.keys = keys
+
+
+class Window:
+    """Sort keys of the newest feed tasks of one key.
+
+    A truncated window may be missing feed tasks, but only ones older than
+    its last item.
+    """
+    __slots__ = ("items", "truncated")
+
+    def __init__(self, items: Optional[List[SortKey]] = None, truncated: bool = False):
+        self.items = items if items is not None else []
+        self.truncated = truncated
+
+
+class FeedCache:
+    def __init__(self, storage, fields: Sequence[str], window: int = WINDOW, max_tasks: int = MAX_TASKS):
+        self.storage = storage
+        self.fields = tuple(fields)
+        self.projection = {"_id": 0, **{field: 1 for field in self.fields}}
+        # Pulls also need what decides feed membership and the cursor
+        self._pull_projection = {**self.projection, "status": 1, "surface_at": 1, "updated_at": 1, "sync_seq": 1}
+        self.window = window
+        self.max_tasks = max_tasks
+        self._entries: Dict[str, Entry] = {}
+        self._windows: Dict[Key, Window] = {}
+        self._oldest: List[Tuple[float, str]] = []
+        self._removed: Dict[str, float] = {}
+        # Ready once built; complete while every feed task is cached, so a
+        # key without a window has no feed tasks at all
+        self.ready = False
+        self.complete = False
+        self.cursor = 0
+        self.synced_at: Optional[float] = None
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.evicted = 0
+        self.rebuild_ms: Optional[float] = None
+        self.pulled = 0
+        self.lag_count = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.lag_last: Optional[float] = None
+
+    # Reads
+
+    def page(self, key: Key, skip: int, limit: int) -> Optional[List[dict]]:
+        window = self._windows.get(key)
+        if window is None:
+            return [] if self.complete else None
+        end = skip + limit
+        if window.truncated and end > len(window.items):
+            return None
+        return [self._entries[sort_key[1]].task for sort_key in window.items[skip:end]]
+
+    async def read(self, region: Optional[str], category: Optional[str], skip: int, limit: int) -> Optional[List[dict]]:
+        """A feed page, or None when the caller has to query the database.
+
+        Callers must treat the tasks as read-only.
+        """
+        if not self.ready:
+            return None
+        key = (region or ANY, _value(category) or ANY)
+        found = self.page(key, skip, limit)
+        if found is not None:
+            self.hits += 1
+            return found
+        self.misses += 1
+        if skip + limit > self.window:
+            return None
+        await reads.do(("feed", key), lambda: self._fill(key))
+        return self.page(key, skip, limit)
+
+    # Writes
+
+    def posted(self, task: dict):
+        if self.ready and in_feed(task):
+            self._add(task)
+
+    def removed(self, task_id: str):
+        self._removed[task_id] = time.monotonic()
+        if self.ready:
+            self._remove(task_id)
+
+    def _summary(self, task: dict) -> dict:
+        return {field: task[field] for field in self.fields if field in task}
+
+    def _keys(self, task: dict) -> List[Key]:
+        location = task["location"]
+        region = cell(location["latitude"], location["longitude"])
+        category = _value(task["category"])
+        return [(region, category), (region, ANY), (ANY, category), (ANY, ANY)]
+
+    def _add(self, task: dict) -> bool:
+        """Cache a feed task; True when it was not cached before."""
+        entry = self._entries.get(task["id"])
+        keys = self._keys(task)
+        if entry is not None:
+            if keys == entry.keys:
+                if task.get("version", 0) >= entry.task.get("version", 0):
+                    entry.task = self._summary(task)
+                return False
+            self._remove(task["id"])
+        entry = self._entries[task["id"]] = Entry(self._summary(task), _sort_key(task), keys)
+        heapq.heappush(self._oldest, (-entry.sort_key[0], entry.sort_key[1]))
+        for key in keys:
+            window = self._windows.get(key)
+            if window is None:
+                if not self.complete:
+                    continue
+                window = self._windows[key] = Window()
+            self._insert(window, entry.sort_key)
+        self._evict()
+        return True
+
+    def _insert(self, window: Window, sort_key: SortKey):
+        items = window.items
+        full = len(items) >= self.window
+        if items and sort_key > items[-1] and (window.truncated or full):
+            # Older than the window's tail: the tasks in between may be missing
+            window.truncated = True
+            return
+        if window.truncated and not items:
+            return
+        bisect.insort(items, sort_key)
+        if len(items) > self.window:
+            items.pop()
+            window.truncated = True
+
+    def _remove(self, task_id: str) -> bool:
+        entry = self._entries.pop(task_id, None)
+        if entry is None:
+            return False
+        for key in entry.keys:
+            window = self._windows.get(key)
+            if window is None:
+                continue
+            at = bisect.bisect_left(window.items, entry.sort_key)
+            if at < len(window.items) and window.items[at] == entry.sort_key:
+                del window.items[at]
+        return True
+
+    def _evict(self):
+        while len(self._entries) > self.max_tasks and self._oldest:
+            created, task_id = heapq.heappop(self._oldest)
+            entry = self._entries.get(task_id)
+            if entry is None or entry.sort_key[0] != -created:
+                continue
+            self._remove(task_id)
+            self.evicted += 1
+            # The oldest task was the tail of its windows
+            for key in entry.keys:
+                window = self._windows.get(key)
+                if window is not None:
+                    window.truncated = True
+        if len(self._oldest) > 2 * len(self._entries) + 1024:
+            self._oldest = [(-entry.sort_key[0], task_id) for task_id, entry in self._entries.items()]
+            heapq.heapify(self._oldest)
+
+    def _removed_since(self, task_id: str, started: float) -> bool:
+        return self._removed.get(task_id, float("-inf")) >= started
+
+    # Loading
+
+    async def _fill(self, key: Key):
+        # Fills must see every write the pulls have already moved past
+        token = current_routing.set(None)
+        try:
+            started = time.monotonic()
+            found = await self.storage.tasks.find(
+                feed_filter(key), self.projection, sort=[("created_at", -1)], limit=self.window
+            )
+        finally:
+            current_routing.reset(token)
+        self.fills += 1
+        window = self._windows.get(key)
+        items = set() if window is None else set(window.items)
+        # Past ``tail`` the cache cannot tell whether tasks are missing
+        tail = _sort_key(found[-1]) if len(found) >= self.window else None
+        for task in found:
+            if self._removed_since(task["id"], started):
+                continue
+            if task["id"] not in self._entries:
+                self._add(task)
+            entry = self._entries.get(task["id"])
+            if entry is None:
+                # Evicted at once: the cache is full of newer tasks
+                tail = _sort_key(task)
+                break
+            items.add(entry.sort_key)
+        ordered = sorted(items)
+        if tail is not None:
+            ordered = [sort_key for sort_key in ordered if sort_key <= tail]
+        # Adding may have evicted tasks added before
+        for n, sort_key in enumerate(ordered):
+            if sort_key[1] not in self._entries:
+                ordered, tail = ordered[:n], sort_key
+                break
+        self._windows[key] = Window(ordered[:self.window], tail is not None or len(ordered) > self.window)
+
+    async def rebuild(self):
+        started = time.monotonic()
+        cursor = await self.storage.changes.current_seq()
+        found = await self.storage.tasks.find(
+            feed_filter((ANY, ANY)), self.projection, sort=[("created_at", -1)], limit=REBUILD_LIMIT
+        )
+        complete = len(found) < REBUILD_LIMIT
+        entries: Dict[str, Entry] = {}
+        windows: Dict[Key, Window] = {}
+        for task in found:  # newest first, so every window fills in order
+            if self._removed_since(task["id"], started):
+                continue
+            entry = entries[task["id"]] = Entry(self._summary(task), _sort_key(task), self._keys(task))
+            for key in entry.keys:
+                window = windows.get(key)
+                if window is None:
+                    window = windows[key] = Window(truncated=not complete)
+                if len(window.items) < self.window:
+                    window.items.append(entry.sort_key)
+                else:
+                    window.truncated = True
+        self._entries, self._windows, self.complete, self.cursor = entries, windows, complete, cursor
+        self._oldest = [(-entry.sort_key[0], task_id) for task_id, entry in entries.items()]
+        heapq.heapify(self._oldest)
+        self._evict()
+        self.ready = True
+        self.rebuild_ms = round((time.monotonic() - started) * 1000, 1)
+        logger.info("feed cache built from %d tasks in %.0f ms", len(entries), self.rebuild_ms)
+
+    def _apply(self, tasks: Iterable[dict], started: float):
+        now = datetime.utcnow()
+        for task in tasks:
+            if self._removed_since(task["id"], started):
+                continue
+            if in_feed(task):
+                changed = self._add(task)
+            else:
+                changed = self._remove(task["id"])
+            if changed and task.get("updated_at"):
+                lag = max(0.0, (now - task["updated_at"]).total_seconds())
+                self.lag_count += 1
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+                self.lag_last = lag
+
+    async def sync(self):
+        """Pull the task changes since the last pull, written by any worker."""
+        while True:
+            started = time.monotonic()
+            since = self.cursor
+            changed = await self.storage.tasks.find(
+                {"sync_seq": {"$gt": since}}, self._pull_projection, sort=[("sync_seq", 1)], limit=SYNC_BATCH
+            )
+            deleted = await self.storage.tombstones.since(since, ["tasks"], SYNC_BATCH)
+            self._apply(changed, started)
+            for tombstone in deleted:
+                self._remove(tombstone["id"])
+            self.pulled += len(changed) + len(deleted)
+            full = [documents[-1]["sync_seq"] for documents in (changed, deleted) if len(documents) >= SYNC_BATCH]
+            if full:
+                # Page boundaries always advance
+                self.cursor = min(full)
+                continue
+            returned = changed + deleted
+            if returned:
+                # Sequence numbers are taken before the write lands, so recent
+                # ones are read again until they settle
+                settle_cutoff = datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)
+                unsettled = [
+                    document["sync_seq"] for document in returned
+                    if (document.get("updated_at") or document.get("deleted_at")) > settle_cutoff
+                ]
+                latest = max(document["sync_seq"] for document in returned)
+                self.cursor = max(since, min(unsettled) - 1) if unsettled else latest
+            break
+        self.synced_at = time.monotonic()
+        expired = time.monotonic() - REMOVED_MEMORY_SECONDS
+        self._removed = {task_id: at for task_id, at in self._removed.items() if at >= expired}
+
+    async def run(self):
+        while not self.ready:
+            try:
+                await self.rebuild()
+            except Exception:
+                logger.exception("feed cache rebuild failed")
+                await asyncio.sleep(SYNC_SECONDS)
+        while True:
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("feed cache sync failed")
+            await asyncio.sleep(SYNC_SECONDS)
+
+    def stats(self) -> dict:
+        served = self.hits + self.misses
+        return {
+            "ready": self.ready,
+            "complete": self.complete,
+            "tasks": len(self._entries),
+            "windows": len(self._windows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / served, 4) if served else None,
+            "fills": self.fills,
+            "evicted": self.evicted,
+            "rebuild_ms": self.rebuild_ms,
+            "pulled": self.pulled,
+            "last_pull_seconds_ago": round(time.monotonic() - self.synced_at, 1) if self.synced_at else None,
+            "staleness_ms": {
+                "last": round(self.lag_last * 1000, 1) if self.lag_last is not None else None,
+                "avg": round(self.lag_total / self.lag_count * 1000, 1) if self.lag_count else None,
+                "max": round(self.lag_max * 1000, 1),
+            },
+        }
+
+
+def install(storage, fields: Sequence[str]) -> FeedCache:
+    cache = FeedCache(storage, fields)
+    metrics.register("feed_cache", cache.stats)
+    return cache
@@ -0,0 +1,20 @@
+"""Process-local metrics registry.
+
+Subsystems register a provider returning a JSON-serializable dict; the
+``/api/metrics`` route reports every provider under its name.
+"""
+from typing import Any, Callable, Dict
+
+_providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def register(name: str, provider: Callable[[], Dict[str, Any]]):
+    _providers[name] = provider
+
+
+def unregister(name: str):
+    _providers.pop(name, None)
+
+
+def snapshot() -> Dict[str, Any]:
+    return {name: provider() for name, provider in sorted(_providers.items())}
@@ -0,0 +1,137 @@
+"""Convert a Mongo database from the plain to the compact storage encoding.
+
+Rewrites every document of every repository collection (and the message
+archives) so UUID strings become BSON Binary subtype 4 and money becomes
+int64 minor units. It then prints collection and index sizes before and
+after. The migration is idempotent: documents already in the compact form
+are left alone, so an interrupted run can simply be restarted.
+
+Stop the API (or run it with ``STORAGE_ENCODING=plain`` and accept a short
+window of mixed documents), migrate, then start it with
+``STORAGE_ENCODING=compact``::
+
+    python migrate_encoding.py --report sizes.json
+    python migrate_encoding.py --dry-run       # sizes and counts only
+
+WiredTiger only returns freed space to the OS after ``compact``; pass
+``--compact`` to run it on each collection so the "after" sizes show the
+gain.
+"""
+import argparse
+import asyncio
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from dotenv import load_dotenv
+from pymongo import ReplaceOne
+
+from storage import MessageArchiveRepo, create_storage
+
+ROOT_DIR = Path(__file__).parent
+
+
+async def collection_sizes(db, names: List[str]) -> Dict[str, dict]:
+    sizes = {}
+    for name in names:
+        stats = await db.command("collStats", name)
+        sizes[name] = {
+            "count": stats.get("count", 0),
+            "size": stats.get("size", 0),
+            "storage_size": stats.get("storageSize", 0),
+            "index_size": stats.get("totalIndexSize", 0),
+            "index_sizes": stats.get("indexSizes", {}),
+        }
+    return sizes
+
+
+async def migrate_collection(raw, codec, batch: int, dry_run: bool) -> Tuple[int, int]:
+    """Returns (documents scanned, documents rewritten)."""
+    scanned = rewritten = 0
+    last_id = None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        documents = await raw.find(query).sort("_id", 1).limit(batch).to_list(batch)
+        if not documents:
+            return scanned, rewritten
+        requests = []
+        for document in documents:
+            encoded = codec.encode_document(document, legacy=True)
+            if encoded != document:
+                requests.append(ReplaceOne({"_id": document["_id"]}, encoded))
+        scanned += len(documents)
+        rewritten += len(requests)
+        if requests and not dry_run:
+            await raw.bulk_write(requests, ordered=False)
+        last_id = documents[-1]["_id"]
+
+
+def _mb(size: int) -> str:
+    return f"{size / 1_000_000:.1f}"
+
+
+def print_report(before: Dict[str, dict], after: Dict[str, dict], migrated: Dict[str, Tuple[int, int]]):
+    header = f"{'collection':<28}{'docs':>10}{'rewritten':>11}{'data MB':>17}{'storage MB':>17}{'index MB':>17}"
+    print(header)
+    print("-" * len(header))
+    totals = {key: [0, 0] for key in ("size", "storage_size", "index_size")}
+    for name in before:
+        old, new = before[name], after.get(name, before[name])
+        cells = []
+        for key in totals:
+            totals[key][0] += old[key]
+            totals[key][1] += new[key]
+            cells.append(f"{_mb(old[key]):>8} → {_mb(new[key]):<6}")
+        print(f"{name:<28}{old['count']:>10}{migrated.get(name, (0, 0))[1]:>11}" + "".join(f"{cell:>17}" for cell in cells))
+    print("-" * len(header))
+    cells = [f"{_mb(old):>8} → {_mb(new):<6}" for old, new in totals.values()]
+    print(f"{'total':<49}" + "".join(f"{cell:>17}" for cell in cells))
+
+
+async def main(args):
+    load_dotenv(ROOT_DIR / ".env")
+    storage = create_storage(backend="mongo", encoding="compact")
+    db = storage.engine.db
+    try:
+        existing = set(await db.list_collection_names())
+        targets = {
+            repo.collection_name: (repo.collection.raw, repo.codec)
+            for repo in storage.repositories().values()
+            if repo.collection_name in existing
+        }
+        archive_codec = storage.codec(MessageArchiveRepo)
+        for name in sorted(existing):
+            if name.startswith("messages_archive_"):
+                targets[name] = (db[name], archive_codec)
+
+        names = sorted(targets)
+        before = await collection_sizes(db, names)
+        migrated = {}
+        for name in names:
+            raw, codec = targets[name]
+            migrated[name] = await migrate_collection(raw, codec, args.batch, args.dry_run)
+            print(f"{name}: {migrated[name][1]} of {migrated[name][0]} documents {'to rewrite' if args.dry_run else 'rewritten'}")
+            if args.compact and not args.dry_run:
+                await db.command("compact", name)
+        after = before if args.dry_run else await collection_sizes(db, names)
+
+        print()
+        print_report(before, after, migrated)
+        if args.report:
+            Path(args.report).write_text(json.dumps({
+                "before": before,
+                "after": after,
+                "migrated": {name: {"scanned": s, "rewritten": r} for name, (s, r) in migrated.items()},
+                "dry_run": args.dry_run,
+            }, indent=2))
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate stored ids and money to the compact encoding.")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="count documents to rewrite without writing")
+    parser.add_argument("--compact", action="store_true", help="run compact on each collection afterwards")
+    parser.add_argument("--report", help="write the size report as JSON to this path")
+    asyncio.run(main(parser.parse_args()))
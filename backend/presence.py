@@ -0,0 +1,356 @@
+"""Tasker presence: who is online right now, and where.
+
+A tasker is online for ``PRESENCE_TTL_SECONDS`` after each heartbeat. The
+heartbeat sources are:
+
+* ``POST /api/taskers/{id}/heartbeat``;
+* a location update from a tasker already online;
+* any message on the offer WebSocket;
+* the keep-alives of the offer stream.
+
+``POST /api/taskers/{id}/offline`` ends presence early.
+
+The registry lives in process memory and is indexed by geohash cell, and
+by every coarser cell containing it. ``PRESENCE_GEOHASH_PRECISION`` sets
+the finest cell; the default of 6 gives cells of about 1.2 x 0.6 km.
+``GET /api/taskers/online`` never touches the database. It picks the finest
+cells that cover the search circle in at most about 9 x 9 cells, scans
+them, then filters by expiry, skill and distance.
+
+With ``PRESENCE_STORE=shared``, heartbeats are also written to the
+``presence`` collection. Every ``PRESENCE_SYNC_SECONDS``, each worker pulls
+the entries changed since its last pull, so workers agree within that
+interval. Expired entries are swept every ``PRESENCE_SWEEP_SECONDS`` and
+skipped by queries in between.
+"""
+import asyncio
+import functools
+import heapq
+import logging
+import math
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import metrics
+from dispatch import EARTH_RADIUS_KM, distance_km
+
+logger = logging.getLogger(__name__)
+
+TTL_SECONDS = float(os.environ.get("PRESENCE_TTL_SECONDS", "60"))
+PRECISION = int(os.environ.get("PRESENCE_GEOHASH_PRECISION", "6"))
+STORE = os.environ.get("PRESENCE_STORE", "memory")
+SYNC_SECONDS = float(os.environ.get("PRESENCE_SYNC_SECONDS", "5"))
+SWEEP_SECONDS = float(os.environ.get("PRESENCE_SWEEP_SECONDS", "30"))
+MAX_RADIUS_KM = float(os.environ.get("PRESENCE_MAX_RADIUS_KM", "50"))
+
+TASKER_ROLES = ("tasker", "both")
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def cell_size(precision: int = PRECISION) -> Tuple[float, float]:
+    """Height and width of a cell in degrees."""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _cell_hash(row: int, column: int, precision: int) -> str:
+    # Geohash interleaves longitude (column) and latitude (row) bits,
+    # longitude first
+    bits = 5 * precision
+    lat_bits, lng_bits = bits // 2, (bits + 1) // 2
+    value = 0
+    for n in range(bits):
+        if n % 2 == 0:
+            value = value << 1 | (column >> (lng_bits - 1 - n // 2)) & 1
+        else:
+            value = value << 1 | (row >> (lat_bits - 1 - n // 2)) & 1
+    return "".join(GEOHASH_ALPHABET[(value >> shift) & 31] for shift in range(bits - 5, -1, -5))
+
+
+def _cell_index(latitude: float, longitude: float, precision: int) -> Tuple[int, int]:
+    height, width = cell_size(precision)
+    rows, columns = round(180 / height), round(360 / width)
+    row = min(max(int((latitude + 90) // height), 0), rows - 1)
+    return row, int((longitude + 180) // width) % columns
+
+
+def geohash(latitude: float, longitude: float, precision: int = PRECISION) -> str:
+    return _cell_hash(*_cell_index(latitude, longitude, precision), precision)
+
+
+def cell_bounds(cell: str) -> Tuple[float, float, float, float]:
+    """South, west, north and east edges of a geohash cell in degrees."""
+    bits = 5 * len(cell)
+    value = 0
+    for char in cell:
+        value = value << 5 | GEOHASH_ALPHABET.index(char)
+    row = column = 0
+    for n in range(bits):
+        bit = value >> (bits - 1 - n) & 1
+        if n % 2 == 0:
+            column = column << 1 | bit
+        else:
+            row = row << 1 | bit
+    height, width = cell_size(len(cell))
+    south, west = row * height - 90, column * width - 180
+    return south, west, south + height, west + width
+
+
+def query_precision(latitude: float, radius_km: float, precision: int = PRECISION) -> int:
+    """The finest precision whose cells cover the search box in at most about 9 x 9 cells."""
+    for candidate in range(precision, 1, -1):
+        height, width = cell_size(candidate)
+        km_per_degree = math.radians(EARTH_RADIUS_KM)
+        if min(height, width * math.cos(math.radians(latitude))) * km_per_degree >= radius_km / 4:
+            return candidate
+    return 1
+
+
+def covering_cells(latitude: float, longitude: float, radius_km: float, precision: int = PRECISION) -> Set[str]:
+    """Cells overlapping the bounding box of a circle."""
+    d_lat = min(90.0, math.degrees(radius_km / EARTH_RADIUS_KM))
+    d_lng = min(180.0, d_lat / max(math.cos(math.radians(latitude)), 1e-6))
+    south, west = _cell_index(latitude - d_lat, longitude - d_lng, precision)
+    north, east = _cell_index(latitude + d_lat, longitude + d_lng, precision)
+    _, width = cell_size(precision)
+    columns = round(360 / width)
+    span = (east - west) % columns
+    if d_lng >= 180:
+        west, span = 0, columns - 1
+    return {
+        _cell_hash(row, (west + offset) % columns, precision)
+        for row in range(south, north + 1)
+        for offset in range(span + 1)
+    }
+
+
+class Presence:
+    __slots__ = ("user_id", "latitude", "longitude", "cell", "skills", "matches", "expires_at")
+
+    def __init__(self, user_id: str, latitude: float, longitude: float, cell: str, skills: List[str], expires_at: float):
+        self.user_id = user_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.cell = cell
+        self.skills = skills
+        self.matches = frozenset(skill.lower() for skill in skills)
+        self.expires_at = expires_at
+
+
+class PresenceRegistry:
+    """Online taskers by geohash cell, expiring ``ttl`` seconds after their last heartbeat."""
+
+    def __init__(self, precision: int = PRECISION):
+        self.precision = precision
+        self._entries: Dict[str, Presence] = {}
+        self._cells: Dict[str, Set[str]] = defaultdict(set)
+        self.queries = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def online(self, now: Optional[float] = None) -> int:
+        now = now or time.time()
+        return sum(1 for entry in self._entries.values() if entry.expires_at > now)
+
+    def get(self, user_id: str, now: Optional[float] = None) -> Optional[Presence]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry.expires_at <= (now or time.time()):
+            return None
+        return entry
+
+    def update(self, user_id: str, latitude: float, longitude: float, skills: List[str], expires_at: float) -> Presence:
+        cell = geohash(latitude, longitude, self.precision)
+        entry = self._entries.get(user_id)
+        if entry is not None and entry.cell != cell:
+            self._leave_cell(entry)
+        entry = Presence(user_id, latitude, longitude, cell, skills, expires_at)
+        self._entries[user_id] = entry
+        # Every prefix is a coarser cell, for searches wider than a few cells
+        for length in range(1, len(cell) + 1):
+            self._cells[cell[:length]].add(user_id)
+        return entry
+
+    def remove(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._leave_cell(entry)
+
+    def _leave_cell(self, entry: Presence):
+        for length in range(1, len(entry.cell) + 1):
+            members = self._cells.get(entry.cell[:length])
+            if members is not None:
+                members.discard(entry.user_id)
+                if not members:
+                    del self._cells[entry.cell[:length]]
+
+    def nearby(self, latitude: float, longitude: float, radius_km: float, skill: Optional[str] = None,
+               limit: int = 50, now: Optional[float] = None) -> List[dict]:
+        self.queries += 1
+        now = now or time.time()
+        skill = skill.lower() if skill else None
+        d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        d_lng = d_lat / max(math.cos(math.radians(latitude)), 1e-6)
+        found: List[Tuple[float, Presence]] = []
+        precision = query_precision(latitude, radius_km, self.precision)
+        for cell in covering_cells(latitude, longitude, radius_km, precision):
+            for user_id in self._cells.get(cell, ()):
+                entry = self._entries[user_id]
+                if entry.expires_at <= now or (skill and skill not in entry.matches):
+                    continue
+                # The bounding box rules most candidates out before the trigonometry
+                if abs(entry.latitude - latitude) > d_lat or abs((entry.longitude - longitude + 180) % 360 - 180) > d_lng:
+                    continue
+                distance = distance_km(latitude, longitude, entry.latitude, entry.longitude)
+                if distance <= radius_km:
+                    found.append((distance, entry))
+        nearest = heapq.nsmallest(limit, found, key=lambda item: item[0])
+        return [
+            {
+                "id": entry.user_id,
+                "latitude": entry.latitude,
+                "longitude": entry.longitude,
+                "distance_km": round(distance, 3),
+                "skills": entry.skills,
+                "online_until": datetime.utcfromtimestamp(entry.expires_at),
+            }
+            for distance, entry in nearest
+        ]
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        now = now or time.time()
+        expired = [user_id for user_id, entry in self._entries.items() if entry.expires_at <= now]
+        for user_id in expired:
+            self.remove(user_id)
+        return len(expired)
+
+    def cells(self) -> int:
+        return sum(1 for cell in self._cells if len(cell) == self.precision)
+
+
+class PresenceService:
+    def __init__(self, storage, registry: PresenceRegistry, shared: bool = STORE == "shared", ttl: float = TTL_SECONDS):
+        self.storage = storage
+        self.registry = registry
+        self.shared = shared
+        self.ttl = ttl
+        self.heartbeats = 0
+        self.synced_at: Optional[datetime] = None
+
+    async def heartbeat(self, user_id: str, latitude: Optional[float] = None, longitude: Optional[float] = None) -> Optional[Presence]:
+        """Mark a tasker online; None when they are not a tasker or have no known location.
+
+        Only a tasker coming online costs a read, for their role, skills and
+        last location.
+        """
+        entry = self.registry.get(user_id)
+        if entry is not None:
+            skills = entry.skills
+            if latitude is None or longitude is None:
+                latitude, longitude = entry.latitude, entry.longitude
+        else:
+            user = await self.storage.users.get(user_id, {"role": 1, "skills": 1, "location": 1})
+            if user is None or user.get("role") not in TASKER_ROLES:
+                return None
+            skills = list(user.get("skills") or [])
+            if latitude is None or longitude is None:
+                location = user.get("location")
+                if not location:
+                    return None
+                latitude, longitude = location["latitude"], location["longitude"]
+        return await self._publish(user_id, latitude, longitude, skills)
+
+    async def refresh(self, user_id: str) -> Optional[Presence]:
+        """Extend the presence of a tasker already online, without any read."""
+        entry = self.registry.get(user_id)
+        if entry is None:
+            return None
+        return await self._publish(user_id, entry.latitude, entry.longitude, entry.skills)
+
+    async def moved(self, user_id: str, latitude: float, longitude: float):
+        entry = self.registry.get(user_id)
+        if entry is not None:
+            await self._publish(user_id, latitude, longitude, entry.skills)
+
+    async def profile_changed(self, user_id: str, role: Optional[str], skills: Optional[List[str]]):
+        """Apply an edit of an online tasker's role or skills; heartbeats never re-read them."""
+        entry = self.registry.get(user_id)
+        if entry is None:
+            return
+        if role not in TASKER_ROLES:
+            await self.offline(user_id)
+        else:
+            await self._publish(user_id, entry.latitude, entry.longitude, list(skills or []), entry.expires_at)
+
+    async def _publish(
+        self, user_id: str, latitude: float, longitude: float, skills: List[str], expires_at: Optional[float] = None
+    ) -> Presence:
+        if expires_at is None:
+            self.heartbeats += 1
+            expires_at = time.time() + self.ttl
+        entry = self.registry.update(user_id, latitude, longitude, skills, expires_at)
+        if self.shared:
+            await self.storage.presence.publish(
+                user_id, latitude, longitude, skills, datetime.utcfromtimestamp(expires_at)
+            )
+        return entry
+
+    async def offline(self, user_id: str):
+        entry = self.registry.get(user_id)
+        self.registry.remove(user_id)
+        if self.shared and entry is not None:
+            # Expired rather than deleted, so the other workers' pulls see it
+            await self.storage.presence.publish(
+                user_id, entry.latitude, entry.longitude, entry.skills, datetime.utcnow()
+            )
+
+    def _apply(self, documents: Iterable[dict]):
+        for document in documents:
+            expires_at = (document["expires_at"] - datetime(1970, 1, 1)).total_seconds()
+            if expires_at <= time.time():
+                self.registry.remove(document["_id"])
+            else:
+                self.registry.update(
+                    document["_id"], document["latitude"], document["longitude"], document["skills"], expires_at
+                )
+
+    async def sync(self):
+        """Pull the presence changes written by other workers."""
+        pulled_at = datetime.utcnow()
+        # Overlap the previous pull a little; applying an entry twice is harmless
+        since = self.synced_at - timedelta(seconds=1) if self.synced_at else pulled_at - timedelta(seconds=self.ttl)
+        self._apply(await self.storage.presence.changed_since(since))
+        self.synced_at = pulled_at
+
+    async def run(self):
+        swept_at = time.monotonic()
+        while True:
+            try:
+                if self.shared:
+                    await self.sync()
+                if time.monotonic() - swept_at >= SWEEP_SECONDS:
+                    self.registry.sweep()
+                    swept_at = time.monotonic()
+            except Exception:
+                logger.exception("presence sync failed")
+            await asyncio.sleep(SYNC_SECONDS if self.shared else SWEEP_SECONDS)
+
+    def stats(self) -> dict:
+        return {
+            "store": "shared" if self.shared else "memory",
+            "online": self.registry.online(),
+            "cells": self.registry.cells(),
+            "heartbeats": self.heartbeats,
+            "queries": self.registry.queries,
+            "synced_at": self.synced_at.isoformat() if self.synced_at else None,
+        }
+
+
+def install(storage) -> PresenceService:
+    service = PresenceService(storage, PresenceRegistry())
+    metrics.register("presence", service.stats)
+    return service
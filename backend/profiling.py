@@ -0,0 +1,308 @@
+"""Opt-in per-request profiling and slow-query logging.
+
+Nothing in here runs unless it is switched on through the environment:
+
+* ``PROFILE_SAMPLE_RATE`` - fraction (0..1) of requests to profile.
+* ``PROFILE_ALLOW_HEADER`` - when true, a request carrying ``X-Profile: 1``
+  is always profiled.
+* ``PROFILE_DUMP_DIR`` - directory receiving one ``.prof`` (pstats) file per
+  profiled request. Without it the top functions are logged instead.
+* ``SLOW_QUERY_MS`` - log every Mongo command slower than this, together with
+  its filter shape and the ``explain()`` winning plan.
+
+When all of them are unset the middleware is not installed and no command
+listener is registered on the Mongo client, so the disabled cost is zero.
+"""
+import asyncio
+import io
+import logging
+import os
+import random
+import time
+import uuid
+from contextvars import ContextVar
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from pymongo import monitoring
+
+if TYPE_CHECKING:
+    import cProfile
+    import pstats
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile"
+
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0") or 0)
+ALLOW_HEADER = os.environ.get("PROFILE_ALLOW_HEADER", "").lower() in ("1", "true", "yes")
+DUMP_DIR = os.environ.get("PROFILE_DUMP_DIR") or None
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "0") or 0)
+
+# Commands worth an explain() when they are slow
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+
+# Self-time of functions living in these files is attributed to a stage
+VALIDATION_MARKERS = ("pydantic", "fastapi/_compat")
+ENCODE_MARKERS = ("fastapi/encoders", "json/encoder", "json/__init__", "starlette/responses")
+
+_current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("request_profile", default=None)
+
+
+def profiling_enabled() -> bool:
+    return SAMPLE_RATE > 0 or ALLOW_HEADER
+
+
+def slow_query_logging_enabled() -> bool:
+    return SLOW_QUERY_MS > 0
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.db_ms = 0.0
+        self.db_commands = 0
+        self.validation_ms = 0.0
+        self.encode_ms = 0.0
+        self.total_ms = 0.0
+        self.profiler: Optional["cProfile.Profile"] = None
+
+    def add_db_time(self, duration_ms: float):
+        self.db_ms += duration_ms
+        self.db_commands += 1
+
+    def attribute_stages(self, stats: "pstats.Stats"):
+        for (filename, _, funcname), (_, _, tottime, _, _) in stats.stats.items():
+            location = filename.replace("\\", "/") + ":" + funcname
+            if any(marker in location for marker in VALIDATION_MARKERS):
+                self.validation_ms += tottime * 1000
+            elif any(marker in location for marker in ENCODE_MARKERS):
+                self.encode_ms += tottime * 1000
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "total_ms": round(self.total_ms, 3),
+            "db_ms": round(self.db_ms, 3),
+            "db_commands": self.db_commands,
+            "validation_ms": round(self.validation_ms, 3),
+            "encode_ms": round(self.encode_ms, 3),
+        }
+
+    def server_timing(self) -> bytes:
+        return (
+            f"db;dur={self.db_ms:.2f}, validation;dur={self.validation_ms:.2f}, "
+            f"encode;dur={self.encode_ms:.2f}, total;dur={self.total_ms:.2f}"
+        ).encode()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling sampled or explicitly requested requests.
+
+    The cProfile run covers the event loop thread only; Mongo time is measured
+    separately through the command listener because Motor runs pymongo on an
+    executor thread. Only one cProfile run can be active per interpreter, so
+    requests overlapping a running one get the DB breakdown only.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._profiler_busy = False
+
+    def _should_profile(self, scope) -> bool:
+        if ALLOW_HEADER:
+            for name, value in scope.get("headers", ()):
+                if name == PROFILE_HEADER:
+                    return value not in (b"0", b"false")
+        return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = _current_profile.set(profile)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                # Stages are only known once the body has been rendered, which
+                # for regular responses happens before the start message
+                _finish(profile, started)
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", profile.server_timing()))
+                headers.append((b"x-profile-id", profile.id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        owns_profiler = not self._profiler_busy
+        if owns_profiler:
+            # Imported here so the disabled path never loads the profilers
+            import cProfile
+
+            self._profiler_busy = True
+            profile.profiler = cProfile.Profile()
+            profile.profiler.enable()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            if owns_profiler:
+                profile.profiler.disable()
+                self._profiler_busy = False
+            _current_profile.reset(token)
+            if not profile.total_ms:
+                _finish(profile, started)
+            _report(profile)
+
+
+def _finish(profile: RequestProfile, started: float):
+    profile.total_ms = (time.perf_counter() - started) * 1000
+    if profile.profiler is not None:
+        import pstats
+
+        profile.profiler.disable()
+        profile.attribute_stages(pstats.Stats(profile.profiler))
+
+
+def _report(profile: RequestProfile):
+    logger.info("request profile %s", profile.summary())
+    if profile.profiler is None:
+        return
+    if DUMP_DIR:
+        path = Path(DUMP_DIR)
+        path.mkdir(parents=True, exist_ok=True)
+        profile.profiler.dump_stats(str(path / f"{int(time.time())}-{profile.id}.prof"))
+    elif logger.isEnabledFor(logging.DEBUG):
+        import pstats
+
+        out = io.StringIO()
+        pstats.Stats(profile.profiler, stream=out).sort_stats("cumulative").print_stats(25)
+        logger.debug("profile %s\n%s", profile.id, out.getvalue())
+
+
+def filter_shape(value: Any) -> Any:
+    """Replace literal values by 1, keeping field names and operators."""
+    if isinstance(value, dict):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # $in: [..] and friends collapse to a single placeholder
+        return [filter_shape(value[0])] if value else []
+    return 1
+
+
+def _command_filter(command_name: str, command: Dict[str, Any]) -> Any:
+    if command_name in ("find", "count", "distinct", "findAndModify"):
+        return command.get("filter", command.get("query", {}))
+    if command_name == "aggregate":
+        return command.get("pipeline", [])
+    if command_name == "update":
+        return [update.get("q", {}) for update in command.get("updates", [])[:1]]
+    if command_name == "delete":
+        return [delete.get("q", {}) for delete in command.get("deletes", [])[:1]]
+    return {}
+
+
+def _winning_plan(explain_result: Dict[str, Any]) -> Any:
+    planner = explain_result.get("queryPlanner")
+    if planner is None:
+        # Aggregations nest the planner under their first stage
+        stages = explain_result.get("stages") or [{}]
+        planner = stages[0].get("$cursor", {}).get("queryPlanner", {})
+    return planner.get("winningPlan")
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Feeds DB time into the active request profile and logs slow commands.
+
+    Motor copies the context into its executor, so the request's profile is
+    visible here even though the callbacks run off the event loop.
+    """
+
+    def __init__(self, threshold_ms: float):
+        self.threshold_ms = threshold_ms
+        self.client = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: Dict[Any, tuple] = {}
+
+    def bind(self, client, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.client = client
+        self.loop = loop
+
+    def _key(self, event):
+        return (event.connection_id, event.request_id)
+
+    def started(self, event):
+        if self.threshold_ms and event.command_name in EXPLAINABLE_COMMANDS:
+            self._pending[self._key(event)] = (event.database_name, event.command_name, event.command)
+
+    def succeeded(self, event):
+        self._complete(event)
+
+    def failed(self, event):
+        self._complete(event)
+
+    def _complete(self, event):
+        duration_ms = event.duration_micros / 1000
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.add_db_time(duration_ms)
+
+        pending = self._pending.pop(self._key(event), None)
+        if pending is None or duration_ms < self.threshold_ms:
+            return
+        database_name, command_name, command = pending
+        shape = filter_shape(_command_filter(command_name, command))
+        collection = command.get(command_name)
+        if self.client is None or self.loop is None or self.loop.is_closed():
+            logger.warning(
+                "slow query %.1fms %s.%s %s filter=%s",
+                duration_ms, database_name, collection, command_name, shape,
+            )
+            return
+        asyncio.run_coroutine_threadsafe(
+            self._explain_and_log(database_name, command_name, command, shape, duration_ms),
+            self.loop,
+        )
+
+    async def _explain_and_log(self, database_name, command_name, command, shape, duration_ms):
+        explainable = {key: value for key, value in command.items() if not key.startswith("$") and key != "lsid"}
+        try:
+            result = await self.client[database_name].command(
+                {"explain": explainable, "verbosity": "queryPlanner"}
+            )
+            plan = _winning_plan(result)
+        except Exception as exc:  # explain is best-effort diagnostics
+            plan = f"<explain failed: {exc}>"
+        logger.warning(
+            "slow query %.1fms %s.%s %s filter=%s winning_plan=%s",
+            duration_ms, database_name, command.get(command_name), command_name, shape, plan,
+        )
+
+
+_listener: Optional[SlowQueryListener] = None
+
+
+def command_listeners() -> List[monitoring.CommandListener]:
+    """Listeners to hand to the Mongo client; empty when profiling is off."""
+    global _listener
+    if not (profiling_enabled() or slow_query_logging_enabled()):
+        return []
+    if _listener is None:
+        _listener = SlowQueryListener(SLOW_QUERY_MS)
+    return [_listener]
+
+
+def bind_client(client):
+    """Give the slow-query listener a client and loop to run explain() on."""
+    if _listener is not None:
+        _listener.bind(client, asyncio.get_running_loop())
+
+
+def install(app):
+    if profiling_enabled():
+        app.add_middleware(ProfilingMiddleware)
@@ -0,0 +1,277 @@
+"""Per-user rate limiting and overload shedding.
+
+Every HTTP request is charged to the peer address (as rewritten by
+uvicorn's proxy headers support for ``--forwarded-allow-ips``) and, when it
+claims one, to a user: the ``X-User-Id`` header, else the user id in a
+``/api/users/{id}`` or ``/api/taskers/{id}`` path. The user is not
+authenticated, so its buckets only split an address's allowance fairly;
+the address buckets, ``RATE_LIMIT_ADDRESS_FACTOR`` times larger to leave
+room for several users behind one NAT, bound what any client gets however
+many users it claims. Each key draws from two token buckets:
+
+* a bucket shared by all routes
+  (``RATE_LIMIT_DEFAULT_RATE`` per second, ``RATE_LIMIT_DEFAULT_BURST``), and
+* the bucket of the first matching route rule, if any.
+
+``RATE_LIMIT_RULES`` lists the route rules as ``METHOD path rate burst``
+entries separated by ``;``. A ``*`` in the path matches one path segment.
+An exhausted bucket gets ``429`` with ``Retry-After``.
+
+Route buckets live in process memory. With ``RATE_LIMIT_STORE=shared`` they
+are kept in the ``rate_limits`` collection instead, so all workers and pods
+share one allowance, at two extra round trips per limited request and key.
+The all-routes buckets always stay in memory, at most
+``RATE_LIMIT_MAX_MEMORY_BUCKETS`` of them; beyond that the least recently
+used are dropped.
+
+Admission control sheds load before it queues. A request gets ``503`` with
+``Retry-After`` when more than ``SHED_MAX_IN_FLIGHT`` requests are waiting
+for their response to start, or when event-loop lag is above
+``SHED_MAX_LOOP_LAG_MS``. Streams stop counting once their headers are
+sent. ``/api/metrics`` is never limited, and the limiter reports its state
+there under ``ratelimit``.
+"""
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+STORE = os.environ.get("RATE_LIMIT_STORE", "memory")
+DEFAULT_RATE = float(os.environ.get("RATE_LIMIT_DEFAULT_RATE", "50"))
+DEFAULT_BURST = int(os.environ.get("RATE_LIMIT_DEFAULT_BURST", "100"))
+ADDRESS_FACTOR = float(os.environ.get("RATE_LIMIT_ADDRESS_FACTOR", "5"))
+MAX_MEMORY_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_MEMORY_BUCKETS", "100000"))
+RULES = os.environ.get(
+    "RATE_LIMIT_RULES",
+    "POST /api/messages 2 10; PUT /api/users/*/location 1 5",
+)
+MAX_IN_FLIGHT = int(os.environ.get("SHED_MAX_IN_FLIGHT", "256"))
+MAX_LOOP_LAG_MS = float(os.environ.get("SHED_MAX_LOOP_LAG_MS", "250"))
+
+LAG_PROBE_SECONDS = 0.1
+EXEMPT_PATHS = {"/api/metrics"}
+USER_HEADER = b"x-user-id"
+USER_PATH = re.compile(r"^/api/(?:users|taskers)/([^/:]+)")
+
+
+def path_pattern(path: str):
+    """Compile a route path in which ``*`` matches one segment."""
+    return re.compile("^" + "/".join("[^/]+" if part == "*" else re.escape(part) for part in path.split("/")) + "$")
+
+
+class Rule:
+    def __init__(self, method: str, path: str, rate: float, burst: int):
+        self.name = f"{method} {path}"
+        self.method = method
+        self.rate = rate
+        self.burst = burst
+        self._path = path_pattern(path)
+
+    def matches(self, method: str, path: str) -> bool:
+        return method == self.method and self._path.match(path) is not None
+
+
+def parse_rules(spec: str) -> List[Rule]:
+    rules = []
+    for entry in spec.split(";"):
+        if not entry.strip():
+            continue
+        method, path, rate, burst = entry.split()
+        rules.append(Rule(method.upper(), path, float(rate), int(burst)))
+    return rules
+
+
+class MemoryBuckets:
+    """Token buckets in process memory, refilled lazily on access.
+
+    Kept in least recently used order and capped at ``max_buckets``, so a
+    flood of new keys costs one eviction per request.
+    """
+
+    def __init__(self, max_buckets: int = MAX_MEMORY_BUCKETS):
+        self.max_buckets = max_buckets
+        self.evicted = 0
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()  # key -> (tokens, updated)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        self._buckets[key] = (tokens - 1, now) if tokens >= 1 else (tokens, now)
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+            self.evicted += 1
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+
+class Limiter:
+    def __init__(self, rules: List[Rule], default_rate: float = DEFAULT_RATE, default_burst: int = DEFAULT_BURST,
+                 store: str = STORE, max_in_flight: int = MAX_IN_FLIGHT, max_loop_lag_ms: float = MAX_LOOP_LAG_MS,
+                 address_factor: float = ADDRESS_FACTOR):
+        self.rules = rules
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.address_factor = address_factor
+        self.store = store
+        self.max_in_flight = max_in_flight
+        self.max_loop_lag_ms = max_loop_lag_ms
+        self.buckets = MemoryBuckets()
+        self.in_flight = 0
+        self.loop_lag_ms = 0.0
+        self.limited: Dict[str, int] = {}
+        self.shed = {"in_flight": 0, "loop_lag": 0}
+        self._monitor: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.max_loop_lag_ms > 0 and self._monitor is None:
+            self._monitor = asyncio.create_task(self._watch_loop_lag())
+
+    async def stop(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+
+    async def _watch_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LAG_PROBE_SECONDS)
+            lag = max(0.0, (loop.time() - started - LAG_PROBE_SECONDS) * 1000)
+            # React to a stall at once, recover gradually
+            self.loop_lag_ms = lag if lag > self.loop_lag_ms else self.loop_lag_ms * 0.7 + lag * 0.3
+
+    @staticmethod
+    def client_keys(scope) -> Tuple[str, Optional[str]]:
+        """The peer address key and the claimed user key, if any."""
+        client = scope.get("client")
+        address = "addr:" + (client[0] if client else "unknown")
+        for name, value in scope.get("headers", ()):
+            if name == USER_HEADER and value:
+                return address, "user:" + value.decode("latin-1")
+        match = USER_PATH.match(scope["path"])
+        return address, ("user:" + match.group(1) if match else None)
+
+    def _charged(self, scope) -> List[Tuple[str, float]]:
+        # (key, allowance factor); an address without a claimed user is one client
+        address, user = self.client_keys(scope)
+        if user is None:
+            return [(address, 1)]
+        return [(address, self.address_factor), (user, 1)]
+
+    def overloaded(self) -> Optional[str]:
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return "in_flight"
+        if self.max_loop_lag_ms and self.loop_lag_ms > self.max_loop_lag_ms:
+            return "loop_lag"
+        return None
+
+    async def _take_rule(self, scope, rule: Rule, key: str, factor: float, now: float) -> float:
+        bucket_key = f"{rule.name}|{key}"
+        storage = getattr(scope["app"].state, "storage", None) if "app" in scope else None
+        if self.store == "shared" and storage is not None:
+            return await storage.rate_limits.take(bucket_key, rule.rate * factor, rule.burst * factor, time.time())
+        return self.buckets.take(bucket_key, rule.rate * factor, rule.burst * factor, now)
+
+    async def check(self, scope) -> Optional[Tuple[str, float]]:
+        """The rule name and wait in seconds when the request is over a limit."""
+        keys = self._charged(scope)
+        now = time.monotonic()
+        for key, factor in keys:
+            wait = self.buckets.take(f"*|{key}", self.default_rate * factor, self.default_burst * factor, now)
+            if wait:
+                return "*", wait
+        for rule in self.rules:
+            if rule.matches(scope["method"], scope["path"]):
+                for key, factor in keys:
+                    wait = await self._take_rule(scope, rule, key, factor, now)
+                    if wait:
+                        return rule.name, wait
+                return None
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "loop_lag_ms": round(self.loop_lag_ms, 2),
+            "max_loop_lag_ms": self.max_loop_lag_ms,
+            "shed": dict(self.shed),
+            "limited": dict(self.limited),
+            "memory_buckets": len(self.buckets),
+            "memory_buckets_evicted": self.buckets.evicted,
+            "store": self.store,
+        }
+
+
+async def _reject(send, status: int, retry_after: float, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, limiter: Limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        limiter = self.limiter
+        reason = limiter.overloaded()
+        if reason:
+            limiter.shed[reason] += 1
+            await _reject(send, 503, 1, "Server is overloaded, retry shortly")
+            return
+        limited = await limiter.check(scope)
+        if limited:
+            name, wait = limited
+            limiter.limited[name] = limiter.limited.get(name, 0) + 1
+            await _reject(send, 429, wait, "Too many requests")
+            return
+
+        limiter.in_flight += 1
+        counted = True
+
+        async def send_and_release(message):
+            nonlocal counted
+            if counted and message["type"] == "http.response.start":
+                counted = False
+                limiter.in_flight -= 1
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_release)
+        finally:
+            if counted:
+                limiter.in_flight -= 1
+
+
+def install(app) -> Optional[Limiter]:
+    if not ENABLED:
+        return None
+    limiter = Limiter(parse_rules(RULES))
+    app.add_middleware(RateLimitMiddleware, limiter=limiter)
+    app.add_event_handler("startup", limiter.start)
+    app.add_event_handler("shutdown", limiter.stop)
+    metrics.register("ratelimit", limiter.stats)
+    return limiter
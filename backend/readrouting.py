@@ -0,0 +1,131 @@
+"""Read routing: staleness-tolerant routes on secondaries, read-your-writes by token.
+
+Routes in ``READ_SECONDARY_ROUTES`` (``METHOD path`` entries separated by
+``;``, ``*`` matching one path segment) read from a secondary that lags the
+primary by at most ``READ_MAX_STALENESS_SECONDS`` (90 at least, the lowest
+bound Mongo accepts). They fall back to the primary when no secondary
+qualifies. Every other route reads from the primary.
+
+A response to a request that touched the database in a causally consistent
+session carries an ``X-Causal-Token`` header: the cluster and operation
+time of its last write. A client that sends the token back reads in a
+causally consistent session, so a secondary waits until it has applied that
+write before answering (bounded by the request deadline). Only the Mongo
+engine routes reads, and only replica sets return tokens.
+"""
+import base64
+import binascii
+import os
+from typing import Any, List, Optional, Tuple
+
+import bson
+from bson import Timestamp
+
+import metrics
+from ratelimit import path_pattern
+from storage import ReadRouting, current_routing
+
+ENABLED = os.environ.get("READ_ROUTING_ENABLED", "1") == "1"
+SECONDARY_ROUTES = os.environ.get(
+    "READ_SECONDARY_ROUTES",
+    "GET /api/tasks; GET /api/reviews/*; GET /api/dashboard/*; GET /api/analytics/*",
+)
+MAX_STALENESS_SECONDS = max(90, int(os.environ.get("READ_MAX_STALENESS_SECONDS", "90")))
+
+HEADER = b"x-causal-token"
+RESPONSE_HEADER = "X-Causal-Token"
+
+
+def encode_token(routing: ReadRouting) -> str:
+    raw = bson.encode({"c": routing.cluster_time, "o": routing.operation_time})
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_token(value: str) -> Optional[Tuple[dict, Timestamp]]:
+    try:
+        document = bson.decode(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+    except (binascii.Error, bson.errors.BSONError, ValueError):
+        return None
+    cluster_time, operation_time = document.get("c"), document.get("o")
+    if not isinstance(operation_time, Timestamp):
+        return None
+    if not isinstance(cluster_time, dict) or not isinstance(cluster_time.get("clusterTime"), Timestamp):
+        return None
+    return cluster_time, operation_time
+
+
+def parse_routes(spec: str) -> List[Tuple[str, Any]]:
+    routes = []
+    for entry in spec.split(";"):
+        if not entry.strip():
+            continue
+        method, path = entry.split()
+        routes.append((method.upper(), path_pattern(path)))
+    return routes
+
+
+class RoutingStats:
+    def __init__(self):
+        self.primary = 0
+        self.secondary = 0
+        self.causal = 0
+        self.tokens_issued = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "max_staleness_seconds": MAX_STALENESS_SECONDS,
+            "requests": {"primary": self.primary, "secondary": self.secondary},
+            "causal_requests": self.causal,
+            "tokens_issued": self.tokens_issued,
+        }
+
+
+class ReadRoutingMiddleware:
+    def __init__(self, app, routes: List[Tuple[str, Any]], stats: RoutingStats):
+        self.app = app
+        self.routes = routes
+        self.stats = stats
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method, path = scope["method"], scope["path"]
+        routing = ReadRouting(
+            secondary=any(method == route_method and pattern.match(path) for route_method, pattern in self.routes),
+            max_staleness_seconds=MAX_STALENESS_SECONDS,
+        )
+        for name, value in scope.get("headers", ()):
+            if name == HEADER:
+                token = decode_token(value.decode("latin-1"))
+                if token is not None:
+                    routing.cluster_time, routing.operation_time = token
+                    self.stats.causal += 1
+                break
+        if routing.secondary:
+            self.stats.secondary += 1
+        else:
+            self.stats.primary += 1
+
+        async def send_with_token(message):
+            if message["type"] == "http.response.start" and routing.operation_time is not None:
+                self.stats.tokens_issued += 1
+                headers = list(message.get("headers", ()))
+                headers.append((RESPONSE_HEADER.lower().encode(), encode_token(routing).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = current_routing.set(routing)
+        try:
+            await self.app(scope, receive, send_with_token)
+        finally:
+            current_routing.reset(token)
+
+
+def install(app) -> Optional[RoutingStats]:
+    if not ENABLED:
+        return None
+    stats = RoutingStats()
+    app.add_middleware(ReadRoutingMiddleware, routes=parse_routes(SECONDARY_ROUTES), stats=stats)
+    metrics.register("read_routing", stats.snapshot)
+    return stats
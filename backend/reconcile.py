@@ -0,0 +1,426 @@
+"""Nightly reconciliation of payments and wallets against the payment gateway.
+
+Streams our payments created in a date range in ``gateway_payment_id``
+order and merge-joins them with the gateway's settlement file for the same
+range (CSV with a header, or NDJSON, with ``gateway_payment_id``, ``amount``
+in major units and ``status`` per row). Both sides are read a row at a time
+and writes go out every ``--batch`` rows as one unordered bulk write, so the
+run takes constant memory however many rows there are.
+
+For each payment:
+
+- matching amounts and a settled, failed or refunded gateway status that
+  differs from ours correct the payment's status (guarded on the status we
+  read, so a concurrent change wins) and stamp ``reconciled_at``;
+- anything else that disagrees is written to ``payment_discrepancies``:
+  ``amount_mismatch``, ``status_mismatch``, ``unknown_status``,
+  ``missing_at_gateway`` (older than ``--grace-hours``), ``missing_locally``
+  (after checking it wasn't just created outside the range) and
+  ``duplicate_local`` / ``duplicate_at_gateway``.
+
+``--wallets`` also merge-joins every wallet with its ``wallet_ledger``
+entries and records ``wallet_balance_mismatch`` where the balance isn't the
+sum of its ledger. Wallet changes made before the ledger existed show up
+here until an opening entry is added for them.
+
+The settlement file has to be sorted by ``gateway_payment_id``, which is
+checked before anything is written; pass ``--sort`` to sort it out of core
+instead. ``standin`` writes a settlement file from our own payments to run
+against locally::
+
+    python reconcile.py standin settlement.csv --since 2024-05-01 --noise 0.01
+    python reconcile.py run settlement.csv --since 2024-05-01 --wallets --report recon.json
+    python reconcile.py run settlement.ndjson --dry-run   # yesterday, no writes
+"""
+import argparse
+import asyncio
+import csv
+import heapq
+import itertools
+import json
+import random
+import tempfile
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+from typing import AsyncIterator, Iterator, List, Optional, Tuple, TypeVar
+
+from dotenv import load_dotenv
+
+from storage import PaymentDiscrepancyRepo, create_storage
+
+ROOT_DIR = Path(__file__).parent
+
+# What create_payment stores until a gateway is wired in; never settles
+PLACEHOLDER_GATEWAY_ID = "xxxx-enter-gateway-api-here-xxxx"
+GATEWAY_STATUSES = {
+    "settled": "completed",
+    "succeeded": "completed",
+    "completed": "completed",
+    "failed": "failed",
+    "declined": "failed",
+    "refunded": "refunded",
+    "pending": "pending",
+}
+FIELDS = ("gateway_payment_id", "amount", "status")
+PAYMENT_PROJECTION = {"_id": 0, "id": 1, "gateway_payment_id": 1, "amount": 1, "status": 1, "created_at": 1}
+BY_GATEWAY_ID = [("gateway_payment_id", 1), ("created_at", 1)]
+
+T = TypeVar("T")
+
+
+class SettlementError(Exception):
+    pass
+
+
+def minor_units(value) -> int:
+    """Money as integer minor units, so amounts compare exactly."""
+    return int((Decimal(str(value)) * 100).to_integral_value())
+
+
+def settlement_format(path: Path, format: Optional[str] = None) -> str:
+    return format or ("csv" if path.suffix.lower() == ".csv" else "ndjson")
+
+
+def read_settlement(path: Path, format: Optional[str] = None) -> Iterator[dict]:
+    """Settlement rows with amounts in minor units, one at a time."""
+    with path.open(newline="") as file:
+        if settlement_format(path, format) == "csv":
+            rows = csv.DictReader(file)
+        else:
+            rows = (json.loads(line) for line in file if line.strip())
+        for number, row in enumerate(rows, 1):
+            try:
+                yield {
+                    "gateway_payment_id": str(row["gateway_payment_id"]),
+                    "amount": minor_units(row["amount"]),
+                    "status": str(row["status"]).strip().lower(),
+                }
+            except (KeyError, TypeError, InvalidOperation) as exc:
+                raise SettlementError(f"{path}: row {number} is not a settlement row: {exc!r}") from exc
+
+
+def check_sorted(rows: Iterator[dict]) -> int:
+    """Row count of a settlement sorted by gateway id; read through before the
+    merge, which would otherwise have written findings by the time it noticed."""
+    previous = None
+    number = 0
+    for number, row in enumerate(rows, 1):
+        if previous is not None and row["gateway_payment_id"] < previous:
+            raise SettlementError(f"settlement row {number} is out of gateway_payment_id order; rerun with --sort")
+        previous = row["gateway_payment_id"]
+    return number
+
+
+def _chunks(rows: Iterator[T], size: int) -> Iterator[List[T]]:
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sort_rows(rows: Iterator[dict], chunk_size: int, directory: str) -> Iterator[dict]:
+    """``rows`` by gateway id, holding ``chunk_size`` rows at a time: sorted runs are
+    spilled to ``directory`` and merged."""
+    runs = []
+    for chunk in _chunks(rows, chunk_size):
+        chunk.sort(key=lambda row: row["gateway_payment_id"])
+        run = tempfile.TemporaryFile("w+", dir=directory)
+        run.writelines(json.dumps(row) + "\n" for row in chunk)
+        run.seek(0)
+        runs.append(run)
+    try:
+        yield from heapq.merge(*((json.loads(line) for line in run) for run in runs), key=lambda row: row["gateway_payment_id"])
+    finally:
+        for run in runs:
+            run.close()
+
+
+async def _next(items: AsyncIterator[T]) -> Optional[T]:
+    return await anext(items, None)
+
+
+class Reconciler:
+    def __init__(
+        self,
+        storage,
+        since: datetime,
+        until: datetime,
+        batch: int = 1000,
+        grace: timedelta = timedelta(hours=24),
+        dry_run: bool = False,
+    ):
+        self.storage = storage
+        self.since = since
+        self.until = until
+        self.batch = batch
+        self.grace = grace
+        self.dry_run = dry_run
+        self.run_id = str(uuid.uuid4())
+        self.now = datetime.utcnow()
+        self.counts: Counter = Counter()
+        self._corrections: List[Tuple[dict, dict]] = []
+        self._findings: List[Tuple[dict, dict]] = []
+        self._unmatched: List[dict] = []
+
+    def _find(self, kind: str, subject: Tuple[Optional[str], ...], **details):
+        self.counts[kind] += 1
+        self._findings.append((
+            {"id": PaymentDiscrepancyRepo.discrepancy_id(kind, *subject)},
+            {
+                "$set": {"kind": kind, "run_id": self.run_id, "last_seen_at": self.now, **details},
+                "$setOnInsert": {"first_seen_at": self.now},
+            },
+        ))
+
+    async def _write(self, final: bool = False):
+        if self._unmatched and (final or len(self._unmatched) >= self.batch):
+            await self._check_unmatched()
+        if self._corrections and (final or len(self._corrections) >= self.batch):
+            corrections, self._corrections = self._corrections, []
+            if not self.dry_run:
+                applied = await self.storage.payments.bulk_update(corrections)
+                # Payments whose status moved since we read them
+                self.counts["correction_conflicts"] += len(corrections) - applied
+        if self._findings and (final or len(self._findings) >= self.batch):
+            findings, self._findings = self._findings, []
+            if not self.dry_run:
+                await self.storage.payment_discrepancies.bulk_update(findings, upsert=True)
+
+    async def _check_unmatched(self):
+        rows, self._unmatched = self._unmatched, []
+        outside = await self.storage.payments.find(
+            {"gateway_payment_id": {"$in": [row["gateway_payment_id"] for row in rows]}},
+            {"_id": 0, "gateway_payment_id": 1},
+            limit=0,
+        )
+        outside = {payment["gateway_payment_id"] for payment in outside}
+        for row in rows:
+            if row["gateway_payment_id"] in outside:
+                self.counts["outside_range"] += 1
+                continue
+            self._find(
+                "missing_locally", (row["gateway_payment_id"],),
+                gateway_payment_id=row["gateway_payment_id"],
+                gateway_amount=row["amount"] / 100,
+                gateway_status=row["status"],
+            )
+
+    def _missing_at_gateway(self, payment: dict):
+        if payment["created_at"] > self.now - self.grace:
+            self.counts["awaiting_settlement"] += 1
+            return
+        self._find(
+            "missing_at_gateway", (payment["gateway_payment_id"], payment["id"]),
+            gateway_payment_id=payment["gateway_payment_id"],
+            payment_id=payment["id"],
+            amount=payment["amount"],
+            status=payment["status"],
+        )
+
+    def _compare(self, payment: dict, row: dict):
+        subject = (payment["gateway_payment_id"], payment["id"])
+        details = {
+            "gateway_payment_id": payment["gateway_payment_id"],
+            "payment_id": payment["id"],
+            "amount": payment["amount"],
+            "gateway_amount": row["amount"] / 100,
+            "status": payment["status"],
+            "gateway_status": row["status"],
+        }
+        if minor_units(payment["amount"]) != row["amount"]:
+            self._find("amount_mismatch", subject, **details)
+            return
+        status = GATEWAY_STATUSES.get(row["status"])
+        if status is None:
+            self._find("unknown_status", subject, **details)
+        elif status == payment["status"]:
+            self.counts["matched"] += 1
+        elif status == "pending":
+            # Ours moved on without the gateway; nothing to correct it to
+            self._find("status_mismatch", subject, **details)
+        else:
+            self.counts["corrected"] += 1
+            self._corrections.append((
+                {"id": payment["id"], "status": payment["status"]},
+                {"$set": {"status": status, "reconciled_at": self.now}},
+            ))
+
+    async def payments(self, rows: Iterator[dict]):
+        in_range = {"created_at": {"$gte": self.since, "$lt": self.until}}
+        self.counts["without_gateway_id"] += await self.storage.payments.count(
+            {**in_range, "gateway_payment_id": PLACEHOLDER_GATEWAY_ID}
+        )
+        stream = self.storage.payments.stream(
+            {**in_range, "gateway_payment_id": {"$ne": PLACEHOLDER_GATEWAY_ID}},
+            PAYMENT_PROJECTION, BY_GATEWAY_ID, self.batch,
+        )
+        ours, theirs = await _next(stream), next(rows, None)
+        while ours is not None or theirs is not None:
+            if theirs is None or (ours is not None and ours["gateway_payment_id"] < theirs["gateway_payment_id"]):
+                self.counts["payments"] += 1
+                self._missing_at_gateway(ours)
+                ours = await _next(stream)
+            elif ours is None or theirs["gateway_payment_id"] < ours["gateway_payment_id"]:
+                self.counts["settlement_rows"] += 1
+                self._unmatched.append(theirs)
+                theirs = next(rows, None)
+            else:
+                key = ours["gateway_payment_id"]
+                self.counts["payments"] += 1
+                self.counts["settlement_rows"] += 1
+                self._compare(ours, theirs)
+                ours, theirs = await _next(stream), next(rows, None)
+                while ours is not None and ours["gateway_payment_id"] == key:
+                    self.counts["payments"] += 1
+                    self._find("duplicate_local", (key, ours["id"]), gateway_payment_id=key, payment_id=ours["id"])
+                    ours = await _next(stream)
+                while theirs is not None and theirs["gateway_payment_id"] == key:
+                    self.counts["settlement_rows"] += 1
+                    self._find("duplicate_at_gateway", (key,), gateway_payment_id=key, gateway_amount=theirs["amount"] / 100)
+                    theirs = next(rows, None)
+            await self._write()
+        await self._write(final=True)
+
+    async def wallets(self):
+        accounts = self.storage.payment_accounts.stream(
+            {"type": "neobank_wallet"}, {"_id": 0, "id": 1, "wallet_balance": 1}, [("id", 1)], self.batch
+        )
+        entries = self.storage.wallet_ledger.stream(
+            None, {"_id": 0, "account_id": 1, "amount": 1}, [("account_id", 1), ("created_at", 1)], self.batch
+        )
+        entry = await _next(entries)
+        async for account in accounts:
+            self.counts["wallets"] += 1
+            while entry is not None and entry["account_id"] < account["id"]:
+                # Ledger of an account that is gone or no longer a wallet
+                self.counts["orphan_ledger_entries"] += 1
+                entry = await _next(entries)
+            ledger = 0
+            while entry is not None and entry["account_id"] == account["id"]:
+                ledger += minor_units(entry["amount"])
+                entry = await _next(entries)
+            if minor_units(account.get("wallet_balance") or 0) != ledger:
+                self._find(
+                    "wallet_balance_mismatch", (account["id"],),
+                    account_id=account["id"],
+                    wallet_balance=account.get("wallet_balance") or 0,
+                    ledger_balance=ledger / 100,
+                )
+            await self._write()
+        while entry is not None:
+            self.counts["orphan_ledger_entries"] += 1
+            entry = await _next(entries)
+        await self._write(final=True)
+
+
+async def write_standin(storage, path: Path, since: datetime, until: datetime, format: Optional[str], noise: float, seed: int) -> int:
+    """Settle every payment of the range, perturbing a ``noise`` share of rows the
+    ways a real settlement file disagrees with us."""
+    chance = random.Random(seed)
+    format = settlement_format(path, format)
+    written = 0
+    with path.open("w", newline="") as file:
+        writer = csv.DictWriter(file, FIELDS) if format == "csv" else None
+        if writer:
+            writer.writeheader()
+        async for payment in storage.payments.stream(
+            {"created_at": {"$gte": since, "$lt": until}, "gateway_payment_id": {"$ne": PLACEHOLDER_GATEWAY_ID}},
+            PAYMENT_PROJECTION, BY_GATEWAY_ID,
+        ):
+            row = {"gateway_payment_id": payment["gateway_payment_id"], "amount": f"{payment['amount']:.2f}", "status": "settled"}
+            rows = [row]
+            if chance.random() < noise:
+                perturb = chance.choice(("drop", "amount", "failed", "refunded", "extra"))
+                if perturb == "drop":
+                    rows = []
+                elif perturb == "amount":
+                    row["amount"] = f"{payment['amount'] + 1:.2f}"
+                elif perturb == "extra":
+                    # Sorts right after this payment's id, so the file stays in order
+                    rows.append({**row, "gateway_payment_id": row["gateway_payment_id"] + "-x"})
+                else:
+                    row["status"] = perturb
+            for row in rows:
+                if writer:
+                    writer.writerow(row)
+                else:
+                    file.write(json.dumps(row) + "\n")
+                written += 1
+    return written
+
+
+def _day(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def _range(args) -> Tuple[datetime, datetime]:
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    since = _day(args.since) if args.since else today - timedelta(days=1)
+    until = _day(args.until) if args.until else since + timedelta(days=1)
+    return since, until
+
+
+async def main(args):
+    load_dotenv(ROOT_DIR / ".env")
+    storage = create_storage()
+    since, until = _range(args)
+    try:
+        if args.command == "standin":
+            written = await write_standin(storage, Path(args.path), since, until, args.format, args.noise, args.seed)
+            print(f"wrote {written} settlement rows for {since:%Y-%m-%d} to {until:%Y-%m-%d} to {args.path}")
+            return
+
+        reconciler = Reconciler(storage, since, until, args.batch, timedelta(hours=args.grace_hours), args.dry_run)
+        with tempfile.TemporaryDirectory() as spill:
+            rows = read_settlement(Path(args.path), args.format)
+            if args.sort:
+                rows = sort_rows(rows, args.sort_chunk, spill)
+            else:
+                check_sorted(rows)
+                rows = read_settlement(Path(args.path), args.format)
+            await reconciler.payments(rows)
+        if args.wallets:
+            await reconciler.wallets()
+
+        print(f"reconciliation {reconciler.run_id} of {since:%Y-%m-%d} to {until:%Y-%m-%d}{' (dry run)' if args.dry_run else ''}")
+        for name, count in sorted(reconciler.counts.items()):
+            print(f"  {name:<24}{count:>12}")
+        if args.report:
+            Path(args.report).write_text(json.dumps({
+                "run_id": reconciler.run_id,
+                "since": since.isoformat(),
+                "until": until.isoformat(),
+                "dry_run": args.dry_run,
+                "counts": dict(reconciler.counts),
+            }, indent=2))
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile payments and wallets against the gateway settlement.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="reconcile against a settlement file")
+    standin = commands.add_parser("standin", help="write a settlement file from our own payments")
+    for command in (run, standin):
+        command.add_argument("path", help="settlement file (.csv, otherwise NDJSON)")
+        command.add_argument("--format", choices=("csv", "ndjson"), help="override the format implied by the suffix")
+        command.add_argument("--since", help="first day, YYYY-MM-DD (default yesterday)")
+        command.add_argument("--until", help="day after the last, YYYY-MM-DD (default the day after --since)")
+    run.add_argument("--batch", type=int, default=1000, help="rows per read and per bulk write")
+    run.add_argument("--grace-hours", type=float, default=24, help="how long a payment may go unsettled")
+    run.add_argument("--sort", action="store_true", help="sort the settlement file first instead of requiring it sorted")
+    run.add_argument("--sort-chunk", type=int, default=100_000, help="rows held in memory per sorted run")
+    run.add_argument("--wallets", action="store_true", help="also check wallet balances against the ledger")
+    run.add_argument("--dry-run", action="store_true", help="count findings and corrections without writing")
+    run.add_argument("--report", help="write the counts as JSON to this path")
+    standin.add_argument("--noise", type=float, default=0.0, help="share of rows to drop or alter")
+    standin.add_argument("--seed", type=int, default=0)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except SettlementError as exc:
+        parser.exit(1, f"{exc}\n")
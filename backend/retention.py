@@ -0,0 +1,136 @@
+"""Data retention: archive closed chats and expire ephemeral data.
+
+Messages of tasks that were completed, cancelled or expired more than
+``MESSAGE_ARCHIVE_AFTER_DAYS`` ago move to monthly, zstd-compressed
+``messages_archive_YYYYMM`` collections. The thread's counter document
+records which months hold its messages, so ``get_task_messages`` finds them
+with the lookup it already does for the thread ETag. Location pings expire
+through a TTL index (swept here for engines without native TTL).
+
+Runs every ``RETENTION_INTERVAL_SECONDS`` inside the app (0 disables it) on
+whichever worker holds the ``retention`` lease, so pods never archive the
+same thread at once; or once from the command line::
+
+    python retention.py --days 30
+"""
+import asyncio
+import logging
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get("MESSAGE_ARCHIVE_AFTER_DAYS", "30"))
+INTERVAL_SECONDS = float(os.environ.get("RETENTION_INTERVAL_SECONDS", "3600"))
+BATCH_TASKS = int(os.environ.get("RETENTION_BATCH_TASKS", "100"))
+LEASE_NAME = "retention"
+
+CLOSED_STATUSES = ["completed", "cancelled", "expired"]
+
+
+async def archive_task_messages(storage, task_id: str) -> int:
+    messages = await storage.messages.find(
+        {"task_id": task_id}, {"_id": 0}, sort=[("created_at", 1)], limit=0
+    )
+    by_month: Dict[str, List[dict]] = defaultdict(list)
+    for message in messages:
+        by_month[message["created_at"].strftime("%Y%m")].append(message)
+
+    for month, batch in by_month.items():
+        archive = await storage.message_archive(month)
+        # Clearing first makes a rerun after a partial failure idempotent
+        await archive.delete_many({"task_id": task_id, "id": {"$in": [message["id"] for message in batch]}})
+        await archive.insert_many(batch)
+    if by_month:
+        await storage.messages.mark_thread_archived(task_id, sorted(by_month))
+
+    # Internal bookkeeping skips change tracking: moving a thread is not a
+    # change clients should see in delta sync or as a new version
+    await storage.tasks.untracked.update_one(
+        {"id": task_id}, {"$set": {"messages_archived_at": datetime.utcnow()}}
+    )
+    if messages:
+        await storage.messages.untracked.delete_many({"task_id": task_id, "id": {"$in": [m["id"] for m in messages]}})
+    return len(messages)
+
+
+async def archive_closed_threads(storage, older_than_days: int = ARCHIVE_AFTER_DAYS, batch: int = BATCH_TASKS) -> Dict[str, int]:
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    query = {
+        "status": {"$in": CLOSED_STATUSES},
+        "messages_archived_at": {"$exists": False},
+        "$or": [
+            {"completed_at": {"$lt": cutoff}},
+            {"expired_at": {"$lt": cutoff}},
+            {"status": "cancelled", "cancelled_at": {"$lt": cutoff}},
+            # Cancelled before cancelled_at was recorded; the last write marks it
+            {"status": "cancelled", "cancelled_at": None, "updated_at": {"$lt": cutoff}},
+        ],
+    }
+    totals = {"tasks": 0, "messages": 0}
+    while True:
+        tasks = await storage.tasks.find(query, {"id": 1}, limit=batch)
+        for task in tasks:
+            totals["messages"] += await archive_task_messages(storage, task["id"])
+            totals["tasks"] += 1
+        if len(tasks) < batch:
+            return totals
+
+
+async def read_archived_messages(storage, task_id: str, months: List[str], limit: int) -> List[dict]:
+    found: List[dict] = []
+    for month in sorted(months):
+        archive = await storage.message_archive(month)
+        found.extend(await archive.find({"task_id": task_id}, sort=[("created_at", 1)], limit=limit - len(found)))
+        if len(found) >= limit:
+            break
+    return found
+
+
+async def run_retention(storage) -> Dict[str, int]:
+    totals = await archive_closed_threads(storage)
+    totals["expired"] = await storage.purge_expired()
+    if any(totals.values()):
+        logger.info("retention pass %s", totals)
+    return totals
+
+
+async def run_periodically(storage, interval: float = INTERVAL_SECONDS, owner: Optional[str] = None):
+    owner = owner or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Outlasts the interval, so the holder keeps running the passes
+            if await storage.leases.acquire(LEASE_NAME, owner, 2 * interval):
+                await run_retention(storage)
+        except Exception:
+            logger.exception("retention pass failed")
+
+
+async def _main(args):
+    from dotenv import load_dotenv
+    from pathlib import Path
+    from storage import create_storage
+
+    load_dotenv(Path(__file__).parent / ".env")
+    storage = create_storage()
+    await storage.ensure_indexes()
+    try:
+        totals = await archive_closed_threads(storage, args.days, args.batch)
+        totals["expired"] = await storage.purge_expired()
+        print(totals)
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    # argparse pulls in gettext; the app imports this module, the CLI alone needs it
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Archive closed chats and expire ephemeral data once.")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch", type=int, default=BATCH_TASKS)
+    asyncio.run(_main(parser.parse_args()))
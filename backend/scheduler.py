@@ -0,0 +1,177 @@
+"""Due-time scheduler for task reminders, feed surfacing and expiry.
+
+``create_task`` stamps each task with the times its events fall due:
+
+- ``surface_at``: scheduled tasks stay out of the public feed until
+  ``SCHEDULED_SURFACE_LEAD_HOURS`` before their ``scheduled_time``.
+- ``remind_at``: ``SCHEDULED_REMINDER_LEAD_MINUTES`` before the scheduled
+  time, ``reminder_sent_at`` is set so both parties see it through sync.
+- ``expire_at``: a task still POSTED at this time becomes EXPIRED; that is
+  ``POSTED_TASK_TTL_HOURS`` after creation, or
+  ``SCHEDULED_EXPIRE_GRACE_MINUTES`` after the scheduled time.
+
+Each field is removed once its event fires, so pending events are exactly
+what the sparse indexes on those fields hold. The leader loads the events
+due in the next ``SCHEDULER_BUCKET_SECONDS`` into a min-heap and sleeps
+until the earliest one. Tasks created on the leader in the meantime are
+pushed straight onto the heap. Tasks created on other workers are picked up
+by the next bucket load. One worker leads at a time through a lease in the
+``leases`` collection. Every event applies as a conditional update, so
+firing it twice is harmless.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("SCHEDULER_ENABLED", "1") == "1"
+BUCKET_SECONDS = float(os.environ.get("SCHEDULER_BUCKET_SECONDS", "60"))
+LEASE_SECONDS = float(os.environ.get("SCHEDULER_LEASE_SECONDS", "30"))
+SURFACE_LEAD = timedelta(hours=float(os.environ.get("SCHEDULED_SURFACE_LEAD_HOURS", "24")))
+REMINDER_LEAD = timedelta(minutes=float(os.environ.get("SCHEDULED_REMINDER_LEAD_MINUTES", "60")))
+EXPIRE_GRACE = timedelta(minutes=float(os.environ.get("SCHEDULED_EXPIRE_GRACE_MINUTES", "60")))
+POSTED_TTL = timedelta(hours=float(os.environ.get("POSTED_TASK_TTL_HOURS", "168")))
+
+LEASE_NAME = "scheduler"
+EVENT_FIELDS = ("surface_at", "remind_at", "expire_at")
+
+Event = Tuple[datetime, str, str]
+
+
+def _utc(value: datetime) -> datetime:
+    # Stored datetimes are naive UTC; clients may send offsets
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def plan(task: dict, now: Optional[datetime] = None) -> dict:
+    """Event fields for a new task."""
+    now = now or datetime.utcnow()
+    scheduled_time = task.get("scheduled_time")
+    if task.get("priority") != "scheduled" or scheduled_time is None:
+        return {"expire_at": task["created_at"] + POSTED_TTL}
+    scheduled_time = _utc(scheduled_time)
+    events = {"expire_at": scheduled_time + EXPIRE_GRACE}
+    if scheduled_time - SURFACE_LEAD > now:
+        events["surface_at"] = scheduled_time - SURFACE_LEAD
+    if scheduled_time - REMINDER_LEAD > now:
+        events["remind_at"] = scheduled_time - REMINDER_LEAD
+    return events
+
+
+class Scheduler:
+    def __init__(self, storage, owner: Optional[str] = None):
+        self.storage = storage
+        self.owner = owner or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self.loaded_until: Optional[datetime] = None
+        self._heap: List[Event] = []
+        self._wake = asyncio.Event()
+        self._fired = {field: 0 for field in EVENT_FIELDS}
+
+    def schedule(self, task: dict):
+        """Queue a new task's events if they fall in the loaded bucket."""
+        if self.loaded_until is None:
+            return
+        pushed = False
+        for field in EVENT_FIELDS:
+            due = task.get(field)
+            if due is not None and due < self.loaded_until:
+                heapq.heappush(self._heap, (due, field, task["id"]))
+                pushed = True
+        if pushed:
+            self._wake.set()
+
+    async def _load_bucket(self, until: datetime):
+        heap: List[Event] = []
+        for field in EVENT_FIELDS:
+            # Earlier buckets' leftovers are included: a field is only
+            # removed once its event has fired
+            due = await self.storage.tasks.find(
+                {field: {"$lt": until}}, {"_id": 0, "id": 1, field: 1}, sort=[(field, 1)], limit=0
+            )
+            heap.extend((task[field], field, task["id"]) for task in due)
+        heapq.heapify(heap)
+        self._heap = heap
+        self.loaded_until = until
+
+    async def _fire(self, field: str, task_id: str, now: datetime):
+        tasks = self.storage.tasks
+        due = {"id": task_id, field: {"$lte": now}}
+        if field == "surface_at":
+            fired = await tasks.update_one(due, {"$unset": {"surface_at": ""}, "$set": {"surfaced_at": now}})
+        elif field == "remind_at":
+            fired = await tasks.update_one(due, {"$unset": {"remind_at": ""}, "$set": {"reminder_sent_at": now}})
+            if fired:
+                logger.info("reminder sent for scheduled task %s", task_id)
+        else:
+            fired = await tasks.update_one(
+                {**due, "status": "posted"},
+                {"$set": {"status": "expired", "expired_at": now}, "$unset": {event: "" for event in EVENT_FIELDS}},
+            )
+            if not fired:
+                # The task moved on before expiring; drop the event quietly
+                await tasks.untracked.update_one(due, {"$unset": {"expire_at": ""}})
+        self._fired[field] += fired
+
+    async def _tick(self) -> datetime:
+        """One leader pass; returns when the next one is due."""
+        now = datetime.utcnow()
+        if self.loaded_until is None or now >= self.loaded_until:
+            await self._load_bucket(now + timedelta(seconds=BUCKET_SECONDS))
+        while self._heap and self._heap[0][0] <= now:
+            _, field, task_id = heapq.heappop(self._heap)
+            await self._fire(field, task_id, now)
+        return min(self._heap[0][0] if self._heap else self.loaded_until, self.loaded_until)
+
+    async def run(self):
+        renew_every = LEASE_SECONDS / 3
+        renew_at = datetime.utcnow()
+        while True:
+            now = datetime.utcnow()
+            try:
+                if now >= renew_at:
+                    leader = await self.storage.leases.acquire(LEASE_NAME, self.owner, LEASE_SECONDS)
+                    if leader != self.is_leader:
+                        logger.info("scheduler %s %s leadership", self.owner, "took" if leader else "lost")
+                    self.is_leader = leader
+                    if not leader:
+                        self._heap, self.loaded_until = [], None
+                    renew_at = now + timedelta(seconds=renew_every)
+                wake_at = await self._tick() if self.is_leader else renew_at
+            except Exception:
+                logger.exception("scheduler pass failed")
+                wake_at = now + timedelta(seconds=renew_every)
+            self._wake.clear()
+            delay = (min(wake_at, renew_at) - datetime.utcnow()).total_seconds()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        if self.is_leader:
+            await self.storage.leases.release(LEASE_NAME, self.owner)
+            self.is_leader = False
+
+    def stats(self) -> dict:
+        return {
+            "leader": self.is_leader,
+            "queued": len(self._heap),
+            "loaded_until": self.loaded_until.isoformat() if self.loaded_until else None,
+            "fired": dict(self._fired),
+        }
+
+
+def install(storage) -> Scheduler:
+    scheduler = Scheduler(storage)
+    metrics.register("scheduler", scheduler.stats)
+    return scheduler
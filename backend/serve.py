@@ -0,0 +1,185 @@
+"""Production entry point: a pre-forking supervisor around uvicorn.
+
+    python serve.py --workers 4 --port 8001
+    WEB_CONCURRENCY=8 python serve.py --loop uvloop --http httptools
+
+The supervisor binds the listening socket once, imports the app (and with it
+FastAPI, pydantic, motor and the storage layer) and only then forks the
+workers. The import cost is paid once, and the workers share those pages
+copy-on-write. Nothing opens a Mongo connection at import time: each worker
+creates its own client in the app's startup hook, which runs during that
+worker's ASGI lifespan after the fork.
+
+All workers accept from the same socket. The periodic retention and
+analytics jobs only run in worker 0, while the scheduler and dispatcher
+already elect a single leader through their leases.
+
+SIGTERM or SIGINT starts a graceful drain. The supervisor forwards SIGTERM,
+and each worker stops accepting, lets in-flight requests finish for up to
+``--graceful-timeout`` seconds and then runs its shutdown hook. Workers
+still alive after that are killed. A worker that exits on its own is
+restarted.
+
+``--loop auto`` / ``--http auto`` pick uvloop and httptools when they are
+installed and fall back to asyncio and h11 otherwise.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict
+
+import uvicorn
+
+logger = logging.getLogger("serve")
+
+RESTART_BACKOFF_SECONDS = 1.0
+
+
+def bind(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def load_app(index: int):
+    import server
+
+    server.app.state.run_periodic_jobs = index == 0
+    return server.app
+
+
+def make_config(app, args) -> uvicorn.Config:
+    return uvicorn.Config(
+        app,
+        loop=args.loop,
+        http=args.http,
+        lifespan="on",
+        backlog=args.backlog,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        limit_max_requests=args.max_requests,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+        access_log=args.access_log,
+    )
+
+
+def run_worker(index: int, sock: socket.socket, args):
+    uvicorn.Server(make_config(load_app(index), args)).run(sockets=[sock])
+
+
+class Supervisor:
+    def __init__(self, sock: socket.socket, args):
+        self.sock = sock
+        self.args = args
+        self.workers: Dict[int, int] = {}  # pid -> worker index
+        self.started_at: Dict[int, float] = {}
+        self.stopping = False
+        self.drain_deadline = None
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            # uvicorn installs its own handlers once the worker's loop runs
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(index, self.sock, self.args)
+            except BaseException:
+                logger.exception("worker %s crashed", index)
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = index
+        self.started_at[pid] = time.monotonic()
+        logger.info("started worker %s (pid %s)", index, pid)
+
+    def signal_workers(self, signum: int):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        logger.info("received %s, draining %s workers", signal.Signals(signum).name, len(self.workers))
+        self.stopping = True
+        self.drain_deadline = time.monotonic() + self.args.graceful_timeout + 5
+        self.signal_workers(signal.SIGTERM)
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if pid == 0:
+                return
+            index = self.workers.pop(pid, None)
+            uptime = time.monotonic() - self.started_at.pop(pid, time.monotonic())
+            if index is None or self.stopping:
+                continue
+            logger.warning("worker %s (pid %s) exited with %s, restarting", index, pid, os.waitstatus_to_exitcode(status))
+            if uptime < RESTART_BACKOFF_SECONDS:
+                # Don't spin when a worker dies during startup
+                time.sleep(RESTART_BACKOFF_SECONDS)
+            self.spawn(index)
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.args.workers):
+            self.spawn(index)
+        while self.workers:
+            self.reap()
+            if self.stopping and self.workers and time.monotonic() > self.drain_deadline:
+                logger.warning("killing %s workers that did not drain in time", len(self.workers))
+                self.signal_workers(signal.SIGKILL)
+                self.drain_deadline = float("inf")
+            time.sleep(0.1)
+        return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8001")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--loop", choices=["auto", "asyncio", "uvloop"], default="auto")
+    parser.add_argument("--http", choices=["auto", "h11", "httptools"], default="auto")
+    parser.add_argument("--backlog", type=int, default=2048, help="listen() queue length")
+    parser.add_argument("--keep-alive", type=int, default=5, help="seconds an idle keep-alive connection is held")
+    parser.add_argument("--graceful-timeout", type=int, default=30, help="seconds to drain on SIGTERM")
+    parser.add_argument("--max-requests", type=int, help="recycle a worker after this many requests")
+    parser.add_argument("--forwarded-allow-ips", default=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"))
+    parser.add_argument("--no-access-log", dest="access_log", action="store_false")
+    parser.add_argument("--no-preload", dest="preload", action="store_false", help="import the app in each worker instead")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sock = bind(args.host, args.port, args.backlog)
+    logger.info("listening on %s:%s with %s workers", args.host, args.port, args.workers)
+    if args.workers <= 1 or not hasattr(os, "fork"):
+        run_worker(0, sock, args)
+        return 0
+    if args.preload:
+        import server  # noqa: F401
+    return Supervisor(sock, args).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,41 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, Response, Header, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from enum import Enum
 import json
+import asyncio
+import metrics
+from etags import format_etag, etag_matches, parse_if_match, version_filter, not_modified, precondition_failed
+import autocomplete
+import compression
+import counters
+import deadlines
+import dispatch
+import feedcache
+import presence
+import profiling
+import ratelimit
+import readrouting
+import scheduler
+from singleflight import reads
+from storage import (
+    Storage, UserRepo, TaskRepo, TaskBidRepo, PaymentAccountRepo, PaymentRepo,
+    MessageRepo, ReviewRepo, ConversationRepo, LocationPingRepo, TaskStatsRepo, PaymentStatsRepo,
+    WalletLedgerRepo, create_storage,
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -39,12 +55,21 @@ class TaskStatus(str, Enum):
     COMPLETED = "completed"
     CANCELLED = "cancelled"
     DISPUTED = "disputed"
+    EXPIRED = "expired"
 
 class PaymentMethod(str, Enum):
     CARD = "card"
     BANK_ACCOUNT = "bank_account"
     NEOBANK_WALLET = "neobank_wallet"
 
+class AutocompleteKind(str, Enum):
+    SKILL = "skill"
+    TITLE = "title"
+
+class TaskSort(str, Enum):
+    NEWEST = "newest"
+    POPULAR = "popular"
+
 class TaskCategory(str, Enum):
     DELIVERY = "delivery"
     CLEANING = "cleaning"
@@ -78,6 +103,8 @@ class User(BaseModel):
     total_reviews: int = 0
     is_verified: bool = False
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
+    version: int = 0
     
 class UserCreate(BaseModel):
     email: str
@@ -106,7 +133,13 @@ class Task(BaseModel):
     accepted_at: Optional[datetime] = None
     started_at: Optional[datetime] = None
     completed_at: Optional[datetime] = None
+    surfaced_at: Optional[datetime] = None
+    reminder_sent_at: Optional[datetime] = None
+    expired_at: Optional[datetime] = None
+    cancelled_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
+    version: int = 0
 
 class TaskCreate(BaseModel):
     title: str
@@ -126,10 +159,13 @@ class TaskBid(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     task_id: str
     tasker_id: str
+    # The task's client, copied on when the bid is placed
+    client_id: Optional[str] = None
     proposed_price: float
     message: str
     estimated_completion: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
 
 class TaskBidCreate(BaseModel):
     task_id: str
@@ -154,6 +190,7 @@ class PaymentAccount(BaseModel):
     is_primary: bool = False
     gateway_customer_id: Optional[str] = None  # "xxxx-enter-gateway-api-here-xxxx"
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
 
 class PaymentAccountCreate(BaseModel):
     user_id: str
@@ -175,6 +212,8 @@ class Payment(BaseModel):
     gateway_payment_id: str = "xxxx-enter-gateway-api-here-xxxx"
     status: str = "pending"  # pending, completed, failed, refunded
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
+    reconciled_at: Optional[datetime] = None  # last status correction from the gateway settlement
 
 class Review(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -184,6 +223,7 @@ class Review(BaseModel):
     rating: int  # 1-5
     comment: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
 
 class ReviewCreate(BaseModel):
     task_id: str
@@ -200,6 +240,7 @@ class Message(BaseModel):
     content: str
     message_type: str = "text"  # text, image, location
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
 
 class MessageCreate(BaseModel):
     task_id: str
@@ -208,57 +249,352 @@ class MessageCreate(BaseModel):
     content: str
     message_type: str = "text"
 
+class MessagePreview(BaseModel):
+    id: str
+    sender_id: str
+    content: str
+    message_type: str = "text"
+    created_at: datetime
+
+class InboxEntry(BaseModel):
+    id: str
+    task_id: str
+    participants: List[str]
+    other_participant_id: Optional[str] = None
+    last_message: MessagePreview
+    last_activity_at: datetime
+    message_count: int = 0
+    unread_count: int = 0
+
+# Embedded in list items by expand=client,tasker,...
+class UserCard(BaseModel):
+    id: str
+    name: str
+    role: UserRole
+    profile_image: Optional[str] = None
+    rating: float = 0.0
+    total_reviews: int = 0
+    is_verified: bool = False
+
+class ExpandedTask(Task):
+    client: Optional[UserCard] = None
+    tasker: Optional[UserCard] = None
+
+class ExpandedTaskBid(TaskBid):
+    tasker: Optional[UserCard] = None
+
+class ExpandedReview(Review):
+    reviewer: Optional[UserCard] = None
+    reviewee: Optional[UserCard] = None
+
+class TaskBundle(BaseModel):
+    # Sections left out through include= are null
+    task: Task
+    bids: Optional[List[TaskBid]] = None
+    messages: Optional[List[Message]] = None
+    client: Optional[UserCard] = None
+    tasker: Optional[UserCard] = None
+    client_reviews: Optional[List[Review]] = None
+    tasker_reviews: Optional[List[Review]] = None
+
+class UserBatch(BaseModel):
+    users: List[User]
+    missing: List[str] = Field(default_factory=list)
+
+class TaskBatch(BaseModel):
+    tasks: List[Task]
+    missing: List[str] = Field(default_factory=list)
+
+class PresenceHeartbeat(BaseModel):
+    # Omitted: the last known position is kept
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+class OnlineTasker(BaseModel):
+    id: str
+    latitude: float
+    longitude: float
+    distance_km: float
+    skills: List[str] = Field(default_factory=list)
+    online_until: datetime
+
+class OnlineTaskers(BaseModel):
+    taskers: List[OnlineTasker]
+    count: int
+
+class Suggestion(BaseModel):
+    text: str
+    count: int
+
+class Tombstone(BaseModel):
+    collection: str
+    id: str
+    sync_seq: int
+    deleted_at: datetime
+
+class SyncResponse(BaseModel):
+    tasks: List[Task] = Field(default_factory=list)
+    bids: List[TaskBid] = Field(default_factory=list)
+    messages: List[Message] = Field(default_factory=list)
+    reviews: List[Review] = Field(default_factory=list)
+    tombstones: List[Tombstone] = Field(default_factory=list)
+    next_token: str
+    has_more: bool = False
+
+class TaskDailyStats(BaseModel):
+    day: str
+    category: str
+    posted: int = 0
+    accepted: int = 0
+    completed: int = 0
+    median_budget: Optional[float] = None
+    median_time_to_accept_seconds: Optional[float] = None
+
+class PaymentDailyStats(BaseModel):
+    day: str
+    payments: int = 0
+    completed_payments: int = 0
+    gmv: float = 0
+
+# Storage dependencies
+def get_storage(request: Request) -> Storage:
+    return request.app.state.storage
+
+def get_scheduler(request: Request) -> scheduler.Scheduler:
+    return request.app.state.scheduler
+
+def get_dispatcher(request: Request) -> dispatch.Dispatcher:
+    return request.app.state.dispatcher
+
+def get_presence(request: Request) -> presence.PresenceService:
+    return request.app.state.presence
+
+def get_feed_cache(request: Request) -> feedcache.FeedCache:
+    return request.app.state.feed_cache
+
+def get_autocomplete(request: Request) -> autocomplete.Autocomplete:
+    return request.app.state.autocomplete
+
+def get_counters(request: Request) -> counters.CounterBuffer:
+    return request.app.state.counters
+
+def get_user_repo(storage: Storage = Depends(get_storage)) -> UserRepo:
+    return storage.users
+
+def get_task_repo(storage: Storage = Depends(get_storage)) -> TaskRepo:
+    return storage.tasks
+
+def get_task_bid_repo(storage: Storage = Depends(get_storage)) -> TaskBidRepo:
+    return storage.task_bids
+
+def get_payment_account_repo(storage: Storage = Depends(get_storage)) -> PaymentAccountRepo:
+    return storage.payment_accounts
+
+def get_payment_repo(storage: Storage = Depends(get_storage)) -> PaymentRepo:
+    return storage.payments
+
+def get_message_repo(storage: Storage = Depends(get_storage)) -> MessageRepo:
+    return storage.messages
+
+def get_review_repo(storage: Storage = Depends(get_storage)) -> ReviewRepo:
+    return storage.reviews
+
+def get_conversation_repo(storage: Storage = Depends(get_storage)) -> ConversationRepo:
+    return storage.conversations
+
+def get_location_ping_repo(storage: Storage = Depends(get_storage)) -> LocationPingRepo:
+    return storage.location_pings
+
+def get_task_stats_repo(storage: Storage = Depends(get_storage)) -> TaskStatsRepo:
+    return storage.task_stats
+
+def get_payment_stats_repo(storage: Storage = Depends(get_storage)) -> PaymentStatsRepo:
+    return storage.payment_stats
+
+def get_wallet_ledger_repo(storage: Storage = Depends(get_storage)) -> WalletLedgerRepo:
+    return storage.wallet_ledger
+
+# Fields maintained by storage that clients cannot set directly
+RESERVED_FIELDS = {"_id", "id", "version", "sync_seq", "updated_at"}
+
+# Batch lookups and reference expansion
+BATCH_MAX_IDS = 100
+BATCH_PROJECTION = {"_id": 0, "sync_seq": 0}
+# Task list pages leave out images, which only GET /api/tasks/{id} serves
+TASK_SUMMARY_FIELDS = [field for field in Task.model_fields if field != "images"]
+TASK_SUMMARY_PROJECTION = {"_id": 0, **{field: 1 for field in TASK_SUMMARY_FIELDS}}
+USER_CARD_PROJECTION = {"_id": 0, **{field: 1 for field in UserCard.model_fields}}
+
+def parse_batch_ids(ids: List[str]) -> List[str]:
+    # ids=a,b,c and ids=a&ids=b both work; duplicates are dropped, order kept
+    requested = list(dict.fromkeys(part.strip() for value in ids for part in value.split(",") if part.strip()))
+    if not requested:
+        raise HTTPException(status_code=400, detail="ids is required")
+    if len(requested) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_IDS} ids per batch")
+    return requested
+
+def parse_names(value: Optional[str], allowed: List[str], param: str) -> List[str]:
+    if not value:
+        return []
+    names = list(dict.fromkeys(name.strip() for name in value.split(",") if name.strip()))
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown {param} {', '.join(unknown)}; expected {', '.join(allowed)}")
+    return names
+
+def parse_expand(expand: Optional[str], allowed: List[str]) -> List[str]:
+    return parse_names(expand, allowed, "expand")
+
+async def expand_users(items: List[dict], names: List[str], users: UserRepo) -> List[dict]:
+    """Embed the user card for each ``<name>_id`` reference, in one query per page."""
+    if not names:
+        return items
+    ids = {item.get(f"{name}_id") for item in items for name in names} - {None}
+    cards = {card["id"]: card for card in await users.get_many(list(ids), USER_CARD_PROJECTION)}
+    # Copies: items may be shared with other readers through single-flight
+    return [{**item, **{name: cards.get(item.get(f"{name}_id")) for name in names}} for item in items]
+
 # User Management APIs
 @api_router.post("/users", response_model=User)
-async def create_user(user_data: UserCreate):
+async def create_user(
+    user_data: UserCreate,
+    users: UserRepo = Depends(get_user_repo),
+    suggestions: autocomplete.Autocomplete = Depends(get_autocomplete)
+):
     user_dict = user_data.dict()
-    user_obj = User(**user_dict)
-    await db.users.insert_one(user_obj.dict())
+    user_obj = User(**user_dict, version=1)
+    await users.insert(user_obj.dict())
+    suggestions.user_skills([], user_obj.skills)
     return user_obj
 
+@api_router.get("/users:batch", response_model=UserBatch)
+async def get_users_batch(ids: List[str] = Query(...), users: UserRepo = Depends(get_user_repo)):
+    requested = parse_batch_ids(ids)
+    found = {user["id"]: user for user in await users.get_many(requested, BATCH_PROJECTION)}
+    return UserBatch(
+        users=[User(**found[user_id]) for user_id in requested if user_id in found],
+        missing=[user_id for user_id in requested if user_id not in found]
+    )
+
 @api_router.get("/users/{user_id}", response_model=User)
-async def get_user(user_id: str):
-    user = await db.users.find_one({"id": user_id})
+async def get_user(
+    user_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    users: UserRepo = Depends(get_user_repo)
+):
+    if if_none_match:
+        current = await users.get(user_id, {"version": 1})
+        if current and etag_matches(if_none_match, current.get("version", 0)):
+            return not_modified(current.get("version", 0))
+    user = await users.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    response.headers["ETag"] = format_etag(user.get("version", 0))
     return User(**user)
 
 @api_router.put("/users/{user_id}", response_model=User)
-async def update_user(user_id: str, user_data: Dict[str, Any]):
-    user = await db.users.find_one({"id": user_id})
-    if not user:
+async def update_user(
+    user_id: str,
+    user_data: Dict[str, Any],
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    users: UserRepo = Depends(get_user_repo),
+    suggestions: autocomplete.Autocomplete = Depends(get_autocomplete),
+    online: presence.PresenceService = Depends(get_presence)
+):
+    expected = parse_if_match(if_match)
+    query = {"id": user_id}
+    if expected is not None:
+        query["version"] = version_filter(expected)
+    changes = {key: value for key, value in user_data.items() if key not in RESERVED_FIELDS}
+    # Skill suggestions count users per skill, so they need the skills replaced
+    previous = await users.get(user_id, {"skills": 1}) if "skills" in changes else None
+    updated_user = await users.find_one_and_update(query, {"$set": changes})
+    if not updated_user:
+        if expected is not None and await users.get(user_id, {"id": 1}):
+            raise precondition_failed()
         raise HTTPException(status_code=404, detail="User not found")
-    
-    await db.users.update_one({"id": user_id}, {"$set": user_data})
-    updated_user = await db.users.find_one({"id": user_id})
+    if previous is not None:
+        suggestions.user_skills(previous.get("skills") or [], updated_user.get("skills") or [])
+    if "skills" in changes or "role" in changes:
+        await online.profile_changed(user_id, updated_user.get("role"), updated_user.get("skills"))
+    response.headers["ETag"] = format_etag(updated_user["version"])
     return User(**updated_user)
 
 @api_router.get("/users", response_model=List[User])
-async def get_users(role: Optional[UserRole] = None, skills: Optional[str] = None):
+async def get_users(
+    role: Optional[UserRole] = None,
+    skills: Optional[str] = None,
+    users: UserRepo = Depends(get_user_repo)
+):
     query = {}
     if role:
         query["role"] = role
     if skills:
         query["skills"] = {"$in": [skills]}
     
-    users = await db.users.find(query).to_list(100)
-    return [User(**user) for user in users]
+    found = await users.find(query, limit=100)
+    return [User(**user) for user in found]
 
 # Task Management APIs
 @api_router.post("/tasks", response_model=Task)
-async def create_task(task_data: TaskCreate):
+async def create_task(
+    task_data: TaskCreate,
+    tasks: TaskRepo = Depends(get_task_repo),
+    task_scheduler: scheduler.Scheduler = Depends(get_scheduler),
+    task_dispatcher: dispatch.Dispatcher = Depends(get_dispatcher),
+    feed: feedcache.FeedCache = Depends(get_feed_cache),
+    suggestions: autocomplete.Autocomplete = Depends(get_autocomplete)
+):
     task_dict = task_data.dict()
-    task_obj = Task(**task_dict)
-    await db.tasks.insert_one(task_obj.dict())
+    task_obj = Task(**task_dict, version=1)
+    task_doc = {**task_obj.dict(), **scheduler.plan(task_obj.dict())}
+    await tasks.insert(task_doc)
+    task_scheduler.schedule(task_doc)
+    task_dispatcher.enqueue(task_doc)
+    feed.posted(task_doc)
+    suggestions.task_posted(task_doc)
     return task_obj
 
-@api_router.get("/tasks", response_model=List[Task])
+@api_router.get("/tasks:batch", response_model=TaskBatch)
+async def get_tasks_batch(ids: List[str] = Query(...), tasks: TaskRepo = Depends(get_task_repo)):
+    requested = parse_batch_ids(ids)
+    found = {task["id"]: task for task in await tasks.get_many(requested, BATCH_PROJECTION)}
+    return TaskBatch(
+        tasks=[Task(**found[task_id]) for task_id in requested if task_id in found],
+        missing=[task_id for task_id in requested if task_id not in found]
+    )
+
+@api_router.get("/tasks", response_model=List[ExpandedTask])
 async def get_tasks(
     category: Optional[TaskCategory] = None,
     status: Optional[TaskStatus] = None,
     client_id: Optional[str] = None,
-    tasker_id: Optional[str] = None
+    tasker_id: Optional[str] = None,
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    skip: int = Query(0, ge=0),
+    limit: int = 100,
+    sort: TaskSort = TaskSort.NEWEST,
+    expand: Optional[str] = None,
+    tasks: TaskRepo = Depends(get_task_repo),
+    users: UserRepo = Depends(get_user_repo),
+    feed: feedcache.FeedCache = Depends(get_feed_cache),
+    task_counters: counters.CounterBuffer = Depends(get_counters)
 ):
+    """Tasks, newest first or ``sort=popular``, without their images.
+
+    ``lat``/``lng`` narrow them to the feed region around that point.
+    Popularity ranks the newest ``POPULAR_CANDIDATES`` matches by views,
+    bids and messages, decayed by age.
+    """
+    expand_names = parse_expand(expand, ["client", "tasker"])
+    if (lat is None) != (lng is None):
+        raise HTTPException(status_code=400, detail="lat and lng go together")
+    region = feedcache.cell(lat, lng) if lat is not None else None
+    limit = _limit(limit)
     query = {}
     if category:
         query["category"] = category
@@ -268,64 +604,253 @@ async def get_tasks(
         query["client_id"] = client_id
     if tasker_id:
         query["tasker_id"] = tasker_id
-    
-    tasks = await db.tasks.find(query).sort("created_at", -1).to_list(100)
-    return [Task(**task) for task in tasks]
+    if not client_id and not tasker_id:
+        # Scheduled tasks join the public feed once the scheduler surfaces them
+        query["surface_at"] = {"$exists": False}
+    if region:
+        query.update(feedcache.region_filter(region))
+    if sort == TaskSort.POPULAR:
+        candidates = await tasks.find(
+            query, {"id": 1, "created_at": 1}, sort=[("created_at", -1)], limit=counters.POPULAR_CANDIDATES
+        )
+        ranked = [task["id"] for task in await task_counters.rank(candidates)][skip:skip + limit]
+        by_id = {task["id"]: task for task in await tasks.get_many(ranked, TASK_SUMMARY_PROJECTION)}
+        found = [by_id[task_id] for task_id in ranked if task_id in by_id]
+    else:
+        found = None
+        if status == TaskStatus.POSTED and not client_id and not tasker_id:
+            found = await feed.read(region, category, skip, limit)
+        if found is None:
+            found = await tasks.find(query, TASK_SUMMARY_PROJECTION, sort=[("created_at", -1)], skip=skip, limit=limit)
+    return [ExpandedTask(**task) for task in await expand_users(found, expand_names, users)]
 
 @api_router.get("/tasks/{task_id}", response_model=Task)
-async def get_task(task_id: str):
-    task = await db.tasks.find_one({"id": task_id})
+async def get_task(
+    task_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    tasks: TaskRepo = Depends(get_task_repo),
+    task_counters: counters.CounterBuffer = Depends(get_counters)
+):
+    if if_none_match:
+        current = await tasks.get(task_id, {"version": 1})
+        if current and etag_matches(if_none_match, current.get("version", 0)):
+            task_counters.add(task_id, "views")
+            return not_modified(current.get("version", 0))
+    task = await reads.do(("GET /api/tasks/{task_id}", task_id), lambda: tasks.get(task_id))
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
+    task_counters.add(task_id, "views")
+    response.headers["ETag"] = format_etag(task.get("version", 0))
     return Task(**task)
 
+BUNDLE_SECTIONS = ["bids", "messages", "client", "tasker", "client_reviews", "tasker_reviews"]
+
+def _limit(value: int) -> int:
+    return max(1, min(value, 100))
+
+@api_router.get("/tasks/{task_id}/bundle", response_model=TaskBundle)
+async def get_task_bundle(
+    task_id: str,
+    include: Optional[str] = None,
+    bids_limit: int = 20,
+    messages_limit: int = 50,
+    reviews_limit: int = 10,
+    storage: Storage = Depends(get_storage),
+    task_counters: counters.CounterBuffer = Depends(get_counters)
+):
+    """Everything the task screen shows, in one round trip.
+
+    ``include=bids,messages,...`` selects sections (all by default). Bids
+    and messages load alongside the task; the people and their reviews as
+    soon as the task names them.
+    """
+    sections = set(parse_names(include, BUNDLE_SECTIONS, "include") or BUNDLE_SECTIONS)
+
+    async def nothing():
+        return None
+
+    async def load_bids():
+        return await storage.task_bids.find(
+            {"task_id": task_id}, BATCH_PROJECTION, sort=[("created_at", -1)], limit=_limit(bids_limit)
+        )
+
+    async def load_messages():
+        thread = await storage.messages.thread_state(task_id)
+        return await load_task_messages(
+            storage, storage.messages, task_id, thread["archive_months"], _limit(messages_limit)
+        )
+
+    async def load_reviews(user_id: Optional[str]):
+        if not user_id:
+            return []
+        return await storage.reviews.find(
+            {"reviewee_id": user_id}, BATCH_PROJECTION, sort=[("created_at", -1)], limit=_limit(reviews_limit)
+        )
+
+    async def load_task_and_people():
+        tasks = storage.tasks
+        task = await reads.do(("GET /api/tasks/{task_id}", task_id), lambda: tasks.get(task_id))
+        if not task:
+            return None, {}
+        people = [name for name in ("client", "tasker") if name in sections]
+        cards, client_reviews, tasker_reviews = await deadlines.gather(
+            storage.users.get_many([task[f"{name}_id"] for name in people if task.get(f"{name}_id")], USER_CARD_PROJECTION)
+            if people else nothing(),
+            load_reviews(task["client_id"]) if "client_reviews" in sections else nothing(),
+            load_reviews(task.get("tasker_id")) if "tasker_reviews" in sections else nothing(),
+        )
+        by_id = {card["id"]: card for card in cards or []}
+        related = {name: by_id.get(task.get(f"{name}_id")) for name in people}
+        related.update(client_reviews=client_reviews, tasker_reviews=tasker_reviews)
+        return task, related
+
+    (task, related), bids, messages = await deadlines.gather(
+        load_task_and_people(),
+        load_bids() if "bids" in sections else nothing(),
+        load_messages() if "messages" in sections else nothing(),
+    )
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    task_counters.add(task_id, "views")
+    return TaskBundle(task=Task(**task), bids=bids, messages=messages, **related)
+
+async def apply_task_transition(
+    tasks: TaskRepo,
+    task_id: str,
+    fields: Dict[str, Any],
+    if_match: Optional[str],
+    response: Response,
+    required_status: Optional[TaskStatus] = None
+):
+    expected = parse_if_match(if_match)
+    query = {"id": task_id}
+    if expected is not None:
+        query["version"] = version_filter(expected)
+    if required_status is not None:
+        query["status"] = required_status
+    updated = await tasks.find_one_and_update(query, {"$set": fields}, {"version": 1})
+    if updated is None and (expected is not None or required_status is not None):
+        current = await tasks.get(task_id, {"status": 1})
+        if current is None:
+            raise HTTPException(status_code=404, detail="Task not found")
+        if required_status is not None and current["status"] != required_status:
+            raise HTTPException(status_code=409, detail=f"Task is no longer {required_status.value}")
+        raise precondition_failed()
+    reads.forget(("GET /api/tasks/{task_id}", task_id))
+    if updated is not None:
+        response.headers["ETag"] = format_etag(updated["version"])
+
 @api_router.put("/tasks/{task_id}/accept")
-async def accept_task(task_id: str, tasker_id: str):
-    task = await db.tasks.find_one({"id": task_id})
+async def accept_task(
+    task_id: str,
+    tasker_id: str,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    tasks: TaskRepo = Depends(get_task_repo),
+    task_dispatcher: dispatch.Dispatcher = Depends(get_dispatcher),
+    feed: feedcache.FeedCache = Depends(get_feed_cache)
+):
+    task = await tasks.get(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
     if task["status"] != TaskStatus.POSTED:
         raise HTTPException(status_code=400, detail="Task is not available for acceptance")
     
-    await db.tasks.update_one(
-        {"id": task_id}, 
-        {"$set": {"tasker_id": tasker_id, "status": TaskStatus.ACCEPTED, "accepted_at": datetime.utcnow()}}
+    # Conditional on POSTED: dispatch offers one task to several taskers at once
+    await apply_task_transition(
+        tasks, task_id,
+        {"tasker_id": tasker_id, "status": TaskStatus.ACCEPTED, "accepted_at": datetime.utcnow()},
+        if_match, response, required_status=TaskStatus.POSTED
     )
+    task_dispatcher.accepted(task_id)
+    feed.removed(task_id)
     return {"message": "Task accepted successfully"}
 
+@api_router.put("/tasks/{task_id}/cancel")
+async def cancel_task(
+    task_id: str,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    tasks: TaskRepo = Depends(get_task_repo),
+    feed: feedcache.FeedCache = Depends(get_feed_cache)
+):
+    task = await tasks.get(task_id, {"status": 1})
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if task["status"] not in (TaskStatus.POSTED, TaskStatus.ACCEPTED):
+        raise HTTPException(status_code=400, detail="Task can no longer be cancelled")
+    await apply_task_transition(
+        tasks, task_id,
+        {"status": TaskStatus.CANCELLED, "cancelled_at": datetime.utcnow()},
+        if_match, response, required_status=TaskStatus(task["status"])
+    )
+    feed.removed(task_id)
+    return {"message": "Task cancelled"}
+
 @api_router.put("/tasks/{task_id}/start")
-async def start_task(task_id: str):
-    await db.tasks.update_one(
-        {"id": task_id}, 
-        {"$set": {"status": TaskStatus.IN_PROGRESS, "started_at": datetime.utcnow()}}
+async def start_task(
+    task_id: str,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    tasks: TaskRepo = Depends(get_task_repo)
+):
+    await apply_task_transition(
+        tasks, task_id, {"status": TaskStatus.IN_PROGRESS, "started_at": datetime.utcnow()}, if_match, response
     )
     return {"message": "Task started"}
 
 @api_router.put("/tasks/{task_id}/complete")
-async def complete_task(task_id: str):
-    await db.tasks.update_one(
-        {"id": task_id}, 
-        {"$set": {"status": TaskStatus.COMPLETED, "completed_at": datetime.utcnow()}}
+async def complete_task(
+    task_id: str,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    tasks: TaskRepo = Depends(get_task_repo)
+):
+    await apply_task_transition(
+        tasks, task_id, {"status": TaskStatus.COMPLETED, "completed_at": datetime.utcnow()}, if_match, response
     )
     return {"message": "Task completed"}
 
 # Task Bidding APIs
 @api_router.post("/task-bids", response_model=TaskBid)
-async def create_task_bid(bid_data: TaskBidCreate):
+async def create_task_bid(
+    bid_data: TaskBidCreate,
+    bids: TaskBidRepo = Depends(get_task_bid_repo),
+    tasks: TaskRepo = Depends(get_task_repo),
+    task_counters: counters.CounterBuffer = Depends(get_counters)
+):
+    task = await tasks.get(bid_data.task_id, {"client_id": 1})
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
     bid_dict = bid_data.dict()
-    bid_obj = TaskBid(**bid_dict)
-    await db.task_bids.insert_one(bid_obj.dict())
+    bid_obj = TaskBid(**bid_dict, client_id=task["client_id"])
+    await bids.insert(bid_obj.dict())
+    reads.forget(("GET /api/task-bids/{task_id}", bid_obj.task_id))
+    task_counters.add(bid_obj.task_id, "bids")
     return bid_obj
 
-@api_router.get("/task-bids/{task_id}", response_model=List[TaskBid])
-async def get_task_bids(task_id: str):
-    bids = await db.task_bids.find({"task_id": task_id}).sort("created_at", -1).to_list(100)
-    return [TaskBid(**bid) for bid in bids]
+@api_router.get("/task-bids/{task_id}", response_model=List[ExpandedTaskBid])
+async def get_task_bids(
+    task_id: str,
+    expand: Optional[str] = None,
+    bids: TaskBidRepo = Depends(get_task_bid_repo),
+    users: UserRepo = Depends(get_user_repo)
+):
+    expand_names = parse_expand(expand, ["tasker"])
+    found = await reads.do(
+        ("GET /api/task-bids/{task_id}", task_id),
+        lambda: bids.find({"task_id": task_id}, sort=[("created_at", -1)], limit=100)
+    )
+    return [ExpandedTaskBid(**bid) for bid in await expand_users(found, expand_names, users)]
 
 # Payment Management APIs
 @api_router.post("/payment-accounts", response_model=PaymentAccount)
-async def create_payment_account(account_data: PaymentAccountCreate):
+async def create_payment_account(
+    account_data: PaymentAccountCreate,
+    accounts: PaymentAccountRepo = Depends(get_payment_account_repo)
+):
     account_dict = account_data.dict()
     
     # Mask sensitive data and add placeholder gateway integration
@@ -337,25 +862,46 @@ async def create_payment_account(account_data: PaymentAccountCreate):
     account_dict["gateway_customer_id"] = "xxxx-enter-gateway-api-here-xxxx"
     
     account_obj = PaymentAccount(**account_dict)
-    await db.payment_accounts.insert_one(account_obj.dict())
+    await accounts.insert(account_obj.dict())
     return account_obj
 
 @api_router.get("/payment-accounts/{user_id}", response_model=List[PaymentAccount])
-async def get_payment_accounts(user_id: str):
-    accounts = await db.payment_accounts.find({"user_id": user_id}).to_list(100)
-    return [PaymentAccount(**account) for account in accounts]
+async def get_payment_accounts(user_id: str, accounts: PaymentAccountRepo = Depends(get_payment_account_repo)):
+    found = await accounts.find({"user_id": user_id}, limit=100)
+    return [PaymentAccount(**account) for account in found]
 
 @api_router.put("/payment-accounts/{account_id}/wallet")
-async def update_wallet_balance(account_id: str, amount: float):
-    await db.payment_accounts.update_one(
+async def update_wallet_balance(
+    account_id: str,
+    amount: float,
+    accounts: PaymentAccountRepo = Depends(get_payment_account_repo),
+    ledger: WalletLedgerRepo = Depends(get_wallet_ledger_repo)
+):
+    account = await accounts.find_one_and_update(
         {"id": account_id, "type": PaymentMethod.NEOBANK_WALLET},
-        {"$inc": {"wallet_balance": amount}}
+        {"$inc": {"wallet_balance": amount}},
+        projection={"_id": 0, "wallet_balance": 1},
     )
+    if account is not None:
+        # The audit trail the reconciliation checks balances against
+        await ledger.insert({
+            "id": str(uuid.uuid4()),
+            "account_id": account_id,
+            "amount": amount,
+            "balance_after": account["wallet_balance"],
+            "created_at": datetime.utcnow(),
+        })
     return {"message": "Wallet balance updated"}
 
 @api_router.post("/payments", response_model=Payment)
-async def create_payment(task_id: str, payment_method: PaymentMethod, amount: float):
-    task = await db.tasks.find_one({"id": task_id})
+async def create_payment(
+    task_id: str,
+    payment_method: PaymentMethod,
+    amount: float,
+    tasks: TaskRepo = Depends(get_task_repo),
+    payments: PaymentRepo = Depends(get_payment_repo)
+):
+    task = await tasks.get(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
@@ -369,61 +915,272 @@ async def create_payment(task_id: str, payment_method: PaymentMethod, amount: fl
         status="pending"
     )
     
-    await db.payments.insert_one(payment_obj.dict())
+    await payments.insert(payment_obj.dict())
     return payment_obj
 
 # Location Sharing APIs
 @api_router.put("/users/{user_id}/location")
-async def update_user_location(user_id: str, location: LocationModel):
-    await db.users.update_one(
+async def update_user_location(
+    user_id: str,
+    location: LocationModel,
+    users: UserRepo = Depends(get_user_repo),
+    pings: LocationPingRepo = Depends(get_location_ping_repo),
+    online: presence.PresenceService = Depends(get_presence)
+):
+    await users.update_one(
         {"id": user_id}, 
-        {"$set": {"location": location.dict()}}
+        {"$set": {"location": location.dict(), "location_updated_at": datetime.utcnow()}}
     )
+    # Location history expires through the collection's TTL index
+    await pings.insert({"user_id": user_id, "location": location.dict(), "created_at": datetime.utcnow()})
+    await online.moved(user_id, location.latitude, location.longitude)
     return {"message": "Location updated"}
 
 @api_router.get("/users/{user_id}/location")
-async def get_user_location(user_id: str):
-    user = await db.users.find_one({"id": user_id}, {"location": 1})
+async def get_user_location(user_id: str, users: UserRepo = Depends(get_user_repo)):
+    user = await users.get(user_id, {"location": 1})
     if not user or not user.get("location"):
         raise HTTPException(status_code=404, detail="Location not found")
     return user["location"]
 
+# Tasker presence (see presence.py)
+@api_router.post("/taskers/{user_id}/heartbeat")
+async def tasker_heartbeat(
+    user_id: str,
+    heartbeat: Optional[PresenceHeartbeat] = None,
+    online: presence.PresenceService = Depends(get_presence)
+):
+    heartbeat = heartbeat or PresenceHeartbeat()
+    entry = await online.heartbeat(user_id, heartbeat.latitude, heartbeat.longitude)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Tasker not found or location unknown")
+    return {"online_until": datetime.utcfromtimestamp(entry.expires_at), "cell": entry.cell}
+
+@api_router.post("/taskers/{user_id}/offline")
+async def tasker_offline(user_id: str, online: presence.PresenceService = Depends(get_presence)):
+    await online.offline(user_id)
+    return {"message": "Tasker offline"}
+
+@api_router.get("/taskers/online", response_model=OnlineTaskers)
+async def get_online_taskers(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(5.0, gt=0, le=presence.MAX_RADIUS_KM),
+    skill: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    online: presence.PresenceService = Depends(get_presence)
+):
+    taskers = online.registry.nearby(lat, lng, radius_km, skill, limit)
+    return OnlineTaskers(taskers=taskers, count=len(taskers))
+
+# Dispatch offer streams (urgent tasks offered to nearby taskers)
+OFFER_KEEPALIVE_SECONDS = 15
+
+def format_sse(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(jsonable_encoder(event))}\n\n"
+
+@api_router.get("/taskers/{user_id}/offers/stream")
+async def stream_offers(
+    user_id: str,
+    task_dispatcher: dispatch.Dispatcher = Depends(get_dispatcher),
+    online: presence.PresenceService = Depends(get_presence)
+):
+    queue = task_dispatcher.hub.subscribe(user_id)
+    pending = await task_dispatcher.pending_offers(user_id)
+
+    async def events():
+        try:
+            for event in pending:
+                yield format_sse(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), OFFER_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    await online.refresh(user_id)
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            task_dispatcher.hub.unsubscribe(user_id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@api_router.websocket("/ws/taskers/{user_id}/offers")
+async def offer_socket(websocket: WebSocket, user_id: str):
+    task_dispatcher: dispatch.Dispatcher = websocket.app.state.dispatcher
+    await websocket.accept()
+    queue = task_dispatcher.hub.subscribe(user_id)
+
+    async def forward():
+        for event in await task_dispatcher.pending_offers(user_id):
+            await websocket.send_json(jsonable_encoder(event))
+        while True:
+            await websocket.send_json(jsonable_encoder(await queue.get()))
+
+    sender = asyncio.create_task(forward())
+    online: presence.PresenceService = websocket.app.state.presence
+    try:
+        # Any message is a presence ping; {"latitude": .., "longitude": ..} also moves the tasker
+        while True:
+            message = await websocket.receive_text()
+            try:
+                ping = json.loads(message)
+            except ValueError:
+                ping = None
+            if isinstance(ping, dict) and isinstance(ping.get("latitude"), (int, float)) and isinstance(ping.get("longitude"), (int, float)):
+                await online.heartbeat(user_id, ping["latitude"], ping["longitude"])
+            else:
+                await online.heartbeat(user_id)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        task_dispatcher.hub.unsubscribe(user_id, queue)
+
 # Messaging APIs
 @api_router.post("/messages", response_model=Message)
-async def send_message(message_data: MessageCreate):
+async def send_message(
+    message_data: MessageCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    messages: MessageRepo = Depends(get_message_repo),
+    conversations: ConversationRepo = Depends(get_conversation_repo),
+    task_counters: counters.CounterBuffer = Depends(get_counters)
+):
+    # If-Match applies to the task's thread version, as served by get_task_messages
+    expected = parse_if_match(if_match)
+    if expected is not None and await messages.thread_version(message_data.task_id) != expected:
+        raise precondition_failed()
     message_dict = message_data.dict()
     message_obj = Message(**message_dict)
-    await db.messages.insert_one(message_obj.dict())
+    await messages.insert(message_obj.dict())
+    # Before the version moves: a reader that sees the new version must not
+    # join a load that started before the insert
+    reads.forget(("GET /api/messages/{task_id}", message_obj.task_id))
+    # Bumped once, after the insert, so a reader never pairs the new version
+    # with a thread that lacks the message
+    if expected is None:
+        version = await messages.bump_thread_version(message_obj.task_id)
+    elif await messages.claim_thread_version(message_obj.task_id, expected):
+        version = expected + 1
+    else:
+        # Another message got in since the check above
+        await messages.delete_one({"id": message_obj.id})
+        reads.forget(("GET /api/messages/{task_id}", message_obj.task_id))
+        raise precondition_failed()
+    await conversations.record_message(message_obj.dict())
+    task_counters.add(message_obj.task_id, "messages")
+    response.headers["ETag"] = format_etag(version)
     return message_obj
 
+async def load_task_messages(
+    storage: Storage, messages: MessageRepo, task_id: str, archive_months: List[str], limit: int
+) -> List[dict]:
+    found: List[dict] = []
+    if archive_months:
+        import retention
+
+        # Archived messages predate anything still live in the thread
+        found = await retention.read_archived_messages(storage, task_id, archive_months, limit)
+    if len(found) < limit:
+        found += await messages.find({"task_id": task_id}, sort=[("created_at", 1)], limit=limit - len(found))
+    return found
+
 @api_router.get("/messages/{task_id}", response_model=List[Message])
-async def get_task_messages(task_id: str):
-    messages = await db.messages.find({"task_id": task_id}).sort("created_at", 1).to_list(100)
-    return [Message(**message) for message in messages]
+async def get_task_messages(
+    task_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    storage: Storage = Depends(get_storage),
+    messages: MessageRepo = Depends(get_message_repo)
+):
+    # Read the version before the messages so the ETag is never newer than the body
+    thread = await messages.thread_state(task_id)
+    version = thread["version"]
+    if etag_matches(if_none_match, version):
+        return not_modified(version)
+
+    found = await reads.do(
+        ("GET /api/messages/{task_id}", task_id),
+        lambda: load_task_messages(storage, messages, task_id, thread["archive_months"], 100)
+    )
+    response.headers["ETag"] = format_etag(version)
+    return [Message(**message) for message in found]
+
+# Inbox APIs
+@api_router.get("/users/{user_id}/inbox", response_model=List[InboxEntry])
+async def get_user_inbox(
+    user_id: str,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    limit: int = 20,
+    conversations: ConversationRepo = Depends(get_conversation_repo)
+):
+    # Page with before=<last_activity_at>&before_id=<id> of the last entry
+    found = await conversations.inbox(user_id, before, before_id, max(1, min(limit, 100)))
+    return [
+        InboxEntry(
+            **conversation,
+            other_participant_id=next((p for p in conversation["participants"] if p != user_id), user_id),
+            unread_count=conversation.get("unread", {}).get(user_id, 0)
+        )
+        for conversation in found
+    ]
+
+@api_router.post("/users/{user_id}/inbox/{conversation_id}/read")
+async def mark_conversation_read(
+    user_id: str,
+    conversation_id: str,
+    conversations: ConversationRepo = Depends(get_conversation_repo)
+):
+    if not await conversations.mark_read(conversation_id, user_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return {"message": "Conversation marked as read"}
 
 # Review System APIs
 @api_router.post("/reviews", response_model=Review)
-async def create_review(review_data: ReviewCreate):
+async def create_review(
+    review_data: ReviewCreate,
+    reviews: ReviewRepo = Depends(get_review_repo),
+    users: UserRepo = Depends(get_user_repo)
+):
     review_dict = review_data.dict()
     review_obj = Review(**review_dict)
-    await db.reviews.insert_one(review_obj.dict())
+    await reviews.insert(review_obj.dict())
     
     # Update user rating
-    user_reviews = await db.reviews.find({"reviewee_id": review_data.reviewee_id}).to_list(1000)
+    user_reviews = await reviews.find({"reviewee_id": review_data.reviewee_id}, limit=1000)
     total_rating = sum([review["rating"] for review in user_reviews])
     avg_rating = total_rating / len(user_reviews) if user_reviews else 0
     
-    await db.users.update_one(
+    await users.update_one(
         {"id": review_data.reviewee_id},
         {"$set": {"rating": avg_rating, "total_reviews": len(user_reviews)}}
     )
     
     return review_obj
 
-@api_router.get("/reviews/{user_id}", response_model=List[Review])
-async def get_user_reviews(user_id: str):
-    reviews = await db.reviews.find({"reviewee_id": user_id}).sort("created_at", -1).to_list(100)
-    return [Review(**review) for review in reviews]
+@api_router.get("/reviews/{user_id}", response_model=List[ExpandedReview])
+async def get_user_reviews(
+    user_id: str,
+    expand: Optional[str] = None,
+    reviews: ReviewRepo = Depends(get_review_repo),
+    users: UserRepo = Depends(get_user_repo)
+):
+    expand_names = parse_expand(expand, ["reviewer", "reviewee"])
+    found = await reviews.find({"reviewee_id": user_id}, sort=[("created_at", -1)], limit=100)
+    return [ExpandedReview(**review) for review in await expand_users(found, expand_names, users)]
+
+@api_router.get("/autocomplete", response_model=List[Suggestion])
+async def get_suggestions(
+    q: str = Query(..., min_length=1, max_length=100),
+    kind: AutocompleteKind = AutocompleteKind.SKILL,
+    limit: int = 10,
+    suggestions: autocomplete.Autocomplete = Depends(get_autocomplete)
+):
+    """Skills or task titles with a word starting with ``q``, most used first."""
+    limit = max(1, min(limit, autocomplete.MAX_RESULTS))
+    return [Suggestion(text=text, count=count) for text, count in suggestions.search(kind.value, q, limit)]
 
 # Service Categories API
 @api_router.get("/categories")
@@ -444,27 +1201,23 @@ async def get_service_categories():
 
 # Analytics & Dashboard APIs
 @api_router.get("/dashboard/{user_id}")
-async def get_user_dashboard(user_id: str):
-    user = await db.users.find_one({"id": user_id})
+async def get_user_dashboard(user_id: str, storage: Storage = Depends(get_storage)):
+    user = await storage.users.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Get user's tasks based on their role
-    if user["role"] in [UserRole.CLIENT, UserRole.BOTH]:
-        client_tasks = await db.tasks.find({"client_id": user_id}).to_list(100)
-    else:
-        client_tasks = []
-    
-    if user["role"] in [UserRole.TASKER, UserRole.BOTH]:
-        tasker_tasks = await db.tasks.find({"tasker_id": user_id}).to_list(100)
-    else:
-        tasker_tasks = []
-    
-    # Get earnings for taskers
-    earnings = 0
-    if user["role"] in [UserRole.TASKER, UserRole.BOTH]:
-        payments = await db.payments.find({"tasker_id": user_id, "status": "completed"}).to_list(100)
-        earnings = sum([payment["amount"] for payment in payments])
+    async def nothing():
+        return []
+
+    # Get user's tasks based on their role, and earnings for taskers
+    is_client = user["role"] in [UserRole.CLIENT, UserRole.BOTH]
+    is_tasker = user["role"] in [UserRole.TASKER, UserRole.BOTH]
+    client_tasks, tasker_tasks, payments = await deadlines.gather(
+        storage.tasks.find({"client_id": user_id}, limit=100) if is_client else nothing(),
+        storage.tasks.find({"tasker_id": user_id}, limit=100) if is_tasker else nothing(),
+        storage.payments.find({"tasker_id": user_id, "status": "completed"}, limit=100) if is_tasker else nothing(),
+    )
+    earnings = sum([payment["amount"] for payment in payments])
     
     # Convert user to User model to handle serialization
     user_obj = User(**user)
@@ -478,6 +1231,132 @@ async def get_user_dashboard(user_id: str):
         "total_reviews": user.get("total_reviews", 0)
     }
 
+# Marketplace analytics, served from the daily rollups maintained by analytics.py
+ANALYTICS_MAX_DAYS = 366
+
+def analytics_day_filter(start: Optional[date], end: Optional[date]) -> Dict[str, Any]:
+    import analytics
+
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=29)
+    if start > end or (end - start).days >= ANALYTICS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range must span 1 to {ANALYTICS_MAX_DAYS} days")
+    return {"day": {"$gte": start.strftime(analytics.DAY_FORMAT), "$lte": end.strftime(analytics.DAY_FORMAT)}}
+
+@api_router.get("/analytics/tasks", response_model=List[TaskDailyStats])
+async def get_task_analytics(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    category: Optional[TaskCategory] = None,
+    task_stats: TaskStatsRepo = Depends(get_task_stats_repo)
+):
+    query = analytics_day_filter(start, end)
+    if category:
+        query["category"] = category
+    found = await task_stats.find(query, {"_id": 0}, sort=[("day", 1), ("category", 1)], limit=0)
+    return [TaskDailyStats(**row) for row in found]
+
+@api_router.get("/analytics/gmv", response_model=List[PaymentDailyStats])
+async def get_gmv_analytics(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    payment_stats: PaymentStatsRepo = Depends(get_payment_stats_repo)
+):
+    found = await payment_stats.find(analytics_day_filter(start, end), {"_id": 0}, sort=[("day", 1)], limit=0)
+    return [PaymentDailyStats(**row) for row in found]
+
+# Delta Sync APIs
+# Changes stamped this recently are sent again on the next sync: a write that
+# drew its sequence number before a newer one but landed after it would
+# otherwise fall behind the client's token.
+SYNC_SETTLE_SECONDS = float(os.environ.get("SYNC_SETTLE_SECONDS", "5"))
+SYNC_COLLECTIONS = ["tasks", "task_bids", "messages", "reviews"]
+
+def parse_sync_token(token: Optional[str]) -> int:
+    if not token:
+        return 0
+    try:
+        since = int(token)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    if since < 0:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    return since
+
+@api_router.get("/sync", response_model=SyncResponse)
+async def sync_changes(
+    user_id: str,
+    since: Optional[str] = None,
+    feed: bool = False,
+    limit: int = 500,
+    storage: Storage = Depends(get_storage)
+):
+    since_seq = parse_sync_token(since)
+    limit = max(1, min(limit, 1000))
+    changed = {"sync_seq": {"$gt": since_seq}}
+    by_seq = [("sync_seq", 1)]
+
+    # With feed=true every task change is sent, so tasks leaving the feed are seen too
+    task_filter = changed if feed else {**changed, "$or": [{"client_id": user_id}, {"tasker_id": user_id}]}
+    # Bids carry their task's client_id, so bids by others on the user's tasks match
+    bid_filter = {**changed, "$or": [{"tasker_id": user_id}, {"client_id": user_id}]}
+    message_filter = {**changed, "$or": [{"sender_id": user_id}, {"receiver_id": user_id}]}
+    review_filter = {**changed, "$or": [{"reviewer_id": user_id}, {"reviewee_id": user_id}]}
+
+    sections = {
+        "tasks": await storage.tasks.find(task_filter, sort=by_seq, limit=limit),
+        "bids": await storage.task_bids.find(bid_filter, sort=by_seq, limit=limit),
+        "messages": await storage.messages.find(message_filter, sort=by_seq, limit=limit),
+        "reviews": await storage.reviews.find(review_filter, sort=by_seq, limit=limit),
+        "tombstones": await storage.tombstones.since(
+            since_seq, SYNC_COLLECTIONS, limit, user_id, public=["tasks"] if feed else []
+        ),
+    }
+
+    # A full section means more changes wait beyond its last item; cut every
+    # section there so the next page starts from one consistent point
+    has_more = False
+    upper = None
+    for documents in sections.values():
+        if len(documents) >= limit:
+            has_more = True
+            last_seq = documents[-1]["sync_seq"]
+            upper = last_seq if upper is None else min(upper, last_seq)
+    if upper is not None:
+        sections = {
+            name: [document for document in documents if document["sync_seq"] <= upper]
+            for name, documents in sections.items()
+        }
+
+    returned = [document for documents in sections.values() for document in documents]
+    if not returned:
+        next_seq = since_seq
+    else:
+        next_seq = max(document["sync_seq"] for document in returned)
+        settle_cutoff = datetime.utcnow() - timedelta(seconds=SYNC_SETTLE_SECONDS)
+        unsettled = [
+            document["sync_seq"] for document in returned
+            if (document.get("updated_at") or document.get("deleted_at")) > settle_cutoff
+        ]
+        # Page boundaries always advance; only the final page holds back
+        if unsettled and not has_more:
+            next_seq = max(since_seq, min(unsettled) - 1)
+
+    return SyncResponse(
+        tasks=[Task(**task) for task in sections["tasks"]],
+        bids=[TaskBid(**bid) for bid in sections["bids"]],
+        messages=[Message(**message) for message in sections["messages"]],
+        reviews=[Review(**review) for review in sections["reviews"]],
+        tombstones=[Tombstone(**tombstone) for tombstone in sections["tombstones"]],
+        next_token=str(next_seq),
+        has_more=has_more,
+    )
+
+# Process metrics
+@api_router.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
 # Basic API
 @api_router.get("/")
 async def root():
@@ -486,14 +1365,30 @@ async def root():
 # Include the router in the main app
 app.include_router(api_router)
 
+# Innermost, so time spent queued behind the limiter doesn't count
+deadlines.install(app)
+
+# Secondaries for staleness-tolerant routes; X-Causal-Token for read-your-writes
+readrouting.install(app)
+
+# Inside CORS so 429/503/504 responses still carry CORS headers
+ratelimit.install(app)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[readrouting.RESPONSE_HEADER],
 )
 
+# gzip/brotli/zstd by Accept-Encoding for bodies over COMPRESSION_MIN_SIZE
+compression.install(app)
+
+# Opt-in request profiling (no-op unless enabled through the environment)
+profiling.install(app)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -501,6 +1396,50 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Autoscaled workers can skip index builds when a deploy step runs them
+ENSURE_INDEXES_ON_STARTUP = os.environ.get("ENSURE_INDEXES_ON_STARTUP", "1") == "1"
+
+@app.on_event("startup")
+async def startup_storage():
+    app.state.storage = create_storage(event_listeners=profiling.command_listeners())
+    if ENSURE_INDEXES_ON_STARTUP:
+        await app.state.storage.ensure_indexes()
+    if app.state.storage.client is not None:
+        profiling.bind_client(app.state.storage.client)
+    # serve.py runs the periodic jobs in one worker only; the others never import them
+    periodic_jobs = ()
+    if getattr(app.state, "run_periodic_jobs", True):
+        import analytics
+        import retention
+
+        periodic_jobs = (retention, analytics)
+    app.state.background_tasks = [
+        asyncio.create_task(job.run_periodically(app.state.storage))
+        for job in periodic_jobs
+        if job.INTERVAL_SECONDS > 0
+    ]
+    app.state.scheduler = scheduler.install(app.state.storage)
+    if scheduler.ENABLED:
+        app.state.background_tasks.append(asyncio.create_task(app.state.scheduler.run()))
+    app.state.dispatcher = dispatch.install(app.state.storage)
+    if dispatch.ENABLED:
+        app.state.background_tasks.append(asyncio.create_task(app.state.dispatcher.run()))
+        app.state.background_tasks.append(asyncio.create_task(app.state.dispatcher.relay()))
+    app.state.presence = presence.install(app.state.storage)
+    app.state.background_tasks.append(asyncio.create_task(app.state.presence.run()))
+    app.state.feed_cache = feedcache.install(app.state.storage, TASK_SUMMARY_FIELDS)
+    app.state.autocomplete = autocomplete.install(app.state.storage)
+    app.state.counters = counters.install(app.state.storage)
+    app.state.counters.start()
+    app.state.background_tasks.append(asyncio.create_task(app.state.autocomplete.run()))
+    if feedcache.ENABLED:
+        app.state.background_tasks.append(asyncio.create_task(app.state.feed_cache.run()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    for task in app.state.background_tasks:
+        task.cancel()
+    await app.state.scheduler.stop()
+    await app.state.dispatcher.stop()
+    await app.state.counters.stop()
+    app.state.storage.close()
\ No newline at end of file
@@ -0,0 +1,86 @@
+"""Single-flight coalescing of identical concurrent reads.
+
+Concurrent callers asking for the same key share one in-flight call and its
+result. Nothing is kept once the call completes, so results are never older
+than an uncoalesced read started at the same moment. Writes call
+``forget`` for the keys they affect, so readers arriving after a write start
+a fresh call instead of joining one that may predate it.
+
+The shared call runs outside any request's deadline: a caller with a short
+``X-Request-Timeout`` must not fail it for everyone else. Each caller bounds
+its own wait by the time it has left.
+"""
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+import metrics
+from storage import DeadlineExceeded, current_deadline
+
+ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() not in ("0", "false", "no")
+
+
+async def _detached(fn: Callable[[], Awaitable[Any]]) -> Any:
+    # A task runs in a copy of the context, so this only affects the shared call
+    current_deadline.set(None)
+    return await fn()
+
+
+class SingleFlight:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.executions = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run ``fn`` unless an identical call is in flight; share its result.
+
+        Callers must treat the shared result as read-only.
+        """
+        self.calls += 1
+        if not self.enabled:
+            self.executions += 1
+            return await fn()
+        future = self._inflight.get(key)
+        if future is None:
+            self.executions += 1
+            # The call runs as its own task so a cancelled caller does not
+            # cancel it for everybody else
+            future = asyncio.ensure_future(_detached(fn))
+            self._inflight[key] = future
+            future.add_done_callback(lambda done, key=key: self._release(key, done))
+        deadline = current_deadline.get()
+        if deadline is None:
+            return await asyncio.shield(future)
+        with deadline.stage("single_flight") as remaining:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), remaining)
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("single_flight") from None
+
+    def _release(self, key: Hashable, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved when every caller went away
+            future.exception()
+
+    def forget(self, key: Hashable):
+        """Let the next caller for ``key`` start a new call."""
+        self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        coalesced = self.calls - self.executions
+        return {
+            "enabled": self.enabled,
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": coalesced,
+            "coalescing_ratio": round(coalesced / self.calls, 4) if self.calls else 0.0,
+            "inflight": len(self._inflight),
+        }
+
+
+reads = SingleFlight(enabled=ENABLED)
+metrics.register("single_flight", reads.stats)
@@ -0,0 +1,175 @@
+"""Pluggable storage: repositories over a Motor or in-memory engine.
+
+``STORAGE_BACKEND`` selects the engine (``mongo`` by default, or
+``memory``). Only the Mongo engine needs ``MONGO_URL`` and ``DB_NAME``.
+``STORAGE_ENCODING`` selects how ids and money are stored (see ``codec``).
+"""
+import asyncio
+import os
+from typing import Dict, Optional, Type
+
+from .base import (
+    ASCENDING,
+    DESCENDING,
+    Collection,
+    DeadlineExceeded,
+    Index,
+    ReadRouting,
+    current_deadline,
+    current_routing,
+)
+from .changes import ChangeTracker, SequenceCounter, TombstoneLog
+from .codec import ENCODINGS, Codec
+from .leases import LeaseStore
+from .memory import MemoryEngine
+from .presence import PresenceStore
+from .ratelimits import RateLimitStore
+from .repositories import (
+    MESSAGE_ARCHIVE_INDEXES,
+    ConversationRepo,
+    DispatchCheckpointRepo,
+    LocationPingRepo,
+    MessageArchiveRepo,
+    MessageRepo,
+    PaymentAccountRepo,
+    PaymentDiscrepancyRepo,
+    PaymentRepo,
+    PaymentStatsRepo,
+    Repository,
+    ReviewRepo,
+    TaskBidRepo,
+    TaskCounterRepo,
+    TaskRepo,
+    TaskStatsRepo,
+    UserRepo,
+    WalletLedgerRepo,
+    message_archive_name,
+)
+
+__all__ = [
+    "ASCENDING",
+    "DESCENDING",
+    "ChangeTracker",
+    "Codec",
+    "Collection",
+    "ConversationRepo",
+    "DeadlineExceeded",
+    "DispatchCheckpointRepo",
+    "Index",
+    "LeaseStore",
+    "LocationPingRepo",
+    "MessageArchiveRepo",
+    "MessageRepo",
+    "PaymentAccountRepo",
+    "PaymentDiscrepancyRepo",
+    "PaymentRepo",
+    "PaymentStatsRepo",
+    "PresenceStore",
+    "RateLimitStore",
+    "ReadRouting",
+    "Repository",
+    "ReviewRepo",
+    "Storage",
+    "TaskBidRepo",
+    "TaskCounterRepo",
+    "TaskRepo",
+    "TaskStatsRepo",
+    "UserRepo",
+    "WalletLedgerRepo",
+    "create_storage",
+    "current_deadline",
+    "current_routing",
+]
+
+
+class Storage:
+    """All repositories of the app, bound to one engine."""
+
+    def __init__(self, engine, encoding: str = "plain"):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown STORAGE_ENCODING {encoding!r}")
+        self.engine = engine
+        self.encoding = encoding
+        self.counters = SequenceCounter(self._collection(SequenceCounter))
+        self.tombstones = TombstoneLog(self._collection(TombstoneLog))
+        self.changes = ChangeTracker(self.counters, self.tombstones)
+        self.leases = LeaseStore(self._collection(LeaseStore))
+        self.rate_limits = RateLimitStore(self._collection(RateLimitStore))
+        self.presence = PresenceStore(self._collection(PresenceStore))
+        self.users = self._repo(UserRepo)
+        self.tasks = self._repo(TaskRepo)
+        self.task_bids = self._repo(TaskBidRepo)
+        self.payment_accounts = self._repo(PaymentAccountRepo)
+        self.payments = self._repo(PaymentRepo)
+        self.messages = self._repo(MessageRepo)
+        self.reviews = self._repo(ReviewRepo)
+        self.conversations = self._repo(ConversationRepo)
+        self.location_pings = self._repo(LocationPingRepo)
+        self.task_stats = self._repo(TaskStatsRepo)
+        self.payment_stats = self._repo(PaymentStatsRepo)
+        self.dispatch_checkpoints = self._repo(DispatchCheckpointRepo)
+        self.task_counters = self._repo(TaskCounterRepo)
+        self.wallet_ledger = self._repo(WalletLedgerRepo)
+        self.payment_discrepancies = self._repo(PaymentDiscrepancyRepo)
+        self._archives: Dict[str, MessageArchiveRepo] = {}
+
+    def _collection(self, owner) -> Collection:
+        return self.engine.collection(owner.collection_name, owner.indexes)
+
+    def codec(self, repo_class: Type[Repository]) -> Optional[Codec]:
+        if self.encoding == "plain":
+            return None
+        return Codec(repo_class.uuid_fields, repo_class.money_fields)
+
+    def _repo(self, repo_class: Type[Repository]) -> Repository:
+        changes = self.changes if repo_class.tracks_changes else None
+        return repo_class(self._collection(repo_class), changes, self.codec(repo_class))
+
+    @property
+    def backend(self) -> str:
+        return self.engine.name
+
+    @property
+    def client(self):
+        """The Motor client, or None for engines without one."""
+        return getattr(self.engine, "client", None)
+
+    def repositories(self) -> Dict[str, Repository]:
+        return {name: repo for name, repo in vars(self).items() if isinstance(repo, Repository)}
+
+    async def ensure_indexes(self):
+        # One createIndexes round trip per collection, all in flight at once
+        collections = [repo.collection for repo in self.repositories().values()]
+        collections += [self.tombstones.collection, self.rate_limits.collection, self.presence.collection]
+        await asyncio.gather(*(collection.ensure_indexes() for collection in collections))
+
+    async def message_archive(self, month: str) -> MessageArchiveRepo:
+        """Compressed archive collection for messages of ``month`` (YYYYMM)."""
+        if month not in self._archives:
+            archive = self.engine.collection(message_archive_name(month), MESSAGE_ARCHIVE_INDEXES, compressed=True)
+            await archive.ensure_indexes()
+            self._archives[month] = MessageArchiveRepo(archive, None, self.codec(MessageArchiveRepo))
+        return self._archives[month]
+
+    async def purge_expired(self) -> int:
+        purged = 0
+        for repo in self.repositories().values():
+            purged += await repo.collection.purge_expired()
+        purged += await self.rate_limits.collection.purge_expired()
+        purged += await self.presence.collection.purge_expired()
+        return purged
+
+    def close(self):
+        self.engine.close()
+
+
+def create_storage(backend: Optional[str] = None, encoding: Optional[str] = None, **client_options) -> Storage:
+    backend = backend or os.environ.get("STORAGE_BACKEND", "mongo")
+    encoding = encoding or os.environ.get("STORAGE_ENCODING", "plain")
+    if backend == "memory":
+        return Storage(MemoryEngine(), encoding)
+    if backend == "mongo":
+        from .mongo import MongoEngine
+
+        return Storage(MongoEngine(os.environ["MONGO_URL"], os.environ["DB_NAME"], **client_options), encoding)
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}")
@@ -0,0 +1,176 @@
+"""Engine-neutral collection interface shared by the Motor and memory stores.
+
+Filters, updates, sorts and projections use the Mongo query language; the
+memory engine implements the subset the API relies on.
+"""
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
+
+Filter = Dict[str, Any]
+Projection = Optional[Dict[str, int]]
+SortSpec = Optional[Sequence[Tuple[str, int]]]
+
+ASCENDING = 1
+DESCENDING = -1
+
+# Deadline of the request being served (see ``deadlines``). Collection calls
+# are bounded by the time it has left and charged to a
+# ``<collection>.<operation>`` stage of it.
+current_deadline: ContextVar[Optional[Any]] = ContextVar("current_deadline", default=None)
+
+
+@dataclass
+class ReadRouting:
+    """Where the current request's reads go (see ``readrouting``).
+
+    ``cluster_time`` and ``operation_time`` are the client's causal token:
+    reads must see everything up to it, and writes move it forward.
+    """
+
+    secondary: bool = False
+    max_staleness_seconds: int = 90
+    cluster_time: Optional[dict] = None
+    operation_time: Any = None
+
+    def observe(self, cluster_time: Optional[dict], operation_time: Any):
+        if operation_time is not None and (self.operation_time is None or operation_time > self.operation_time):
+            self.operation_time = operation_time
+        if cluster_time is not None and (
+            self.cluster_time is None or cluster_time["clusterTime"] > self.cluster_time["clusterTime"]
+        ):
+            self.cluster_time = cluster_time
+
+
+current_routing: ContextVar[Optional[ReadRouting]] = ContextVar("current_routing", default=None)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: Optional[str] = None):
+        super().__init__(f"Deadline exceeded in {stage}" if stage else "Deadline exceeded")
+        self.stage = stage
+
+
+def bounded(method):
+    """Run a collection call within the current deadline, if there is one."""
+
+    @functools.wraps(method)
+    async def call(self, *args, **kwargs):
+        deadline = current_deadline.get()
+        if deadline is None:
+            return await method(self, *args, **kwargs)
+        stage = f"{self.name}.{method.__name__}"
+        with deadline.stage(stage) as remaining, self.time_limit(remaining, stage):
+            return await method(self, *args, **kwargs)
+
+    return call
+
+
+@dataclass
+class Index:
+    keys: List[Tuple[str, int]]
+    unique: bool = False
+    expire_after_seconds: Optional[int] = None
+    sparse: bool = False
+    name: Optional[str] = None
+    options: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def first_field(self) -> str:
+        return self.keys[0][0]
+
+
+def normalize_sort(sort: Union[None, str, Sequence[Tuple[str, int]]], direction: int = ASCENDING) -> SortSpec:
+    if sort is None:
+        return None
+    if isinstance(sort, str):
+        return [(sort, direction)]
+    return list(sort)
+
+
+class Collection:
+    """Async collection API implemented by every storage engine."""
+
+    name: str
+
+    @contextmanager
+    def time_limit(self, seconds: Optional[float], stage: str):
+        """Hand the time left to the engine; engines without server-side limits skip it."""
+        yield
+
+    async def ensure_indexes(self):
+        raise NotImplementedError
+
+    async def find_one(self, filter: Filter, projection: Projection = None, sort: SortSpec = None) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def find(
+        self,
+        filter: Optional[Filter] = None,
+        projection: Projection = None,
+        sort: SortSpec = None,
+        skip: int = 0,
+        limit: int = 100,
+    ) -> List[dict]:
+        raise NotImplementedError
+
+    def stream(
+        self,
+        filter: Optional[Filter] = None,
+        projection: Projection = None,
+        sort: SortSpec = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[dict]:
+        """Iterate over every match, ``batch_size`` documents per round trip, without
+        holding them all; for batch jobs, so not bounded by a request deadline."""
+        raise NotImplementedError
+
+    async def count(self, filter: Optional[Filter] = None) -> int:
+        raise NotImplementedError
+
+    async def insert_one(self, document: dict):
+        raise NotImplementedError
+
+    async def insert_many(self, documents: List[dict]):
+        raise NotImplementedError
+
+    async def update_one(self, filter: Filter, update: dict, upsert: bool = False) -> int:
+        """Apply ``update`` to the first match; returns the matched count."""
+        raise NotImplementedError
+
+    async def update_many(self, filter: Filter, update: dict) -> int:
+        raise NotImplementedError
+
+    async def bulk_update(self, updates: List[Tuple[Filter, dict]], upsert: bool = False) -> int:
+        """Apply each ``(filter, update)`` to its first match in one round trip, in no
+        particular order; returns the matched count."""
+        raise NotImplementedError
+
+    async def find_one_and_update(
+        self,
+        filter: Filter,
+        update: dict,
+        projection: Projection = None,
+        upsert: bool = False,
+        return_new: bool = True,
+    ) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def aggregate(self, pipeline: List[dict]) -> List[dict]:
+        """Run an aggregation pipeline; one ending in ``$merge`` returns ``[]``."""
+        raise NotImplementedError
+
+    async def delete_one(self, filter: Filter) -> int:
+        raise NotImplementedError
+
+    async def delete_many(self, filter: Filter) -> int:
+        raise NotImplementedError
+
+    async def drop(self):
+        raise NotImplementedError
+
+    async def purge_expired(self) -> int:
+        """Remove documents past a TTL index; engines with native TTL skip it."""
+        return 0
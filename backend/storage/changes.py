@@ -0,0 +1,111 @@
+"""Change tracking for delta sync.
+
+Every write through a tracked repository is stamped with ``updated_at`` and
+a ``sync_seq`` drawn from one global, monotonically increasing counter.
+Deletions leave a tombstone carrying the sequence of the delete and the
+users the deleted document concerned, so each user syncs only their own.
+"""
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+from pymongo.errors import DuplicateKeyError
+
+from .base import ASCENDING, Collection, Index
+
+CHANGE_SEQUENCE = "changes"
+
+
+class SequenceCounter:
+    """Named counters stored as ``{_id: name, value: n}`` documents."""
+
+    collection_name = "counters"
+    indexes: List[Index] = []
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    async def next(self, name: str, count: int = 1) -> int:
+        """Reserve ``count`` values and return the last one."""
+        counter = await self.collection.find_one_and_update(
+            {"_id": name}, {"$inc": {"value": count}}, upsert=True, return_new=True
+        )
+        return counter["value"]
+
+    async def compare_and_increment(self, name: str, expected: int) -> bool:
+        counter = await self.collection.find_one_and_update(
+            {"_id": name, "value": expected}, {"$inc": {"value": 1}}
+        )
+        if counter is not None:
+            return True
+        if expected != 0:
+            return False
+        # A counter that was never bumped has no document yet
+        try:
+            await self.collection.insert_one({"_id": name, "value": 1})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def advance(self, name: str, value: int):
+        """Move the counter forward to ``value``; never moves it back."""
+        await self.collection.update_one({"_id": name}, {"$max": {"value": value}}, upsert=True)
+
+    async def current(self, name: str) -> int:
+        counter = await self.collection.find_one({"_id": name})
+        return counter["value"] if counter else 0
+
+
+class TombstoneLog:
+    collection_name = "tombstones"
+    indexes = [
+        Index([("sync_seq", ASCENDING)]),
+        Index([("users", ASCENDING), ("sync_seq", ASCENDING)]),
+    ]
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    async def record(self, collection_name: str, ids: List[str], last_seq: int, users: Sequence[List[str]] = ()):
+        """``users`` holds, per id, the users the deleted document concerned."""
+        first_seq = last_seq - len(ids) + 1
+        now = datetime.utcnow()
+        users = list(users) or [[] for _ in ids]
+        await self.collection.insert_many([
+            {"collection": collection_name, "id": id, "users": users[offset], "sync_seq": first_seq + offset, "deleted_at": now}
+            for offset, id in enumerate(ids)
+        ])
+
+    async def since(
+        self,
+        since: int,
+        collections: List[str],
+        limit: int,
+        user_id: Optional[str] = None,
+        public: Sequence[str] = (),
+    ) -> List[dict]:
+        """Tombstones after ``since``; with ``user_id``, only that user's plus
+        those of the ``public`` collections."""
+        query = {"sync_seq": {"$gt": since}, "collection": {"$in": collections}}
+        if user_id is not None:
+            query["$or"] = [{"users": user_id}, {"collection": {"$in": list(public)}}]
+        return await self.collection.find(
+            query,
+            {"_id": 0, "users": 0},
+            sort=[("sync_seq", ASCENDING)],
+            limit=limit,
+        )
+
+
+class ChangeTracker:
+    def __init__(self, counters: SequenceCounter, tombstones: TombstoneLog):
+        self.counters = counters
+        self.tombstones = tombstones
+
+    async def next_seq(self, count: int = 1) -> int:
+        return await self.counters.next(CHANGE_SEQUENCE, count)
+
+    async def current_seq(self) -> int:
+        return await self.counters.current(CHANGE_SEQUENCE)
+
+    async def stamp(self) -> dict:
+        return {"updated_at": datetime.utcnow(), "sync_seq": await self.next_seq()}
@@ -0,0 +1,156 @@
+"""Compact storage encoding for ids and money.
+
+With ``STORAGE_ENCODING=compact`` repositories store UUID strings as BSON
+Binary subtype 4 (16 bytes instead of a 36-character string) and money as
+int64 minor units. Filters, updates and results are translated at the
+repository boundary, so callers and the public API keep seeing UUID strings
+and decimal amounts. Each repository declares which paths hold ids and money.
+
+``plain`` (the default) stores values as given. Existing data must be
+converted with ``migrate_encoding.py`` before switching to ``compact``.
+"""
+import uuid
+from typing import Any, Callable, FrozenSet, Iterable, Optional
+
+from bson.binary import UUID_SUBTYPE, Binary
+
+ENCODINGS = ("plain", "compact")
+MINOR_UNITS = 100
+
+_LOGICAL_OPERATORS = ("$and", "$or", "$nor")
+_LIST_OPERATORS = ("$in", "$nin", "$all")
+_LITERAL_OPERATORS = ("$exists", "$size", "$type", "$regex", "$options", "$elemMatch")
+
+
+def encode_uuid(value: Any) -> Any:
+    if not isinstance(value, str):
+        return value
+    try:
+        parsed = uuid.UUID(value)
+    except ValueError:
+        return value
+    # Only canonical strings, so decoding gives back exactly what was stored
+    return Binary.from_uuid(parsed) if str(parsed) == value else value
+
+
+def decode_uuid(value: Any) -> Any:
+    if isinstance(value, Binary) and value.subtype == UUID_SUBTYPE:
+        return str(value.as_uuid())
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def encode_money(value: Any) -> Any:
+    return int(round(value * MINOR_UNITS)) if _is_number(value) else value
+
+
+def encode_legacy_money(value: Any) -> Any:
+    # Plain documents hold floats; ints are already minor units, which keeps
+    # a rerun of the migration from scaling twice
+    return encode_money(value) if isinstance(value, float) else value
+
+
+def decode_money(value: Any) -> Any:
+    return value / MINOR_UNITS if _is_number(value) else value
+
+
+def _each(convert: Callable[[Any], Any], value: Any) -> Any:
+    if isinstance(value, list):
+        return [convert(item) for item in value]
+    return convert(value)
+
+
+def _parents(paths: Iterable[str]) -> FrozenSet[str]:
+    parents = set()
+    for path in paths:
+        parts = path.split(".")
+        parents.update(".".join(parts[:end]) for end in range(1, len(parts)))
+    return frozenset(parents)
+
+
+class Codec:
+    def __init__(self, uuid_fields: Iterable[str], money_fields: Iterable[str] = ()):
+        self.uuid_fields = frozenset(uuid_fields)
+        self.money_fields = frozenset(money_fields)
+        self._parents = _parents(self.uuid_fields | self.money_fields)
+
+    def _encode_value(self, path: str, value: Any, money: Callable[[Any], Any] = encode_money) -> Any:
+        if path in self.uuid_fields:
+            return _each(encode_uuid, value)
+        if path in self.money_fields:
+            return _each(money, value)
+        if path in self._parents:
+            if isinstance(value, dict):
+                return {key: self._encode_value(f"{path}.{key}", item, money) for key, item in value.items()}
+            if isinstance(value, list):
+                return [self._encode_value(path, item, money) for item in value]
+        return value
+
+    def _encode_condition(self, path: str, condition: Any) -> Any:
+        if not (isinstance(condition, dict) and any(key.startswith("$") for key in condition)):
+            return self._encode_value(path, condition)
+        encoded = {}
+        for operator, operand in condition.items():
+            if operator in _LIST_OPERATORS:
+                encoded[operator] = [self._encode_value(path, item) for item in operand]
+            elif operator in _LITERAL_OPERATORS:
+                encoded[operator] = operand
+            elif operator == "$not":
+                encoded[operator] = self._encode_condition(path, operand)
+            else:
+                encoded[operator] = self._encode_value(path, operand)
+        return encoded
+
+    def encode_filter(self, filter: Optional[dict]) -> Optional[dict]:
+        if not filter:
+            return filter
+        encoded = {}
+        for path, condition in filter.items():
+            if path in _LOGICAL_OPERATORS:
+                encoded[path] = [self.encode_filter(clause) for clause in condition]
+            else:
+                encoded[path] = self._encode_condition(path, condition)
+        return encoded
+
+    def encode_update(self, update: dict) -> dict:
+        encoded = {}
+        for operator, fields in update.items():
+            if operator == "$unset":
+                encoded[operator] = fields
+                continue
+            encoded_fields = {}
+            for path, value in fields.items():
+                if operator in ("$push", "$addToSet") and isinstance(value, dict) and "$each" in value:
+                    encoded_fields[path] = {**value, "$each": [self._encode_value(path, item) for item in value["$each"]]}
+                elif operator == "$pull":
+                    encoded_fields[path] = self._encode_condition(path, value)
+                else:
+                    encoded_fields[path] = self._encode_value(path, value)
+            encoded[operator] = encoded_fields
+        return encoded
+
+    def encode_document(self, document: dict, legacy: bool = False) -> dict:
+        money = encode_legacy_money if legacy else encode_money
+        return {path: self._encode_value(path, value, money) for path, value in document.items()}
+
+    def _decode_value(self, path: str, value: Any) -> Any:
+        if path in self.uuid_fields:
+            return _each(decode_uuid, value)
+        if path in self.money_fields:
+            return _each(decode_money, value)
+        if path in self._parents:
+            if isinstance(value, dict):
+                return {key: self._decode_value(f"{path}.{key}", item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [self._decode_value(path, item) for item in value]
+        return value
+
+    def decode(self, document: Optional[dict]) -> Optional[dict]:
+        if document is None:
+            return None
+        return {path: self._decode_value(path, value) for path, value in document.items()}
@@ -0,0 +1,33 @@
+"""Named, time-limited leases for electing one worker to run a job."""
+from datetime import datetime, timedelta
+from typing import List
+
+from pymongo.errors import DuplicateKeyError
+
+from .base import Collection, Index
+
+
+class LeaseStore:
+    collection_name = "leases"
+    indexes: List[Index] = []
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    async def acquire(self, name: str, owner: str, ttl_seconds: float) -> bool:
+        """Take or renew lease ``name``; False while another owner holds it."""
+        now = datetime.utcnow()
+        try:
+            lease = await self.collection.find_one_and_update(
+                {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+                upsert=True,
+                return_new=True,
+            )
+        except DuplicateKeyError:
+            # The upsert raced an unexpired lease held by someone else
+            return False
+        return lease is not None and lease["owner"] == owner
+
+    async def release(self, name: str, owner: str):
+        await self.collection.delete_one({"_id": name, "owner": owner})
@@ -0,0 +1,840 @@
+"""In-memory storage engine for tests, benchmarks and single-node deployments.
+
+Documents live in a dict keyed by ``_id`` with a hash index per declared
+index (on its leading field), so equality and ``$in`` lookups on indexed
+fields avoid full scans. Compound indexes additionally keep each bucket
+sorted on their second field, so "equality + sort + limit" queries such as
+the task feed only walk the page they return. Values go through a BSON-like normalisation on the
+way in and out (enums to their value, tuples to lists, datetimes truncated to
+milliseconds, deep copies), so handlers see the same shapes Mongo returns.
+``aggregate`` covers the pipeline stages the analytics rollups and the
+autocomplete build use, including a trailing ``$merge``.
+"""
+import bisect
+import functools
+import heapq
+import itertools
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from .base import Collection, Filter, Index, Projection, SortSpec, bounded
+
+_MISSING = object()
+
+
+def to_stored(value: Any) -> Any:
+    """Copy ``value`` the way a BSON round-trip would."""
+    if isinstance(value, dict):
+        return {key: to_stored(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_stored(item) for item in value]
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def get_path(document: dict, path: str) -> Any:
+    if "." not in path:
+        return document.get(path, _MISSING)
+    value: Any = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            index = int(part)
+            value = value[index] if index < len(value) else _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def set_path(document: dict, path: str, value: Any):
+    parts = path.split(".")
+    target = document
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    target[parts[-1]] = value
+
+
+def unset_path(document: dict, path: str):
+    parts = path.split(".")
+    target = document
+    for part in parts[:-1]:
+        target = target.get(part)
+        if not isinstance(target, dict):
+            return
+    target.pop(parts[-1], None)
+
+
+# Mongo's cross-type ordering, reduced to the types the API stores
+def _type_rank(value: Any) -> int:
+    if value is _MISSING or value is None:
+        return 0
+    if isinstance(value, bool):
+        return 5
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    if isinstance(value, ObjectId):
+        return 6
+    if isinstance(value, datetime):
+        return 7
+    return 8
+
+
+def compare(left: Any, right: Any) -> int:
+    left_rank, right_rank = _type_rank(left), _type_rank(right)
+    if left_rank != right_rank:
+        return -1 if left_rank < right_rank else 1
+    if left_rank == 0:
+        return 0
+    try:
+        return (left > right) - (left < right)
+    except TypeError:
+        return 0
+
+
+def _candidates(value: Any) -> List[Any]:
+    # An array field matches when the array itself or any element matches
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+
+def _match_operator(value: Any, operator: str, operand: Any) -> bool:
+    if operator == "$eq":
+        return _match_value(value, operand)
+    if operator == "$ne":
+        return not _match_value(value, operand)
+    if operator == "$in":
+        return any(_match_value(value, item) for item in operand)
+    if operator == "$nin":
+        return not any(_match_value(value, item) for item in operand)
+    if operator == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        if value is _MISSING:
+            return False
+        for candidate in _candidates(value):
+            if _type_rank(candidate) != _type_rank(operand):
+                continue
+            result = compare(candidate, operand)
+            if (
+                (operator == "$gt" and result > 0)
+                or (operator == "$gte" and result >= 0)
+                or (operator == "$lt" and result < 0)
+                or (operator == "$lte" and result <= 0)
+            ):
+                return True
+        return False
+    if operator == "$regex":
+        pattern = operand if hasattr(operand, "search") else re.compile(operand)
+        return any(isinstance(item, str) and pattern.search(item) for item in _candidates(value))
+    if operator == "$size":
+        return isinstance(value, list) and len(value) == operand
+    if operator == "$all":
+        return isinstance(value, list) and all(_match_value(value, item) for item in operand)
+    if operator == "$elemMatch":
+        return isinstance(value, list) and any(isinstance(item, dict) and matches(item, operand) for item in value)
+    if operator == "$not":
+        return not _match_condition(value, operand)
+    raise ValueError(f"Unsupported query operator {operator}")
+
+
+def _match_value(value: Any, expected: Any) -> bool:
+    if expected is None:
+        return value is _MISSING or value is None
+    if value is _MISSING:
+        return False
+    return any(candidate == expected for candidate in _candidates(value))
+
+
+def _match_condition(value: Any, condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        return all(_match_operator(value, operator, operand) for operator, operand in condition.items())
+    return _match_value(value, condition)
+
+
+def matches(document: dict, filter: Optional[Filter]) -> bool:
+    if not filter:
+        return True
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(document, clause) for clause in condition):
+                return False
+        elif not _match_condition(get_path(document, key), condition):
+            return False
+    return True
+
+
+def apply_update(document: dict, update: dict, inserting: bool = False):
+    if update and not any(key.startswith("$") for key in update):
+        # Replacement document
+        preserved_id = document.get("_id")
+        document.clear()
+        document.update(update)
+        document["_id"] = preserved_id
+        return
+    for operator, fields in update.items():
+        for path, operand in fields.items():
+            current = get_path(document, path)
+            if operator == "$set":
+                set_path(document, path, operand)
+            elif operator == "$setOnInsert":
+                if inserting:
+                    set_path(document, path, operand)
+            elif operator == "$unset":
+                unset_path(document, path)
+            elif operator == "$inc":
+                set_path(document, path, (0 if current in (_MISSING, None) else current) + operand)
+            elif operator == "$max":
+                if current is _MISSING or compare(operand, current) > 0:
+                    set_path(document, path, operand)
+            elif operator == "$min":
+                if current is _MISSING or compare(operand, current) < 0:
+                    set_path(document, path, operand)
+            elif operator in ("$push", "$addToSet"):
+                items = list(current) if isinstance(current, list) else []
+                each = operand.get("$each") if isinstance(operand, dict) and "$each" in operand else [operand]
+                for item in each:
+                    if operator == "$push" or item not in items:
+                        items.append(item)
+                if isinstance(operand, dict) and "$slice" in operand:
+                    limit = operand["$slice"]
+                    items = items[limit:] if limit < 0 else items[:limit]
+                set_path(document, path, items)
+            elif operator == "$pull":
+                if isinstance(current, list):
+                    set_path(document, path, [item for item in current if not _match_condition(item, operand)])
+            else:
+                raise ValueError(f"Unsupported update operator {operator}")
+
+
+def project(document: dict, projection: Projection) -> dict:
+    if not projection:
+        return document
+    include_id = projection.get("_id", 1)
+    included = [path for path, flag in projection.items() if flag and path != "_id"]
+    if included:
+        result: Dict[str, Any] = {}
+        for path in included:
+            value = get_path(document, path)
+            if value is not _MISSING:
+                set_path(result, path, value)
+        if include_id and "_id" in document:
+            result["_id"] = document["_id"]
+        return result
+    result = dict(document)
+    for path, flag in projection.items():
+        if not flag:
+            unset_path(result, path)
+    return result
+
+
+# Aggregation: the stages, expressions and accumulators the rollups use
+
+def _arithmetic(args, combine):
+    if any(arg is None for arg in args):
+        return None
+    result = args[0]
+    for arg in args[1:]:
+        result = combine(result, arg)
+    return result
+
+
+def _subtract(left, right):
+    if isinstance(left, datetime) and isinstance(right, datetime):
+        # Date differences are in milliseconds, as in Mongo
+        return int((left - right).total_seconds() * 1000)
+    if isinstance(left, datetime):
+        return left - timedelta(milliseconds=right)
+    return left - right
+
+
+def _cond(document: dict, args) -> Any:
+    if isinstance(args, dict):
+        args = [args["if"], args["then"], args["else"]]
+    condition, then, otherwise = args
+    return evaluate(document, then if evaluate(document, condition) else otherwise)
+
+
+def _date_to_string(document: dict, args: dict) -> Any:
+    date = evaluate(document, args["date"])
+    if not isinstance(date, datetime):
+        return None
+    return date.strftime(args.get("format", "%Y-%m-%dT%H:%M:%S.000Z"))
+
+
+_EXPRESSIONS = {
+    "$add": lambda values: _arithmetic(values, lambda a, b: a + b),
+    "$subtract": lambda values: _arithmetic(values, _subtract),
+    "$multiply": lambda values: _arithmetic(values, lambda a, b: a * b),
+    "$divide": lambda values: _arithmetic(values, lambda a, b: a / b),
+    "$concat": lambda values: None if any(value is None for value in values) else "".join(values),
+    "$eq": lambda values: compare(values[0], values[1]) == 0,
+    "$ifNull": lambda values: next((value for value in values if value is not None), None),
+}
+
+# Operators that evaluate their own arguments
+_LAZY_EXPRESSIONS = {"$cond": _cond, "$dateToString": _date_to_string}
+
+
+def evaluate(document: dict, expression: Any) -> Any:
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = get_path(document, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            operator, args = next(iter(expression.items()))
+            if operator in _LAZY_EXPRESSIONS:
+                return _LAZY_EXPRESSIONS[operator](document, args)
+            if operator in _EXPRESSIONS:
+                args = args if isinstance(args, list) else [args]
+                return _EXPRESSIONS[operator]([evaluate(document, arg) for arg in args])
+            if operator.startswith("$"):
+                raise ValueError(f"Unsupported expression operator {operator}")
+        return {key: evaluate(document, value) for key, value in expression.items()}
+    if isinstance(expression, list):
+        return [evaluate(document, item) for item in expression]
+    return expression
+
+
+def _numbers(values: List[Any]) -> List[Any]:
+    return [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+
+def _median(values: List[Any]) -> Any:
+    numbers = sorted(_numbers(values))
+    # Nearest-rank, so the result is always one of the inputs
+    return numbers[(len(numbers) - 1) // 2] if numbers else None
+
+
+_ACCUMULATORS = {
+    "$sum": lambda values: sum(_numbers(values)),
+    "$avg": lambda values: sum(_numbers(values)) / len(_numbers(values)) if _numbers(values) else None,
+    "$min": lambda values: min((v for v in values if v is not None), key=functools.cmp_to_key(compare), default=None),
+    "$max": lambda values: max((v for v in values if v is not None), key=functools.cmp_to_key(compare), default=None),
+    "$first": lambda values: values[0] if values else None,
+    "$last": lambda values: values[-1] if values else None,
+    "$push": list,
+    "$median": _median,
+}
+
+
+def _group(documents: List[dict], spec: dict) -> List[dict]:
+    groups: Dict[Any, list] = {}
+    for document in documents:
+        key = evaluate(document, spec["_id"])
+        groups.setdefault(repr(key), [key, []])[1].append(document)
+    results = []
+    for key, members in groups.values():
+        result = {"_id": key}
+        for field_name, accumulator in spec.items():
+            if field_name == "_id":
+                continue
+            operator, argument = next(iter(accumulator.items()))
+            if operator not in _ACCUMULATORS:
+                raise ValueError(f"Unsupported accumulator {operator}")
+            if operator == "$median":
+                argument = argument["input"]
+            result[field_name] = _ACCUMULATORS[operator]([evaluate(member, argument) for member in members])
+        results.append(result)
+    return results
+
+
+def _add_fields(documents: List[dict], spec: dict) -> List[dict]:
+    results = []
+    for document in documents:
+        result = dict(document)
+        for path, expression in spec.items():
+            set_path(result, path, evaluate(document, expression))
+        results.append(result)
+    return results
+
+
+def _project_stage(documents: List[dict], spec: dict) -> List[dict]:
+    if all(flag in (0, 1, True, False) for flag in spec.values()):
+        return [project(document, spec) for document in documents]
+    results = []
+    for document in documents:
+        result = {"_id": document["_id"]} if spec.get("_id", 1) == 1 and "_id" in document else {}
+        for path, expression in spec.items():
+            if expression in (0, False):
+                continue
+            value = get_path(document, path) if expression in (1, True) else evaluate(document, expression)
+            if value is not _MISSING:
+                set_path(result, path, value)
+        results.append(result)
+    return results
+
+
+def _unwind(documents: List[dict], spec) -> List[dict]:
+    path = (spec if isinstance(spec, str) else spec["path"])[1:]
+    if "." in path:
+        raise ValueError(f"Unsupported $unwind path {path}")
+    results = []
+    for document in documents:
+        values = document.get(path)
+        if values is None:
+            continue
+        for value in values if isinstance(values, list) else [values]:
+            results.append({**document, path: value})
+    return results
+
+
+def run_pipeline(documents: List[dict], pipeline: List[dict]) -> List[dict]:
+    """Apply every stage except a trailing ``$merge`` to ``documents``."""
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == "$match":
+            documents = [document for document in documents if matches(document, spec)]
+        elif name == "$group":
+            documents = _group(documents, spec)
+        elif name == "$unwind":
+            documents = _unwind(documents, spec)
+        elif name in ("$set", "$addFields"):
+            documents = _add_fields(documents, spec)
+        elif name == "$project":
+            documents = _project_stage(documents, spec)
+        elif name == "$sort":
+            documents = sorted(documents, key=lambda doc: _SortKey(doc, list(spec.items())))
+        elif name == "$skip":
+            documents = documents[spec:]
+        elif name == "$limit":
+            documents = documents[:spec]
+        else:
+            raise ValueError(f"Unsupported aggregation stage {name}")
+    return documents
+
+
+class _SortKey:
+    __slots__ = ("values", "directions")
+
+    def __init__(self, document: dict, sort):
+        self.values = [get_path(document, path) for path, _ in sort]
+        self.directions = [direction for _, direction in sort]
+
+    def __lt__(self, other: "_SortKey") -> bool:
+        for left, right, direction in zip(self.values, other.values, self.directions):
+            result = compare(left, right)
+            if result:
+                return result * direction < 0
+        return False
+
+
+def _plain_sort_key(document: dict, sort) -> tuple:
+    key = []
+    for path, _ in sort:
+        value = get_path(document, path)
+        rank = _type_rank(value)
+        key.append((rank, None if rank == 0 else value))
+    return tuple(key)
+
+
+def _index_values(value: Any) -> Iterable[Any]:
+    if value is _MISSING:
+        return [None]
+    if isinstance(value, list):
+        return [item for item in value if _hashable(item)] or [None]
+    return [value] if _hashable(value) else []
+
+
+def _hashable(value: Any) -> bool:
+    return not isinstance(value, (dict, list))
+
+
+class MemoryCollection(Collection):
+    def __init__(self, name: str, indexes: List[Index], engine: Optional["MemoryEngine"] = None):
+        self.name = name
+        self.engine = engine
+        self.indexes = indexes
+        self._documents: Dict[Any, dict] = {}
+        self._index: Dict[str, Dict[Any, Set[Any]]] = {
+            index.first_field: defaultdict(set) for index in indexes
+        }
+        self._unique = [index.first_field for index in indexes if index.unique and len(index.keys) == 1]
+        # (equality field, sort field) -> value -> sorted [(sort key, seq, _id)]
+        self._ordered: Dict[tuple, Dict[Any, list]] = {
+            (index.keys[0][0], index.keys[1][0]): defaultdict(list) for index in indexes if len(index.keys) > 1
+        }
+        self._seq: Dict[Any, int] = {}
+        self._counter = itertools.count()
+
+    async def ensure_indexes(self):
+        # Index structures are maintained from construction on
+        return None
+
+    # Index maintenance
+
+    def _index_add(self, key, document: dict):
+        for path, entries in self._index.items():
+            for value in _index_values(get_path(document, path)):
+                entries[value].add(key)
+        if self._ordered:
+            seq = self._seq.setdefault(key, next(self._counter))
+            for (path, sort_path), buckets in self._ordered.items():
+                entry = (_plain_sort_key(document, [(sort_path, 1)]), seq, key)
+                for value in _index_values(get_path(document, path)):
+                    bisect.insort(buckets[value], entry)
+
+    def _index_remove(self, key, document: dict):
+        for path, entries in self._index.items():
+            for value in _index_values(get_path(document, path)):
+                bucket = entries.get(value)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del entries[value]
+        if self._ordered:
+            seq = self._seq[key]
+            for (path, sort_path), buckets in self._ordered.items():
+                entry = (_plain_sort_key(document, [(sort_path, 1)]), seq, key)
+                for value in _index_values(get_path(document, path)):
+                    bucket = buckets.get(value)
+                    if not bucket:
+                        continue
+                    position = bisect.bisect_left(bucket, entry)
+                    if position < len(bucket) and bucket[position] == entry:
+                        del bucket[position]
+                    if not bucket:
+                        del buckets[value]
+
+    def _check_unique(self, document: dict, key=None):
+        for path in self._unique:
+            value = get_path(document, path)
+            if value is _MISSING:
+                continue
+            owners = self._index[path].get(value, ())
+            if any(owner != key for owner in owners):
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {path}_1")
+
+    # Query planning
+
+    def _scan(self, filter: Optional[Filter]) -> List[dict]:
+        keys, exact = self._plan(filter or {})
+        if keys is None:
+            candidates: Iterable[dict] = self._documents.values()
+        else:
+            candidates = [self._documents[key] for key in keys]
+            if exact:
+                return candidates
+        return [document for document in candidates if matches(document, filter)]
+
+    def _plan(self, filter: Filter):
+        """Smallest candidate key set from equality or $in on indexed fields.
+
+        The second value tells whether the index lookup alone satisfies the
+        filter, in which case candidates need no further matching.
+        """
+        primary = filter.get("_id", _MISSING)
+        if primary is not _MISSING and _hashable(primary):
+            keys = {primary} if primary in self._documents else set()
+            return keys, len(filter) == 1
+        best: Optional[Set[Any]] = None
+        exact = False
+        for path, condition in filter.items():
+            entries = self._index.get(path)
+            if entries is None:
+                continue
+            if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+                if "$eq" in condition:
+                    values = [condition["$eq"]]
+                elif "$in" in condition:
+                    values = list(condition["$in"])
+                else:
+                    continue
+            else:
+                values = [condition]
+            if not all(_hashable(value) and value is not None for value in values):
+                continue
+            keys: Set[Any] = set()
+            for value in values:
+                keys |= entries.get(value, set())
+            if best is None or len(keys) < len(best):
+                best = keys
+                exact = len(filter) == 1
+        return best, exact
+
+    def _ordered_scan(self, filter: Filter, sort, wanted: int) -> Optional[List[dict]]:
+        """Walk a sorted compound-index bucket, stopping after ``wanted`` hits."""
+        if len(sort) != 1:
+            return None
+        sort_path, direction = sort[0]
+        for path, condition in filter.items():
+            buckets = self._ordered.get((path, sort_path))
+            if buckets is None or isinstance(condition, (dict, list)) or condition is None:
+                continue
+            entries = buckets.get(condition, [])
+            exact = len(filter) == 1
+            found = []
+            for _, _, key in (reversed(entries) if direction < 0 else entries):
+                document = self._documents[key]
+                if exact or matches(document, filter):
+                    found.append(document)
+                    if wanted and len(found) >= wanted:
+                        break
+            return found
+        return None
+
+    def _select(self, filter, sort, skip: int = 0, limit: int = 0) -> List[dict]:
+        if sort and filter and self._ordered:
+            documents = self._ordered_scan(filter, sort, skip + limit if limit else 0)
+            if documents is not None:
+                return documents[skip:]
+        documents = self._scan(filter)
+        if sort:
+            directions = {direction for _, direction in sort}
+            if len(directions) == 1:
+                # Plain tuple keys are much cheaper than _SortKey comparisons
+                key, reverse = (lambda doc: _plain_sort_key(doc, sort)), directions.pop() < 0
+            else:
+                key, reverse = (lambda doc: _SortKey(doc, sort)), False
+            if limit and skip + limit < len(documents):
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                documents = select(skip + limit, documents, key=key)
+            else:
+                documents.sort(key=key, reverse=reverse)
+        if skip:
+            documents = documents[skip:]
+        if limit:
+            documents = documents[:limit]
+        return documents
+
+    def _output(self, document: dict, projection: Projection) -> dict:
+        return to_stored(project(document, projection))
+
+    # Collection API
+
+    @bounded
+    async def find_one(self, filter: Filter, projection: Projection = None, sort: SortSpec = None) -> Optional[dict]:
+        found = self._select(filter, sort, limit=1)
+        return self._output(found[0], projection) if found else None
+
+    @bounded
+    async def find(
+        self,
+        filter: Optional[Filter] = None,
+        projection: Projection = None,
+        sort: SortSpec = None,
+        skip: int = 0,
+        limit: int = 100,
+    ) -> List[dict]:
+        return [self._output(document, projection) for document in self._select(filter, sort, skip, limit)]
+
+    async def stream(
+        self,
+        filter: Optional[Filter] = None,
+        projection: Projection = None,
+        sort: SortSpec = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[dict]:
+        for document in self._select(filter, sort):
+            yield self._output(document, projection)
+
+    @bounded
+    async def count(self, filter: Optional[Filter] = None) -> int:
+        if not filter:
+            return len(self._documents)
+        return len(self._scan(filter))
+
+    def _insert(self, document: dict) -> dict:
+        stored = to_stored(document)
+        stored.setdefault("_id", ObjectId())
+        key = stored["_id"]
+        if key in self._documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+        self._check_unique(stored)
+        self._documents[key] = stored
+        self._index_add(key, stored)
+        return stored
+
+    @bounded
+    async def insert_one(self, document: dict):
+        self._insert(document)
+
+    @bounded
+    async def insert_many(self, documents: List[dict]):
+        for document in documents:
+            self._insert(document)
+
+    def _update(self, document: dict, update: dict, inserting: bool = False):
+        key = document["_id"]
+        updated = to_stored(document)
+        apply_update(updated, to_stored(update), inserting=inserting)
+        self._check_unique(updated, key)
+        self._index_remove(key, document)
+        self._documents[key] = updated
+        self._index_add(key, updated)
+        return updated
+
+    def _upsert(self, filter: Filter, update: dict) -> dict:
+        seed = {
+            path: condition
+            for path, condition in filter.items()
+            if not path.startswith("$") and not (isinstance(condition, dict) and any(k.startswith("$") for k in condition))
+        }
+        document: Dict[str, Any] = {}
+        for path, value in seed.items():
+            set_path(document, path, value)
+        stored = self._insert(document)
+        return self._update(stored, update, inserting=True)
+
+    @bounded
+    async def update_one(self, filter: Filter, update: dict, upsert: bool = False) -> int:
+        found = self._select(filter, None, limit=1)
+        if found:
+            self._update(found[0], update)
+            return 1
+        if upsert:
+            self._upsert(filter, update)
+        return 0
+
+    @bounded
+    async def update_many(self, filter: Filter, update: dict) -> int:
+        found = self._scan(filter)
+        for document in found:
+            self._update(document, update)
+        return len(found)
+
+    @bounded
+    async def bulk_update(self, updates: List[Tuple[Filter, dict]], upsert: bool = False) -> int:
+        matched = 0
+        for filter, update in updates:
+            found = self._select(filter, None, limit=1)
+            if found:
+                self._update(found[0], update)
+                matched += 1
+            elif upsert:
+                self._upsert(filter, update)
+        return matched
+
+    @bounded
+    async def find_one_and_update(
+        self,
+        filter: Filter,
+        update: dict,
+        projection: Projection = None,
+        upsert: bool = False,
+        return_new: bool = True,
+    ) -> Optional[dict]:
+        found = self._select(filter, None, limit=1)
+        if found:
+            before = found[0]
+            after = self._update(before, update)
+            return self._output(after if return_new else before, projection)
+        if upsert:
+            after = self._upsert(filter, update)
+            return self._output(after, projection) if return_new else None
+        return None
+
+    def _delete(self, document: dict):
+        key = document["_id"]
+        self._index_remove(key, document)
+        del self._documents[key]
+        self._seq.pop(key, None)
+
+    @bounded
+    async def delete_one(self, filter: Filter) -> int:
+        found = self._select(filter, None, limit=1)
+        if found:
+            self._delete(found[0])
+        return len(found)
+
+    @bounded
+    async def delete_many(self, filter: Filter) -> int:
+        found = self._scan(filter)
+        for document in found:
+            self._delete(document)
+        return len(found)
+
+    @bounded
+    async def aggregate(self, pipeline: List[dict]) -> List[dict]:
+        merge = pipeline[-1]["$merge"] if pipeline and "$merge" in pipeline[-1] else None
+        stages = pipeline[:-1] if merge is not None else pipeline
+        # A leading $match can use the indexes
+        if stages and "$match" in stages[0]:
+            documents, stages = self._scan(stages[0]["$match"]), stages[1:]
+        else:
+            documents = list(self._documents.values())
+        documents = run_pipeline([to_stored(document) for document in documents], stages)
+        if merge is None:
+            return documents
+        await self._merge(documents, merge)
+        return []
+
+    async def _merge(self, documents: List[dict], spec):
+        if isinstance(spec, str):
+            spec = {"into": spec}
+        target = self.engine.collection(spec["into"], [])
+        on = spec.get("on", "_id")
+        fields = [on] if isinstance(on, str) else list(on)
+        when_matched = spec.get("whenMatched", "merge")
+        when_not_matched = spec.get("whenNotMatched", "insert")
+        for document in documents:
+            key = {field: document.get(field) for field in fields}
+            existing = await target.find_one(key, {"_id": 1})
+            if existing is None:
+                if when_not_matched == "insert":
+                    await target.insert_one(document)
+                elif when_not_matched == "fail":
+                    raise ValueError(f"$merge found no match for {key}")
+            elif when_matched == "merge":
+                await target.update_one(key, {"$set": {k: v for k, v in document.items() if k != "_id"}})
+            elif when_matched == "replace":
+                await target.delete_one({"_id": existing["_id"]})
+                await target.insert_one({**document, "_id": existing["_id"]})
+            elif when_matched == "fail":
+                raise DuplicateKeyError(f"$merge matched an existing document for {key}")
+
+    async def purge_expired(self) -> int:
+        purged = 0
+        for index in self.indexes:
+            if index.expire_after_seconds is None:
+                continue
+            cutoff = datetime.utcnow() - timedelta(seconds=index.expire_after_seconds)
+            purged += await self.delete_many({index.first_field: {"$lt": cutoff}})
+        return purged
+
+    async def drop(self):
+        self._documents.clear()
+        self._seq.clear()
+        for entries in self._index.values():
+            entries.clear()
+        for buckets in self._ordered.values():
+            buckets.clear()
+
+
+class MemoryEngine:
+    name = "memory"
+
+    def __init__(self):
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def collection(self, name: str, indexes: List[Index], compressed: bool = False) -> MemoryCollection:
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name, indexes, self)
+        return self._collections[name]
+
+    def close(self):
+        return None
@@ -0,0 +1,225 @@
+"""Motor-backed storage engine."""
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import CollectionInvalid, PyMongoError
+from pymongo.read_preferences import SecondaryPreferred
+
+from .base import Collection, DeadlineExceeded, Filter, Index, Projection, SortSpec, bounded, current_routing
+
+
+class MongoCollection(Collection):
+    def __init__(self, collection, indexes: List[Index], create_options: Optional[dict] = None):
+        self.raw = collection
+        self.name = collection.name
+        self.indexes = indexes
+        self.create_options = create_options
+        self._readers: Dict[int, object] = {}
+
+    def _reader(self):
+        """The collection handle for reads, on a secondary when the route allows it."""
+        routing = current_routing.get()
+        if routing is None or not routing.secondary:
+            return self.raw
+        reader = self._readers.get(routing.max_staleness_seconds)
+        if reader is None:
+            reader = self.raw.with_options(read_preference=SecondaryPreferred(max_staleness=routing.max_staleness_seconds))
+            self._readers[routing.max_staleness_seconds] = reader
+        return reader
+
+    @asynccontextmanager
+    async def _causal(self, write: bool):
+        """A causally consistent session for a call that extends, or must see, the client's token.
+
+        Each call gets its own session, since concurrent calls can't share one.
+        """
+        routing = current_routing.get()
+        if routing is None or not (write or (routing.secondary and routing.operation_time is not None)):
+            yield None
+            return
+        session = await self.raw.database.client.start_session(causal_consistency=True)
+        try:
+            if routing.cluster_time is not None:
+                session.advance_cluster_time(routing.cluster_time)
+            if routing.operation_time is not None:
+                session.advance_operation_time(routing.operation_time)
+            yield session
+            routing.observe(session.cluster_time, session.operation_time)
+        finally:
+            # Only hands the server session back to the pool
+            session.delegate.end_session()
+
+    @contextmanager
+    def time_limit(self, seconds: Optional[float], stage: str):
+        if seconds is None:
+            yield
+            return
+        # pymongo sends the time left as maxTimeMS with every command, and
+        # Motor carries the setting over to its executor threads
+        try:
+            with pymongo.timeout(seconds):
+                yield
+        except PyMongoError as exc:
+            if exc.timeout:
+                raise DeadlineExceeded(stage) from exc
+            raise
+
+    async def ensure_indexes(self):
+        if self.create_options:
+            # Options such as block compression only apply at creation time
+            try:
+                await self.raw.database.create_collection(self.name, **self.create_options)
+            except CollectionInvalid:
+                pass
+        if not self.indexes:
+            return
+        models = []
+        for index in self.indexes:
+            options = dict(index.options)
+            if index.unique:
+                options["unique"] = True
+            if index.sparse:
+                options["sparse"] = True
+            if index.expire_after_seconds is not None:
+                options["expireAfterSeconds"] = index.expire_after_seconds
+            if index.name:
+                options["name"] = index.name
+            models.append(IndexModel(index.keys, **options))
+        await self.raw.create_indexes(models)
+
+    @bounded
+    async def find_one(self, filter: Filter, projection: Projection = None, sort: SortSpec = None) -> Optional[dict]:
+        async with self._causal(write=False) as session:
+            return await self._reader().find_one(filter, projection, sort=sort, session=session)
+
+    @bounded
+    async def find(
+        self,
+        filter: Optional[Filter] = None,
+        projection: Projection = None,
+        sort: SortSpec = None,
+        skip: int = 0,
+        limit: int = 100,
+    ) -> List[dict]:
+        async with self._causal(write=False) as session:
+            cursor = self._reader().find(filter or {}, projection, session=session)
+            if sort:
+                cursor = cursor.sort(list(sort))
+            if skip:
+                cursor = cursor.skip(skip)
+            if limit:
+                cursor = cursor.limit(limit)
+            return await cursor.to_list(limit or None)
+
+    async def stream(
+        self,
+        filter: Optional[Filter] = None,
+        projection: Projection = None,
+        sort: SortSpec = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[dict]:
+        cursor = self.raw.find(filter or {}, projection, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(list(sort))
+        try:
+            async for document in cursor:
+                yield document
+        finally:
+            await cursor.close()
+
+    @bounded
+    async def count(self, filter: Optional[Filter] = None) -> int:
+        async with self._causal(write=False) as session:
+            return await self._reader().count_documents(filter or {}, session=session)
+
+    @bounded
+    async def insert_one(self, document: dict):
+        async with self._causal(write=True) as session:
+            await self.raw.insert_one(document, session=session)
+
+    @bounded
+    async def insert_many(self, documents: List[dict]):
+        if documents:
+            async with self._causal(write=True) as session:
+                await self.raw.insert_many(documents, ordered=False, session=session)
+
+    @bounded
+    async def update_one(self, filter: Filter, update: dict, upsert: bool = False) -> int:
+        async with self._causal(write=True) as session:
+            result = await self.raw.update_one(filter, update, upsert=upsert, session=session)
+        return result.matched_count
+
+    @bounded
+    async def update_many(self, filter: Filter, update: dict) -> int:
+        async with self._causal(write=True) as session:
+            result = await self.raw.update_many(filter, update, session=session)
+        return result.matched_count
+
+    @bounded
+    async def bulk_update(self, updates: List[Tuple[Filter, dict]], upsert: bool = False) -> int:
+        if not updates:
+            return 0
+        requests = [UpdateOne(filter, update, upsert=upsert) for filter, update in updates]
+        async with self._causal(write=True) as session:
+            result = await self.raw.bulk_write(requests, ordered=False, session=session)
+        return result.matched_count
+
+    @bounded
+    async def find_one_and_update(
+        self,
+        filter: Filter,
+        update: dict,
+        projection: Projection = None,
+        upsert: bool = False,
+        return_new: bool = True,
+    ) -> Optional[dict]:
+        async with self._causal(write=True) as session:
+            return await self.raw.find_one_and_update(
+                filter,
+                update,
+                projection=projection,
+                upsert=upsert,
+                return_document=ReturnDocument.AFTER if return_new else ReturnDocument.BEFORE,
+                session=session,
+            )
+
+    @bounded
+    async def aggregate(self, pipeline: List[dict]) -> List[dict]:
+        # A pipeline ending in $merge writes, so it stays on the primary
+        write = bool(pipeline) and "$merge" in pipeline[-1]
+        async with self._causal(write) as session:
+            source = self.raw if write else self._reader()
+            return await source.aggregate(pipeline, session=session).to_list(None)
+
+    @bounded
+    async def delete_one(self, filter: Filter) -> int:
+        async with self._causal(write=True) as session:
+            result = await self.raw.delete_one(filter, session=session)
+        return result.deleted_count
+
+    @bounded
+    async def delete_many(self, filter: Filter) -> int:
+        async with self._causal(write=True) as session:
+            result = await self.raw.delete_many(filter, session=session)
+        return result.deleted_count
+
+    async def drop(self):
+        await self.raw.drop()
+
+
+class MongoEngine:
+    name = "mongo"
+
+    def __init__(self, mongo_url: str, db_name: str, **client_options):
+        self.client = AsyncIOMotorClient(mongo_url, **client_options)
+        self.db = self.client[db_name]
+
+    def collection(self, name: str, indexes: List[Index], compressed: bool = False) -> MongoCollection:
+        options = {"storageEngine": {"wiredTiger": {"configString": "block_compressor=zstd"}}} if compressed else None
+        return MongoCollection(self.db[name], indexes, options)
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,33 @@
+"""Shared tasker presence, so every worker can answer for taskers online anywhere."""
+from datetime import datetime
+from typing import List
+
+from .base import ASCENDING, Collection, Index
+
+
+class PresenceStore:
+    collection_name = "presence"
+    indexes: List[Index] = [
+        Index([("expires_at", ASCENDING)], expire_after_seconds=0),
+        Index([("updated_at", ASCENDING)]),
+    ]
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    async def publish(self, user_id: str, latitude: float, longitude: float, skills: List[str], expires_at: datetime):
+        await self.collection.update_one(
+            {"_id": user_id},
+            {"$set": {
+                "latitude": latitude,
+                "longitude": longitude,
+                "skills": skills,
+                "expires_at": expires_at,
+                "updated_at": datetime.utcnow(),
+            }},
+            upsert=True,
+        )
+
+    async def changed_since(self, since: datetime) -> List[dict]:
+        """Entries written at or after ``since``, oldest first; going offline is a write too."""
+        return await self.collection.find({"updated_at": {"$gte": since}}, sort=[("updated_at", ASCENDING)], limit=0)
@@ -0,0 +1,42 @@
+"""Shared rate-limit buckets, so every worker draws from one allowance.
+
+Buckets use GCRA (the generic cell rate algorithm), which behaves like a
+token bucket but needs only one number per key: the theoretical arrival
+time ``tat`` of the next request. A request is allowed while ``tat`` is no
+more than ``(burst - 1) / rate`` seconds in the future, and each allowed
+request pushes ``tat`` back by ``1 / rate``.
+"""
+from datetime import datetime, timedelta
+from typing import List
+
+from .base import ASCENDING, Collection, Index
+
+
+class RateLimitStore:
+    collection_name = "rate_limits"
+    indexes: List[Index] = [Index([("expires_at", ASCENDING)], expire_after_seconds=0)]
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    async def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        """Take one request from ``key``'s bucket.
+
+        Returns 0 when allowed, otherwise the seconds until a request would be.
+        ``now`` is a Unix timestamp, so every worker shares one clock.
+        """
+        interval = 1 / rate
+        tolerance = interval * (burst - 1)
+        # Idle buckets are refilled to full by bringing tat up to now; $max
+        # keeps that harmless when workers race
+        expires_at = datetime.utcnow() + timedelta(seconds=tolerance + interval)
+        await self.collection.update_one(
+            {"_id": key}, {"$max": {"tat": now}, "$set": {"expires_at": expires_at}}, upsert=True
+        )
+        taken = await self.collection.find_one_and_update(
+            {"_id": key, "tat": {"$lte": now + tolerance}}, {"$inc": {"tat": interval}}
+        )
+        if taken is not None:
+            return 0.0
+        bucket = await self.collection.find_one({"_id": key}, {"tat": 1})
+        return max(bucket["tat"] - now - tolerance, interval) if bucket else interval
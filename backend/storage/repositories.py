@@ -0,0 +1,500 @@
+"""Repositories wrapping one collection each.
+
+A repository declares its collection name and indexes and forwards queries
+to whichever engine collection it was built with, so route handlers never
+touch Motor directly. Repositories built with a ``ChangeTracker`` stamp
+``updated_at``/``sync_seq`` and increment ``version`` on every write, and
+leave tombstones on delete.
+"""
+import os
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, FrozenSet, List, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+from .base import ASCENDING, DESCENDING, Collection, Filter, Index, Projection, SortSpec
+from .changes import ChangeTracker
+from .codec import Codec
+
+
+def _with_stamp(update: dict, stamp: dict) -> dict:
+    return {
+        **update,
+        "$set": {**update.get("$set", {}), **stamp},
+        "$inc": {**update.get("$inc", {}), "version": 1},
+    }
+
+
+class Repository:
+    collection_name: str = ""
+    indexes: List[Index] = [Index([("id", ASCENDING)], unique=True)]
+    # Read models skip change tracking to keep their writes to one round trip
+    tracks_changes = True
+    # Paths translated by the compact storage encoding
+    uuid_fields: FrozenSet[str] = frozenset({"id"})
+    money_fields: FrozenSet[str] = frozenset()
+    # Users whose delta sync includes a document, copied onto its tombstone
+    user_fields: Tuple[str, ...] = ()
+
+    def __init__(self, collection: Collection, changes: Optional[ChangeTracker] = None, codec: Optional[Codec] = None):
+        self.collection = collection
+        self.changes = changes
+        self.codec = codec
+
+    @property
+    def untracked(self) -> "Repository":
+        """This repository without change tracking, for internal bookkeeping writes."""
+        return type(self)(self.collection, None, self.codec)
+
+    def _filter(self, filter: Optional[Filter]) -> Optional[Filter]:
+        return self.codec.encode_filter(filter) if self.codec else filter
+
+    def _update(self, update: dict) -> dict:
+        return self.codec.encode_update(update) if self.codec else update
+
+    def _document(self, document: dict) -> dict:
+        return self.codec.encode_document(document) if self.codec else document
+
+    def _out(self, document: Optional[dict]) -> Optional[dict]:
+        return self.codec.decode(document) if self.codec else document
+
+    def _outs(self, documents: List[dict]) -> List[dict]:
+        return [self.codec.decode(document) for document in documents] if self.codec else documents
+
+    async def _stamp(self) -> Optional[dict]:
+        if self.changes is None:
+            return None
+        return await self.changes.stamp()
+
+    async def get(self, id: str, projection: Projection = None) -> Optional[dict]:
+        return self._out(await self.collection.find_one(self._filter({"id": id}), projection))
+
+    async def get_many(self, ids: List[str], projection: Projection = None) -> List[dict]:
+        """Documents with the given ids in one ``$in`` query, in no particular order."""
+        if not ids:
+            return []
+        return await self.find({"id": {"$in": list(ids)}}, projection, limit=0)
+
+    async def find_one(self, filter: Filter, projection: Projection = None, sort: SortSpec = None) -> Optional[dict]:
+        return self._out(await self.collection.find_one(self._filter(filter), projection, sort))
+
+    async def find(
+        self,
+        filter: Optional[Filter] = None,
+        projection: Projection = None,
+        sort: SortSpec = None,
+        skip: int = 0,
+        limit: int = 100,
+    ) -> List[dict]:
+        return self._outs(await self.collection.find(self._filter(filter), projection, sort, skip, limit))
+
+    async def stream(
+        self,
+        filter: Optional[Filter] = None,
+        projection: Projection = None,
+        sort: SortSpec = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[dict]:
+        async for document in self.collection.stream(self._filter(filter), projection, sort, batch_size):
+            yield self._out(document)
+
+    async def count(self, filter: Optional[Filter] = None) -> int:
+        return await self.collection.count(self._filter(filter))
+
+    async def insert(self, document: dict):
+        stamp = await self._stamp()
+        await self.collection.insert_one(self._document({**document, **stamp, "version": 1} if stamp else document))
+
+    async def insert_many(self, documents: List[dict]):
+        if self.changes is not None and documents:
+            last_seq = await self.changes.next_seq(len(documents))
+            first_seq = last_seq - len(documents) + 1
+            now = datetime.utcnow()
+            documents = [
+                {**document, "updated_at": now, "sync_seq": first_seq + offset, "version": 1}
+                for offset, document in enumerate(documents)
+            ]
+        await self.collection.insert_many([self._document(document) for document in documents])
+
+    async def update_one(self, filter: Filter, update: dict, upsert: bool = False) -> int:
+        stamp = await self._stamp()
+        update = _with_stamp(update, stamp) if stamp else update
+        return await self.collection.update_one(self._filter(filter), self._update(update), upsert)
+
+    async def update_many(self, filter: Filter, update: dict) -> int:
+        stamp = await self._stamp()
+        update = _with_stamp(update, stamp) if stamp else update
+        return await self.collection.update_many(self._filter(filter), self._update(update))
+
+    async def bulk_update(self, updates: List[Tuple[Filter, dict]], upsert: bool = False) -> int:
+        if self.changes is not None and updates:
+            last_seq = await self.changes.next_seq(len(updates))
+            first_seq = last_seq - len(updates) + 1
+            now = datetime.utcnow()
+            updates = [
+                (filter, _with_stamp(update, {"updated_at": now, "sync_seq": first_seq + offset}))
+                for offset, (filter, update) in enumerate(updates)
+            ]
+        return await self.collection.bulk_update(
+            [(self._filter(filter), self._update(update)) for filter, update in updates], upsert
+        )
+
+    async def find_one_and_update(
+        self,
+        filter: Filter,
+        update: dict,
+        projection: Projection = None,
+        upsert: bool = False,
+        return_new: bool = True,
+    ) -> Optional[dict]:
+        stamp = await self._stamp()
+        if stamp:
+            update = _with_stamp(update, stamp)
+        return self._out(await self.collection.find_one_and_update(
+            self._filter(filter), self._update(update), projection, upsert, return_new
+        ))
+
+    async def aggregate(self, pipeline: List[dict]) -> List[dict]:
+        return self._outs(await self.collection.aggregate(pipeline))
+
+    async def delete_one(self, filter: Filter) -> int:
+        if self.changes is None:
+            return await self.collection.delete_one(self._filter(filter))
+        document = await self.collection.find_one(self._filter(filter), self._tombstone_projection())
+        if document is None:
+            return 0
+        deleted = await self.collection.delete_one({"_id": document["_id"]})
+        if deleted:
+            document = self._out(document)
+            await self.changes.tombstones.record(
+                self.collection_name, [document["id"]], await self.changes.next_seq(), [self._users(document)]
+            )
+        return deleted
+
+    async def delete_many(self, filter: Filter) -> int:
+        if self.changes is None:
+            return await self.collection.delete_many(self._filter(filter))
+        documents = await self.collection.find(self._filter(filter), self._tombstone_projection(), limit=0)
+        if not documents:
+            return 0
+        deleted = await self.collection.delete_many({"_id": {"$in": [document["_id"] for document in documents]}})
+        documents = self._outs(documents)
+        await self.changes.tombstones.record(
+            self.collection_name,
+            [document["id"] for document in documents],
+            await self.changes.next_seq(len(documents)),
+            [self._users(document) for document in documents],
+        )
+        return deleted
+
+    def _tombstone_projection(self) -> dict:
+        return {"id": 1, **{field: 1 for field in self.user_fields}}
+
+    def _users(self, document: dict) -> List[str]:
+        return sorted({document[field] for field in self.user_fields if document.get(field)})
+
+
+class UserRepo(Repository):
+    collection_name = "users"
+    indexes = Repository.indexes + [
+        Index([("role", ASCENDING)]),
+        Index([("skills", ASCENDING)]),
+        # Bounding-box searches for nearby taskers
+        Index([("location.latitude", ASCENDING), ("location.longitude", ASCENDING)], sparse=True),
+    ]
+
+
+class TaskRepo(Repository):
+    collection_name = "tasks"
+    indexes = Repository.indexes + [
+        Index([("status", ASCENDING), ("created_at", DESCENDING)]),
+        Index([("client_id", ASCENDING), ("created_at", DESCENDING)]),
+        Index([("tasker_id", ASCENDING), ("created_at", DESCENDING)]),
+        Index([("category", ASCENDING), ("created_at", DESCENDING)]),
+        # Day ranges scanned by the analytics rollups
+        Index([("created_at", ASCENDING)]),
+        Index([("accepted_at", ASCENDING)], sparse=True),
+        Index([("completed_at", ASCENDING)], sparse=True),
+        # Pending scheduler events, present only until they fire
+        Index([("surface_at", ASCENDING)], sparse=True),
+        Index([("remind_at", ASCENDING)], sparse=True),
+        Index([("expire_at", ASCENDING)], sparse=True),
+        Index([("sync_seq", ASCENDING)]),
+        Index([("client_id", ASCENDING), ("sync_seq", ASCENDING)]),
+        Index([("tasker_id", ASCENDING), ("sync_seq", ASCENDING)]),
+    ]
+    uuid_fields = frozenset({"id", "client_id", "tasker_id"})
+    money_fields = frozenset({"budget_min", "budget_max"})
+    user_fields = ("client_id", "tasker_id")
+
+
+class TaskBidRepo(Repository):
+    collection_name = "task_bids"
+    indexes = Repository.indexes + [
+        Index([("task_id", ASCENDING), ("created_at", DESCENDING)]),
+        Index([("tasker_id", ASCENDING), ("sync_seq", ASCENDING)]),
+        # client_id is the task's, copied on so sync finds bids on a user's tasks
+        Index([("client_id", ASCENDING), ("sync_seq", ASCENDING)]),
+    ]
+    uuid_fields = frozenset({"id", "task_id", "tasker_id", "client_id"})
+    money_fields = frozenset({"proposed_price"})
+    user_fields = ("tasker_id", "client_id")
+
+
+class PaymentAccountRepo(Repository):
+    collection_name = "payment_accounts"
+    indexes = Repository.indexes + [
+        Index([("user_id", ASCENDING)]),
+    ]
+    uuid_fields = frozenset({"id", "user_id"})
+    money_fields = frozenset({"wallet_balance"})
+
+
+class PaymentRepo(Repository):
+    collection_name = "payments"
+    indexes = Repository.indexes + [
+        Index([("tasker_id", ASCENDING), ("status", ASCENDING)]),
+        Index([("created_at", ASCENDING)]),
+        Index([("sync_seq", ASCENDING)]),
+        # Reconciliation walks a date range in gateway id order
+        Index([("gateway_payment_id", ASCENDING), ("created_at", ASCENDING)]),
+    ]
+    uuid_fields = frozenset({"id", "task_id", "client_id", "tasker_id"})
+    money_fields = frozenset({"amount"})
+
+
+class WalletLedgerRepo(Repository):
+    """Append-only record of every wallet balance change."""
+
+    collection_name = "wallet_ledger"
+    tracks_changes = False
+    indexes = Repository.indexes + [
+        Index([("account_id", ASCENDING), ("created_at", ASCENDING)]),
+    ]
+    uuid_fields = frozenset({"id", "account_id"})
+    money_fields = frozenset({"amount", "balance_after"})
+
+
+class PaymentDiscrepancyRepo(Repository):
+    """Findings of the reconciliation (``reconcile.py``), one per kind and subject.
+
+    Ids derive from the kind and the payment or account concerned, so
+    rerunning a date range updates earlier findings instead of repeating them.
+    """
+
+    collection_name = "payment_discrepancies"
+    tracks_changes = False
+    indexes = Repository.indexes + [
+        Index([("run_id", ASCENDING)]),
+        Index([("kind", ASCENDING), ("last_seen_at", DESCENDING)]),
+        Index([("gateway_payment_id", ASCENDING)], sparse=True),
+    ]
+    uuid_fields = frozenset({"id", "run_id", "payment_id", "account_id"})
+    money_fields = frozenset({"amount", "gateway_amount", "wallet_balance", "ledger_balance"})
+
+    @staticmethod
+    def discrepancy_id(kind: str, *subject: Optional[str]) -> str:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, ":".join(["discrepancy", kind, *(part or "" for part in subject)])))
+
+
+class MessageRepo(Repository):
+    collection_name = "messages"
+    indexes = Repository.indexes + [
+        Index([("task_id", ASCENDING), ("created_at", ASCENDING)]),
+        Index([("sender_id", ASCENDING), ("sync_seq", ASCENDING)]),
+        Index([("receiver_id", ASCENDING), ("sync_seq", ASCENDING)]),
+    ]
+    uuid_fields = frozenset({"id", "task_id", "sender_id", "receiver_id"})
+    user_fields = ("sender_id", "receiver_id")
+
+    # Each task's thread has a version counter bumped by every new message
+
+    @staticmethod
+    def _thread_counter(task_id: str) -> str:
+        return f"messages:{task_id}"
+
+    async def thread_version(self, task_id: str) -> int:
+        return (await self.thread_state(task_id))["version"]
+
+    async def thread_state(self, task_id: str) -> dict:
+        """Version and archive months of a thread, from one counter lookup."""
+        counter = await self.changes.counters.collection.find_one({"_id": self._thread_counter(task_id)})
+        counter = counter or {}
+        return {"version": counter.get("value", 0), "archive_months": counter.get("archive_months", [])}
+
+    async def mark_thread_archived(self, task_id: str, months: List[str]):
+        await self.changes.counters.collection.update_one(
+            {"_id": self._thread_counter(task_id)},
+            {"$addToSet": {"archive_months": {"$each": months}}, "$setOnInsert": {"value": 0}},
+            upsert=True,
+        )
+
+    async def bump_thread_version(self, task_id: str) -> int:
+        return await self.changes.counters.next(self._thread_counter(task_id))
+
+    async def claim_thread_version(self, task_id: str, expected: int) -> bool:
+        """Atomically move the thread from ``expected`` to the next version."""
+        return await self.changes.counters.compare_and_increment(self._thread_counter(task_id), expected)
+
+
+class ReviewRepo(Repository):
+    collection_name = "reviews"
+    indexes = Repository.indexes + [
+        Index([("reviewee_id", ASCENDING), ("created_at", DESCENDING)]),
+        Index([("reviewer_id", ASCENDING), ("sync_seq", ASCENDING)]),
+        Index([("reviewee_id", ASCENDING), ("sync_seq", ASCENDING)]),
+    ]
+    uuid_fields = frozenset({"id", "task_id", "reviewer_id", "reviewee_id"})
+    user_fields = ("reviewer_id", "reviewee_id")
+
+
+class ConversationRepo(Repository):
+    """Inbox read model: one document per task conversation between two users.
+
+    Kept current by a single upsert per message, so listing an inbox is one
+    query on the (participants, last_activity_at, id) index.
+    """
+
+    collection_name = "conversations"
+    tracks_changes = False
+    indexes = Repository.indexes + [
+        Index([("participants", ASCENDING), ("last_activity_at", DESCENDING), ("id", DESCENDING)]),
+    ]
+    uuid_fields = frozenset({"id", "task_id", "participants", "last_message.id", "last_message.sender_id"})
+
+    PREVIEW_LENGTH = 200
+
+    @staticmethod
+    def conversation_id(task_id: str, user_a: str, user_b: str) -> str:
+        first, second = sorted([user_a, user_b])
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"conversation:{task_id}:{first}:{second}"))
+
+    async def record_message(self, message: dict):
+        sender, receiver = message["sender_id"], message["receiver_id"]
+        filter = {"id": self.conversation_id(message["task_id"], sender, receiver)}
+        update = {
+            "$set": {
+                "last_message": {
+                    "id": message["id"],
+                    "sender_id": sender,
+                    "content": message["content"][:self.PREVIEW_LENGTH],
+                    "message_type": message["message_type"],
+                    "created_at": message["created_at"],
+                },
+                "last_activity_at": message["created_at"],
+            },
+            "$inc": {f"unread.{receiver}": 1, f"unread.{sender}": 0, "message_count": 1},
+        }
+        try:
+            await self.update_one(filter, {
+                **update,
+                "$setOnInsert": {
+                    "task_id": message["task_id"],
+                    "participants": sorted([sender, receiver]),
+                    "created_at": message["created_at"],
+                },
+            }, upsert=True)
+        except DuplicateKeyError:
+            # Both first messages of a thread upserted and the other one
+            # created the conversation; this message is already stored
+            await self.update_one(filter, update)
+
+    async def inbox(
+        self,
+        user_id: str,
+        before: Optional[datetime] = None,
+        before_id: Optional[str] = None,
+        limit: int = 20,
+    ) -> List[dict]:
+        """Newest first; page with the (last_activity_at, id) of the last entry."""
+        query: dict = {"participants": user_id}
+        if before is not None and before_id is not None:
+            # Conversations that share a timestamp are ordered by id, so a
+            # page boundary between them neither skips nor repeats any
+            query["$or"] = [
+                {"last_activity_at": {"$lt": before}},
+                {"last_activity_at": before, "id": {"$lt": before_id}},
+            ]
+        elif before is not None:
+            query["last_activity_at"] = {"$lt": before}
+        return await self.find(query, sort=[("last_activity_at", DESCENDING), ("id", DESCENDING)], limit=limit)
+
+    async def mark_read(self, conversation_id: str, user_id: str) -> bool:
+        matched = await self.update_one(
+            {"id": conversation_id, "participants": user_id},
+            {"$set": {f"unread.{user_id}": 0, f"last_read_at.{user_id}": datetime.utcnow()}},
+        )
+        return bool(matched)
+
+
+class LocationPingRepo(Repository):
+    """Ephemeral location history, dropped by a TTL index."""
+
+    collection_name = "location_pings"
+    tracks_changes = False
+    ttl_seconds = int(os.environ.get("LOCATION_PING_TTL_SECONDS", str(7 * 24 * 3600)))
+    indexes = [
+        Index([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        Index([("created_at", ASCENDING)], expire_after_seconds=ttl_seconds),
+    ]
+    uuid_fields = frozenset({"user_id"})
+
+
+# Closed threads are moved to one archive collection per month of the messages
+MESSAGE_ARCHIVE_INDEXES = [
+    Index([("id", ASCENDING)], unique=True),
+    Index([("task_id", ASCENDING), ("created_at", ASCENDING)]),
+]
+
+
+def message_archive_name(month: str) -> str:
+    return f"messages_archive_{month}"
+
+
+class MessageArchiveRepo(Repository):
+    """One month of archived messages; built per month by ``Storage.message_archive``."""
+
+    indexes = MESSAGE_ARCHIVE_INDEXES
+    tracks_changes = False
+    uuid_fields = MessageRepo.uuid_fields
+
+
+class TaskStatsRepo(Repository):
+    """Daily per-category task rollups, keyed ``"<day>:<category>"``."""
+
+    collection_name = "stats_daily_tasks"
+    indexes = [Index([("day", ASCENDING), ("category", ASCENDING)])]
+    tracks_changes = False
+    uuid_fields = frozenset()
+    money_fields = frozenset({"median_budget"})
+
+
+class PaymentStatsRepo(Repository):
+    """Daily GMV rollups, keyed by day."""
+
+    collection_name = "stats_daily_payments"
+    indexes = [Index([("day", ASCENDING)])]
+    tracks_changes = False
+    uuid_fields = frozenset()
+    money_fields = frozenset({"gmv"})
+
+
+class TaskCounterRepo(Repository):
+    """Engagement counters per task, keyed by task id and written in batches by ``counters``."""
+
+    collection_name = "task_counters"
+    tracks_changes = False
+
+
+class DispatchCheckpointRepo(Repository):
+    """One compact document per running urgent-task dispatch, keyed by task id."""
+
+    collection_name = "dispatch_checkpoints"
+    indexes = Repository.indexes + [
+        Index([("current", ASCENDING)]),
+        Index([("heartbeat_at", ASCENDING)]),
+    ]
+    tracks_changes = False
+    uuid_fields = frozenset({"id", "offered", "current", "offer.task_id", "offer.client_id"})
+    money_fields = frozenset({"offer.budget_min", "offer.budget_max"})
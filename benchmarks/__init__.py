@@ -0,0 +1 @@
+"""In-process load testing and benchmarks for the marketplace API."""
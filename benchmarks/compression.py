@@ -0,0 +1,133 @@
+"""Bytes and CPU per response for each encoding and compression level.
+
+    python -m benchmarks.compression --output compression.json
+    python -m benchmarks.compression --levels gzip=1,6,9 br=1,4,11 zstd=1,3,10
+
+Representative payloads (a task feed page, a chat history, a task with
+inline base64 images) are fetched uncompressed from the app on the
+in-memory engine. Each one is then compressed with the same compressor
+classes the middleware uses. The streamed variant feeds the payload in
+4 KiB chunks with a flush per chunk, like a ``StreamingResponse`` export.
+CPU time is process time averaged over ``--repeat`` runs.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("RETENTION_INTERVAL_SECONDS", "0")
+os.environ.setdefault("ANALYTICS_ROLLUP_INTERVAL_SECONDS", "0")
+os.environ.setdefault("SCHEDULER_ENABLED", "0")
+os.environ.setdefault("DISPATCH_ENABLED", "0")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+
+import httpx  # noqa: E402
+
+from .seed import SeedConfig, seed, task_id, user_id  # noqa: E402
+
+STREAM_CHUNK = 4096
+DEFAULT_LEVELS = {"gzip": [1, 6, 9], "br": [1, 4, 11], "zstd": [1, 3, 10]}
+
+
+async def fetch_payloads(image_kb: int):
+    import server
+
+    cfg = SeedConfig(users=200, tasks=2_000, chats=20, messages_per_chat=200, seed=7)
+    await server.app.router.startup()
+    try:
+        await seed(server.app.state.storage, cfg)
+        rng = random.Random(7)
+        image = base64.b64encode(rng.randbytes(image_kb * 1024)).decode()
+        images_task = {
+            "title": "Assemble wardrobe", "description": "Photos attached", "category": "handyman",
+            "client_id": user_id(0), "budget_min": 40, "budget_max": 80,
+            "location": {"latitude": 40.7, "longitude": -74.0, "address": "1 Bench St"},
+            "images": [image, image[: len(image) // 2]],
+        }
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            headers = {"Accept-Encoding": "identity"}
+            payloads = {
+                "task_feed_100": await client.get("/api/tasks", params={"limit": 100}, headers=headers),
+                "chat_history_200": await client.get(f"/api/messages/{task_id(0)}", headers=headers),
+            }
+            created = (await client.post("/api/tasks", json=images_task)).json()
+            payloads["task_with_images"] = await client.get(f"/api/tasks/{created['id']}", headers=headers)
+        for name, response in payloads.items():
+            response.raise_for_status()
+        return {name: response.content for name, response in payloads.items()}
+    finally:
+        await server.app.router.shutdown()
+
+
+def measure(factory, payload: bytes, repeat: int, streamed: bool):
+    started = time.process_time()
+    for _ in range(repeat):
+        compressor = factory()
+        if streamed:
+            chunks = [payload[offset:offset + STREAM_CHUNK] for offset in range(0, len(payload), STREAM_CHUNK)]
+            out = sum(len(compressor.compress(chunk)) for chunk in chunks[:-1])
+            out += len(compressor.finish(chunks[-1] if chunks else b""))
+        else:
+            out = len(compressor.finish(payload))
+    return out, (time.process_time() - started) / repeat * 1000
+
+
+def parse_levels(values):
+    levels = {}
+    for value in values:
+        name, _, numbers = value.partition("=")
+        levels[name] = [int(number) for number in numbers.split(",") if number]
+    return levels
+
+
+def main(args):
+    import compression
+
+    factories = compression.COMPRESSORS
+    levels = parse_levels(args.levels) if args.levels else DEFAULT_LEVELS
+    payloads = asyncio.run(fetch_payloads(args.image_kb))
+
+    report = {"repeat": args.repeat, "stream_chunk": STREAM_CHUNK, "payloads": {}}
+    print(f"{'payload':<20}{'encoding':<10}{'level':>6}{'bytes':>12}{'ratio':>8}{'cpu ms':>9}{'streamed bytes':>16}{'cpu ms':>9}")
+    for name, payload in payloads.items():
+        rows = [{"encoding": "identity", "level": None, "bytes": len(payload), "ratio": 1.0, "cpu_ms": 0.0}]
+        print(f"{name:<20}{'identity':<10}{'-':>6}{len(payload):>12}{1.0:>8.3f}{0.0:>9.3f}")
+        for encoding, encoding_levels in levels.items():
+            factory = factories.get(encoding)
+            if factory is None:
+                print(f"{name:<20}{encoding:<10}  not installed")
+                continue
+            for level in encoding_levels:
+                size, cpu_ms = measure(lambda: factory(level), payload, args.repeat, streamed=False)
+                streamed_size, streamed_cpu_ms = measure(lambda: factory(level), payload, args.repeat, streamed=True)
+                rows.append({
+                    "encoding": encoding, "level": level, "bytes": size, "ratio": round(size / len(payload), 4),
+                    "cpu_ms": round(cpu_ms, 3), "streamed_bytes": streamed_size, "streamed_cpu_ms": round(streamed_cpu_ms, 3),
+                })
+                print(
+                    f"{name:<20}{encoding:<10}{level:>6}{size:>12}{size / len(payload):>8.3f}{cpu_ms:>9.3f}"
+                    f"{streamed_size:>16}{streamed_cpu_ms:>9.3f}"
+                )
+        report["payloads"][name] = rows
+
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"report written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", nargs="+", help="encoding=level,level... (default: gzip=1,6,9 br=1,4,11 zstd=1,3,10)")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--image-kb", type=int, default=200, help="size of the inline image before base64")
+    parser.add_argument("--output", default="compression_output.json")
+    main(parser.parse_args())
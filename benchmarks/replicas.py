@@ -0,0 +1,274 @@
+"""Primary CPU offload from read routing, on a local 3-node replica set.
+
+    python -m benchmarks.replicas --mongod /usr/bin/mongod --duration 20
+    python -m benchmarks.replicas --keep-data /tmp/rs-bench   # reuse the seeded set
+
+The script starts three ``mongod`` processes as replica set ``bench-rs`` on
+``--base-port`` and the next two ports. Node 0 gets the highest priority so
+it is elected primary. It seeds ``DB_NAME`` through the app's storage layer,
+then runs ``serve.py`` twice against the set: once with
+``READ_ROUTING_ENABLED=0`` (every read on the primary) and once with read
+routing on. Both runs get the same read-heavy mix of feed pages, reviews,
+dashboards and user profiles.
+
+For each run the report lists rps, p50/p99 latency, and the CPU seconds each
+``mongod`` used (from ``/proc``, so Linux only). It also lists the
+queries each node served (``opcounters``). ``primary_offload`` is the drop
+in primary CPU per request with routing on. Expect it to approach the
+share of requests on secondary routes.
+
+Finally ``--causal-checks`` write/read round trips post a task and list the
+client's tasks from the feed route at once, with and without the
+``X-Causal-Token`` of the write. Reads without the token can miss the new
+task while the secondary catches up; reads with it must not.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from .scaling import _free_port, _wait_ready
+from .seed import CATEGORIES, SeedConfig, seed, user_id
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+REPLICA_SET = "bench-rs"
+
+
+def _cpu_seconds(pid: int) -> float:
+    fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    # utime and stime are fields 14 and 15 of the whole line
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def start_replica_set(args, data_dir: Path):
+    from pymongo import MongoClient
+
+    ports = [args.base_port + n for n in range(3)]
+    nodes = []
+    for n, port in enumerate(ports):
+        path = data_dir / f"node{n}"
+        path.mkdir(parents=True, exist_ok=True)
+        nodes.append(subprocess.Popen(
+            [args.mongod, "--replSet", REPLICA_SET, "--port", str(port), "--bind_ip", "127.0.0.1",
+             "--dbpath", str(path), "--logpath", str(path / "mongod.log"), "--wiredTigerCacheSizeGB", "0.5"],
+        ))
+    with MongoClient(f"mongodb://127.0.0.1:{ports[0]}/?directConnection=true", serverSelectionTimeoutMS=30_000) as admin:
+        if admin.admin.command("hello").get("setName") != REPLICA_SET:
+            admin.admin.command("replSetInitiate", {
+                "_id": REPLICA_SET,
+                "members": [
+                    {"_id": n, "host": f"127.0.0.1:{port}", "priority": 2 if n == 0 else 1}
+                    for n, port in enumerate(ports)
+                ],
+            })
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            states = [member["stateStr"] for member in admin.admin.command("replSetGetStatus")["members"]]
+            if states[0] == "PRIMARY" and states[1:] == ["SECONDARY", "SECONDARY"]:
+                break
+            time.sleep(0.5)
+        else:
+            raise RuntimeError(f"replica set did not come up: {states}")
+    url = f"mongodb://{','.join(f'127.0.0.1:{port}' for port in ports)}/?replicaSet={REPLICA_SET}"
+    return nodes, ports, url
+
+
+def _opcounters(port: int) -> dict:
+    from pymongo import MongoClient
+
+    with MongoClient(f"mongodb://127.0.0.1:{port}/?directConnection=true") as client:
+        counters = client.admin.command("serverStatus")["opcounters"]
+    return {name: counters[name] for name in ("query", "getmore", "command")}
+
+
+async def _seed(url: str, db_name: str, cfg: SeedConfig):
+    os.environ.update(STORAGE_BACKEND="mongo", MONGO_URL=url, DB_NAME=db_name)
+    sys.path.insert(0, str(ROOT_DIR / "backend"))
+    from storage import create_storage
+
+    storage = create_storage()
+    try:
+        if await storage.users.count({}) >= cfg.users:
+            print("replica set already seeded")
+            return
+        await storage.ensure_indexes()
+        await seed(storage, cfg)
+    finally:
+        storage.close()
+
+
+async def _drive(url: str, cfg: SeedConfig, concurrency: int, duration: float):
+    import httpx
+
+    rng = random.Random(7)
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                roll = rng.random()
+                user = user_id(rng.randrange(cfg.users))
+                if roll < 0.5:
+                    path, params = "/api/tasks", {"status": "posted", "category": rng.choice(CATEGORIES)}
+                elif roll < 0.65:
+                    path, params = f"/api/reviews/{user}", None
+                elif roll < 0.8:
+                    path, params = f"/api/dashboard/{user}", None
+                else:
+                    path, params = f"/api/users/{user}", None
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path, params=params)
+                    if response.status_code not in (200, 404):
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+async def _causal_checks(url: str, cfg: SeedConfig, rounds: int) -> dict:
+    import httpx
+
+    misses = {"without_token": 0, "with_token": 0}
+    async with httpx.AsyncClient(base_url=url, timeout=30) as client:
+        for n in range(rounds):
+            client_id = user_id(n % cfg.users)
+            for mode in misses:
+                created = await client.post("/api/tasks", json={
+                    "client_id": client_id, "title": f"causal {mode} {n}", "description": "benchmark",
+                    "category": "other", "location": {"latitude": 40.7, "longitude": -73.9},
+                    "budget_min": 10, "budget_max": 20,
+                })
+                created.raise_for_status()
+                token = created.headers.get("X-Causal-Token")
+                headers = {"X-Causal-Token": token} if mode == "with_token" and token else {}
+                listed = await client.get("/api/tasks", params={"client_id": client_id}, headers=headers)
+                if created.json()["id"] not in {task["id"] for task in listed.json()}:
+                    misses[mode] += 1
+    return {"rounds": rounds, "stale_reads": misses}
+
+
+def run_mode(routing: bool, mongo_url: str, nodes, ports, cfg: SeedConfig, args) -> dict:
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        "STORAGE_BACKEND": "mongo",
+        "MONGO_URL": mongo_url,
+        "DB_NAME": args.db_name,
+        "READ_ROUTING_ENABLED": "1" if routing else "0",
+        "RETENTION_INTERVAL_SECONDS": "0",
+        "ANALYTICS_ROLLUP_INTERVAL_SECONDS": "0",
+        "SCHEDULER_ENABLED": "0",
+        "DISPATCH_ENABLED": "0",
+        "RATE_LIMIT_ENABLED": "0",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers),
+         "--no-access-log", "--graceful-timeout", "5"],
+        cwd=ROOT_DIR / "backend", env=env,
+    )
+    try:
+        _wait_ready(url, server)
+        asyncio.run(_drive(url, cfg, args.concurrency, args.warmup))
+        cpu_before = [_cpu_seconds(node.pid) for node in nodes]
+        ops_before = [_opcounters(port) for port in ports]
+        started = time.perf_counter()
+        latencies, errors = asyncio.run(_drive(url, cfg, args.concurrency, args.duration))
+        elapsed = time.perf_counter() - started
+        cpu = [round(_cpu_seconds(node.pid) - before, 2) for node, before in zip(nodes, cpu_before)]
+        ops = [
+            {name: after[name] - before[name] for name in after}
+            for before, after in zip(ops_before, (_opcounters(port) for port in ports))
+        ]
+        causal = asyncio.run(_causal_checks(url, cfg, args.causal_checks)) if routing and args.causal_checks else None
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    latencies.sort()
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 2) if latencies else 0.0
+
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": pct(50),
+        "p99_ms": pct(99),
+        "errors": errors,
+        "cpu_seconds": {"primary": cpu[0], "secondaries": cpu[1:]},
+        "primary_cpu_ms_per_request": round(cpu[0] * 1000 / len(latencies), 4) if latencies else None,
+        "opcounters": {"primary": ops[0], "secondaries": ops[1:]},
+        "causal": causal,
+    }
+
+
+def main(args) -> int:
+    if shutil.which(args.mongod) is None:
+        print(f"mongod not found: {args.mongod}")
+        return 2
+    cfg = SeedConfig(users=args.users, tasks=args.tasks, chats=args.users // 10)
+    data_dir = Path(args.keep_data) if args.keep_data else Path(tempfile.mkdtemp(prefix="replicas-bench-"))
+    nodes, ports, mongo_url = start_replica_set(args, data_dir)
+    report = {"workers": args.workers, "concurrency": args.concurrency, "duration_s": args.duration}
+    try:
+        asyncio.run(_seed(mongo_url, args.db_name, cfg))
+        for mode, routing in (("primary_only", False), ("routed", True)):
+            report[mode] = result = run_mode(routing, mongo_url, nodes, ports, cfg, args)
+            print(
+                f"{mode:<14}{result['rps']:>10.1f} rps  p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms  "
+                f"primary cpu {result['cpu_seconds']['primary']:.2f}s  secondaries {result['cpu_seconds']['secondaries']}"
+            )
+        before = report["primary_only"]["primary_cpu_ms_per_request"]
+        after = report["routed"]["primary_cpu_ms_per_request"]
+        report["primary_offload"] = round(1 - after / before, 3) if before else None
+        print(f"primary CPU per request down {report['primary_offload']:.1%}")
+        if report["routed"]["causal"]:
+            print(f"stale reads after a write: {report['routed']['causal']['stale_reads']}")
+    finally:
+        for node in nodes:
+            node.send_signal(signal.SIGTERM)
+        for node in nodes:
+            node.wait(timeout=60)
+        if not args.keep_data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"report written to {args.output}")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongod", default="mongod", help="mongod binary")
+    parser.add_argument("--base-port", type=int, default=27117)
+    parser.add_argument("--keep-data", help="data directory to keep (and reuse) between runs")
+    parser.add_argument("--db-name", default="marketplace_replicas")
+    parser.add_argument("--workers", type=int, default=2, help="serve.py worker processes")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--tasks", type=int, default=100_000)
+    parser.add_argument("--causal-checks", type=int, default=200, help="write/read rounds in the routed run")
+    parser.add_argument("--output", default="replicas_output.json")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
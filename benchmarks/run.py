@@ -0,0 +1,217 @@
+"""Run the benchmark suite against the app in-process.
+
+    python -m benchmarks.run --users 100000 --tasks 1000000 --output bench.json
+    python -m benchmarks.run --skip-seed --compare bench.json
+
+The app is driven through an ASGI transport, so no server or network is
+involved; Mongo is whatever ``MONGO_URL`` points at (a local mongod by
+default) using a dedicated ``DB_NAME``. ``--storage memory`` runs against
+the in-memory engine instead, which isolates the pure API overhead.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "marketplace_bench")
+# Background jobs would compete with the measured traffic
+os.environ.setdefault("RETENTION_INTERVAL_SECONDS", "0")
+os.environ.setdefault("ANALYTICS_ROLLUP_INTERVAL_SECONDS", "0")
+os.environ.setdefault("SCHEDULER_ENABLED", "0")
+os.environ.setdefault("DISPATCH_ENABLED", "0")
+# All benchmark traffic comes from one address
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+
+import httpx  # noqa: E402
+
+from .scenarios import SCENARIOS, Recorder, ScenarioContext  # noqa: E402
+from .seed import SeedConfig, seed  # noqa: E402
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder: Recorder, elapsed: float):
+    routes = {}
+    for route, latencies in sorted(recorder.latencies.items()):
+        values = sorted(latencies)
+        routes[route] = {
+            "count": len(values),
+            "rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 50), 3),
+            "p95_ms": round(percentile(values, 95), 3),
+            "p99_ms": round(percentile(values, 99), 3),
+            "max_ms": round(values[-1], 3),
+            "errors": recorder.errors.get(route, 0),
+            "statuses": {str(status): n for status, n in sorted(recorder.statuses[route].items())},
+        }
+    total = sum(route["count"] for route in routes.values())
+    return {
+        "duration_s": round(elapsed, 3),
+        "requests": total,
+        "rps": round(total / elapsed, 2),
+        "errors": sum(route["errors"] for route in routes.values()),
+        "routes": routes,
+    }
+
+
+async def run_scenario(app, name: str, cfg: SeedConfig, concurrency: int, duration: float, warmup: float):
+    scenario = SCENARIOS[name]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        recorder = Recorder()
+        contexts = [ScenarioContext(client, recorder, cfg, seed=worker) for worker in range(concurrency)]
+        # Warm-up traffic goes to a throwaway recorder
+        warmup_recorder = Recorder()
+        for ctx in contexts:
+            ctx.recorder = warmup_recorder
+        deadline = time.perf_counter() + warmup
+
+        async def worker(ctx):
+            while time.perf_counter() < deadline:
+                await scenario(ctx)
+
+        await asyncio.gather(*(worker(ctx) for ctx in contexts))
+
+        for ctx in contexts:
+            ctx.recorder = recorder
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(worker(ctx) for ctx in contexts))
+        return summarize(recorder, time.perf_counter() - started)
+
+
+def compare(current, baseline, threshold_pct: float):
+    """Print per-route deltas and return the regressions found."""
+    regressions = []
+    print(f"\n{'scenario / route':<55} {'rps':>18} {'p95 ms':>20}")
+    for scenario, result in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if not base:
+            continue
+        for route, stats in result["routes"].items():
+            before = base["routes"].get(route)
+            if not before:
+                continue
+            rps_delta = (stats["rps"] - before["rps"]) / before["rps"] * 100 if before["rps"] else 0.0
+            p95_delta = (stats["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100 if before["p95_ms"] else 0.0
+            flag = ""
+            if rps_delta < -threshold_pct or p95_delta > threshold_pct:
+                flag = "  REGRESSION"
+                regressions.append((scenario, route, rps_delta, p95_delta))
+            print(
+                f"{scenario + ' ' + route:<55} "
+                f"{before['rps']:>8.1f}->{stats['rps']:<8.1f} "
+                f"{before['p95_ms']:>8.2f}->{stats['p95_ms']:<8.2f} "
+                f"({rps_delta:+.1f}% rps, {p95_delta:+.1f}% p95){flag}"
+            )
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args) -> int:
+    os.environ["STORAGE_BACKEND"] = args.storage
+    import server
+
+    # server configures INFO logging; httpx would then log every request and
+    # the log I/O would show up in the latencies
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    cfg = SeedConfig(
+        users=args.users,
+        tasks=args.tasks,
+        chats=args.chats,
+        messages_per_chat=args.messages_per_chat,
+        seed=args.seed,
+    )
+    await server.app.router.startup()
+    try:
+        if not args.skip_seed:
+            started = time.perf_counter()
+            await seed(server.app.state.storage, cfg)
+            print(f"seeded in {time.perf_counter() - started:.1f}s")
+
+        report = {
+            "meta": {
+                "started_at": datetime.utcnow().isoformat(),
+                "git_revision": _git_revision(),
+                "python": platform.python_version(),
+                "storage": args.storage,
+                "db_name": os.environ["DB_NAME"] if args.storage == "mongo" else None,
+                "concurrency": args.concurrency,
+                "duration_s": args.duration,
+                "seed": vars(cfg),
+            },
+            "scenarios": {},
+        }
+        for name in args.scenarios:
+            print(f"running {name} ({args.concurrency} workers, {args.duration}s)")
+            result = await run_scenario(server.app, name, cfg, args.concurrency, args.duration, args.warmup)
+            report["scenarios"][name] = result
+            for route, stats in result["routes"].items():
+                print(
+                    f"  {route:<40} {stats['rps']:>9.1f} rps  p50 {stats['p50_ms']:.2f}ms  "
+                    f"p95 {stats['p95_ms']:.2f}ms  p99 {stats['p99_ms']:.2f}ms  errors {stats['errors']}"
+                )
+    finally:
+        await server.app.router.shutdown()
+
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"report written to {args.output}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold}%")
+            return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--tasks", type=int, default=1_000_000)
+    parser.add_argument("--chats", type=int, default=20_000)
+    parser.add_argument("--messages-per-chat", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--storage", choices=["mongo", "memory"], default="mongo")
+    parser.add_argument("--skip-seed", action="store_true", help="reuse a database seeded with the same sizes")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", help="previous report to diff against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    args = parser.parse_args(argv)
+    if args.skip_seed and args.storage == "memory":
+        parser.error("--skip-seed needs a persistent store")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,206 @@
+"""Throughput scaling of ``backend/serve.py`` from 1 to N worker processes.
+
+    python -m benchmarks.run --duration 1 --warmup 0   # seeds marketplace_bench once
+    python -m benchmarks.scaling --workers 1 2 4 8 --output scaling.json
+
+For each worker count the script starts ``serve.py`` on a free port and
+waits until it answers. It then drives the server over real HTTP from
+``--clients`` load-generator processes, each with ``--concurrency`` open
+connections, and stops it with SIGTERM. The mix is read-heavy: feed pages,
+user profiles and single tasks against the seeded ``DB_NAME``. That way
+the servers share one dataset. ``--storage memory`` gives each worker its
+own empty store, so use it only to measure framework overhead.
+
+With ``--pin`` (Linux) the server is restricted to the first ``k`` CPUs
+and the load generators to the CPUs after the largest worker count. The
+measurement then reflects the cores the server really had. Without spare
+cores the load generators compete with the workers, and the speedup is
+understated.
+
+The report lists rps, p50/p99 latency and errors per worker count, along
+with the speedup over one worker and the parallel efficiency
+(speedup / workers). Expect near-linear scaling until Mongo or the load
+generators saturate. That point shows up as efficiency falling off while
+p99 grows.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from .seed import CATEGORIES, SeedConfig, task_id, user_id
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, process, timeout: float = 60):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode}")
+        try:
+            if httpx.get(url + "/api/", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+
+def start_server(workers: int, port: int, args, cpus):
+    env = {
+        **os.environ,
+        "STORAGE_BACKEND": args.storage,
+        "RETENTION_INTERVAL_SECONDS": "0",
+        "ANALYTICS_ROLLUP_INTERVAL_SECONDS": "0",
+        "SCHEDULER_ENABLED": "0",
+        "DISPATCH_ENABLED": "0",
+        "RATE_LIMIT_ENABLED": "0",
+    }
+    env.setdefault("DB_NAME", "marketplace_bench")
+    command = [
+        sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--no-access-log", "--graceful-timeout", "5",
+    ]
+    preexec = (lambda: os.sched_setaffinity(0, cpus)) if cpus else None
+    return subprocess.Popen(command, cwd=ROOT_DIR / "backend", env=env, preexec_fn=preexec)
+
+
+async def _drive(url: str, cfg: SeedConfig, concurrency: int, duration: float, seed: int):
+    import httpx
+
+    rng = random.Random(seed)
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                roll = rng.random()
+                if roll < 0.5:
+                    path, params = "/api/tasks", {"status": "posted", "category": rng.choice(CATEGORIES), "limit": 20}
+                elif roll < 0.8:
+                    path, params = f"/api/users/{user_id(rng.randrange(cfg.users))}", None
+                else:
+                    path, params = f"/api/tasks/{task_id(rng.randrange(cfg.tasks))}", None
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path, params=params)
+                    if response.status_code not in (200, 404):
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def _load_generator(url, cfg, concurrency, duration, seed, cpus, results):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    results.put(asyncio.run(_drive(url, cfg, concurrency, duration, seed)))
+
+
+def measure(url: str, cfg: SeedConfig, args, cpus, duration: float):
+    results = multiprocessing.Queue()
+    generators = [
+        multiprocessing.Process(
+            target=_load_generator, args=(url, cfg, args.concurrency, duration, seed, cpus, results)
+        )
+        for seed in range(args.clients)
+    ]
+    started = time.perf_counter()
+    for generator in generators:
+        generator.start()
+    collected = [results.get() for _ in generators]
+    elapsed = time.perf_counter() - started
+    for generator in generators:
+        generator.join()
+    latencies = sorted(value for values, _ in collected for value in values)
+    errors = sum(count for _, count in collected)
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 3) if latencies else 0.0
+
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": pct(50),
+        "p99_ms": pct(99),
+        "errors": errors,
+    }
+
+
+def main(args) -> int:
+    cfg = SeedConfig(users=args.users, tasks=args.tasks)
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    client_cpus = available[max(args.workers):] if args.pin else []
+    if args.pin and not client_cpus:
+        print("warning: no CPUs left for the load generators; running them unpinned")
+
+    report = {"workers": {}, "clients": args.clients, "concurrency": args.concurrency, "duration_s": args.duration}
+    print(f"{'workers':>8}{'rps':>12}{'speedup':>10}{'efficiency':>12}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    baseline = None
+    for workers in args.workers:
+        port = _free_port()
+        url = f"http://127.0.0.1:{port}"
+        server = start_server(workers, port, args, available[:workers] if args.pin else None)
+        try:
+            _wait_ready(url, server)
+            measure(url, cfg, args, client_cpus, args.warmup)
+            result = measure(url, cfg, args, client_cpus, args.duration)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+        baseline = baseline or result["rps"]
+        result["speedup"] = round(result["rps"] / baseline, 2) if baseline else None
+        result["efficiency"] = round(result["speedup"] / workers, 2) if baseline else None
+        report["workers"][str(workers)] = result
+        print(
+            f"{workers:>8}{result['rps']:>12.1f}{result['speedup']:>10.2f}{result['efficiency']:>12.2f}"
+            f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['errors']:>8}"
+        )
+
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"report written to {args.output}")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--clients", type=int, default=4, help="load-generator processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="connections per load generator")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--users", type=int, default=100_000, help="must match the seeded database")
+    parser.add_argument("--tasks", type=int, default=1_000_000, help="must match the seeded database")
+    parser.add_argument("--storage", choices=["mongo", "memory"], default="mongo")
+    parser.add_argument("--pin", action="store_true", help="pin server and load generators to disjoint CPUs")
+    parser.add_argument("--output", default="scaling_output.json")
+    args = parser.parse_args(argv)
+    args.workers = sorted(set(args.workers))
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
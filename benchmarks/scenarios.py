@@ -0,0 +1,128 @@
+"""Concurrent load scenarios.
+
+Each scenario is an async callable running one iteration of a user's
+behaviour through ``ctx.request``; the runner calls it in a loop from many
+concurrent workers for a fixed duration.
+"""
+import random
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List
+
+from .seed import CATEGORIES, SeedConfig, task_id, user_id
+
+# Chats and tasks that every worker piles onto
+HOT_CHATS = 50
+HOT_TASKS = 200
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route: str, status: int, elapsed_ms: float, ok: bool):
+        self.latencies[route].append(elapsed_ms)
+        self.statuses[route][status] += 1
+        if not ok:
+            self.errors[route] += 1
+
+
+class ScenarioContext:
+    def __init__(self, client, recorder: Recorder, cfg: SeedConfig, seed: int):
+        self.client = client
+        self.recorder = recorder
+        self.cfg = cfg
+        self.rng = random.Random(seed)
+        self.storm_tasks: List[str] = []
+
+    def random_user(self) -> str:
+        return user_id(self.rng.randrange(self.cfg.users))
+
+    def random_client(self) -> str:
+        return user_id(self.rng.randrange(self.cfg.users // 2) * 2)
+
+    def random_tasker(self) -> str:
+        return user_id(self.rng.randrange(self.cfg.taskers) * 2 + 1)
+
+    def random_task(self) -> str:
+        return task_id(self.rng.randrange(self.cfg.tasks))
+
+    async def request(self, method: str, path: str, route: str, expected=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            status = response.status_code
+        except Exception:
+            status = 599
+            response = None
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.recorder.record(route, status, elapsed_ms, status in expected)
+        return response
+
+
+async def task_feed(ctx: ScenarioContext):
+    """Landing screen: posted feed, sometimes filtered, then a task detail."""
+    params = {"status": "posted"}
+    if ctx.rng.random() < 0.5:
+        params["category"] = ctx.rng.choice(CATEGORIES)
+    await ctx.request("GET", "/api/tasks", "GET /api/tasks", params=params)
+    if ctx.rng.random() < 0.3:
+        await ctx.request("GET", f"/api/tasks/{ctx.random_task()}", "GET /api/tasks/{task_id}")
+
+
+async def accept_storm(ctx: ScenarioContext):
+    """Many taskers racing to accept the same freshly posted tasks."""
+    if not ctx.storm_tasks or ctx.rng.random() < 0.05:
+        response = await ctx.request(
+            "POST", "/api/tasks", "POST /api/tasks",
+            json={
+                "title": "Storm delivery",
+                "description": "Pick up a parcel and bring it across town",
+                "category": "delivery",
+                "client_id": ctx.random_client(),
+                "location": {"latitude": 40.7, "longitude": -73.9},
+                "budget_min": 20.0,
+                "budget_max": 40.0,
+                "priority": "urgent",
+            },
+        )
+        if response is not None and response.status_code == 200:
+            ctx.storm_tasks.append(response.json()["id"])
+            del ctx.storm_tasks[:-HOT_TASKS]
+        return
+    target = ctx.storm_tasks[-1] if ctx.rng.random() < 0.8 else ctx.rng.choice(ctx.storm_tasks)
+    # Losing the race is a 400, which is the expected outcome for most workers
+    await ctx.request(
+        "PUT", f"/api/tasks/{target}/accept", "PUT /api/tasks/{task_id}/accept",
+        expected=(200, 400), params={"tasker_id": ctx.random_tasker()},
+    )
+
+
+async def chat_burst(ctx: ScenarioContext):
+    """Bursty messaging on a handful of hot conversations."""
+    chat = ctx.rng.randrange(min(HOT_CHATS, ctx.cfg.chats))
+    await ctx.request(
+        "POST", "/api/messages", "POST /api/messages",
+        json={
+            "task_id": task_id(chat),
+            "sender_id": ctx.random_client(),
+            "receiver_id": ctx.random_tasker(),
+            "content": "On my way!",
+        },
+    )
+    if ctx.rng.random() < 0.25:
+        await ctx.request("GET", f"/api/messages/{task_id(chat)}", "GET /api/messages/{task_id}")
+
+
+async def dashboard(ctx: ScenarioContext):
+    await ctx.request("GET", f"/api/dashboard/{ctx.random_user()}", "GET /api/dashboard/{user_id}")
+
+
+SCENARIOS: Dict[str, Callable[[ScenarioContext], Awaitable[None]]] = {
+    "task_feed": task_feed,
+    "accept_storm": accept_storm,
+    "chat_burst": chat_burst,
+    "dashboard": dashboard,
+}
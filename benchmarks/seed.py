@@ -0,0 +1,202 @@
+"""Seed a benchmark database with realistic volumes.
+
+Ids are derived from the row number, so scenarios can pick random users and
+tasks without holding a million ids in memory, and a seeded database can be
+reused across runs with ``--skip-seed``.
+"""
+import random
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+CATEGORIES = [
+    "delivery", "cleaning", "handyman", "moving", "beauty",
+    "tech_support", "tutoring", "pet_care", "transportation", "other",
+]
+STATUSES = ["posted", "accepted", "in_progress", "completed", "cancelled"]
+STATUS_WEIGHTS = [30, 10, 5, 50, 5]
+SKILLS = [
+    "delivery", "cleaning", "handyman", "moving", "plumbing", "electrical",
+    "tutoring", "dog walking", "furniture assembly", "tech support",
+]
+
+# High bits keep the id ranges of each collection apart
+USER_NAMESPACE = 1 << 120
+TASK_NAMESPACE = 2 << 120
+MESSAGE_NAMESPACE = 3 << 120
+BID_NAMESPACE = 4 << 120
+
+
+def user_id(n: int) -> str:
+    return str(uuid.UUID(int=USER_NAMESPACE | n))
+
+
+def task_id(n: int) -> str:
+    return str(uuid.UUID(int=TASK_NAMESPACE | n))
+
+
+@dataclass
+class SeedConfig:
+    users: int = 100_000
+    tasks: int = 1_000_000
+    chats: int = 20_000
+    messages_per_chat: int = 25
+    bids_per_task: int = 2
+    batch_size: int = 5_000
+    seed: int = 42
+
+    @property
+    def taskers(self) -> int:
+        # Every other user is a tasker (or both)
+        return self.users // 2
+
+
+def _location(rng: random.Random):
+    return {
+        "latitude": round(40.60 + rng.random() * 0.3, 6),
+        "longitude": round(-74.05 + rng.random() * 0.3, 6),
+        "address": f"{rng.randint(1, 999)} Benchmark St",
+        "is_shared": rng.random() < 0.3,
+    }
+
+
+def make_user(n: int, rng: random.Random, now: datetime):
+    role = "client" if n % 2 == 0 else rng.choice(["tasker", "both"])
+    return {
+        "id": user_id(n),
+        "email": f"user{n}@bench.example",
+        "phone": f"+1-555-{n:07d}",
+        "name": f"Bench User {n}",
+        "role": role,
+        "profile_image": None,
+        "bio": "Seeded benchmark user",
+        "skills": rng.sample(SKILLS, 3) if role != "client" else [],
+        "location": _location(rng),
+        "rating": round(rng.uniform(3.0, 5.0), 2),
+        "total_reviews": rng.randint(0, 200),
+        "is_verified": rng.random() < 0.6,
+        "created_at": now - timedelta(days=rng.randint(0, 720)),
+    }
+
+
+def make_task(n: int, cfg: SeedConfig, rng: random.Random, now: datetime):
+    status = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+    created_at = now - timedelta(minutes=rng.randint(0, 60 * 24 * 365))
+    budget_min = float(rng.randint(10, 300))
+    # Clients are the even-numbered users, taskers the odd ones
+    tasker = user_id(rng.randrange(cfg.taskers) * 2 + 1) if status != "posted" else None
+    return {
+        "id": task_id(n),
+        "title": f"{rng.choice(CATEGORIES).replace('_', ' ').title()} job #{n}",
+        "description": "Seeded benchmark task with a realistic amount of text. " * 4,
+        "category": rng.choice(CATEGORIES),
+        "client_id": user_id(rng.randrange(cfg.users // 2) * 2),
+        "tasker_id": tasker,
+        "location": _location(rng),
+        "budget_min": budget_min,
+        "budget_max": budget_min + rng.randint(0, 200),
+        "status": status,
+        "priority": rng.choices(["normal", "urgent", "scheduled"], [85, 10, 5])[0],
+        "estimated_duration": rng.choice([30, 60, 90, 120, 240]),
+        "required_skills": rng.sample(SKILLS, 2),
+        "images": [],
+        "scheduled_time": None,
+        "accepted_at": created_at + timedelta(minutes=rng.randint(1, 600)) if tasker else None,
+        "started_at": None,
+        "completed_at": None,
+        "created_at": created_at,
+    }
+
+
+def make_bid(n: int, task: dict, cfg: SeedConfig, rng: random.Random):
+    return {
+        "id": str(uuid.UUID(int=BID_NAMESPACE | n)),
+        "task_id": task["id"],
+        "tasker_id": user_id(rng.randrange(cfg.taskers) * 2 + 1),
+        "client_id": task["client_id"],
+        "proposed_price": task["budget_min"] + rng.randint(0, 50),
+        "message": "I can do this today.",
+        "estimated_completion": None,
+        "created_at": task["created_at"] + timedelta(minutes=rng.randint(1, 120)),
+    }
+
+
+def make_chat(chat: int, cfg: SeedConfig, rng: random.Random, now: datetime):
+    """Messages of one task conversation between its client and a tasker."""
+    task = task_id(chat)
+    client, tasker = user_id(rng.randrange(cfg.users // 2) * 2), user_id(rng.randrange(cfg.taskers) * 2 + 1)
+    started = now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+    for i in range(cfg.messages_per_chat):
+        sender, receiver = (client, tasker) if i % 2 == 0 else (tasker, client)
+        yield {
+            "id": str(uuid.UUID(int=MESSAGE_NAMESPACE | (chat * cfg.messages_per_chat + i))),
+            "task_id": task,
+            "sender_id": sender,
+            "receiver_id": receiver,
+            "content": f"Benchmark message {i}",
+            "message_type": "text",
+            "created_at": started + timedelta(seconds=i * 45),
+        }
+
+
+async def _insert_batches(repo, docs, batch_size: int, label: str, total: int, log):
+    batch = []
+    done = 0
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            await repo.insert_many(batch)
+            done += len(batch)
+            batch = []
+            if done % (batch_size * 20) == 0:
+                log(f"  {label}: {done}/{total}")
+    if batch:
+        await repo.insert_many(batch)
+        done += len(batch)
+    log(f"  {label}: {done} inserted")
+
+
+async def seed(storage, cfg: SeedConfig, log=print):
+    """Empty and refill every repository of ``storage``."""
+    rng = random.Random(cfg.seed)
+    now = datetime.utcnow()
+    for repo in storage.repositories().values():
+        await repo.collection.drop()
+    await storage.ensure_indexes()
+
+    log(f"seeding {cfg.users} users, {cfg.tasks} tasks, {cfg.chats} chats")
+    await _insert_batches(
+        storage.users, (make_user(n, rng, now) for n in range(cfg.users)),
+        cfg.batch_size, "users", cfg.users, log,
+    )
+
+    # Bids are generated alongside their task and flushed in their own batches
+    task_batch, bid_batch = [], []
+    bid_n = 0
+    for n in range(cfg.tasks):
+        task = make_task(n, cfg, rng, now)
+        task_batch.append(task)
+        if task["status"] == "posted":
+            for _ in range(cfg.bids_per_task):
+                bid_batch.append(make_bid(bid_n, task, cfg, rng))
+                bid_n += 1
+        if len(task_batch) >= cfg.batch_size:
+            await storage.tasks.insert_many(task_batch)
+            task_batch = []
+            if (n + 1) % (cfg.batch_size * 20) == 0:
+                log(f"  tasks: {n + 1}/{cfg.tasks}")
+        if len(bid_batch) >= cfg.batch_size:
+            await storage.task_bids.insert_many(bid_batch)
+            bid_batch = []
+    if task_batch:
+        await storage.tasks.insert_many(task_batch)
+    if bid_batch:
+        await storage.task_bids.insert_many(bid_batch)
+    log(f"  tasks: {cfg.tasks} inserted, task_bids: {bid_n} inserted")
+
+    def messages():
+        for chat in range(cfg.chats):
+            yield from make_chat(chat, cfg, rng, now)
+
+    total_messages = cfg.chats * cfg.messages_per_chat
+    await _insert_batches(storage.messages, messages(), cfg.batch_size, "messages", total_messages, log)
@@ -0,0 +1,60 @@
+"""Shared setup: the backend on the in-memory engine, with background jobs off."""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+for name, value in {
+    "STORAGE_BACKEND": "memory",
+    "RATE_LIMIT_ENABLED": "0",
+    "SCHEDULER_ENABLED": "0",
+    "DISPATCH_ENABLED": "0",
+    "FEED_CACHE_ENABLED": "0",
+    "RETENTION_INTERVAL_SECONDS": "0",
+    "ANALYTICS_ROLLUP_INTERVAL_SECONDS": "0",
+    "PROFILE_SAMPLE_RATE": "0",
+}.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def client():
+    """A test client on a fresh in-memory store."""
+    from fastapi.testclient import TestClient
+
+    import server
+
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def make_user(client):
+    def make(role: str = "client", **fields) -> dict:
+        response = client.post("/api/users", json={
+            "email": f"{os.urandom(4).hex()}@example.com", "phone": "555-0100", "name": "Test User", "role": role, **fields,
+        })
+        assert response.status_code == 200, response.text
+        return response.json()
+    return make
+
+
+@pytest.fixture
+def make_task(client, make_user):
+    def make(client_id: str = None, **fields) -> dict:
+        response = client.post("/api/tasks", json={
+            "title": "Fix leaking sink",
+            "description": "Kitchen sink drips overnight",
+            "category": "handyman",
+            "client_id": client_id or make_user()["id"],
+            "location": {"latitude": 52.52, "longitude": 13.405},
+            "budget_min": 40,
+            "budget_max": 80,
+            **fields,
+        })
+        assert response.status_code == 200, response.text
+        return response.json()
+    return make
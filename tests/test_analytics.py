@@ -0,0 +1,99 @@
+"""Analytics rollups against the same numbers aggregated straight from the source."""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import analytics
+from storage import create_storage
+
+DAY = datetime(2024, 5, 1, 9, 0, 0)
+
+
+@pytest.fixture(autouse=True)
+def no_settle_window(monkeypatch):
+    monkeypatch.setattr(analytics, "SETTLE_SECONDS", 0)
+
+
+def task(category: str, created_at: datetime, **fields) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "category": category,
+        "budget_min": 40.0,
+        "budget_max": 80.0,
+        "created_at": created_at,
+        **fields,
+    }
+
+
+def payment(created_at: datetime, amount: float, status: str = "completed") -> dict:
+    return {"id": str(uuid.uuid4()), "created_at": created_at, "amount": amount, "status": status}
+
+
+async def direct(source, pipelines) -> dict:
+    """What the rollups should hold: every pipeline over all time, without its $merge."""
+    rows: dict = {}
+    for pipeline in pipelines((None, None), "unused"):
+        for row in await source.aggregate(pipeline[:-1]):
+            rows.setdefault(row["_id"], {}).update(row)
+    return rows
+
+
+async def rolled_up(rollups) -> dict:
+    return {row["_id"]: row for row in await rollups.find({}, limit=0)}
+
+
+async def assert_rollups_match(storage):
+    assert await rolled_up(storage.task_stats) == await direct(storage.tasks, analytics.task_pipelines)
+    assert await rolled_up(storage.payment_stats) == await direct(storage.payments, analytics.payment_pipelines)
+
+
+def test_rebuild_then_incremental_runs_match_a_direct_aggregate():
+    async def run():
+        storage = create_storage(backend="memory")
+        next_day = DAY + timedelta(days=1)
+        cleaning = task("cleaning", DAY, budget_max=120.0)
+        moving = task("moving", DAY, accepted_at=DAY + timedelta(hours=2))
+        accepted = task("moving", DAY, accepted_at=next_day, completed_at=next_day + timedelta(hours=3))
+        await storage.tasks.insert_many([cleaning, moving, accepted])
+        refunded = payment(DAY, 30.0)
+        await storage.payments.insert_many([payment(DAY, 50.0), refunded, payment(next_day, 20.0, "pending")])
+
+        assert await analytics.run_rollups(storage) == {"task_days": -1, "payment_days": -1}
+        await assert_rollups_match(storage)
+        first = await rolled_up(storage.task_stats)
+        assert first["2024-05-01:moving"]["posted"] == 2 and first["2024-05-01:moving"]["accepted"] == 1
+        assert first["2024-05-02:moving"]["completed"] == 1
+        assert (await rolled_up(storage.payment_stats))["2024-05-01"]["gmv"] == 80.0
+
+        # Both moving tasks become cleaning ones, which leaves the moving rows
+        # of both days with nothing to count
+        await storage.tasks.update_one({"id": moving["id"]}, {"$set": {"category": "cleaning"}})
+        await storage.tasks.update_one({"id": accepted["id"]}, {"$set": {"category": "cleaning"}})
+        await storage.payments.update_one({"id": refunded["id"]}, {"$set": {"status": "refunded"}})
+        await storage.tasks.insert_many([task("gardening", DAY + timedelta(days=5))])
+
+        totals = await analytics.run_rollups(storage)
+        await assert_rollups_match(storage)
+        return totals, await rolled_up(storage.task_stats), await rolled_up(storage.payment_stats)
+
+    totals, tasks, payments = asyncio.run(run())
+    assert totals == {"task_days": 3, "payment_days": 1}
+    assert sorted(tasks) == ["2024-05-01:cleaning", "2024-05-02:cleaning", "2024-05-06:gardening"]
+    assert tasks["2024-05-01:cleaning"]["posted"] == 3
+    assert tasks["2024-05-01:cleaning"]["accepted"] == 1
+    assert payments["2024-05-01"]["gmv"] == 50.0 and payments["2024-05-01"]["payments"] == 2
+
+
+def test_recompute_keeps_rows_of_days_outside_the_window():
+    async def run():
+        storage = create_storage(backend="memory")
+        await storage.tasks.insert_many([task("cleaning", DAY), task("cleaning", DAY + timedelta(days=2))])
+        await analytics.run_rollups(storage)
+        await storage.tasks.insert_many([task("moving", DAY + timedelta(days=1))])
+        await analytics.run_rollups(storage)
+        await assert_rollups_match(storage)
+        return sorted(await rolled_up(storage.task_stats))
+
+    assert asyncio.run(run()) == ["2024-05-01:cleaning", "2024-05-02:moving", "2024-05-03:cleaning"]
@@ -0,0 +1,88 @@
+"""Autocomplete: prefix index ranking and live updates around rebuilds."""
+import asyncio
+import uuid
+from datetime import datetime
+
+import autocomplete
+from storage import create_storage
+
+
+def terms(found):
+    return [text for text, _ in found]
+
+
+def test_matches_word_starts_ignoring_case_and_spacing():
+    index = autocomplete.PrefixIndex.build([("Fix  leaking sink", 2), ("Sink install", 1), ("Kitchen", 1)])
+    assert terms(index.search("sink", 10)) == ["Fix leaking sink", "Sink install"]
+    assert terms(index.search("  LEAKING   s", 10)) == ["Fix leaking sink"]
+    assert index.search("fix leaking sink", 10) == [("Fix leaking sink", 2)]
+    assert index.search("plumb", 10) == [] and index.search("   ", 10) == []
+
+
+def test_build_merges_spellings_under_the_most_used():
+    index = autocomplete.PrefixIndex.build([("painting", 1), ("Painting", 3), ("PAINTING", 2), ("empty", 0)])
+    assert len(index) == 1
+    assert index.search("pa", 10) == [("Painting", 6)]
+
+
+def test_top_k_is_ranked_by_count_then_text():
+    index = autocomplete.PrefixIndex.build(
+        [("cleaning", 5), ("carpentry", 5), ("cooking", 9), ("cabling", 1)], max_results=3
+    )
+    # "c" is warmed with the index, "ca" is computed on first search
+    assert terms(index.search("c", 10)) == ["cooking", "carpentry", "cleaning"]
+    assert terms(index.search("c", 2)) == ["cooking", "carpentry"]
+    assert terms(index.search("ca", 10)) == ["carpentry", "cabling"]
+
+
+def test_adds_promote_into_cached_top_lists():
+    index = autocomplete.PrefixIndex.build([("cleaning", 5), ("carpentry", 4), ("cooking", 3)], max_results=2)
+    assert terms(index.search("c", 10)) == ["cleaning", "carpentry"]
+    assert terms(index.search("coo", 10)) == ["cooking"]
+    index.add("cooking", 3)
+    assert terms(index.search("c", 10)) == ["cooking", "cleaning"]
+    index.add("Cabinet making", 7)
+    assert index.search("c", 10) == [("Cabinet making", 7), ("cooking", 6)]
+    assert index.search("mak", 10) == [("Cabinet making", 7)]
+
+
+def test_removes_drop_out_of_top_lists():
+    index = autocomplete.PrefixIndex.build([("cleaning", 5), ("carpentry", 4), ("cooking", 3)], max_results=2)
+    assert terms(index.search("c", 10)) == ["cleaning", "carpentry"]
+    index.add("cleaning", -2)
+    assert terms(index.search("c", 10)) == ["carpentry", "cleaning"]
+    index.add("carpentry", -4)
+    assert terms(index.search("c", 10)) == ["cleaning", "cooking"]
+    assert index.search("carp", 10) == []
+    assert len(index) == 2
+    # Taking uses from an unknown term is a no-op
+    index.add("plumbing", -1)
+    assert len(index) == 2 and index.search("pl", 10) == []
+
+
+def test_updates_during_a_build_survive_the_swap():
+    async def run():
+        storage = create_storage(backend="memory")
+        await storage.users.untracked.insert_many([{"id": str(uuid.uuid4()), "skills": ["painting"]}])
+        service = autocomplete.Autocomplete(storage)
+        aggregate = storage.tasks.aggregate
+        reads = []
+
+        async def slow_aggregate(pipeline):
+            found = await aggregate(pipeline)
+            reads.append(pipeline)
+            if len(reads) == 1:
+                # Requests served while the build reads
+                service.task_posted({"title": "Hang shelves", "required_skills": ["drilling"]})
+                service.user_skills(["painting"], [])
+            return found
+
+        storage.tasks.aggregate = slow_aggregate
+        await service.build()
+        return service
+
+    service = asyncio.run(run())
+    assert service.search("title", "hang", 10) == [("Hang shelves", 1)]
+    assert service.search("skill", "dri", 10) == [("drilling", 1)]
+    assert service.search("skill", "pai", 10) == []
+    assert service._pending is None and service.built_at <= datetime.utcnow()
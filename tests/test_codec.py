@@ -0,0 +1,98 @@
+"""Compact encoding: documents, filters and updates survive the round trip."""
+import asyncio
+import uuid
+
+from bson.binary import Binary
+
+from storage import create_storage
+from storage.codec import Codec
+
+CODEC = Codec(
+    {"id", "participants", "last_message.id"},
+    {"budget_min", "offer.budget_max"},
+)
+
+
+def ids(count: int):
+    return [str(uuid.uuid4()) for _ in range(count)]
+
+
+def test_documents_round_trip():
+    first, second, third = ids(3)
+    document = {
+        "id": first,
+        "participants": [second, third],
+        "last_message": {"id": second, "text": first},
+        "offer": {"budget_max": 80.5},
+        "budget_min": 19.99,
+        "title": "Move a sofa",
+    }
+    encoded = CODEC.encode_document(document)
+
+    assert encoded["id"] == Binary.from_uuid(uuid.UUID(first))
+    assert all(isinstance(value, Binary) for value in encoded["participants"])
+    # Only declared paths are converted
+    assert encoded["last_message"]["text"] == first
+    assert encoded["budget_min"] == 1999
+    assert encoded["offer"]["budget_max"] == 8050
+    assert CODEC.decode(encoded) == document
+
+
+def test_values_that_would_not_round_trip_stay_as_given():
+    upper = str(uuid.uuid4()).upper()
+    document = {"id": upper, "participants": ["not-a-uuid", None], "budget_min": None}
+
+    assert CODEC.encode_document(document) == document
+    assert CODEC.decode(CODEC.encode_document(document)) == document
+
+
+def test_legacy_documents_only_scale_floats():
+    # Ints in a half-migrated document are already minor units
+    assert CODEC.encode_document({"budget_min": 12.5}, legacy=True) == {"budget_min": 1250}
+    assert CODEC.encode_document({"budget_min": 1250}, legacy=True) == {"budget_min": 1250}
+
+
+def test_filters_and_updates_encode_operands():
+    first, second = ids(2)
+    binary = [Binary.from_uuid(uuid.UUID(value)) for value in (first, second)]
+
+    assert CODEC.encode_filter({
+        "$or": [{"id": {"$in": [first, second]}}, {"participants": first}],
+        "budget_min": {"$gte": 10.0, "$exists": True},
+        "title": {"$regex": first},
+    }) == {
+        "$or": [{"id": {"$in": binary}}, {"participants": binary[0]}],
+        "budget_min": {"$gte": 1000, "$exists": True},
+        "title": {"$regex": first},
+    }
+    assert CODEC.encode_update({
+        "$set": {"budget_min": 5.25, "last_message": {"id": first}},
+        "$addToSet": {"participants": {"$each": [first, second]}},
+        "$pull": {"participants": {"$in": [second]}},
+        "$unset": {"offer": ""},
+    }) == {
+        "$set": {"budget_min": 525, "last_message": {"id": binary[0]}},
+        "$addToSet": {"participants": {"$each": binary}},
+        "$pull": {"participants": {"$in": [binary[1]]}},
+        "$unset": {"offer": ""},
+    }
+
+
+def test_compact_repository_round_trip():
+    async def run():
+        storage = create_storage(backend="memory", encoding="compact")
+        task_id, client_id = ids(2)
+        await storage.tasks.insert({"id": task_id, "client_id": client_id, "budget_min": 40.0, "budget_max": 80.25})
+        await storage.tasks.update_one({"id": task_id}, {"$set": {"budget_max": 95.5}})
+
+        raw = await storage.tasks.collection.find_one({})
+        found = await storage.tasks.find({"client_id": client_id, "budget_max": {"$gt": 90}})
+        return raw, found, task_id, client_id
+
+    raw, found, task_id, client_id = asyncio.run(run())
+    assert raw["id"] == Binary.from_uuid(uuid.UUID(task_id))
+    assert (raw["budget_min"], raw["budget_max"]) == (4000, 9550)
+    assert len(found) == 1
+    assert found[0]["id"] == task_id
+    assert found[0]["client_id"] == client_id
+    assert (found[0]["budget_min"], found[0]["budget_max"]) == (40.0, 95.5)
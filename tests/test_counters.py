@@ -0,0 +1,132 @@
+"""Write-behind counters: buffering, overflow, failed flushes and ranking."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import counters
+from storage import create_storage
+
+NOW = datetime(2024, 5, 1, 12, 0, 0)
+
+
+async def stored(storage) -> dict:
+    found = await storage.task_counters.find({}, {"_id": 0, "updated_at": 0}, limit=0)
+    return {document.pop("id"): document for document in found}
+
+
+def test_increments_buffer_until_flushed():
+    async def run():
+        storage = create_storage(backend="memory")
+        buffer = counters.CounterBuffer(storage, flush_seconds=60)
+        buffer.add("a", "views")
+        buffer.add("a", "views")
+        buffer.add("a", "bids")
+        buffer.add("b", "messages", 3)
+        assert await stored(storage) == {}
+        await buffer.flush()
+        first = await stored(storage)
+        buffer.add("a", "views")
+        await buffer.flush()
+        await buffer.flush()  # nothing pending: no write
+        return first, await stored(storage), buffer.stats()
+
+    first, second, stats = asyncio.run(run())
+    assert first == {"a": {"views": 2, "bids": 1}, "b": {"messages": 3}}
+    assert second == {"a": {"views": 3, "bids": 1}, "b": {"messages": 3}}
+    assert stats["increments"] == 7 and stats["flushes"] == 2 and stats["written"] == 3
+    assert stats["pending"] == 0
+
+
+def test_full_buffer_wakes_the_flush_and_drops_new_tasks():
+    async def run():
+        buffer = counters.CounterBuffer(create_storage(backend="memory"), max_pending=2)
+        buffer.add("a", "views")
+        assert not buffer._wake.is_set()
+        buffer.add("b", "views")
+        assert buffer._wake.is_set()
+        buffer.add("c", "views", 4)
+        # Tasks already buffered keep counting
+        buffer.add("a", "views")
+        stats = buffer.stats()
+        await buffer.flush()
+        buffer.add("c", "views")
+        return stats, await stored(buffer.storage), buffer.stats()
+
+    full, written, after = asyncio.run(run())
+    assert full["dropped"] == 4 and full["increments"] == 3 and full["pending"] == 2
+    assert written == {"a": {"views": 2}, "b": {"views": 1}}
+    assert after["pending"] == 1
+
+
+def test_failed_flush_puts_increments_back():
+    async def run():
+        storage = create_storage(backend="memory")
+        buffer = counters.CounterBuffer(storage)
+        bulk_update = storage.task_counters.bulk_update
+
+        async def unavailable(*args, **kwargs):
+            raise ConnectionError("primary stepped down")
+
+        buffer.add("a", "views", 2)
+        storage.task_counters.bulk_update = unavailable
+        with pytest.raises(ConnectionError):
+            await buffer.flush()
+        failed = buffer.stats()
+        storage.task_counters.bulk_update = bulk_update
+        buffer.add("a", "views")
+        buffer.add("b", "bids")
+        await buffer.flush()
+        return failed, await stored(storage), buffer.stats()
+
+    failed, written, stats = asyncio.run(run())
+    assert failed["failures"] == 1 and failed["pending"] == 1 and failed["increments"] == 2
+    assert written == {"a": {"views": 3}, "b": {"bids": 1}}
+    assert stats["increments"] == 4 and stats["flushes"] == 1
+
+
+def test_stop_flushes_what_is_left():
+    async def run():
+        storage = create_storage(backend="memory")
+        buffer = counters.CounterBuffer(storage, flush_seconds=60)
+        buffer.start()
+        await asyncio.sleep(0)
+        buffer.add("a", "messages")
+        await buffer.stop()
+        return buffer._task.done(), await stored(storage)
+
+    stopped, written = asyncio.run(run())
+    assert stopped
+    assert written == {"a": {"messages": 1}}
+
+
+def test_popularity_weights_events_and_decays_with_age():
+    fresh = counters.popularity(None, NOW, NOW)
+    assert fresh == 1
+    assert counters.popularity({"views": 3}, NOW, NOW) == 1 + 3 * counters.WEIGHTS["views"]
+    assert counters.popularity({"bids": 1}, NOW, NOW) > counters.popularity({"views": 1}, NOW, NOW)
+    half_life = timedelta(hours=counters.HALF_LIFE_HOURS)
+    assert counters.popularity({"views": 3}, NOW - half_life, NOW) == pytest.approx((1 + 3 * counters.WEIGHTS["views"]) / 2)
+    # Tasks "created" in the future don't get a boost
+    assert counters.popularity(None, NOW + half_life, NOW) == fresh
+
+
+def test_rank_orders_by_flushed_popularity():
+    async def run():
+        storage = create_storage(backend="memory")
+        buffer = counters.CounterBuffer(storage)
+        buffer.add("viewed", "views", 2)
+        buffer.add("bid", "bids", 2)
+        buffer.add("old", "bids", 2)
+        await buffer.flush()
+        buffer.add("unflushed", "bids", 100)
+        tasks = [
+            {"id": "quiet", "created_at": NOW},
+            {"id": "viewed", "created_at": NOW},
+            {"id": "old", "created_at": NOW - timedelta(hours=counters.HALF_LIFE_HOURS * 4)},
+            {"id": "unflushed", "created_at": NOW - timedelta(minutes=1)},
+            {"id": "bid", "created_at": NOW - timedelta(minutes=1)},
+        ]
+        return [task["id"] for task in await buffer.rank(tasks, now=NOW)]
+
+    assert asyncio.run(run()) == ["bid", "viewed", "quiet", "unflushed", "old"]
@@ -0,0 +1,20 @@
+"""Routes take their repositories through overridable dependencies."""
+import server
+from storage import create_storage
+
+
+def test_repository_override_reaches_routes(client):
+    other = create_storage(backend="memory")
+    user = server.User(email="stub@example.com", phone="555-0100", name="Stub", role="tasker")
+    client.portal.call(other.users.insert, user.dict())
+
+    # The app's own store has no such user
+    assert client.get(f"/api/users/{user.id}").status_code == 404
+
+    server.app.dependency_overrides[server.get_user_repo] = lambda: other.users
+    try:
+        response = client.get(f"/api/users/{user.id}")
+    finally:
+        server.app.dependency_overrides.clear()
+    assert response.status_code == 200
+    assert response.json()["name"] == "Stub"
@@ -0,0 +1,75 @@
+"""Nearest-tasker search and the cross-worker offer relay."""
+import asyncio
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import dispatch
+from storage import create_storage
+
+LAT, LNG = 52.52, 13.405
+
+
+def tasker(distance_km: float) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "role": "tasker",
+        "location": {"latitude": LAT + distance_km / 111.2, "longitude": LNG},
+        "location_updated_at": datetime.utcnow(),
+    }
+
+
+def test_nearest_taskers_in_a_dense_area(monkeypatch):
+    monkeypatch.setattr(dispatch, "SEARCH_SCAN_LIMIT", 5)
+
+    async def run():
+        storage = create_storage(backend="memory")
+        taskers = [tasker(0.05 * n) for n in range(1, 40)]
+        nearest_ids = [t["id"] for t in taskers[:3]]
+        random.Random(7).shuffle(taskers)
+        await storage.users.insert_many(taskers)
+        dispatcher = dispatch.Dispatcher(storage, dispatch.OfferHub())
+        found = await dispatcher.nearest_taskers(LAT, LNG, 3, set())
+        assert [t["id"] for t in found] == nearest_ids
+        excluded = await dispatcher.nearest_taskers(LAT, LNG, 1, {nearest_ids[0]})
+        assert [t["id"] for t in excluded] == nearest_ids[1:2]
+    asyncio.run(run())
+
+
+def test_relay_delivers_offers_from_other_workers():
+    async def run():
+        storage = create_storage(backend="memory")
+        here = dispatch.Dispatcher(storage, dispatch.OfferHub())
+        tasker_id, task_id = str(uuid.uuid4()), str(uuid.uuid4())
+        queue = here.hub.subscribe(tasker_id)
+        # A wave opened by a dispatch running on another worker
+        await storage.dispatch_checkpoints.insert({
+            "id": task_id, "owner": "elsewhere", "wave": 1, "offered": [tasker_id], "current": [tasker_id],
+            "wave_ends_at": datetime.utcnow() + timedelta(seconds=30), "heartbeat_at": datetime.utcnow(),
+            "offer": {"task_id": task_id, "title": "Deliver a parcel"},
+        })
+        assert await here.relay_once() == 1
+        offer = queue.get_nowait()
+        assert (offer["type"], offer["task_id"], offer["wave"]) == ("offer", task_id, 1)
+        assert await here.relay_once() == 0 and queue.empty()
+
+        await storage.dispatch_checkpoints.delete_one({"id": task_id})
+        assert await here.relay_once() == 1
+        assert queue.get_nowait() == {"type": "withdrawn", "task_id": task_id}
+    asyncio.run(run())
+
+
+def test_replayed_offers_are_not_relayed_again():
+    async def run():
+        storage = create_storage(backend="memory")
+        here = dispatch.Dispatcher(storage, dispatch.OfferHub())
+        tasker_id, task_id = str(uuid.uuid4()), str(uuid.uuid4())
+        await storage.dispatch_checkpoints.insert({
+            "id": task_id, "owner": "elsewhere", "wave": 2, "offered": [tasker_id], "current": [tasker_id],
+            "wave_ends_at": datetime.utcnow() + timedelta(seconds=30), "heartbeat_at": datetime.utcnow(),
+            "offer": {"task_id": task_id},
+        })
+        queue = here.hub.subscribe(tasker_id)
+        assert len(await here.pending_offers(tasker_id)) == 1
+        assert await here.relay_once() == 0 and queue.empty()
+    asyncio.run(run())
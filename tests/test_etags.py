@@ -0,0 +1,108 @@
+"""Versioned ETags, conditional reads and If-Match writes."""
+import pytest
+from fastapi import HTTPException
+
+import etags
+import server
+from storage import MessageRepo
+
+LONG_DESCRIPTION = "Kitchen sink drips overnight and the cabinet below is soaked. " * 40
+
+
+def test_encoded_etag_stays_strong():
+    assert etags.encoded_etag(b'"3"', "gzip") == b'"3-gzip"'
+    assert etags.encoded_etag(b'W/"3"', "gzip") == b'W/"3"'
+
+
+@pytest.mark.parametrize("header", ['"3"', '"3-gzip"', 'W/"3-br"', '"1", "3-zstd"', "*"])
+def test_if_none_match_ignores_encoding(header):
+    assert etags.etag_matches(header, 3)
+
+
+def test_if_none_match_other_version():
+    assert not etags.etag_matches('"2-gzip"', 3)
+
+
+def test_parse_if_match():
+    assert etags.parse_if_match('"3"') == 3
+    assert etags.parse_if_match('"3-gzip"') == 3
+    assert etags.parse_if_match("*") is None
+    for header in ('W/"3"', '"1", "2"', '"x"'):
+        with pytest.raises(HTTPException) as raised:
+            etags.parse_if_match(header)
+        assert raised.value.status_code == 412
+
+
+def test_gzip_etag_round_trips_through_if_match(client, make_task, make_user):
+    task = make_task(description=LONG_DESCRIPTION)
+    read = client.get(f"/api/tasks/{task['id']}", headers={"Accept-Encoding": "gzip"})
+    assert read.headers["content-encoding"] == "gzip"
+    etag = read.headers["etag"]
+    assert etag.endswith('-gzip"') and not etag.startswith("W/")
+
+    assert client.get(f"/api/tasks/{task['id']}", headers={"If-None-Match": etag}).status_code == 304
+    accepted = client.put(
+        f"/api/tasks/{task['id']}/accept", params={"tasker_id": make_user("tasker")["id"]}, headers={"If-Match": etag}
+    )
+    assert accepted.status_code == 200, accepted.text
+    stale = client.put(f"/api/tasks/{task['id']}/start", headers={"If-Match": etag})
+    assert stale.status_code == 412
+
+
+def _send(client, task, sender, receiver, headers=None):
+    return client.post("/api/messages", json={
+        "task_id": task["id"], "sender_id": sender["id"], "receiver_id": receiver["id"], "content": "On my way",
+    }, headers=headers or {})
+
+
+def test_task_conditional_get(client, make_task):
+    task = make_task()
+    first = client.get(f"/api/tasks/{task['id']}")
+    assert first.headers["etag"] == '"1"'
+    assert client.get(f"/api/tasks/{task['id']}", headers={"If-None-Match": '"1"'}).status_code == 304
+    assert client.get(f"/api/tasks/{task['id']}", headers={"If-None-Match": '"0"'}).status_code == 200
+
+
+def test_send_message_bumps_thread_version_once(client, make_task, make_user):
+    owner, tasker = make_user(), make_user("tasker")
+    task = make_task(owner["id"])
+    assert client.get(f"/api/messages/{task['id']}").headers["etag"] == '"0"'
+
+    sent = _send(client, task, tasker, owner, {"If-Match": '"0"'})
+    assert sent.status_code == 200, sent.text
+    assert sent.headers["etag"] == '"1"'
+    thread = client.get(f"/api/messages/{task['id']}")
+    assert thread.headers["etag"] == '"1"' and len(thread.json()) == 1
+
+    assert _send(client, task, owner, tasker).headers["etag"] == '"2"'
+    assert client.get(f"/api/messages/{task['id']}", headers={"If-None-Match": '"2"'}).status_code == 304
+
+
+def test_send_message_drops_shared_loads_before_bumping(client, make_task, make_user, monkeypatch):
+    owner, tasker = make_user(), make_user("tasker")
+    task = make_task(owner["id"])
+    events = []
+    forget = server.reads.forget
+    bump = MessageRepo.bump_thread_version
+
+    def recording_forget(key):
+        events.append("forget")
+        forget(key)
+
+    async def recording_bump(repo, task_id):
+        events.append("bump")
+        return await bump(repo, task_id)
+
+    monkeypatch.setattr(server.reads, "forget", recording_forget)
+    monkeypatch.setattr(MessageRepo, "bump_thread_version", recording_bump)
+    assert _send(client, task, tasker, owner).status_code == 200
+    assert events[:2] == ["forget", "bump"]
+
+
+def test_send_message_with_stale_if_match(client, make_task, make_user):
+    owner, tasker = make_user(), make_user("tasker")
+    task = make_task(owner["id"])
+    _send(client, task, tasker, owner)
+    assert _send(client, task, owner, tasker, {"If-Match": '"0"'}).status_code == 412
+    thread = client.get(f"/api/messages/{task['id']}")
+    assert thread.headers["etag"] == '"1"' and len(thread.json()) == 1
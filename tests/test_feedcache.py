@@ -0,0 +1,97 @@
+"""Feed windows: contents per region and category, eviction and refills."""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import feedcache
+from storage import create_storage
+
+FIELDS = ["id", "title", "category", "location", "budget_min", "budget_max", "status", "created_at"]
+BERLIN = (52.52, 13.405)
+MUNICH = (48.137, 11.575)
+START = datetime(2024, 5, 1)
+
+
+def task(n: int, place=BERLIN, category="delivery", **fields) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "title": f"Task {n}",
+        "category": category,
+        "location": {"latitude": place[0], "longitude": place[1]},
+        "budget_min": 10,
+        "budget_max": 20,
+        "status": "posted",
+        "images": ["aGVsbG8="],
+        "created_at": START + timedelta(minutes=n),
+        **fields,
+    }
+
+
+def titles(page):
+    return [entry["title"] for entry in page]
+
+
+async def built(tasks, **options):
+    storage = create_storage(backend="memory")
+    await storage.tasks.insert_many(tasks)
+    cache = feedcache.FeedCache(storage, FIELDS, **options)
+    await cache.rebuild()
+    return storage, cache
+
+
+def test_windows_per_region_and_category():
+    async def run():
+        tasks = [
+            task(1), task(2, category="cleaning"), task(3, MUNICH), task(4),
+            task(5, status="accepted"), task(6, surface_at=START + timedelta(days=1)),
+        ]
+        _, cache = await built(tasks)
+        berlin = feedcache.cell(*BERLIN)
+        assert titles(await cache.read(None, None, 0, 10)) == ["Task 4", "Task 3", "Task 2", "Task 1"]
+        assert titles(await cache.read(berlin, None, 0, 10)) == ["Task 4", "Task 2", "Task 1"]
+        assert titles(await cache.read(berlin, "delivery", 0, 10)) == ["Task 4", "Task 1"]
+        assert titles(await cache.read(berlin, "delivery", 1, 1)) == ["Task 1"]
+        # The cache holds every feed task, so an empty key needs no query
+        assert await cache.read(feedcache.cell(*MUNICH), "cleaning", 0, 10) == []
+        assert cache.misses == 0
+    asyncio.run(run())
+
+
+def test_entries_are_summaries():
+    async def run():
+        _, cache = await built([task(1)])
+        cache.posted(task(2))
+        for entry in await cache.read(None, None, 0, 10):
+            assert set(entry) <= set(FIELDS) and "images" not in entry
+    asyncio.run(run())
+
+
+def test_eviction_truncates_and_refills():
+    async def run():
+        tasks = [task(n) for n in range(10)]
+        _, cache = await built(tasks, window=4, max_tasks=6)
+        assert cache.stats()["tasks"] == 6
+        assert titles(await cache.read(None, None, 0, 4)) == ["Task 9", "Task 8", "Task 7", "Task 6"]
+        assert cache.hits == 1
+        # Past the window the database answers
+        assert await cache.read(None, None, 2, 4) is None
+        for n in range(10, 13):
+            cache.posted(task(n))
+        assert cache.evicted >= 3 and cache.stats()["tasks"] == 6
+        assert titles(await cache.read(None, None, 0, 4)) == ["Task 12", "Task 11", "Task 10", "Task 9"]
+    asyncio.run(run())
+
+
+def test_local_removal_and_pulled_changes():
+    async def run():
+        first, second = task(1), task(2)
+        storage, cache = await built([first, second])
+        cache.removed(first["id"])
+        assert titles(await cache.read(None, None, 0, 10)) == ["Task 2"]
+        # Written by another worker
+        await storage.tasks.update_one({"id": second["id"]}, {"$set": {"status": "accepted"}})
+        third = task(3)
+        await storage.tasks.insert(third)
+        await cache.sync()
+        assert titles(await cache.read(None, None, 0, 10)) == ["Task 3"]
+    asyncio.run(run())
@@ -0,0 +1,91 @@
+"""Inbox read model: racing first messages and paging through ties."""
+import asyncio
+import uuid
+from datetime import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from storage import create_storage
+
+AT = datetime(2024, 5, 1, 12, 0, 0)
+
+
+def message(task_id: str, sender_id: str, receiver_id: str, content: str = "hello", **fields) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "task_id": task_id,
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "content": content,
+        "message_type": "text",
+        "created_at": AT,
+        **fields,
+    }
+
+
+def test_first_message_that_loses_the_upsert_race_still_counts():
+    async def run():
+        storage = create_storage(backend="memory")
+        conversations = storage.conversations
+        client, tasker, task_id = str(uuid.uuid4()), str(uuid.uuid4()), str(uuid.uuid4())
+        first = message(task_id, client, tasker, "from the client")
+        second = message(task_id, tasker, client, "from the tasker")
+        original = conversations.collection.update_one
+
+        async def racing_upsert(filter, update, upsert=False):
+            if upsert and first["id"] == update["$set"]["last_message"]["id"]:
+                # The other first message creates the conversation between
+                # this upsert's lookup and its insert
+                await conversations.record_message(second)
+                raise DuplicateKeyError("E11000 duplicate key error collection: conversations index: id_1")
+            return await original(filter, update, upsert)
+
+        conversations.collection.update_one = racing_upsert
+        await conversations.record_message(first)
+        return await conversations.inbox(client), await conversations.inbox(tasker), client, tasker
+
+    client_inbox, tasker_inbox, client, tasker = asyncio.run(run())
+    assert len(client_inbox) == len(tasker_inbox) == 1
+    conversation = client_inbox[0]
+    assert conversation["message_count"] == 2
+    assert conversation["unread"] == {client: 1, tasker: 1}
+    assert conversation["last_message"]["content"] == "from the client"
+
+
+def test_paging_keeps_conversations_that_share_a_timestamp():
+    async def run():
+        storage = create_storage(backend="memory", encoding="compact")
+        user = str(uuid.uuid4())
+        for _ in range(5):
+            await storage.conversations.record_message(message(str(uuid.uuid4()), str(uuid.uuid4()), user))
+        pages, before, before_id = [], None, None
+        while True:
+            page = await storage.conversations.inbox(user, before, before_id, limit=2)
+            if not page:
+                return pages, await storage.conversations.inbox(user, limit=10)
+            pages.append([conversation["id"] for conversation in page])
+            before, before_id = page[-1]["last_activity_at"], page[-1]["id"]
+
+    pages, everything = asyncio.run(run())
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [found for page in pages for found in page] == [conversation["id"] for conversation in everything]
+    assert len(everything) == 5
+
+
+def test_inbox_endpoint_pages_with_the_last_entry(client, make_user, make_task):
+    owner, tasker = make_user("client"), make_user("tasker")
+    for _ in range(3):
+        task = make_task(owner["id"])
+        sent = client.post("/api/messages", json={
+            "task_id": task["id"], "sender_id": tasker["id"], "receiver_id": owner["id"], "content": "hi",
+        })
+        assert sent.status_code == 200, sent.text
+
+    first = client.get(f"/api/users/{owner['id']}/inbox", params={"limit": 2}).json()
+    last = first[-1]
+    rest = client.get(f"/api/users/{owner['id']}/inbox", params={
+        "limit": 2, "before": last["last_activity_at"], "before_id": last["id"],
+    }).json()
+    assert len(first) == 2 and len(rest) == 1
+    assert {entry["id"] for entry in first}.isdisjoint(entry["id"] for entry in rest)
+    assert all(entry["other_participant_id"] == tasker["id"] for entry in first + rest)
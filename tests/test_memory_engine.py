@@ -0,0 +1,297 @@
+"""The in-memory engine against the Mongo semantics the repositories rely on.
+
+Every query runs on an unindexed collection and on one with the indexes the
+engine plans with, which must return the same documents.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from storage.base import ASCENDING, DESCENDING, Index
+from storage.memory import MemoryEngine
+
+START = datetime(2024, 5, 1)
+
+DOCUMENTS = [
+    {"id": "a", "status": "posted", "budget": 40, "tags": ["paint", "wall"], "created_at": START, "owner": {"city": "Berlin"}},
+    {"id": "b", "status": "posted", "budget": 80, "tags": ["move"], "created_at": START + timedelta(hours=1)},
+    {"id": "c", "status": "done", "budget": 20, "tags": [], "created_at": START + timedelta(hours=2), "owner": {"city": "Munich"}},
+    {"id": "d", "status": "posted", "budget": None, "created_at": START + timedelta(hours=3)},
+    {"id": "e", "status": "done", "budget": 60, "tags": ["paint"], "created_at": START + timedelta(hours=4)},
+]
+INDEXES = [
+    Index([("id", ASCENDING)], unique=True),
+    Index([("status", ASCENDING), ("created_at", DESCENDING)]),
+    Index([("tags", ASCENDING)]),
+]
+
+
+def run(awaitable):
+    return asyncio.run(awaitable)
+
+
+@pytest.fixture(params=["scan", "indexed"])
+def collection(request):
+    engine = MemoryEngine()
+    collection = engine.collection("things", INDEXES if request.param == "indexed" else [])
+    run(collection.insert_many(DOCUMENTS))
+    return collection
+
+
+def ids(documents):
+    return [document["id"] for document in documents]
+
+
+def found(collection, filter, **options):
+    return ids(run(collection.find(filter, sort=[("id", ASCENDING)], limit=0, **options)))
+
+
+@pytest.mark.parametrize("filter, expected", [
+    ({"status": "posted"}, ["a", "b", "d"]),
+    ({"status": {"$in": ["done", "gone"]}}, ["c", "e"]),
+    ({"status": {"$nin": ["posted"]}}, ["c", "e"]),
+    ({"status": {"$ne": "posted"}}, ["c", "e"]),
+    # Array fields match on any element, or on the whole array
+    ({"tags": "paint"}, ["a", "e"]),
+    ({"tags": {"$in": ["move", "wall"]}}, ["a", "b"]),
+    ({"tags": ["move"]}, ["b"]),
+    ({"tags": {"$all": ["paint", "wall"]}}, ["a"]),
+    ({"tags": {"$size": 0}}, ["c"]),
+    ({"tags": {"$exists": False}}, ["d"]),
+    ({"owner": {"$exists": True}}, ["a", "c"]),
+    # null matches both null and missing
+    ({"budget": None}, ["d"]),
+    ({"owner": None}, ["b", "d", "e"]),
+    # Range operators skip other types, null included
+    ({"budget": {"$gte": 40, "$lt": 80}}, ["a", "e"]),
+    ({"budget": {"$lte": 20}}, ["c"]),
+    ({"created_at": {"$gt": START + timedelta(hours=3)}}, ["e"]),
+    ({"budget": {"$not": {"$gt": 30}}}, ["c", "d"]),
+    ({"owner.city": "Munich"}, ["c"]),
+    ({"owner.city": {"$regex": "^Ber"}}, ["a"]),
+    ({"$or": [{"status": "done"}, {"budget": 80}]}, ["b", "c", "e"]),
+    ({"$and": [{"status": "posted"}, {"tags": "paint"}]}, ["a"]),
+    ({"$nor": [{"status": "done"}, {"budget": None}]}, ["a", "b"]),
+    ({"status": "posted", "$or": [{"budget": {"$gt": 50}}, {"tags": {"$exists": False}}]}, ["b", "d"]),
+])
+def test_filters(collection, filter, expected):
+    assert found(collection, filter) == expected
+    assert run(collection.count(filter)) == len(expected)
+
+
+def test_elem_match():
+    collection = MemoryEngine().collection("things", [])
+    run(collection.insert_many([
+        {"id": "x", "bids": [{"by": "a", "price": 10}, {"by": "b", "price": 50}]},
+        {"id": "y", "bids": [{"by": "a", "price": 60}]},
+    ]))
+    assert found(collection, {"bids": {"$elemMatch": {"by": "a", "price": {"$gt": 20}}}}) == ["y"]
+
+
+@pytest.mark.parametrize("sort, skip, limit, expected", [
+    ([("budget", ASCENDING)], 0, 0, ["d", "c", "a", "e", "b"]),
+    ([("budget", DESCENDING)], 1, 2, ["e", "a"]),
+    ([("status", ASCENDING), ("created_at", DESCENDING)], 0, 3, ["e", "c", "d"]),
+    ([("status", DESCENDING), ("budget", ASCENDING)], 2, 0, ["b", "c", "e"]),
+])
+def test_sort_skip_limit(collection, sort, skip, limit, expected):
+    assert ids(run(collection.find(None, sort=sort, skip=skip, limit=limit))) == expected
+
+
+def test_equality_sort_and_limit_walks_the_compound_index(collection):
+    # The feed's query shape: equality on the leading field, sorted by the second
+    newest = run(collection.find({"status": "posted"}, sort=[("created_at", DESCENDING)], skip=1, limit=1))
+    assert ids(newest) == ["b"]
+    oldest = run(collection.find({"status": "posted"}, sort=[("created_at", ASCENDING)], limit=2))
+    assert ids(oldest) == ["a", "b"]
+    # Index buckets follow updates
+    run(collection.update_one({"id": "a"}, {"$set": {"created_at": START + timedelta(days=1)}}))
+    assert ids(run(collection.find({"status": "posted"}, sort=[("created_at", DESCENDING)], limit=1))) == ["a"]
+
+
+@pytest.mark.parametrize("projection, expected", [
+    ({"id": 1, "owner.city": 1, "_id": 0}, {"id": "a", "owner": {"city": "Berlin"}}),
+    ({"_id": 0, "tags": 0, "owner": 0, "created_at": 0}, {"id": "a", "status": "posted", "budget": 40}),
+    ({"id": 1, "missing": 1, "_id": 0}, {"id": "a"}),
+])
+def test_projections(collection, projection, expected):
+    assert run(collection.find_one({"id": "a"}, projection)) == expected
+
+
+def test_projection_keeps_id_unless_excluded(collection):
+    assert set(run(collection.find_one({"id": "a"}, {"status": 1}))) == {"_id", "status"}
+
+
+def test_results_are_copies(collection):
+    document = run(collection.find_one({"id": "a"}))
+    document["tags"].append("changed")
+    assert run(collection.find_one({"id": "a"}))["tags"] == ["paint", "wall"]
+
+
+def test_update_operators(collection):
+    run(collection.update_one({"id": "a"}, {
+        "$set": {"owner.zip": "10115", "status": "done"},
+        "$unset": {"budget": ""},
+        "$inc": {"views": 2},
+        "$max": {"created_at": START - timedelta(days=1)},
+        "$min": {"rank": 3},
+        "$push": {"history": {"$each": [1, 2, 3], "$slice": -2}},
+        "$addToSet": {"tags": {"$each": ["paint", "roof"]}},
+    }))
+    document = run(collection.find_one({"id": "a"}, {"_id": 0}))
+    assert document == {
+        "id": "a",
+        "status": "done",
+        "tags": ["paint", "wall", "roof"],
+        "created_at": START,
+        "owner": {"city": "Berlin", "zip": "10115"},
+        "views": 2,
+        "rank": 3,
+        "history": [2, 3],
+    }
+    run(collection.update_one({"id": "a"}, {"$inc": {"views": -1}, "$pull": {"tags": {"$in": ["wall", "roof"]}}}))
+    assert run(collection.find_one({"id": "a"}, {"views": 1, "tags": 1, "_id": 0})) == {"views": 1, "tags": ["paint"]}
+    # The indexes follow the new values
+    assert found(collection, {"status": "done"}) == ["a", "c", "e"]
+    assert found(collection, {"tags": "wall"}) == []
+
+
+def test_update_many_and_counts(collection):
+    assert run(collection.update_many({"status": "posted"}, {"$set": {"status": "closed"}})) == 3
+    assert run(collection.update_one({"id": "zz"}, {"$set": {"status": "x"}})) == 0
+    assert found(collection, {"status": "closed"}) == ["a", "b", "d"]
+
+
+def test_upserts_seed_from_equality_and_set_on_insert():
+    collection = MemoryEngine().collection("counters", [])
+    update = {"$inc": {"value": 1}, "$max": {"peak": 5}, "$setOnInsert": {"created": "first"}}
+    run(collection.update_one({"_id": "views", "kind": "task", "value": {"$gte": 0}}, update, upsert=True))
+    run(collection.update_one({"_id": "views", "kind": "task"}, {**update, "$setOnInsert": {"created": "second"}}, upsert=True))
+    assert run(collection.find_one({"_id": "views"})) == {"_id": "views", "kind": "task", "value": 2, "peak": 5, "created": "first"}
+
+
+def test_find_one_and_update():
+    collection = MemoryEngine().collection("counters", [])
+    assert run(collection.find_one_and_update({"_id": "seq"}, {"$inc": {"value": 5}}, upsert=True)) == {"_id": "seq", "value": 5}
+    before = run(collection.find_one_and_update({"_id": "seq"}, {"$inc": {"value": 1}}, return_new=False))
+    assert before["value"] == 5
+    assert run(collection.find_one_and_update({"_id": "other"}, {"$inc": {"value": 1}})) is None
+    assert run(collection.find_one_and_update({"_id": "other"}, {"$inc": {"value": 1}}, upsert=True, return_new=False)) is None
+
+
+def test_bulk_update_counts_matches_and_upserts():
+    collection = MemoryEngine().collection("things", INDEXES)
+    run(collection.insert_one({"id": "a", "n": 1}))
+    matched = run(collection.bulk_update([
+        ({"id": "a"}, {"$inc": {"n": 1}}),
+        ({"id": "b"}, {"$set": {"n": 9}}),
+    ], upsert=True))
+    assert matched == 1
+    assert found(collection, {}, projection={"_id": 0}) == ["a", "b"]
+
+
+def test_unique_index():
+    collection = MemoryEngine().collection("things", INDEXES)
+    run(collection.insert_many(DOCUMENTS))
+    with pytest.raises(DuplicateKeyError):
+        run(collection.insert_one({"id": "a"}))
+    with pytest.raises(DuplicateKeyError):
+        run(collection.update_one({"id": "b"}, {"$set": {"id": "a"}}))
+    # The failed update left both documents as they were
+    assert found(collection, {"id": {"$in": ["a", "b"]}}) == ["a", "b"]
+
+
+def test_deletes(collection):
+    assert run(collection.delete_one({"status": "done", "budget": {"$gt": 50}})) == 1
+    assert run(collection.delete_many({"tags": "paint"})) == 1
+    assert run(collection.delete_many({"id": "nothing"})) == 0
+    assert found(collection, {}) == ["b", "c", "d"]
+    assert found(collection, {"status": "done"}) == ["c"]
+
+
+def test_aggregation_stages(collection):
+    pipeline = [
+        {"$match": {"budget": {"$ne": None}}},
+        {"$unwind": "$tags"},
+        {"$set": {
+            "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+            "cheap": {"$cond": [{"$eq": ["$status", "done"]}, 1, 0]},
+            "hours": {"$divide": [{"$subtract": ["$created_at", START]}, 3600000]},
+            "doubled": {"$multiply": ["$budget", 2]},
+            "label": {"$concat": ["$status", "-", "$tags"]},
+            "city": {"$ifNull": ["$owner.city", "unknown"]},
+        }},
+        {"$group": {
+            "_id": {"tag": "$tags"},
+            "count": {"$sum": 1},
+            "total": {"$sum": "$doubled"},
+            "average": {"$avg": "$budget"},
+            "lowest": {"$min": "$budget"},
+            "highest": {"$max": "$hours"},
+            "first": {"$first": "$label"},
+            "last": {"$last": "$city"},
+            "days": {"$push": "$day"},
+            "done": {"$sum": "$cheap"},
+            "median": {"$median": {"input": "$budget", "method": "approximate"}},
+        }},
+        {"$project": {"_id": 0, "tag": "$_id.tag", "count": 1, "total": 1, "average": 1, "lowest": 1,
+                      "highest": 1, "first": 1, "last": 1, "days": 1, "done": 1, "median": 1}},
+        {"$sort": {"count": -1, "tag": 1}},
+        {"$skip": 0},
+        {"$limit": 2},
+    ]
+    assert run(collection.aggregate(pipeline)) == [
+        {
+            "tag": "paint", "count": 2, "total": 200, "average": 50.0, "lowest": 40, "highest": 4.0,
+            "first": "posted-paint", "last": "unknown", "days": ["2024-05-01", "2024-05-01"], "done": 1, "median": 40,
+        },
+        {
+            "tag": "move", "count": 1, "total": 160, "average": 80.0, "lowest": 80, "highest": 1.0,
+            "first": "posted-move", "last": "unknown", "days": ["2024-05-01"], "done": 0, "median": 80,
+        },
+    ]
+
+
+def test_unwind_drops_missing_and_empty_arrays(collection):
+    unwound = run(collection.aggregate([{"$unwind": "$tags"}, {"$project": {"_id": 0, "id": 1}}]))
+    assert sorted(ids(unwound)) == ["a", "a", "b", "e"]
+
+
+def test_merge_into_another_collection():
+    engine = MemoryEngine()
+    source = engine.collection("tasks", [])
+    target = engine.collection("stats", [])
+    run(target.insert_one({"day": "d1", "category": "x", "posted": 9, "kept": True}))
+    run(source.insert_many([
+        {"day": "d1", "category": "x"},
+        {"day": "d1", "category": "x"},
+        {"day": "d2", "category": "y"},
+    ]))
+    group = {"$group": {"_id": {"day": "$day", "category": "$category"}, "posted": {"$sum": 1}}}
+    shape = {"$project": {"_id": 0, "day": "$_id.day", "category": "$_id.category", "posted": 1}}
+
+    assert run(source.aggregate([group, shape, {"$merge": {"into": "stats", "on": ["day", "category"]}}])) == []
+    rows = run(target.find({}, {"_id": 0}, sort=[("day", ASCENDING)]))
+    # whenMatched "merge" keeps fields the pipeline didn't produce
+    assert rows == [{"day": "d1", "category": "x", "posted": 2, "kept": True}, {"day": "d2", "category": "y", "posted": 1}]
+
+    run(source.aggregate([group, shape, {"$merge": {"into": "stats", "on": ["day", "category"], "whenMatched": "replace"}}]))
+    assert run(target.find_one({"day": "d1"}, {"_id": 0})) == {"day": "d1", "category": "x", "posted": 2}
+
+
+def test_values_are_stored_like_bson():
+    collection = MemoryEngine().collection("things", [])
+    run(collection.insert_one({"id": "a", "at": datetime(2024, 5, 1, 12, 0, 0, 123456), "pair": (1, 2)}))
+    document = run(collection.find_one({"id": "a"}, {"_id": 0}))
+    assert document == {"id": "a", "at": datetime(2024, 5, 1, 12, 0, 0, 123000), "pair": [1, 2]}
+
+
+def test_unsupported_operators_fail_loudly(collection):
+    with pytest.raises(ValueError):
+        run(collection.find({"budget": {"$mod": [2, 0]}}))
+    with pytest.raises(ValueError):
+        run(collection.update_one({"id": "a"}, {"$rename": {"budget": "price"}}))
+    with pytest.raises(ValueError):
+        run(collection.aggregate([{"$lookup": {"from": "other"}}]))
@@ -0,0 +1,108 @@
+"""Presence: geohash cells, registry searches and profile edits."""
+import time
+
+import pytest
+
+import presence
+
+NOW = 1_700_000_000.0
+LATER = NOW + 60
+
+
+def registry(*taskers, precision=6) -> presence.PresenceRegistry:
+    online = presence.PresenceRegistry(precision)
+    for user_id, latitude, longitude, skills in taskers:
+        online.update(user_id, latitude, longitude, skills, LATER)
+    return online
+
+
+def nearby_ids(online, latitude, longitude, radius_km, **options):
+    return [found["id"] for found in online.nearby(latitude, longitude, radius_km, now=NOW, **options)]
+
+
+def test_geohash_matches_the_reference_encoding():
+    assert presence.geohash(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    south, west, north, east = presence.cell_bounds("u4pruydqqvj")
+    assert south <= 57.64911 < north and west <= 10.40744 < east
+
+
+@pytest.mark.parametrize("latitude, longitude", [(52.52, 13.405), (-33.86, 151.2), (0.0, 0.0), (89.99, -179.99)])
+def test_cells_contain_their_points(latitude, longitude):
+    cell = presence.geohash(latitude, longitude)
+    south, west, north, east = presence.cell_bounds(cell)
+    assert south <= latitude <= north and west <= longitude <= east
+
+
+def test_nearest_first_within_radius():
+    online = registry(
+        ("near", 52.5201, 13.4051, []),
+        ("farther", 52.53, 13.41, []),
+        ("outside", 52.60, 13.60, []),
+    )
+    assert nearby_ids(online, 52.52, 13.405, 5) == ["near", "farther"]
+    assert nearby_ids(online, 52.52, 13.405, 5, limit=1) == ["near"]
+    # A wide search uses coarser cells and still finds everyone
+    assert nearby_ids(online, 52.52, 13.405, 50) == ["near", "farther", "outside"]
+
+
+def test_search_across_the_antimeridian():
+    online = registry(("east", -16.5, 179.99, []), ("west", -16.5, -179.99, []))
+    assert sorted(nearby_ids(online, -16.5, 179.995, 5)) == ["east", "west"]
+    assert sorted(nearby_ids(online, -16.5, -179.995, 5)) == ["east", "west"]
+
+
+def test_search_near_the_poles():
+    # Near a pole the circle spans many longitudes
+    online = registry(("a", 89.99, 0.0, []), ("b", 89.99, 120.0, []), ("c", 89.99, -120.0, []), ("far", 89.0, 0.0, []))
+    assert sorted(nearby_ids(online, 90.0, 0.0, 5)) == ["a", "b", "c"]
+    online = registry(("south", -89.995, 45.0, []))
+    assert nearby_ids(online, -89.995, -135.0, 2) == ["south"]
+
+
+def test_expired_entries_are_skipped_then_swept():
+    online = registry(("fresh", 52.52, 13.405, []))
+    online.update("stale", 52.52, 13.405, [], NOW - 1)
+    assert nearby_ids(online, 52.52, 13.405, 1) == ["fresh"]
+    assert online.get("stale", now=NOW) is None
+    assert online.online(now=NOW) == 1
+    assert online.sweep(now=NOW) == 1
+    assert len(online) == 1
+    assert online.sweep(now=LATER) == 1
+    assert len(online) == 0 and online.cells() == 0
+
+
+def test_skill_filter_ignores_case():
+    online = registry(("painter", 52.52, 13.405, ["Painting", "Moving"]), ("cleaner", 52.52, 13.405, ["cleaning"]))
+    assert nearby_ids(online, 52.52, 13.405, 1, skill="painting") == ["painter"]
+    assert nearby_ids(online, 52.52, 13.405, 1, skill="CLEANING") == ["cleaner"]
+    assert nearby_ids(online, 52.52, 13.405, 1, skill="plumbing") == []
+
+
+def test_moving_between_cells_leaves_the_old_one():
+    online = registry(("tasker", 52.52, 13.405, []))
+    online.update("tasker", 48.137, 11.575, [], LATER)
+    assert nearby_ids(online, 52.52, 13.405, 5) == []
+    assert nearby_ids(online, 48.137, 11.575, 5) == ["tasker"]
+    online.remove("tasker")
+    assert online.cells() == 0
+
+
+def test_profile_edits_reach_online_taskers(client, make_user):
+    tasker = make_user("tasker", skills=["painting"])
+    heartbeat = client.post(f"/api/taskers/{tasker['id']}/heartbeat", json={"latitude": 52.52, "longitude": 13.405})
+    assert heartbeat.status_code == 200, heartbeat.text
+
+    def online(skill):
+        response = client.get("/api/taskers/online", params={"lat": 52.52, "lng": 13.405, "skill": skill})
+        return [found["id"] for found in response.json()["taskers"]]
+
+    assert online("painting") == [tasker["id"]]
+    client.put(f"/api/users/{tasker['id']}", json={"skills": ["plumbing"]})
+    assert online("painting") == []
+    assert online("plumbing") == [tasker["id"]]
+    # A skills edit is not a heartbeat
+    entry = client.app.state.presence.registry.get(tasker["id"])
+    assert entry.expires_at <= time.time() + client.app.state.presence.ttl
+
+    client.put(f"/api/users/{tasker['id']}", json={"role": "client"})
+    assert online("plumbing") == []
@@ -0,0 +1,80 @@
+"""Token buckets, shared GCRA buckets and the limiter's choice of keys."""
+import asyncio
+
+import pytest
+
+import ratelimit
+from storage import create_storage
+
+
+def scope(path="/api/messages", method="POST", user=None, address="10.0.0.1"):
+    headers = [(b"x-user-id", user.encode())] if user else []
+    return {"type": "http", "method": method, "path": path, "headers": headers, "client": (address, 40000)}
+
+
+def test_memory_bucket_refills_at_rate():
+    buckets = ratelimit.MemoryBuckets()
+    assert [buckets.take("k", 2, 3, 0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert buckets.take("k", 2, 3, 0.0) == pytest.approx(0.5)
+    assert buckets.take("k", 2, 3, 0.5) == 0.0
+    assert buckets.take("k", 2, 3, 0.5) > 0
+
+
+def test_memory_buckets_are_capped_in_lru_order():
+    buckets = ratelimit.MemoryBuckets(max_buckets=3)
+    for key in ("a", "b", "c"):
+        buckets.take(key, 1, 1, 0.0)
+    buckets.take("a", 1, 1, 0.0)  # a is now the most recently used
+    buckets.take("d", 1, 1, 0.0)
+    assert len(buckets) == 3 and buckets.evicted == 1
+    # a kept its (empty) bucket; b was dropped and starts full again
+    assert buckets.take("a", 1, 1, 0.0) > 0
+    assert buckets.take("b", 1, 1, 0.0) == 0.0
+
+
+def test_gcra_store_allows_burst_then_paces():
+    async def run():
+        store = create_storage(backend="memory").rate_limits
+        waits = [await store.take("k", 2, 3, 100.0) for _ in range(4)]
+        assert waits[:3] == [0.0, 0.0, 0.0]
+        assert waits[3] == pytest.approx(0.5)
+        assert await store.take("k", 2, 3, 100.5) == 0.0
+        assert await store.take("other", 2, 3, 100.0) == 0.0
+    asyncio.run(run())
+
+
+def test_route_rule_limits_per_user():
+    limiter = ratelimit.Limiter(ratelimit.parse_rules("POST /api/messages 1 2"), max_loop_lag_ms=0)
+
+    async def run():
+        results = [await limiter.check(scope(user="alice")) for _ in range(3)]
+        assert results[:2] == [None, None]
+        assert results[2][0] == "POST /api/messages"
+        assert await limiter.check(scope(user="bob")) is None
+    asyncio.run(run())
+
+
+def test_claimed_users_cannot_escape_the_address_limit():
+    limiter = ratelimit.Limiter(ratelimit.parse_rules("POST /api/messages 1 2"), max_loop_lag_ms=0, address_factor=2)
+
+    async def run():
+        # A fresh made-up user each time still draws from the address's route bucket (2 x 2)
+        results = [await limiter.check(scope(user=f"user-{n}")) for n in range(5)]
+        assert results[:4] == [None] * 4
+        assert results[4][0] == "POST /api/messages"
+        assert await limiter.check(scope(user="someone", address="10.0.0.2")) is None
+    asyncio.run(run())
+
+
+def test_address_all_routes_bucket():
+    limiter = ratelimit.Limiter([], default_rate=1, default_burst=3, max_loop_lag_ms=0, address_factor=1)
+
+    async def run():
+        results = [await limiter.check(scope("/api/tasks", "GET", user=f"u{n}")) for n in range(4)]
+        assert results[:3] == [None] * 3 and results[3][0] == "*"
+    asyncio.run(run())
+
+
+def test_client_keys():
+    assert ratelimit.Limiter.client_keys(scope("/api/users/abc/location", "PUT")) == ("addr:10.0.0.1", "user:abc")
+    assert ratelimit.Limiter.client_keys(scope("/api/tasks", "GET")) == ("addr:10.0.0.1", None)
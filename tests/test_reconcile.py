@@ -0,0 +1,216 @@
+"""Reconciliation: merge-join findings, corrections and reruns."""
+import asyncio
+import csv
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import reconcile
+from storage import create_storage
+
+SINCE = datetime(2024, 5, 1)
+UNTIL = SINCE + timedelta(days=1)
+
+# (gateway id, amount, our status) per payment in the range
+PAYMENTS = [
+    ("pi_a", 10.0, "pending"),
+    ("pi_b", 20.0, "completed"),
+    ("pi_c", 30.0, "pending"),
+    ("pi_d", 40.0, "completed"),
+    ("pi_e", 50.0, "pending"),
+    ("pi_f", 60.0, "pending"),
+    ("pi_g", 70.0, "completed"),
+    ("pi_g", 70.0, "completed"),
+    ("pi_h", 80.0, "completed"),
+    (reconcile.PLACEHOLDER_GATEWAY_ID, 90.0, "pending"),
+]
+SETTLEMENT = [
+    ("pi_a", "10.00", "settled"),
+    ("pi_b", "20.00", "Settled"),
+    ("pi_c", "31.00", "settled"),
+    ("pi_d", "40.00", "pending"),
+    ("pi_e", "50.00", "chargeback"),
+    ("pi_g", "70.00", "settled"),
+    ("pi_h", "80.00", "settled"),
+    ("pi_h", "80.00", "settled"),
+    ("pi_x", "5.00", "settled"),
+    ("pi_y", "7.50", "settled"),
+]
+FINDINGS = {
+    "amount_mismatch": 1,
+    "status_mismatch": 1,
+    "unknown_status": 1,
+    "missing_at_gateway": 1,
+    "duplicate_local": 1,
+    "duplicate_at_gateway": 1,
+    "missing_locally": 1,
+}
+
+
+def payment(gateway_id: str, amount: float, status: str, created_at: datetime) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "gateway_payment_id": gateway_id,
+        "amount": amount,
+        "status": status,
+        "created_at": created_at,
+    }
+
+
+async def seeded(encoding: str):
+    storage = create_storage(backend="memory", encoding=encoding)
+    await storage.payments.insert_many(
+        [payment(*fields, SINCE + timedelta(minutes=n)) for n, fields in enumerate(PAYMENTS)]
+        # Settled in this file, but created the day before
+        + [payment("pi_y", 7.5, "completed", SINCE - timedelta(hours=1))]
+    )
+    return storage
+
+
+def write_settlement(path, rows):
+    with path.open("w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(reconcile.FIELDS)
+        writer.writerows(rows)
+    return path
+
+
+async def reconcile_file(storage, path, **options):
+    reconciler = reconcile.Reconciler(storage, SINCE, UNTIL, batch=2, **options)
+    await reconciler.payments(reconcile.read_settlement(path))
+    return reconciler
+
+
+@pytest.mark.parametrize("encoding", ["plain", "compact"])
+def test_findings_and_corrections(tmp_path, encoding):
+    path = write_settlement(tmp_path / "settlement.csv", SETTLEMENT)
+
+    async def run():
+        storage = await seeded(encoding)
+        reconciler = await reconcile_file(storage, path)
+        found = await storage.payment_discrepancies.find(limit=0)
+        corrected = await storage.payments.find_one({"gateway_payment_id": "pi_a"})
+        return reconciler.counts, found, corrected
+
+    counts, found, corrected = asyncio.run(run())
+    assert {kind: counts[kind] for kind in FINDINGS} == FINDINGS
+    assert counts["corrected"] == 1
+    assert counts["matched"] == 3
+    assert counts["outside_range"] == 1
+    assert counts["without_gateway_id"] == 1
+    assert counts["correction_conflicts"] == 0
+    assert sorted(finding["kind"] for finding in found) == sorted(FINDINGS)
+    assert corrected["status"] == "completed"
+    assert corrected["reconciled_at"]
+
+    mismatch = next(finding for finding in found if finding["kind"] == "amount_mismatch")
+    assert (mismatch["gateway_payment_id"], mismatch["amount"], mismatch["gateway_amount"]) == ("pi_c", 30.0, 31.0)
+
+
+def test_dry_run_counts_without_writing(tmp_path):
+    path = write_settlement(tmp_path / "settlement.csv", SETTLEMENT)
+
+    async def run():
+        storage = await seeded("plain")
+        reconciler = await reconcile_file(storage, path, dry_run=True)
+        return (
+            reconciler.counts,
+            await storage.payment_discrepancies.count(),
+            await storage.payments.find_one({"gateway_payment_id": "pi_a"}),
+        )
+
+    counts, discrepancies, untouched = asyncio.run(run())
+    assert {kind: counts[kind] for kind in FINDINGS} == FINDINGS
+    assert counts["corrected"] == 1
+    assert discrepancies == 0
+    assert untouched["status"] == "pending"
+
+
+def test_rerun_updates_the_same_findings(tmp_path):
+    path = write_settlement(tmp_path / "settlement.csv", SETTLEMENT)
+
+    async def run():
+        storage = await seeded("plain")
+        first = await reconcile_file(storage, path)
+        before = {finding["id"]: finding for finding in await storage.payment_discrepancies.find(limit=0)}
+        second = await reconcile_file(storage, path)
+        after = await storage.payment_discrepancies.find(limit=0)
+        return first, before, second, after
+
+    first, before, second, after = asyncio.run(run())
+    # The correction is in; the payment now simply matches
+    assert second.counts["corrected"] == 0
+    assert second.counts["matched"] == first.counts["matched"] + 1
+    assert len(after) == len(before)
+    for finding in after:
+        assert finding["first_seen_at"] == before[finding["id"]]["first_seen_at"]
+        assert finding["run_id"] == second.run_id
+
+
+def test_recent_payments_get_a_grace_period(tmp_path):
+    path = write_settlement(tmp_path / "settlement.csv", [])
+
+    async def run():
+        storage = create_storage(backend="memory")
+        await storage.payments.insert_many([payment("pi_new", 5.0, "pending", datetime.utcnow())])
+        reconciler = reconcile.Reconciler(storage, SINCE, datetime.utcnow() + timedelta(days=1))
+        await reconciler.payments(reconcile.read_settlement(path))
+        return reconciler.counts, await storage.payment_discrepancies.count()
+
+    counts, discrepancies = asyncio.run(run())
+    assert counts["awaiting_settlement"] == 1
+    assert discrepancies == 0
+
+
+def test_unsorted_settlement_is_rejected_or_sorted(tmp_path):
+    shuffled = write_settlement(tmp_path / "settlement.csv", SETTLEMENT[::-1])
+    with pytest.raises(reconcile.SettlementError, match="out of gateway_payment_id order"):
+        reconcile.check_sorted(reconcile.read_settlement(shuffled))
+
+    async def run():
+        storage = await seeded("plain")
+        reconciler = reconcile.Reconciler(storage, SINCE, UNTIL, batch=2)
+        await reconciler.payments(reconcile.sort_rows(reconcile.read_settlement(shuffled), 3, str(tmp_path)))
+        return reconciler.counts
+
+    counts = asyncio.run(run())
+    assert {kind: counts[kind] for kind in FINDINGS} == FINDINGS
+
+
+def test_ndjson_and_bad_rows(tmp_path):
+    ndjson = tmp_path / "settlement.ndjson"
+    ndjson.write_text('{"gateway_payment_id": "pi_a", "amount": 10.1, "status": "SETTLED"}\n\n')
+    assert list(reconcile.read_settlement(ndjson)) == [{"gateway_payment_id": "pi_a", "amount": 1010, "status": "settled"}]
+
+    broken = tmp_path / "broken.csv"
+    broken.write_text("gateway_payment_id,amount,status\npi_a,ten,settled\n")
+    with pytest.raises(reconcile.SettlementError, match="row 1"):
+        list(reconcile.read_settlement(broken))
+
+
+def test_wallet_balances_against_ledger():
+    async def run():
+        storage = create_storage(backend="memory")
+        accounts = [
+            {"id": str(uuid.uuid4()), "user_id": str(uuid.uuid4()), "type": "neobank_wallet", "wallet_balance": balance}
+            for balance in (7.25, 9.0, 0.0)
+        ]
+        await storage.payment_accounts.insert_many(accounts)
+        entries = [(accounts[0], 10.5), (accounts[0], -3.25), (accounts[1], 10.0)]
+        # The ledger of an account that no longer exists
+        entries.append(({"id": "0" * 32}, 1.0))
+        await storage.wallet_ledger.insert_many([
+            {"id": str(uuid.uuid4()), "account_id": account["id"], "amount": amount, "created_at": SINCE + timedelta(minutes=n)}
+            for n, (account, amount) in enumerate(entries)
+        ])
+        reconciler = reconcile.Reconciler(storage, SINCE, UNTIL)
+        await reconciler.wallets()
+        return accounts, reconciler.counts, await storage.payment_discrepancies.find(limit=0)
+
+    accounts, counts, found = asyncio.run(run())
+    assert counts["wallets"] == 3
+    assert counts["orphan_ledger_entries"] == 1
+    assert [(finding["account_id"], finding["wallet_balance"], finding["ledger_balance"]) for finding in found] == [
+        (accounts[1]["id"], 9.0, 10.0)
+    ]
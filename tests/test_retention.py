@@ -0,0 +1,73 @@
+"""Retention: which closed threads get archived, and who runs the passes."""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import retention
+from storage import create_storage
+
+OLD = datetime.utcnow() - timedelta(days=90)
+RECENT = datetime.utcnow() - timedelta(days=1)
+
+
+def task(status: str, **fields) -> dict:
+    return {"id": str(uuid.uuid4()), "title": status, "status": status, "updated_at": RECENT, **fields}
+
+
+async def archived_titles(tasks) -> set:
+    storage = create_storage(backend="memory")
+    await storage.tasks.untracked.insert_many(tasks)
+    await retention.archive_closed_threads(storage, older_than_days=30)
+    return {found["title"] for found in await storage.tasks.find({"messages_archived_at": {"$exists": True}})}
+
+
+def test_cancelled_threads_age_from_cancellation():
+    async def run():
+        return await archived_titles([
+            # Touched since, but cancelled long ago
+            task("cancelled", title="old cancel", cancelled_at=OLD),
+            # Written long ago, but only just cancelled
+            task("cancelled", title="new cancel", cancelled_at=RECENT, updated_at=OLD),
+            task("completed", title="old completion", completed_at=OLD),
+            task("completed", title="new completion", completed_at=RECENT),
+        ])
+
+    assert asyncio.run(run()) == {"old cancel", "old completion"}
+
+
+def test_cancellations_without_timestamp_fall_back_to_last_write():
+    async def run():
+        return await archived_titles([
+            task("cancelled", title="legacy old", updated_at=OLD),
+            task("cancelled", title="legacy null", cancelled_at=None, updated_at=OLD),
+            task("cancelled", title="legacy recent"),
+        ])
+
+    assert asyncio.run(run()) == {"legacy old", "legacy null"}
+
+
+def test_passes_wait_for_the_lease(monkeypatch):
+    passes = []
+
+    async def fake_retention(storage):
+        passes.append(storage)
+
+    monkeypatch.setattr(retention, "run_retention", fake_retention)
+
+    async def run_for(storage, owner):
+        worker = asyncio.create_task(retention.run_periodically(storage, interval=0.01, owner=owner))
+        await asyncio.sleep(0.05)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+    async def run():
+        storage = create_storage(backend="memory")
+        assert await storage.leases.acquire(retention.LEASE_NAME, "other-pod", 60)
+        await run_for(storage, "this-pod")
+        skipped = len(passes)
+        await storage.leases.release(retention.LEASE_NAME, "other-pod")
+        await run_for(storage, "this-pod")
+        return skipped
+
+    assert asyncio.run(run()) == 0
+    assert passes
@@ -0,0 +1,112 @@
+"""Scheduler: planned event times and what each event does when it fires."""
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import scheduler
+from storage import create_storage
+
+NOW = datetime(2024, 5, 1, 12, 0, 0)
+
+
+def test_unscheduled_tasks_only_expire():
+    task = {"priority": "normal", "created_at": NOW, "scheduled_time": NOW + timedelta(days=3)}
+    assert scheduler.plan(task, NOW) == {"expire_at": NOW + scheduler.POSTED_TTL}
+    assert scheduler.plan({"priority": "scheduled", "created_at": NOW}, NOW) == {"expire_at": NOW + scheduler.POSTED_TTL}
+
+
+def test_scheduled_tasks_surface_remind_and_expire_around_their_time():
+    at = NOW + timedelta(days=3)
+    assert scheduler.plan({"priority": "scheduled", "created_at": NOW, "scheduled_time": at}, NOW) == {
+        "surface_at": at - scheduler.SURFACE_LEAD,
+        "remind_at": at - scheduler.REMINDER_LEAD,
+        "expire_at": at + scheduler.EXPIRE_GRACE,
+    }
+
+
+def test_lead_times_already_passed_are_left_out():
+    # Inside the surface lead: the task is in the feed straight away
+    at = NOW + scheduler.SURFACE_LEAD - timedelta(minutes=1)
+    assert set(scheduler.plan({"priority": "scheduled", "created_at": NOW, "scheduled_time": at}, NOW)) == {
+        "remind_at", "expire_at",
+    }
+    at = NOW + scheduler.REMINDER_LEAD - timedelta(minutes=1)
+    assert scheduler.plan({"priority": "scheduled", "created_at": NOW, "scheduled_time": at}, NOW) == {
+        "expire_at": at + scheduler.EXPIRE_GRACE,
+    }
+
+
+def test_offsets_are_converted_to_naive_utc():
+    local = datetime(2024, 5, 4, 14, 0, 0, tzinfo=timezone(timedelta(hours=2)))
+    events = scheduler.plan({"priority": "scheduled", "created_at": NOW, "scheduled_time": local}, NOW)
+    assert events["expire_at"] == datetime(2024, 5, 4, 12, 0, 0) + scheduler.EXPIRE_GRACE
+    assert events["expire_at"].tzinfo is None
+
+
+def task(status: str = "posted", **events) -> dict:
+    return {"id": str(uuid.uuid4()), "status": status, "created_at": NOW, **events}
+
+
+async def fields_of(storage, task_id: str) -> dict:
+    return (await storage.tasks.find({"id": task_id}, {"_id": 0}))[0]
+
+
+def test_due_events_fire_once_and_clear_their_fields():
+    async def run():
+        storage = create_storage(backend="memory")
+        past, future = datetime.utcnow() - timedelta(minutes=1), datetime.utcnow() + timedelta(days=1)
+        surfacing = task(surface_at=past, remind_at=future, expire_at=future)
+        reminding = task(remind_at=past, expire_at=future)
+        expiring = task(surface_at=future, remind_at=future, expire_at=past)
+        accepted = task("assigned", expire_at=past)
+        await storage.tasks.insert_many([surfacing, reminding, expiring, accepted])
+
+        service = scheduler.Scheduler(storage)
+        await service._tick()
+        found = {name: await fields_of(storage, document["id"]) for name, document in [
+            ("surfacing", surfacing), ("reminding", reminding), ("expiring", expiring), ("accepted", accepted),
+        ]}
+        # Firing again is harmless: the fields are gone
+        await service._fire("surface_at", surfacing["id"], datetime.utcnow())
+        return found, await fields_of(storage, surfacing["id"]), service.stats()
+
+    found, refired, stats = asyncio.run(run())
+    surfacing = found["surfacing"]
+    assert "surface_at" not in surfacing and surfacing["surfaced_at"]
+    assert "remind_at" in surfacing and "expire_at" in surfacing
+    assert "remind_at" not in found["reminding"] and found["reminding"]["reminder_sent_at"]
+    expiring = found["expiring"]
+    assert expiring["status"] == "expired" and expiring["expired_at"]
+    assert not {"surface_at", "remind_at", "expire_at"} & set(expiring)
+    # A task that moved on before expiring keeps its status and loses the event
+    assert found["accepted"]["status"] == "assigned" and "expire_at" not in found["accepted"]
+    assert "expired_at" not in found["accepted"]
+    assert refired["surfaced_at"] == surfacing["surfaced_at"]
+    assert stats["fired"] == {"surface_at": 1, "remind_at": 1, "expire_at": 1}
+    assert stats["queued"] == 0
+
+
+def test_tasks_created_after_the_load_join_the_heap():
+    async def run():
+        storage = create_storage(backend="memory")
+        service = scheduler.Scheduler(storage)
+        wake_at = await service._tick()
+        assert wake_at == service.loaded_until and service.stats()["queued"] == 0
+
+        soon = datetime.utcnow() + timedelta(milliseconds=20)
+        later = service.loaded_until + timedelta(hours=1)
+        created = task(remind_at=soon, expire_at=later)
+        await storage.tasks.insert_many([created])
+        service.schedule(created)
+        assert service._wake.is_set()
+        # The expiry falls after the loaded bucket; the next load takes it
+        assert service.stats()["queued"] == 1
+
+        await asyncio.sleep(0.03)
+        await service._tick()
+        return await fields_of(storage, created["id"]), service.stats()
+
+    found, stats = asyncio.run(run())
+    assert found["reminder_sent_at"] and "remind_at" not in found
+    assert found["status"] == "posted" and "expire_at" in found
+    assert stats["fired"]["remind_at"] == 1 and stats["queued"] == 0
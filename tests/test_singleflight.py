@@ -0,0 +1,139 @@
+"""Single-flight: identical concurrent reads share one call."""
+import asyncio
+
+import pytest
+
+from deadlines import Deadline
+from singleflight import SingleFlight
+from storage import DeadlineExceeded, current_deadline
+
+
+class Source:
+    """Counts calls; each one waits until the test lets it finish."""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = asyncio.Event()
+
+    async def read(self):
+        self.calls += 1
+        call = self.calls
+        await self.gate.wait()
+        return {"call": call}
+
+
+def test_concurrent_callers_share_one_call():
+    async def run():
+        flight, source = SingleFlight(), Source()
+        readers = [asyncio.ensure_future(flight.do("task:1", source.read)) for _ in range(5)]
+        other = asyncio.ensure_future(flight.do("task:2", source.read))
+        await asyncio.sleep(0)
+        source.gate.set()
+        results = await asyncio.gather(*readers)
+        await other
+        # Nothing is kept once the call completes
+        later = await flight.do("task:1", source.read)
+        return flight, source, results, later
+
+    flight, source, results, later = asyncio.run(run())
+    assert results == [{"call": 1}] * 5
+    assert source.calls == 3
+    assert later == {"call": 3}
+    assert flight.stats() == {
+        "enabled": True,
+        "calls": 7,
+        "executions": 3,
+        "coalesced": 4,
+        "coalescing_ratio": round(4 / 7, 4),
+        "inflight": 0,
+    }
+
+
+def test_forget_starts_a_fresh_call():
+    async def run():
+        flight, source = SingleFlight(), Source()
+        before = asyncio.ensure_future(flight.do("task:1", source.read))
+        await asyncio.sleep(0)
+        # A write landed; the call in flight may predate it
+        flight.forget("task:1")
+        after = asyncio.ensure_future(flight.do("task:1", source.read))
+        await asyncio.sleep(0)
+        source.gate.set()
+        return await before, await after
+
+    assert asyncio.run(run()) == ({"call": 1}, {"call": 2})
+
+
+def test_errors_reach_every_caller_and_are_not_kept():
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        await asyncio.sleep(0)
+        raise RuntimeError("storage down")
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", failing) for _ in range(3)), return_exceptions=True)
+        with pytest.raises(RuntimeError):
+            await flight.do("key", failing)
+        return results
+
+    results = asyncio.run(run())
+    assert [type(result) for result in results] == [RuntimeError] * 3
+    assert len(attempts) == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    async def run():
+        flight, source = SingleFlight(), Source()
+        leaving = asyncio.ensure_future(flight.do("key", source.read))
+        staying = asyncio.ensure_future(flight.do("key", source.read))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        await asyncio.sleep(0)
+        source.gate.set()
+        return leaving, await staying, source
+
+    leaving, result, source = asyncio.run(run())
+    assert leaving.cancelled()
+    assert result == {"call": 1}
+    assert source.calls == 1
+
+
+def test_disabled_runs_every_call():
+    async def run():
+        flight, source = SingleFlight(enabled=False), Source()
+        source.gate.set()
+        results = await asyncio.gather(*(flight.do("key", source.read) for _ in range(3)))
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert results == [{"call": 1}, {"call": 2}, {"call": 3}]
+    assert flight.stats()["coalesced"] == 0
+
+
+def test_short_deadline_does_not_fail_the_shared_call():
+    seen = []
+
+    async def slow():
+        seen.append(current_deadline.get())
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def caller(flight, budget_ms):
+        current_deadline.set(Deadline(budget_ms, "header"))
+        return await flight.do("key", slow)
+
+    async def run():
+        flight = SingleFlight()
+        impatient = asyncio.ensure_future(caller(flight, 10))
+        await asyncio.sleep(0)
+        patient = asyncio.ensure_future(caller(flight, 5000))
+        return await asyncio.gather(impatient, patient, return_exceptions=True)
+
+    impatient, patient = asyncio.run(run())
+    assert isinstance(impatient, DeadlineExceeded)
+    assert impatient.stage == "single_flight"
+    assert patient == "done"
+    assert seen == [None]
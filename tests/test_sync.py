@@ -0,0 +1,148 @@
+"""Delta sync: paging by sequence, tombstones and the settle window."""
+import pytest
+
+import backfill_sync
+import server
+
+
+def sync(client, user_id: str, since: str = None, **params) -> dict:
+    response = client.get("/api/sync", params={"user_id": user_id, "since": since, **params})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def sync_all(client, user_id: str, since: str = None, limit: int = 2):
+    """Follow pages until has_more is off; returns the pages and the final token."""
+    pages = []
+    while True:
+        page = sync(client, user_id, since, limit=limit)
+        pages.append(page)
+        assert int(page["next_token"]) >= int(since or 0)
+        since = page["next_token"]
+        if not page["has_more"]:
+            return pages, since
+
+
+def delete_task(client, task_id: str):
+    client.portal.call(client.app.state.storage.tasks.delete_one, {"id": task_id})
+
+
+@pytest.fixture
+def settled(monkeypatch):
+    monkeypatch.setattr(server, "SYNC_SETTLE_SECONDS", 0)
+
+
+def test_pages_cover_changes_and_tombstones_once(settled, client, make_user, make_task):
+    owner = make_user()["id"]
+    tasks = [make_task(owner)["id"] for _ in range(5)]
+    make_task()  # someone else's, outside this user's sync without the feed
+    for task_id in tasks[:2]:
+        delete_task(client, task_id)
+
+    pages, token = sync_all(client, owner)
+    seen = [task["id"] for page in pages for task in page["tasks"]]
+    gone = [tombstone["id"] for page in pages for tombstone in page["tombstones"]]
+    assert len(pages) > 1
+    assert sorted(seen) == sorted(tasks[2:])
+    assert sorted(gone) == sorted(tasks[:2])
+
+    # Nothing new: an empty page and the same token
+    empty = sync(client, owner, token)
+    assert empty["next_token"] == token
+    assert not any(empty[section] for section in ("tasks", "bids", "messages", "reviews", "tombstones"))
+
+    # Later changes arrive from the token on
+    assert client.put(f"/api/tasks/{tasks[2]}/cancel").status_code == 200
+    delete_task(client, tasks[3])
+    pages, _ = sync_all(client, owner, token)
+    assert [task["id"] for page in pages for task in page["tasks"]] == [tasks[2]]
+    assert [tombstone["id"] for page in pages for tombstone in page["tombstones"]] == [tasks[3]]
+
+
+def test_pages_cut_every_section_at_one_point(settled, client, make_user, make_task):
+    owner = make_user()["id"]
+    tasks = [make_task(owner)["id"] for _ in range(3)]
+    delete_task(client, tasks[0])
+    later = make_task(owner)["id"]
+
+    # With one item per section, the tombstone fills its section long before
+    # the tasks are through; it must still arrive exactly once, in order
+    pages, _ = sync_all(client, owner, limit=1)
+    changes = [
+        (section, change["id"]) for page in pages for section in ("tasks", "tombstones") for change in page[section]
+    ]
+    assert changes == [
+        ("tasks", tasks[1]),
+        ("tasks", tasks[2]),
+        ("tombstones", tasks[0]),
+        ("tasks", later),
+    ]
+
+
+def test_final_page_holds_back_unsettled_changes(client, make_user, make_task):
+    owner = make_user()["id"]
+    task_id = make_task(owner)["id"]
+
+    first = sync(client, owner)
+    assert [task["id"] for task in first["tasks"]] == [task_id]
+    # Still inside the settle window, so it is sent again
+    again = sync(client, owner, first["next_token"])
+    assert [task["id"] for task in again["tasks"]] == [task_id]
+
+
+@pytest.mark.parametrize("token", ["abc", "-1"])
+def test_invalid_token(client, token):
+    response = client.get("/api/sync", params={"user_id": "someone", "since": token})
+    assert response.status_code == 400
+
+
+def test_bids_on_own_tasks_and_only_own_tombstones(settled, client, make_user, make_task):
+    owner, tasker, stranger = make_user()["id"], make_user("tasker")["id"], make_user()["id"]
+    task_id = make_task(owner)["id"]
+    bid = client.post("/api/task-bids", json={
+        "task_id": task_id, "tasker_id": tasker, "proposed_price": 50, "message": "Today",
+    })
+    assert bid.status_code == 200, bid.text
+    assert bid.json()["client_id"] == owner
+    client.portal.call(client.app.state.storage.task_bids.delete_one, {"id": bid.json()["id"]})
+
+    for user_id in (owner, tasker):
+        pages, _ = sync_all(client, user_id)
+        assert [tombstone["id"] for page in pages for tombstone in page["tombstones"]] == [bid.json()["id"]]
+    pages, _ = sync_all(client, stranger)
+    assert not any(page["tombstones"] or page["tasks"] for page in pages)
+    # With the feed, task changes and deletions of everyone's tasks come along
+    delete_task(client, task_id)
+    feed = sync(client, stranger, feed=True)
+    assert [tombstone["id"] for tombstone in feed["tombstones"]] == [task_id]
+
+
+def test_bid_on_missing_task(client, make_user):
+    response = client.post("/api/task-bids", json={
+        "task_id": "missing", "tasker_id": make_user("tasker")["id"], "proposed_price": 50, "message": "Today",
+    })
+    assert response.status_code == 404
+
+
+def test_backfill_brings_older_documents_into_sync(settled, client, make_user):
+    owner, tasker = make_user()["id"], make_user("tasker")["id"]
+    storage = client.app.state.storage
+    task = server.Task(
+        title="Old task", description="From before sync", category="handyman", client_id=owner,
+        location={"latitude": 52.52, "longitude": 13.405}, budget_min=40, budget_max=80,
+    ).dict()
+    bid = server.TaskBid(task_id=task["id"], tasker_id=tasker, proposed_price=50, message="Today").dict()
+    del bid["client_id"]
+    client.portal.call(storage.tasks.untracked.insert, task)
+    client.portal.call(storage.task_bids.untracked.insert, bid)
+    assert not sync(client, owner)["tasks"]
+
+    totals = client.portal.call(backfill_sync.backfill, storage)
+    assert totals["tasks"] == 1 and totals["task_bids"] == 1 and totals["task_bids.client_id"] == 1
+
+    page = sync(client, owner)
+    assert [found["id"] for found in page["tasks"]] == [task["id"]]
+    assert [found["id"] for found in page["bids"]] == [bid["id"]]
+    assert page["tasks"][0]["version"] == 0
+    # Nothing left to do on a rerun
+    assert not any(client.portal.call(backfill_sync.backfill, storage).values())